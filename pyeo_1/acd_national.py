@@ -2,15 +2,16 @@ import configparser
 import glob
 import logging
 import os
+import shlex
 import subprocess
 import sys
-import time
+from multiprocessing.dummy import Pool
 from tempfile import TemporaryDirectory
 
 import fiona
 import geopandas as gpd
 import pandas as pd
-from pyeo_1 import filesystem_utilities
+from pyeo_1 import filesystem_utilities, job_scheduling
 from pyeo_1.apps.acd_national import (acd_by_tile_raster,
                                       acd_by_tile_vectorisation)
 
@@ -53,7 +54,26 @@ def automatic_change_detection_national(config_path):
     if config_dict["do_tile_intersection"]:
         tilelist_filepath = acd_roi_tile_intersection(config_dict, acd_log)
 
-    if config_dict["do_raster"] and config_dict["do_tile_intersection"]:
+    if (
+        config_dict["do_parallel"]
+        and config_dict["do_raster"]
+        and config_dict["do_vectorise"]
+        and config_dict["do_tile_intersection"]
+    ):
+        acd_log.info("---------------------------------------------------------------")
+        acd_log.info("Starting acd_parallel_tile_processing():")
+        acd_log.info("  raster processing, then vectorisation, of each tile as its own job")
+        acd_log.info("---------------------------------------------------------------")
+
+        tiles = list(pd.read_csv(tilelist_filepath)["tile"])
+        if config_dict["do_delete_existing_vector"]:
+            for tile in tiles:
+                _delete_existing_vectors(config_dict, tile, acd_log)
+        acd_parallel_tile_processing(
+            config_dict, acd_log, tiles, config_path, do_raster=True, do_vectorise=True
+        )
+
+    elif config_dict["do_raster"] and config_dict["do_tile_intersection"]:
         acd_log.info("---------------------------------------------------------------")
         acd_log.info("Starting acd_integrated_raster():")
         acd_log.info("---------------------------------------------------------------")
@@ -61,7 +81,11 @@ def automatic_change_detection_national(config_path):
         acd_integrated_raster(config_dict, acd_log, tilelist_filepath, config_path)
 
     # and skip already existing vectors
-    if config_dict["do_vectorise"] and config_dict["do_tile_intersection"] :
+    if (
+        config_dict["do_vectorise"]
+        and config_dict["do_tile_intersection"]
+        and not (config_dict["do_parallel"] and config_dict["do_raster"])
+    ):
         acd_log.info("---------------------------------------------------------------")
         acd_log.info("Starting acd_integrated_vectorisation()")
         acd_log.info("  vectorising each change report raster, by tile")
@@ -472,139 +496,155 @@ def acd_integrated_raster(
         pass
 
     ######## run acd_by_tile_raster
+    if config_dict["do_parallel"]:
+        # launch an instance for each tile through the configured job backend
+        acd_parallel_tile_processing(
+            config_dict, log, list(tilelist_df["tile"]), config_path, do_raster=True
+        )
+        return
+
     for _, tile in tilelist_df.iterrows():
         # try:
         log.info(f"Starting ACD Raster Processes for Tile :  {tile[0]}")
+        acd_by_tile_raster.acd_by_tile_raster(config_path, tile[0])
+        log.info(f"Finished ACD Raster Processes for Tile :  {tile[0]}")
+        log.info(f"")
+        log.info(f"")
+        # except:
+        # log.error(f"Could not complete ACD Raster Processes for Tile: {tile[0]}")
 
-        if not config_dict["do_parallel"]:
-            acd_by_tile_raster.acd_by_tile_raster(config_path, tile[0])
-            log.info(f"Finished ACD Raster Processes for Tile :  {tile[0]}")
-            log.info(f"")
-            log.info(f"")
 
-        if config_dict["do_parallel"]:
-            # Launch an instance for this tile using qsub for parallelism
-
-            # Setup required paths
-            ## TODO Update to obtain these from config file on config_path and match variable names to standardise on those in pyeo_1.ini)        a config_dict containing `conda_directory` and `conda_env_name`
-            ## TODO Change print statments to log.info
-            ## (Temporary test paths point to a test function 'apps/automation/_random_duration_test_program.py' that returns after a short random time delay)
-            data_directory = config_dict[
-                "tile_dir"
-            ]  # '/data/clcr/shared/IMPRESS/Ivan/pyeo_1/pyeo_1/pyeo_1/apps/automation' #
-            sen2cor_path = config_dict[
-                "sen2cor_path"
-            ]  # '/home/i/ir81/Sen2Cor-02.09.00-Linux64'  #
-
-            conda_directory = config_dict["conda_directory"]
-            # conda_environment_directory = "/home/i/ir81/miniconda3/envs"  # config_dict["conda_env_directory"] (NOTE: Doesn't exist in ini file yet)
-            conda_environment_name = config_dict["conda_env_name"]  # 'pyeo_env'  #
-            conda_environment_path = os.path.join(
-                conda_directory, conda_environment_name
-            )
-            code_directory = config_dict[
-                "pyeo_dir"
-            ]  # '/data/clcr/shared/IMPRESS/Ivan/pyeo_1/pyeo_1/pyeo_1' #
-            python_executable = "pyeo_1/apps/acd_national/acd_by_tile_raster.py"  # 'apps/automation/_random_duration_test_program.py'  #
-            wall_time_hours = config_dict["wall_time_hours"]
-            watch_time_hours = config_dict["watch_time_hours"]
-            watch_period_seconds = config_dict["watch_period_seconds"]
-            qsub_processor_options = config_dict["qsub_processor_options"]
-
-            # qsub_options = f"walltime=00:{wall_time_hours}:00:00,{qsub_processor_options}"
-
-            qsub_options = f"walltime=00:{wall_time_hours}:00:00,{qsub_processor_options}"  # 'walltime=00:00:02:00,nodes=1:ppn=16,vmem=64Gb'
-            # config_directory = '/data/clcr/shared/IMPRESS/Ivan/pyeo_1/pyeo_1/pyeo_1' # '/data/clcr/shared/IMPRESS/Ivan/pyeo_1/pyeo_1/pyeo_1'
-            # config_filename = 'pyeo_1.ini'
-            # config_path = os.path.join(config_directory, config_filename)
-            automation_script_path = os.path.join(
-                code_directory, "pyeo_1/apps/automation/automate_launch.sh"
-            )
+def acd_parallel_tile_processing(
+    config_dict: dict,
+    log: logging.Logger,
+    tiles: list,
+    config_path: str,
+    do_raster: bool = True,
+    do_vectorise: bool = False
+    ) -> dict:
+    """
 
-            tile_name = tile[0]
-            new_line = "\n"
+    This function:
 
-            log.info(
-                f"automation_test.py: Checking if tile {tile_name} is already being processed and, if so, deleting current process to avoid possible conflicts"
-            )
-            df = qstat_to_dataframe()
-            if not df.empty:
-                current_tile_processes_df = df[df["Name"] == tile_name]
-                # log.info('current_tile_processes_df')
-                # log.info(current_tile_processes_df)
-                for index, p in current_tile_processes_df.iterrows():
-                    log.info(p)
-                    if p["Status"] in ["Q", "R"]:
-                        job_id = p["JobID"].split(".")[0]
-                        log.info(f"{new_line}Deleting job: {job_id} {new_line}")
-                        os.system(f"qdel {job_id}")
+        - runs `acd_by_tile_raster` and/or `acd_by_tile_vectorisation` for each tile as separate jobs, through the
+          job backend named by `job_backend` in the config: processes on this machine (`local`), or jobs on a PBS
+          (`pbs`) or SLURM (`slurm`) cluster
 
-            log.info(
-                f"automation_test.py: Preparing to launch tile processing of tile {tile_name}"
-            )
-            # log.info(f'config_path: {type(config_path)}')
-            # log.info(f'config_path: {config_path[0]}')
+        - starts the vectorisation of a tile as soon as its raster processing has succeeded
 
-            python_launch_string = f"cd {data_directory}; module load python; source activate {conda_environment_path}; SEN2COR_HOME={sen2cor_path}; export SEN2COR_HOME; python {os.path.join(code_directory, python_executable)} {config_path} {tile_name}"
-            qsub_launch_string = f'qsub -N {tile_name} -o {os.path.join(data_directory, tile_name + "_o.txt")} -e {os.path.join(data_directory, tile_name + "_e.txt")} -l {qsub_options}'
-            shell_command_string = f"{automation_script_path} '{python_launch_string}' '{qsub_launch_string}'"
+        - runs up to `max_parallel_jobs` jobs at once, each declaring `tile_job_mem_mb` against `job_mem_limit_mb`
 
-            log.info(f"python_launch_string: {python_launch_string}{new_line}")
-            log.info(f"qsub_launch_string: {qsub_launch_string}{new_line}")
-            log.info(f"shell_command_string: {shell_command_string}{new_line}")
+        - records the state of every job in `tile_jobs_ledger.json` in the log directory; with `resume_jobs`, jobs
+          finished by a previous run are skipped
 
-            result = subprocess.run(
-                shell_command_string, capture_output=True, text=True, shell=True
-            )
-            log.info(
-                f" Subprocess launched for tile {tile_name}, return value: {result.stdout}"
-            )
-        # except:
-        # log.error(f"Could not complete ACD Raster Processes for Tile: {tile[0]}")
+    Parameters
+    ----------
+    config_dict : dict
+        Dictionary of the Configuration Parameters specified in the `.ini`
 
-    # if parallel, monitor parallel processes once all have been launched
-    if config_dict["do_parallel"]:
-        log.info("automation_test.py: subprocess launching completed")
-        log.info("automation_test.py: subprocess monitoring started")
+    log : logging.Logger
+        Logger object
+
+    tiles : list of str
+        The Sentinel-2 tiles to process
 
-        # TODO Move these parameters into the config file and change monitoring loop to a while loop
-        # TODO Set maximum_monitoring_period_raster to greater than walltime ( > maximum expected processing time for a tile)
-        # monitoring_cycles = 24 * 60  # 24 hours
-        # monitoring_period_seconds = 60
+    config_path : str
+        filepath of the config (pyeo_1.ini), passed to each job
 
-        # monitoring_period_seconds = watch_time_hours * 60 * 60
-        watch_cycles = int((watch_time_hours * 60 * 60) / watch_period_seconds)
+    do_raster : bool, optional
+        Run the raster processing of each tile. Defaults to True.
 
-        end_monitoring = False
-        for i in range(watch_cycles):
-            time.sleep(watch_period_seconds)
-            log.info(
-                f"automation_test.py: Checking which tiles are still being processed after {i * watch_period_seconds} seconds"
-            )
+    do_vectorise : bool, optional
+        Run the vectorisation of each tile. Defaults to False.
+
+    Returns
+    ----------
+    dict
+        The final state of each job, by job name: 'done', 'failed', 'skipped' or 'running'
+    """
 
-            df = qstat_to_dataframe()
-            if not df.empty and end_monitoring == False:
-                active_process_count = 0
-                for _, tile in tilelist_df.iterrows():
-                    current_tile_processes_df = df[df["Name"] == tile[0]]
-                    # log.info('current_tile_processes_df')
-                    # log.info(current_tile_processes_df)
-                    for index, p in current_tile_processes_df.iterrows():
-                        if p["Status"] in ["Q", "R"]:  # ['Q', 'R', 'C']):
-                            job_id = p["JobID"].split(".")[0]
-                            log.info(
-                                f'Tile {tile[0]} still running pid: {job_id}, status; {p["Status"]} '
-                            )
-                            active_process_count += 1
-                if active_process_count == 0:
-                    end_monitoring = True
-            else:
-                log.info(
-                    "All tiles have been processed.. continuing to next pipeline stage"
+    apps_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "apps", "acd_national")
+    tile_directory = config_dict["tile_dir"]
+    os.makedirs(tile_directory, exist_ok=True)
+
+    setup_command = None
+    resource_options = None
+    if config_dict["job_backend"] in ("pbs", "slurm"):
+        # slurm runs the command under /bin/sh, so the setup avoids bash-only builtins such as source
+        setup_parts = [f"cd {shlex.quote(tile_directory)}"]
+        if config_dict["environment_manager"] == "conda":
+            conda_environment_path = os.path.join(
+                config_dict["conda_directory"], config_dict["conda_env_name"]
+            )
+            setup_parts += ["module load python", f". activate {shlex.quote(conda_environment_path)}"]
+        setup_parts += [f"SEN2COR_HOME={shlex.quote(config_dict['sen2cor_path'])}", "export SEN2COR_HOME"]
+        setup_command = "; ".join(setup_parts)
+        if config_dict["job_backend"] == "pbs":
+            # the pbs backend blocks on qsub -W block=true, which only PBS Professional supports
+            if "ppn=" in config_dict["qsub_processor_options"]:
+                log.warning(
+                    f"qsub_processor_options looks like a Torque resource list: {config_dict['qsub_processor_options']}. "
+                    "The pbs job backend needs PBS Professional and its select syntax, e.g. select=1:ncpus=16:mem=64gb"
                 )
-                break
+            resource_options = f"walltime={config_dict['wall_time_hours']}:00:00,{config_dict['qsub_processor_options']}"
+        else:
+            resource_options = f"--time={config_dict['wall_time_hours']}:00:00 {config_dict['slurm_options']}"
+    backend = job_scheduling.get_backend(
+        config_dict["job_backend"],
+        log_dir=tile_directory,
+        resource_options=resource_options,
+        setup_command=setup_command,
+    )
+    scheduler = job_scheduling.JobScheduler(
+        backend,
+        max_jobs=config_dict["max_parallel_jobs"],
+        mem_limit_mb=config_dict["job_mem_limit_mb"],
+        ledger_path=os.path.join(config_dict["log_dir"], "tile_jobs_ledger.json"),
+        resume=config_dict["resume_jobs"],
+        timeout_hours=config_dict["watch_time_hours"],
+        log=log,
+    )
 
-        log.info("automation_test.py subprocesses completed")
+    # jobs on a cluster node use the python of the environment activated by setup_command
+    python_executable = sys.executable if config_dict["job_backend"] == "local" else "python"
+    for tile in tiles:
+        raster_job = f"{tile}_raster"
+        if do_raster:
+            scheduler.add_job(
+                raster_job,
+                [python_executable, os.path.join(apps_directory, "acd_by_tile_raster.py"), config_path, tile],
+                mem_mb=config_dict["tile_job_mem_mb"],
+            )
+        if do_vectorise:
+            scheduler.add_job(
+                f"{tile}_vector",
+                [python_executable, os.path.join(apps_directory, "acd_by_tile_vectorisation.py"), config_path, tile],
+                depends_on=[raster_job] if do_raster else [],
+                mem_mb=config_dict["tile_job_mem_mb"],
+            )
+
+    log.info(f"Running {len(scheduler.jobs)} tile jobs with the {backend.name} backend")
+    states = scheduler.run()
+    for job_name, state in states.items():
+        log.info(f"  {job_name}  :  {state}")
+    log.info("Parallel tile processing completed")
+
+    return states
+
+
+def _delete_existing_vectors(config_dict: dict, tile: str, log: logging.Logger):
+    """
+    :meta private:
+    Deletes the vectorised change report shapefiles, pkls and csvs of a tile, keeping the report rasters.
+    """
+    report_pattern = os.path.join(config_dict["tile_dir"], tile, "output", "probabilities", "report*")
+    for file in glob.glob(report_pattern):
+        if file.endswith(".tif"):
+            continue
+        try:
+            os.remove(file)
+        except:
+            log.error(f"Could not delete : {file}, skipping")
 
 
 def qstat_to_dataframe():
@@ -729,30 +769,17 @@ def acd_integrated_vectorisation(
         log.info("---------------------------------------------------------------")
 
     # vectorise per path logic
+    parallel_tiles = []
     for report in sorted_filepaths:
+        # find tile string for the report to be vectorised
+        # tile = sorted_filepaths[0].split(os.sep)[-1].split("_")[-2]
+        tile = report.split(os.sep)[-1].split("_")[-2]
         if config_dict["do_delete_existing_vector"]:
             # get list of existing report files in report path
             log.info(
                 "do_delete_existing_vector flag = True: Deleting existing vectorised change report shapefiles, pkls and csvs"
             )
-            directory = os.path.dirname(report)
-            report_shp_pattern = f"{os.sep}report*"
-            search_shp_pattern = f"{directory}{report_shp_pattern}"
-            existing_files = glob.glob(search_shp_pattern)
-
-            # exclude .tif files from the delete list
-            files_to_remove = [
-                file for file in existing_files if not file.endswith(".tif")
-            ]
-
-            for file in files_to_remove:
-                try:
-                    os.remove(file)
-                except:
-                    log.error(f"Could not delete : {file}, skipping")
-        # find tile string for the report to be vectorised
-        # tile = sorted_filepaths[0].split(os.sep)[-1].split("_")[-2]
-        tile = report.split(os.sep)[-1].split("_")[-2]
+            _delete_existing_vectors(config_dict, tile, log)
 
         if not config_dict["do_parallel"]:
             # try:
@@ -760,12 +787,12 @@ def acd_integrated_vectorisation(
             # except:
             #   log.error(f"Sequential Mode: Failed to vectorise {report}, moving on to the next")
         if config_dict["do_parallel"]:
-            try:
-                subprocess.run()
-            except:
-                log.error(
-                    f"Parallel Mode: Failed to vectorise {report}, moving on to the next"
-                )
+            parallel_tiles.append(tile)
+
+    if parallel_tiles:
+        acd_parallel_tile_processing(
+            config_dict, log, parallel_tiles, config_path, do_raster=False, do_vectorise=True
+        )
 
     log.info("---------------------------------------------------------------")
     log.info("---------------------------------------------------------------")
@@ -776,20 +803,54 @@ def acd_integrated_vectorisation(
     return
 
 
+def _read_and_clip_tile_report(
+    vector: str,
+    roi: gpd.GeoDataFrame,
+    epsg: int,
+    log: logging.Logger
+):
+    """
+    :meta private:
+    Reads one tile's change report shapefile, reprojects it to epsg and intersects it with the ROI, which must already
+    be in epsg. Only the report polygons and ROI polygons whose bounding boxes overlap, found through the spatial index
+    of the ROI, take part in the overlay. Returns None if the report cannot be read or intersected.
+    """
+    try:
+        log.info(f"Reading in change report shapefile   :  {vector}")
+        shape = gpd.read_file(vector).to_crs(epsg)
+
+        shape_index, roi_index = roi.sindex.query(shape.geometry, predicate="intersects")
+        if len(roi_index) == 0:
+            log.info(f"No change polygons of {vector} intersect the ROI")
+            return None
+        log.info(f"Intersecting {vector} with the ROI")
+        intersected = shape.iloc[sorted(set(shape_index))].overlay(
+            roi.iloc[sorted(set(roi_index))], how="intersection"
+        )
+        log.info(f"Intersection of {vector}: Success")
+        return intersected
+    except Exception as error:
+        log.error(f"failed to merge geodataframe: {vector}")
+        log.error(f"  {error}")
+        return None
+
+
 def acd_national_integration(
     root_dir: str,
     log: logging.Logger,
     epsg: int,
     config_dict: dict,
-    write_kml: bool
+    write_kml: bool,
+    n_workers: int = None
 ):
     """
 
     This function:
-        - glob to find 1 report_xxx.pkl file per tile in output/probabilities,
-        - from which to read in a Pandas DataFrame of the vectorised changes,
-        - then concatenate DataFrame for each tile to form a national change event DataFrame
-        - save to disc in /integrated/acd_national_integration.pkl
+        - glob to find 1 report_xxx.shp file per tile in output/probabilities,
+        - read each of them in parallel and intersect it with the RoI, reprojected once and spatially indexed,
+        - then concatenate the GeoDataFrames of all tiles once to form a national change event GeoDataFrame,
+        - explode multipolygons and compute the area of the integrated GeoDataFrame,
+        - save to disc as national_geodataframe.shp, .gpkg, .parquet (if pyarrow is installed) and optionally .kml
 
     Parameters:
     ----------
@@ -805,6 +866,9 @@ def acd_national_integration(
     write_kml : bool
         writes to `.kml` if True
 
+    n_workers : int, optional
+        The number of tile reports to read and intersect concurrently. If None, uses the number of CPUs.
+
     Returns:
     ----------
     None
@@ -817,17 +881,14 @@ def acd_national_integration(
     search_pattern = f"{tiles_name_pattern}{report_shp_pattern}"
 
     # glob through passed directory, return files matching the two patterns
-    vectorised_paths = glob.glob(os.path.join(root_dir, search_pattern))
+    vectorised_paths = sorted(glob.glob(os.path.join(root_dir, search_pattern)))
     log.info(
         f"Number of change Report Shapefiles to integrate  :  {len(vectorised_paths)}"
     )
     log.info("Paths of shapefiles to integrate are:")
-    for number, path in enumerate(sorted(vectorised_paths)):
+    for number, path in enumerate(vectorised_paths):
         log.info(f"{number} : {path}")
 
-    # initialise empty geodataframe
-    merged_gdf = gpd.GeoDataFrame()
-
     # specify roi path
     roi_filepath = os.path.join(config_dict["roi_dir"], config_dict["roi_filename"])
 
@@ -837,64 +898,69 @@ def acd_national_integration(
         log.error(f"Exiting acd_national(), ensure  {roi_filepath}  exists")
         sys.exit(1)
 
-    # read in ROI, reproject
+    # read in ROI, reproject once and build its spatial index before the tiles are read
     log.info("Reading in ROI")
     roi = gpd.read_file(roi_filepath)
-    # log.info(f"Ensuring ROI is of EPSG  :  {epsg}")
     roi = roi.to_crs(epsg)
+    roi.sindex  # the index is built lazily, so build it here rather than in the worker threads
+
+    # read and intersect the tile reports concurrently, keeping them in tile order
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    thread_pool = Pool(max(min(n_workers, len(vectorised_paths)), 1))
+    intersected_gdfs = thread_pool.map(
+        lambda vector: _read_and_clip_tile_report(vector, roi, epsg, log),
+        vectorised_paths,
+    )
+    thread_pool.close()
+    thread_pool.join()
+    intersected_gdfs = [gdf for gdf in intersected_gdfs if gdf is not None]
+
+    # join the gdfs once, then explode any multipolygons created from intersecting to individual polygons
+    if intersected_gdfs:
+        merged_gdf = pd.concat(intersected_gdfs, ignore_index=True)
+        merged_gdf = merged_gdf.explode(index_parts=False)
+        merged_gdf["area"] = merged_gdf.area
+    else:
+        merged_gdf = gpd.GeoDataFrame()
+    log.info(f"Integrated geodataframe length is  :  {len(merged_gdf)}")
 
-    # for each shapefile in the list of shapefile paths, read, filter and merge
-    with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-        for vector in sorted(vectorised_paths):
-            try:
-                # read in shapefile, reproject
-                log.info(f"Reading in change report shapefile   :  {vector}")
-                shape = gpd.read_file(vector)
-                # log.info(f"Ensuring change report shapefile is of EPSG  :  {epsg}")
-                shape = shape.to_crs(epsg)
-
-                # spatial filter intersection of shapefile with ROI
-                log.info(f"Intersecting {vector} with {roi_filepath}")
-                intersected = shape.overlay(roi, how="intersection")
-
-                # join the two gdfs
-                merged_gdf = pd.concat([merged_gdf, intersected], ignore_index=True)
-                log.info(f"Intersection: Success")
-
-                # explode to convert any multipolygons created from intersecting to individual polygons
-                merged_gdf = merged_gdf.explode(index_parts=False)
-
-                # recompute area
-                merged_gdf["area"] = merged_gdf.area
-
-                log.info(
-                    f"Integrated geodataframe length is currently  :  {len(merged_gdf['area'])}"
-                )
-            except:
-                log.error(f"failed to merge geodataframe: {vector}")
+    # write integrated geodataframe to shapefile, geopackage and geoparquet
+    out_path = f"{os.path.join(root_dir, 'national_geodataframe.shp')}"
+    try:
+        log.info(
+            f"Merging complete, now writing integrated shapefile to {out_path}"
+        )
+        merged_gdf.to_file(filename=out_path)
+        log.info(f"Integrated GeoDataFrame written to : {out_path}")
+    except:
+        log.error(f"failed to write output to shapefile at :  {out_path}")
 
-    # write integrated geodataframe to shapefile
-    with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-        try:
-            out_path = f"{os.path.join(root_dir, 'national_geodataframe.shp')}"
-            log.info(
-                f"Merging loop complete, now writing integrated shapefile to {out_path}"
-            )
-            merged_gdf.to_file(filename=out_path)
-        except:
-            log.error(f"failed to write output to shapefile at :  {out_path}")
+    gpkg_out_path = f"{os.path.join(root_dir, 'national_geodataframe.gpkg')}"
+    try:
+        merged_gdf.to_file(gpkg_out_path, driver="GPKG")
+        log.info(f"Integrated GeoDataFrame written to : {gpkg_out_path}")
+    except:
+        log.error(f"failed to write output to geopackage at :  {gpkg_out_path}")
 
-        if write_kml:
-            try:
-                kml_out_path = f"{os.path.join(root_dir, 'national_geodataframe.kml')}"
-                fiona.supported_drivers['KML'] = 'rw'
-                merged_gdf.to_file(kml_out_path, driver='KML')
-            except:
-                log.error(f"failed to write output to kml, at : {kml_out_path}")
+    parquet_out_path = f"{os.path.join(root_dir, 'national_geodataframe.parquet')}"
+    try:
+        merged_gdf.to_parquet(parquet_out_path)
+        log.info(f"Integrated GeoDataFrame written to : {parquet_out_path}")
+    except ImportError:
+        log.warning(f"pyarrow is not installed, skipping geoparquet output {parquet_out_path}")
+    except:
+        log.error(f"failed to write output to geoparquet at :  {parquet_out_path}")
 
-    log.info(f"Integrated GeoDataFrame written to : {out_path}")
     if write_kml:
-       log.info(f"Integrated GeoDataFrame written to : {kml_out_path}")
+        kml_out_path = f"{os.path.join(root_dir, 'national_geodataframe.kml')}"
+        try:
+            fiona.supported_drivers['KML'] = 'rw'
+            merged_gdf.to_file(kml_out_path, driver='KML')
+            log.info(f"Integrated GeoDataFrame written to : {kml_out_path}")
+        except:
+            log.error(f"failed to write output to kml, at : {kml_out_path}")
+
     log.info("---------------------------------------------------------------")
     log.info("---------------------------------------------------------------")
     log.info("National Integration of the Vectorised Change Reports Complete")
@@ -12,8 +12,9 @@ from tempfile import TemporaryDirectory
 import geopandas as gpd
 import numpy as np
 import pandas as pd
-from pyeo_1 import (acd_national, classification, filesystem_utilities,
-                    queries_and_downloads, raster_manipulation)
+from pyeo_1 import (acd_national, change_cube, classification,
+                    filesystem_utilities, queries_and_downloads,
+                    raster_manipulation)
 
 
 def acd_by_tile_raster(config_path: str,
@@ -106,6 +107,23 @@ def acd_by_tile_raster(config_path: str,
     composite_l2_masked_image_dir = os.path.join(tile_root_dir, f"composite{os.sep}cloud_masked")
     quicklook_dir = os.path.join(tile_root_dir, f"output{os.sep}quicklooks")
 
+    # answer file lookups from a per-tile catalogue instead of walking the tile directories every time
+    filesystem_utilities.use_catalogue(
+        os.path.join(tile_root_dir, "log", f"{tile}_catalogue.sqlite")
+    )
+    # record what each stage produced from which inputs, so that re-runs only rebuild outputs whose inputs changed
+    filesystem_utilities.use_processing_manifest(
+        os.path.join(tile_root_dir, "log", f"{tile}_processing_manifest.sqlite")
+    )
+    # keep Dataspace query results per tile, so that each run only queries the dates it has not seen
+    query_cache_path = (
+        os.path.join(tile_root_dir, "log", f"{tile}_query_cache.sqlite")
+        if config_dict["query_resync_days"] >= 0
+        else None
+    )
+    # create every raster of this tile with the configured tiling and compression
+    raster_manipulation.use_output_profile(config_dict["output_profile"])
+
     start_date = config_dict["start_date"]
     end_date = config_dict["end_date"]
     composite_start_date = config_dict["composite_start"]
@@ -209,7 +227,9 @@ def acd_by_tile_raster(config_path: str,
                     end_date=dataspace_composite_end,
                     area_of_interest=geometry,
                     max_records=100,
-                    log=tile_log
+                    log=tile_log,
+                    cache_path=query_cache_path,
+                    resync_days=config_dict["query_resync_days"]
                 )
             except Exception as error:
                 tile_log.error(f"query_dataspace_by_polygon received this error: {error}")
@@ -534,37 +554,42 @@ def acd_by_tile_raster(config_path: str,
         if l1c_products.shape[0] > 0:
             tile_log.info(f"Downloading Sentinel-2 L1C products from {download_source}:")
 
-            if download_source == "scihub":
-
-                queries_and_downloads.download_s2_data_from_df(
-                    l1c_products,
-                    composite_l1_image_dir,
-                    composite_l2_image_dir,
-                    source="scihub",
-                    user=sen_user,
-                    passwd=sen_pass,
-                    try_scihub_on_fail=True,
-                )
-
-            if download_source == "dataspace":
-
-                queries_and_downloads.download_s2_data_from_dataspace(
-                    product_df=l1c_products,
-                    l1c_directory=composite_l1_image_dir,
-                    l2a_directory=composite_l2_image_dir,
-                    dataspace_username=sen_user,
-                    dataspace_password=sen_pass,
-                    log=tile_log
-                )
-            
-            tile_log.info("Atmospheric correction with sen2cor.")
-            raster_manipulation.atmospheric_correction(
-                composite_l1_image_dir,
+            # products are atmospherically corrected as they arrive from the dataspace
+            with raster_manipulation.Sen2CorPool(
                 composite_l2_image_dir,
                 sen2cor_path,
+                n_workers=config_dict["sen2cor_workers"],
                 delete_unprocessed_image=False,
                 log=tile_log,
-            )
+            ) as sen2cor_pool:
+                if download_source == "scihub":
+
+                    queries_and_downloads.download_s2_data_from_df(
+                        l1c_products,
+                        composite_l1_image_dir,
+                        composite_l2_image_dir,
+                        source="scihub",
+                        user=sen_user,
+                        passwd=sen_pass,
+                        try_scihub_on_fail=True,
+                    )
+
+                if download_source == "dataspace":
+
+                    queries_and_downloads.download_s2_data_from_dataspace(
+                        product_df=l1c_products,
+                        l1c_directory=composite_l1_image_dir,
+                        l2a_directory=composite_l2_image_dir,
+                        dataspace_username=sen_user,
+                        dataspace_password=sen_pass,
+                        log=tile_log,
+                        on_l1c_ready=sen2cor_pool.submit
+                    )
+
+                tile_log.info("Atmospheric correction with sen2cor.")
+                for image in sorted(os.listdir(composite_l1_image_dir)):
+                    if image.startswith("MSIL1C", 4):
+                        sen2cor_pool.submit(os.path.join(composite_l1_image_dir, image))
 
         if l2a_products.shape[0] > 0:
             tile_log.info("Downloading Sentinel-2 L2A products.")
@@ -654,6 +679,9 @@ def acd_by_tile_raster(config_path: str,
                     "---------------------------------------------------------------"
                 )
 
+        # the previous stage has written new files, so file lookups have to look at the disk again; the catalogue
+        # is invalidated like this at the start of every stage
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info(
             "Applying simple cloud, cloud shadow and haze mask based on SCL files and stacking the masked band raster files."
@@ -667,30 +695,13 @@ def acd_by_tile_raster(config_path: str,
             if f.endswith(".tif") and os.path.isfile(os.path.join(directory, f))
         ]
 
-        directory = composite_l2_image_dir
-        l2a_zip_file_paths = [f for f in os.listdir(directory) if f.endswith(".zip")]
-
-        if len(l2a_zip_file_paths) > 0:
-            for f in l2a_zip_file_paths:
-                # check whether the zipped file has already been cloud masked
-                zip_timestamp = filesystem_utilities.get_image_acquisition_time(
-                    os.path.basename(f)
-                ).strftime("%Y%m%dT%H%M%S")
-                if any(zip_timestamp in f for f in masked_file_paths):
-                    continue
-                else:
-                    # extract it if not
-                    filesystem_utilities.unzip_contents(
-                        os.path.join(composite_l2_image_dir, f),
-                        ifstartswith="S2",
-                        ending=".SAFE",
-                    )
-
+        # zipped products are cloud masked from inside their archive, so they are not extracted first
         directory = composite_l2_image_dir
         l2a_safe_file_paths = [
             f
             for f in os.listdir(directory)
-            if f.endswith(".SAFE") and os.path.isdir(os.path.join(directory, f))
+            if (f.endswith(".SAFE") and os.path.isdir(os.path.join(directory, f)))
+            or (f.startswith("S2") and f.endswith(".zip"))
         ]
 
         files_for_cloud_masking = []
@@ -721,9 +732,11 @@ def acd_by_tile_raster(config_path: str,
                 haze=None,
                 epsg=epsg,
                 skip_existing=skip_existing,
+                apply_offset=True,
             )
         # I.R. 20220607 START
         # Apply offset to any images of processing baseline 0400 in the composite cloud_masked folder
+        # that were masked without it by earlier runs
         tile_log.info("---------------------------------------------------------------")
         tile_log.info("Offsetting cloud masked L2A images for composite.")
         tile_log.info("---------------------------------------------------------------")
@@ -792,6 +805,7 @@ def acd_by_tile_raster(config_path: str,
                 "---------------------------------------------------------------"
             )
 
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info(
             "Building initial cloud-free median composite from directory {}".format(
@@ -813,6 +827,7 @@ def acd_by_tile_raster(config_path: str,
                 chunks=config_dict["chunks"],
                 generate_date_images=True,
                 missing_data_value=0,
+                mem_limit_mb=config_dict["mem_limit_mb"],
             )
             tile_log.info(
                 "---------------------------------------------------------------"
@@ -946,6 +961,7 @@ def acd_by_tile_raster(config_path: str,
     # Step 2: Download change detection images for the specific time window (L2A where available plus additional L1C)
     # ------------------------------------------------------------------------
     if config_dict["do_all"] or config_dict["do_download"]:
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info(
             "Downloading change detection images between {} and {} with cloud cover <= {}".format(
@@ -980,7 +996,9 @@ def acd_by_tile_raster(config_path: str,
                     end_date=dataspace_change_end,
                     area_of_interest=geometry,
                     max_records=100,
-                    log=tile_log
+                    log=tile_log,
+                    cache_path=query_cache_path,
+                    resync_days=config_dict["query_resync_days"]
                 )
             except Exception as error:
                 tile_log.error(f"query_by_polygon received this error: {error}")
@@ -1189,40 +1207,46 @@ def acd_by_tile_raster(config_path: str,
         if l1c_products.shape[0] > 0:
 
             tile_log.info(f"Downloading Sentinel-2 L1C products from {download_source}")
-            
-            if download_source == "scihub":
-                queries_and_downloads.download_s2_data_from_df(
-                    l1c_products,
-                    l1_image_dir,
-                    l2_image_dir,
-                    download_source,
-                    user=sen_user,
-                    passwd=sen_pass,
-                    try_scihub_on_fail=True,
-                )
-            elif download_source == "dataspace":
-                    queries_and_downloads.download_s2_data_from_dataspace(
-                    product_df=l1c_products,
-                    l1c_directory=l1_image_dir,
-                    l2a_directory=l2_image_dir,
-                    dataspace_username=sen_user,
-                    dataspace_password=sen_pass,
-                    log=tile_log
-                )
-            else:
+
+            if download_source not in ("scihub", "dataspace"):
                 tile_log.error(f"download source specified did not match 'scihub' or 'dataspace'")
                 tile_log.error(f"download source supplied was  :  {download_source}")
                 tile_log.error("exiting pipeline...")
                 sys.exit(1)
 
-            tile_log.info("Atmospheric correction with sen2cor.")
-            raster_manipulation.atmospheric_correction(
-                l1_image_dir,
+            # products are atmospherically corrected as they arrive from the dataspace
+            with raster_manipulation.Sen2CorPool(
                 l2_image_dir,
                 sen2cor_path,
+                n_workers=config_dict["sen2cor_workers"],
                 delete_unprocessed_image=False,
                 log=tile_log,
-            )
+            ) as sen2cor_pool:
+                if download_source == "scihub":
+                    queries_and_downloads.download_s2_data_from_df(
+                        l1c_products,
+                        l1_image_dir,
+                        l2_image_dir,
+                        download_source,
+                        user=sen_user,
+                        passwd=sen_pass,
+                        try_scihub_on_fail=True,
+                    )
+                elif download_source == "dataspace":
+                    queries_and_downloads.download_s2_data_from_dataspace(
+                        product_df=l1c_products,
+                        l1c_directory=l1_image_dir,
+                        l2a_directory=l2_image_dir,
+                        dataspace_username=sen_user,
+                        dataspace_password=sen_pass,
+                        log=tile_log,
+                        on_l1c_ready=sen2cor_pool.submit
+                    )
+
+                tile_log.info("Atmospheric correction with sen2cor.")
+                for image in sorted(os.listdir(l1_image_dir)):
+                    if image.startswith("MSIL1C", 4):
+                        sen2cor_pool.submit(os.path.join(l1_image_dir, image))
         if l2a_products.shape[0] > 0:
             tile_log.info(f"Downloading Sentinel-2 L2A products from {download_source}")
 
@@ -1307,6 +1331,7 @@ def acd_by_tile_raster(config_path: str,
                     "---------------------------------------------------------------"
                 )
 
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info(
             "Applying simple cloud, cloud shadow and haze mask based on SCL files and stacking the masked band raster files."
@@ -1326,6 +1351,7 @@ def acd_by_tile_raster(config_path: str,
             haze=None,
             epsg=epsg,
             skip_existing=skip_existing,
+            apply_offset=True,
         )
 
         tile_log.info("---------------------------------------------------------------")
@@ -1333,7 +1359,8 @@ def acd_by_tile_raster(config_path: str,
         tile_log.info("---------------------------------------------------------------")
 
         # I.R. 20220607 START
-        # Apply offset to any images of processing baseline 0400 in the composite cloud_masked folder
+        # Apply offset to any images of processing baseline 0400 in the cloud_masked folder
+        # that were masked without it by earlier runs
         tile_log.info("---------------------------------------------------------------")
         tile_log.info("Offsetting cloud masked L2A images.")
         tile_log.info("---------------------------------------------------------------")
@@ -1400,6 +1427,7 @@ def acd_by_tile_raster(config_path: str,
                 "---------------------------------------------------------------"
             )
 
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info(
             "Compressing tiff files in directory {} and all subdirectories".format(
@@ -1429,6 +1457,7 @@ def acd_by_tile_raster(config_path: str,
     # Step 3: Classify each L2A image and the baseline composite
     # ------------------------------------------------------------------------
     if config_dict["do_all"] or config_dict["do_classify"]:
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info("Classifying composite & change images using Random Forest Model")
         tile_log.info("Model Provided: {}".format(model_path))
@@ -1443,8 +1472,9 @@ def acd_by_tile_raster(config_path: str,
             prob_out_dir=None,
             apply_mask=False,
             out_type="GTiff",
-            chunks=config_dict["chunks"],
             skip_existing=skip_existing,
+            mem_limit_mb=config_dict["mem_limit_mb"],
+            n_workers=config_dict["classification_workers"],
         )
         classification.classify_directory(
             l2_masked_image_dir,
@@ -1453,8 +1483,9 @@ def acd_by_tile_raster(config_path: str,
             prob_out_dir=None,
             apply_mask=False,
             out_type="GTiff",
-            chunks=config_dict["chunks"],
             skip_existing=skip_existing,
+            mem_limit_mb=config_dict["mem_limit_mb"],
+            n_workers=config_dict["classification_workers"],
         )
 
         tile_log.info("---------------------------------------------------------------")
@@ -1514,6 +1545,7 @@ def acd_by_tile_raster(config_path: str,
     # ------------------------------------------------------------------------
 
     if config_dict["do_all"] or config_dict["do_change"]:
+        filesystem_utilities.invalidate_catalogue()
         tile_log.info("---------------------------------------------------------------")
         tile_log.info("Creating change layers from stacked class images.")
         tile_log.info("---------------------------------------------------------------")
@@ -1630,61 +1662,104 @@ def acd_by_tile_raster(config_path: str,
             )
             tile_log.info("I.R. Report file name will be {}".format(output_product))
 
-            # if a report file exists, archive it  ( I.R. Changed from 'rename it to show it has been updated')
-            n_report_files = len(
-                [
-                    f
-                    for f in os.scandir(probability_image_dir)
-                    if f.is_file()
-                    and f.name.startswith("report_")
-                    and f.name.endswith(".tif")
-                ]
-            )
+            # settings that the report layers depend on; an existing report is only extended if they are unchanged
+            report_settings = {
+                "baseline": os.path.basename(latest_class_composite_path),
+                "change_from": from_classes,
+                "change_to": to_classes,
+                "viband1": 4,
+                "viband2": 3,
+                "dNDVI_threshold": -0.2,
+            }
+            reported_class_image_paths = []
+
+            # if a report file exists, extend it with the new class images if possible, otherwise archive it
+            # ( I.R. Changed from 'rename it to show it has been updated')
+            existing_report_paths = [
+                f.path
+                for f in os.scandir(probability_image_dir)
+                if f.is_file()
+                and f.name.startswith("report_")
+                and f.name.endswith(".tif")
+            ]
 
-            if n_report_files > 0:
+            if len(existing_report_paths) > 0:
                 # I.R. ToDo: Should iterate over output_product_existing in case more than one report file is present (though unlikely)
-                output_product_existing = [
-                    f.path
-                    for f in os.scandir(probability_image_dir)
-                    if f.is_file()
-                    and f.name.startswith("report_")
-                    and f.name.endswith(".tif")
-                ][0]
+                output_product_existing = existing_report_paths[0]
                 tile_log.info(
                     "Found existing report image product: {}".format(
                         output_product_existing
                     )
                 )
-                # I.R. 20220610 START
-                ## Mark existing reports as 'archive_'
-                ## - do not try and extend upon existing reports
-                ## - calls to __change_from_class_maps below will build a report incorporating all new AND pre-existing change maps
-                ## - this might be the cause of the error in report generation that caused over-range and periodicity in the histogram - as reported to Heiko by email
-                # report_timestamp = pyeo_1.filesystem_utilities.get_change_detection_dates(os.path.basename(output_product_existing))[1]
-                # if report_timestamp < after_timestamp:
-                # tile_log.info("Report timestamp {}".format(report_timestamp.strftime("%Y%m%dT%H%M%S")))
-                # tile_log.info(" is earlier than {}".format(after_timestamp.strftime("%Y%m%dT%H%M%S")))
-                # tile_log.info("Updating its file name to: {}".format(output_product))
-                # os.rename(output_product_existing, output_product)
-
-                # Renaming any pre-existing report file with prefix 'archive_'
-                ## it will therefore not be detected in __change_from_class_maps which will therefore create a new report file
-
-                output_product_existing_archived = os.path.join(
-                    os.path.dirname(output_product_existing),
-                    "archived_" + os.path.basename(output_product_existing),
+                new_class_image_paths = raster_manipulation.get_change_report_increment(
+                    report_path=output_product_existing,
+                    class_image_paths=class_image_paths,
+                    report_settings=report_settings,
                 )
-                tile_log.info(
-                    "Renaming existing report image product to: {}".format(
-                        output_product_existing_archived
+                if new_class_image_paths is not None:
+                    # the report layers hold the accumulated counts and first-change dates, so only the class
+                    # images acquired since the report was last updated need to be folded in
+                    tile_log.info(
+                        "Extending the existing report with {} new class images.".format(
+                            len(new_class_image_paths)
+                        )
                     )
-                )
-                os.rename(output_product_existing, output_product_existing_archived)
+                    reported_class_image_paths = [
+                        path
+                        for path in class_image_paths
+                        if path not in new_class_image_paths
+                    ]
+                    class_image_paths = new_class_image_paths
+                    if output_product_existing != output_product:
+                        tile_log.info(
+                            "Renaming existing report image product to: {}".format(
+                                output_product
+                            )
+                        )
+                        os.rename(output_product_existing, output_product)
+                        os.rename(
+                            raster_manipulation.get_change_report_manifest_path(
+                                output_product_existing
+                            ),
+                            raster_manipulation.get_change_report_manifest_path(
+                                output_product
+                            ),
+                        )
+                else:
+                    # I.R. 20220610 START
+                    ## Mark existing reports as 'archive_'
+                    ## - calls to __change_from_class_maps below will build a report incorporating all new AND pre-existing change maps
+                    ## - this might be the cause of the error in report generation that caused over-range and periodicity in the histogram - as reported to Heiko by email
+
+                    # Renaming any pre-existing report file with prefix 'archive_'
+                    ## it will therefore not be detected in __change_from_class_maps which will therefore create a new report file
+
+                    output_product_existing_archived = os.path.join(
+                        os.path.dirname(output_product_existing),
+                        "archived_" + os.path.basename(output_product_existing),
+                    )
+                    tile_log.info(
+                        "Rebuilding the report. Renaming existing report image product to: {}".format(
+                            output_product_existing_archived
+                        )
+                    )
+                    os.rename(output_product_existing, output_product_existing_archived)
+                    existing_manifest_path = raster_manipulation.get_change_report_manifest_path(
+                        output_product_existing
+                    )
+                    if os.path.exists(existing_manifest_path):
+                        os.rename(
+                            existing_manifest_path,
+                            raster_manipulation.get_change_report_manifest_path(
+                                output_product_existing_archived
+                            ),
+                        )
 
-                # I.R. 20220610 END
+                    # I.R. 20220610 END
 
         # find change patterns in the stack of classification images
 
+        cube_dir = os.path.join(probability_image_dir, "change_cube")
         for index, image in enumerate(class_image_paths):
             tile_log.info("")
             tile_log.info("")
@@ -1753,23 +1828,53 @@ def acd_by_tile_raster(config_path: str,
                 tile_log.info(
                     "Update of the report image product based on change detection image."
                 )
-                raster_manipulation.__change_from_class_maps(
+                result = raster_manipulation.__change_from_class_maps(
                     old_class_path=latest_class_composite_path,
                     new_class_path=image,
                     change_raster=change_raster,
                     dNDVI_raster=dNDVI_raster,
                     NDVI_raster=NDVI_raster,
-                    change_from=from_classes,
-                    change_to=to_classes,
+                    change_from=report_settings["change_from"],
+                    change_to=report_settings["change_to"],
                     report_path=output_product,
                     skip_existing=skip_existing,
                     old_image_dir=composite_dir,
                     new_image_dir=l2_masked_image_dir,
-                    viband1=4,
-                    viband2=3,
-                    dNDVI_threshold=-0.2,
+                    viband1=report_settings["viband1"],
+                    viband2=report_settings["viband2"],
+                    dNDVI_threshold=report_settings["dNDVI_threshold"],
                     log=tile_log,
                 )
+                # images rejected by __change_from_class_maps are recorded too, otherwise every later run would
+                # find them missing from the manifest and rebuild the report
+                reported_class_image_paths.append(image)
+                if os.path.exists(output_product):
+                    # the report is updated in place, so the manifest has to follow it image by image; a run that
+                    # stops part way through must not fold the same images in again
+                    raster_manipulation.save_change_report_manifest(
+                        report_path=output_product,
+                        report_settings=report_settings,
+                        class_image_paths=reported_class_image_paths,
+                    )
+                if result == change_raster:
+                    # keep the per-date layers in the tile's time-series cube as well
+                    cube = change_cube.ChangeCube.open_or_create(
+                        cube_dir, template_path=change_raster
+                    )
+                    try:
+                        cube.append_rasters(
+                            after_timestamp,
+                            {
+                                "class": image,
+                                "change": change_raster,
+                                "dNDVI": dNDVI_raster,
+                                "NDVI": NDVI_raster,
+                            },
+                        )
+                    except ValueError as error:
+                        tile_log.warning(
+                            "Not added to the change cube: {}".format(error)
+                        )
             else:
                 raster_manipulation.change_from_class_maps(
                     latest_class_composite_path,
@@ -1780,13 +1885,29 @@ def acd_by_tile_raster(config_path: str,
                     skip_existing=skip_existing,
                 )
 
+        if config_dict["do_dev"] and os.path.exists(output_product):
+            tile_log.info(
+                "Report manifest updated: {}".format(
+                    raster_manipulation.get_change_report_manifest_path(output_product)
+                )
+            )
+
         # I.R. ToDo: Function compute additional layers derived from set of layers in report file generated in __change_from_class_maps()
         # pyeo_1.raster_manipulation.computed_report_layer_generation(report_path = output_product)
 
-        # I.R. ToDo: Function to generate 3D time series array of classified (+NDVI?) images over full date range
-        ## and save it to disk as a layered GeoTIFF (or numpy array)
-        ## (Build into above loop that generates report...?)
-        # pyeo_1.raster_manipulation.time_series_construction(classified_image_dir = classified_image_dir, change_from = from_classes,change_to = to_classes)
+        # the class, change, dNDVI and NDVI time series built in the loop above are summarised per pixel
+        if config_dict["do_dev"] and os.path.exists(
+            os.path.join(cube_dir, change_cube.CUBE_INDEX_NAME)
+        ):
+            time_series_path = os.path.join(
+                probability_image_dir, "time_series_summary_{}.tif".format(tile)
+            )
+            change_cube.ChangeCube(cube_dir).map_chunks(
+                lambda series: change_cube.summarise_change_series(series["change"]),
+                ["change"],
+                time_series_path,
+            )
+            tile_log.info("Time series summary written: {}".format(time_series_path))
 
         # I.R. ToDo: Insert function to perform time series analysis on 3D classified (+NDVI?) time series array and generate forest alert outputs
         ## in a GeoTIFF file
@@ -1985,6 +2106,7 @@ def acd_by_tile_raster(config_path: str,
     # ------------------------------------------------------------------------
 
     if config_dict["do_update"] or config_dict["do_all"]:
+        filesystem_utilities.invalidate_catalogue()
         tile_log.warning(
             "---------------------------------------------------------------"
         )
@@ -2095,6 +2217,8 @@ def acd_by_tile_raster(config_path: str,
             latest_composite_path = new_composite_path
         """
 
+    filesystem_utilities.use_catalogue(None)
+
     tile_log.info("---------------------------------------------------------------")
     tile_log.info("---                  PROCESSING END                         ---")
     tile_log.info("---------------------------------------------------------------")
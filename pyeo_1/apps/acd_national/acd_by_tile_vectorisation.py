@@ -63,41 +63,18 @@ def vector_report_generation(config_path: str, tile: str):
     tile_log.info(f"Starting Vectorisation of the Change Report Raster of Tile: {tile}")
     tile_log.info("--" * 20)
 
-    path_vectorised_binary = vectorisation.vectorise_from_band(
+    # vectorise the non-zero pixels of band 15 (was band=6), and in the same pass calculate the zonal statistics of
+    # the ndetections (was band=2), confidence (was band=5) and first change date (was band=7) bands
+    path_vectorised_binary_filtered, zstats_dfs = vectorisation.vectorise_with_zonal_statistics(
         change_report_path=change_report_path,
         band=15,
-        log=tile_log
+        report_bands=[5, 9, 4],
+        log=tile_log,
+        n_workers=config_dict["vectorise_workers"]
     )
-    # was band=6
-
-    path_vectorised_binary_filtered = vectorisation.clean_zero_nodata_vectorised_band(
-        vectorised_band_path=path_vectorised_binary,
-        log=tile_log
-    )
-
-    rb_ndetections_zstats_df = vectorisation.zonal_statistics(
-        raster_path=change_report_path,
-        shapefile_path=path_vectorised_binary_filtered,
-        report_band=5,
-        log=tile_log
-        )
-    # was band=2
-
-    rb_confidence_zstats_df = vectorisation.zonal_statistics(
-        raster_path=change_report_path,
-        shapefile_path=path_vectorised_binary_filtered,
-        report_band=9,
-        log=tile_log
-    )
-    # was band=5
-
-    rb_first_changedate_zstats_df = vectorisation.zonal_statistics(
-        raster_path=change_report_path,
-        shapefile_path=path_vectorised_binary_filtered,
-        report_band=4,
-        log=tile_log
-    )
-    # was band=7
+    rb_ndetections_zstats_df = zstats_dfs[5]
+    rb_confidence_zstats_df = zstats_dfs[9]
+    rb_first_changedate_zstats_df = zstats_dfs[4]
 
     # table joins, area, lat lon, county
     output_vector_files = vectorisation.merge_and_calculate_spatial(
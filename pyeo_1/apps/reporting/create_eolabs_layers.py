@@ -3,7 +3,6 @@ import os
 import pyeo_1.raster_manipulation
 import csv
 from osgeo import gdal
-import numpy as np
 import argparse
 from tempfile import TemporaryDirectory
 from zipfile import ZipFile
@@ -44,37 +43,29 @@ def create_report(
             out_zip.write()
 
 
-def create_display_layer(class_path, out_path, class_color_key):
-    class_raster = gdal.Open(class_path)
-    display_raster = pyeo_1.raster_manipulation.create_matching_dataset(
-        class_raster, out_path, bands=3, datatype=gdal.GDT_Byte
-    )
-    display_array = display_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-
-    class_array = class_raster.GetVirtualMemArray()
-    for index, class_pixel in np.ndenumerate(class_array):
-        display_array[:, index[0], index[1]] = [
-            class_row[1:4]
-            for class_row in class_color_key
-            if class_row[0] == str(class_pixel)
-        ][0]
-    display_array = None
-    class_array = None
-    gdal.ReprojectImage(display_raster, dst_wkt=SRS)
-    display_raster = None
-    class_raster = None
+def create_display_layer(class_path, out_path, class_color_key, mode="rgba"):
+    with TemporaryDirectory() as td:
+        # the classes are reprojected before they are coloured, so that no colours are blended
+        mercator_path = os.path.join(td, "classes.vrt")
+        gdal.Warp(
+            mercator_path, class_path, format="VRT", dstSRS=SRS, resampleAlg="near"
+        )
+        pyeo_1.raster_manipulation.render_class_map(
+            mercator_path, out_path, class_color_key, mode=mode
+        )
 
 
 def load_color_pallet(pallet_path):
-    reader = csv.reader(pallet_path)
-    out = list(reader)
+    with open(pallet_path, newline="") as f:
+        reader = csv.reader(f)
+        out = [row for row in reader if row]
     return out
 
 
 def write_color_pallet(pallet, pallet_path):
-    with open(pallet_path, "w") as f:
+    with open(pallet_path, "w", newline="") as f:
         writer = csv.writer(f)
-        writer.write()
+        writer.writerows(pallet)
 
 
 if __name__ == "__main__":
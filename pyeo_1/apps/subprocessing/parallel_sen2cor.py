@@ -31,6 +31,12 @@ if __name__ == "__main__":
     parser.add_argument(
         "l2_dir", action="store", help="Path to directory to contain L2 imagery"
     )
+    parser.add_argument(
+        "--sen2cor_path",
+        action="store",
+        default=r"/scratch/clcr/shared/Sen2Cor-02.05.05-Linux64/bin/L2A_Process",
+        help="Path to the L2A_Process executable",
+    )
     array_id = int(os.getenv("PBS_ARRAYID"))
     sen_2_cor_home = os.getenv("SEN2COR_HOME")
     args = parser.parse_args()
@@ -43,7 +49,6 @@ if __name__ == "__main__":
         os.mkdir(new_home)
     except FileExistsError:
         log.warning("{} already exists, continuing.".format(new_home))
-    os.putenv("SEN2COR_HOME", new_home)
 
     file_list = [
         os.path.join(args.l1_dir, l1_filename)
@@ -52,7 +57,9 @@ if __name__ == "__main__":
 
     l2_name = pyeo_1.raster_manipulation.apply_sen2cor(
         file_list[array_id],
-        r"/scratch/clcr/shared/Sen2Cor-02.05.05-Linux64/bin/L2A_Process",
+        args.sen2cor_path,
+        log=log,
+        sen2cor_home=new_home,
     )
     from_path = os.path.join(args.l1_dir, os.path.basename(l2_name))
     to_path = os.path.join(args.l2_dir, os.path.basename(l2_name))
@@ -0,0 +1,492 @@
+"""
+pyeo_1.change_cube
+==================
+A chunked on-disk data cube holding the per-date change detection layers of a tile, with vectorised time-series
+operations over it.
+
+Key functions
+-------------
+
+:py:class:`ChangeCube` Stores the class, change, dNDVI and NDVI layers of every date of a tile along a time index.
+
+:py:func:`run_lengths` Finds the longest and the current run of consecutive detections of each pixel.
+
+:py:func:`first_true_index` Finds the first time step at which each pixel was detected.
+
+:py:func:`first_change_date` Finds the earliest change date of each pixel.
+
+:py:func:`repeatability` The percentage of valid observations since the first change that detected change.
+
+Layout
+------
+
+A cube is a directory holding `cube.json`, which records the grid, the chunk size, the variables and the dates, and a
+directory for each variable with one file per spatial chunk, e.g. `change/3_7.bin` for chunk row 3, chunk column 7.
+Each chunk file holds the chunk for every date in time order as raw arrays, one date after the other. So:
+
+* appending a date appends one array to the end of each chunk file
+* the layer of a single date is one contiguous read from each chunk file
+* the time series of the pixels of a chunk is one sequential read of the whole chunk file. The values of a single
+  pixel are not contiguous: they are one date-sized stride apart, so reading one pixel reads its whole chunk
+
+Dates must be appended in time order. The dates in `cube.json` are updated after the chunks have been written, so a
+cube interrupted part way through an append still opens with the dates it had before.
+
+Time series
+-----------
+
+The time-series functions take arrays of shape (time, y, x), such as those returned by :py:meth:`ChangeCube.read`,
+and return arrays of shape (y, x). :py:meth:`ChangeCube.map_chunks` applies one of them to the whole cube, chunk by
+chunk, and writes the result to a raster.
+
+The change layer follows :py:func:`pyeo_1.raster_manipulation.__change_from_class_maps`: the acquisition date in days
+since 2000-01-01 where a change was detected, -1 for cloud or missing data and 0 otherwise.
+"""
+
+import datetime
+import json
+import logging
+import os
+
+import numpy as np
+from osgeo import gdal
+from osgeo.gdal_array import NumericTypeCodeToGDALTypeCode
+
+from pyeo_1.raster_manipulation import build_overviews, get_creation_options
+
+log = logging.getLogger(__name__)
+
+CUBE_INDEX_NAME = "cube.json"
+TIMESTAMP_FORMAT = r"%Y%m%dT%H%M%S"
+
+# The layers of each date and their datatypes; dNDVI and NDVI are scaled by 100 as in the change detection
+DEFAULT_VARIABLES = {
+    "class": "uint8",
+    "change": "int32",
+    "dNDVI": "int16",
+    "NDVI": "int16",
+}
+
+
+class ChangeCube:
+    """
+    A chunked, appendable time series of the change detection layers of one tile. See the module documentation for
+    the layout on disk.
+
+    Parameters
+    ----------
+    cube_dir : str
+        The directory of an existing cube. Use :py:meth:`create` or :py:meth:`open_or_create` to make a new one.
+
+    Examples
+    --------
+    >>> cube = ChangeCube.open_or_create("36NXG/output/change_cube", "36NXG/output/classified/composite_class.tif")
+    >>> cube.append_rasters("20230105T074151", {"class": class_path, "change": change_path})
+    >>> change_series = cube.read("change", xoff=0, yoff=0, xsize=256, ysize=256)  # (time, 256, 256)
+    >>> cube.map_chunks(lambda series: first_change_date(series["change"]), ["change"], "first_change.tif")
+
+    """
+
+    def __init__(self, cube_dir):
+        self.cube_dir = cube_dir
+        with open(os.path.join(cube_dir, CUBE_INDEX_NAME), "r") as index_file:
+            index = json.load(index_file)
+        self.x_size, self.y_size = index["size"]
+        self.chunk_x, self.chunk_y = index["chunk_size"]
+        self.geotransform = index["geotransform"]
+        self.projection = index["projection"]
+        self.variables = {name: np.dtype(dtype) for name, dtype in index["variables"].items()}
+        self.dates = index["dates"]
+
+    @classmethod
+    def create(cls, cube_dir, template_path, variables=None, chunk_size=256):
+        """
+        Creates an empty cube on the grid of a raster.
+
+        Parameters
+        ----------
+        cube_dir : str
+            The directory to create the cube in
+        template_path : str
+            A raster with the size, geotransform and projection of the layers to store
+        variables : dict, optional
+            The datatype of each layer, by name. Defaults to DEFAULT_VARIABLES.
+        chunk_size : int or tuple of int, optional
+            The x and y size of the spatial chunks. Defaults to 256.
+
+        Returns
+        -------
+        The new ChangeCube
+
+        """
+        if variables is None:
+            variables = DEFAULT_VARIABLES
+        if isinstance(chunk_size, int):
+            chunk_size = (chunk_size, chunk_size)
+        template = gdal.Open(template_path)
+        os.makedirs(cube_dir, exist_ok=True)
+        for name in variables:
+            os.makedirs(os.path.join(cube_dir, name), exist_ok=True)
+        index = {
+            "size": [template.RasterXSize, template.RasterYSize],
+            "chunk_size": [min(chunk_size[0], template.RasterXSize), min(chunk_size[1], template.RasterYSize)],
+            "geotransform": list(template.GetGeoTransform()),
+            "projection": template.GetProjection(),
+            "variables": {name: np.dtype(dtype).name for name, dtype in variables.items()},
+            "dates": [],
+        }
+        template = None
+        _write_index(cube_dir, index)
+        log.info("Created change cube at {}".format(cube_dir))
+        return cls(cube_dir)
+
+    @classmethod
+    def open_or_create(cls, cube_dir, template_path, variables=None, chunk_size=256):
+        """Opens the cube in cube_dir, creating it on the grid of template_path if it does not exist yet"""
+        if os.path.exists(os.path.join(cube_dir, CUBE_INDEX_NAME)):
+            return cls(cube_dir)
+        return cls.create(cube_dir, template_path, variables, chunk_size)
+
+    @property
+    def times(self):
+        """The dates of the cube as datetimes"""
+        return [datetime.datetime.strptime(date, TIMESTAMP_FORMAT) for date in self.dates]
+
+    def chunk_windows(self):
+        """
+        Returns the (xoff, yoff, xsize, ysize) window of every spatial chunk, suitable for :py:meth:`read` or for
+        ReadAsArray and WriteArray on a raster of the same grid.
+        """
+        return [
+            (xoff, yoff, min(self.chunk_x, self.x_size - xoff), min(self.chunk_y, self.y_size - yoff))
+            for yoff in range(0, self.y_size, self.chunk_y)
+            for xoff in range(0, self.x_size, self.chunk_x)
+        ]
+
+    def _chunk_path(self, name, xoff, yoff):
+        return os.path.join(
+            self.cube_dir, name, "{}_{}.bin".format(yoff // self.chunk_y, xoff // self.chunk_x)
+        )
+
+    def _read_chunk(self, name, window, time_index=slice(None)):
+        xoff, yoff, xsize, ysize = window
+        n_dates = len(self.dates)
+        if n_dates == 0:
+            return np.zeros((0, ysize, xsize), dtype=self.variables[name])
+        chunk = np.memmap(
+            self._chunk_path(name, xoff, yoff),
+            dtype=self.variables[name],
+            mode="r",
+            shape=(n_dates, ysize, xsize),
+        )
+        return np.array(chunk[time_index])
+
+    def _append_chunk(self, name, window, array):
+        xoff, yoff, xsize, ysize = window
+        chunk_path = self._chunk_path(name, xoff, yoff)
+        frame_bytes = xsize * ysize * self.variables[name].itemsize
+        with open(chunk_path, "ab") as chunk_file:
+            # drop anything left over from an append that was interrupted before the index was updated
+            chunk_file.truncate(len(self.dates) * frame_bytes)
+            chunk_file.write(np.ascontiguousarray(array, dtype=self.variables[name]).tobytes())
+
+    def append(self, date, arrays):
+        """
+        Appends the layers of a new date to the cube.
+
+        Parameters
+        ----------
+        date : str or datetime.datetime
+            The acquisition time of the layers, as a datetime or a yyyymmddTHHMMSS timestamp. Must be later than every
+            date in the cube.
+        arrays : dict
+            The full-size (y, x) array of each layer, by variable name. Variables that are left out are stored as 0.
+
+        Returns
+        -------
+        bool
+            True if the date was appended, False if it was already in the cube
+
+        """
+        return self._append(date, lambda name, window: _window_of(arrays.get(name), window))
+
+    def append_rasters(self, date, raster_paths, mem_limit_mb=1024):
+        """
+        Appends the layers of a new date to the cube from single-band rasters on the grid of the cube, reading them one
+        row of chunks at a time.
+
+        Parameters
+        ----------
+        date : str or datetime.datetime
+            The acquisition time of the layers. See :py:meth:`append`.
+        raster_paths : dict
+            The path to the raster of each layer, by variable name. Variables that are left out are stored as 0.
+        mem_limit_mb : int, optional
+            Ignored unless a row of chunks would exceed it, in which case rows are read chunk by chunk. Defaults to 1024.
+
+        Returns
+        -------
+        bool
+            True if the date was appended, False if it was already in the cube
+
+        """
+        rasters = {}
+        for name, path in raster_paths.items():
+            raster = gdal.Open(path)
+            if (raster.RasterXSize, raster.RasterYSize) != (self.x_size, self.y_size):
+                raise ValueError(
+                    "{} does not match the {} x {} grid of the change cube".format(path, self.x_size, self.y_size)
+                )
+            rasters[name] = raster
+        row_bytes = self.x_size * self.chunk_y * 8 * max(len(rasters), 1)
+        read_by_row = row_bytes <= mem_limit_mb * 1024 * 1024
+        strips = {}
+
+        def read(name, window):
+            if name not in rasters:
+                return None
+            xoff, yoff, xsize, ysize = window
+            if not read_by_row:
+                return rasters[name].GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+            if strips.get(name, (None,))[0] != yoff:
+                strips[name] = (yoff, rasters[name].GetRasterBand(1).ReadAsArray(0, yoff, self.x_size, ysize))
+            return strips[name][1][:, xoff : xoff + xsize]
+
+        appended = self._append(date, read)
+        rasters = None
+        return appended
+
+    def _append(self, date, read_window):
+        if isinstance(date, datetime.datetime):
+            date = date.strftime(TIMESTAMP_FORMAT)
+        if date in self.dates:
+            log.info("{} is already in the change cube {}".format(date, self.cube_dir))
+            return False
+        new_time = datetime.datetime.strptime(date, TIMESTAMP_FORMAT)
+        if self.dates and new_time <= self.times[-1]:
+            raise ValueError(
+                "Cannot append {} to the change cube {}: its latest date is {}".format(
+                    date, self.cube_dir, self.dates[-1]
+                )
+            )
+        for window in self.chunk_windows():
+            xoff, yoff, xsize, ysize = window
+            for name in self.variables:
+                array = read_window(name, window)
+                if array is None:
+                    array = np.zeros((ysize, xsize), dtype=self.variables[name])
+                self._append_chunk(name, window, array)
+        self.dates.append(date)
+        with open(os.path.join(self.cube_dir, CUBE_INDEX_NAME), "r") as index_file:
+            index = json.load(index_file)
+        index["dates"] = self.dates
+        _write_index(self.cube_dir, index)
+        log.info("Appended {} to the change cube {}".format(date, self.cube_dir))
+        return True
+
+    def read(self, name, xoff=0, yoff=0, xsize=None, ysize=None, time_index=slice(None)):
+        """
+        Reads the time series of a layer over a window.
+
+        Parameters
+        ----------
+        name : str
+            The variable to read, e.g. 'change'
+        xoff, yoff : int, optional
+            The top-left pixel of the window. Defaults to 0.
+        xsize, ysize : int, optional
+            The size of the window. Defaults to the rest of the cube.
+        time_index : slice, int or array_like, optional
+            The time steps to read. Defaults to all of them.
+
+        Returns
+        -------
+        array_like
+            An array of shape (time, ysize, xsize), or (ysize, xsize) if time_index is an int
+
+        """
+        if xsize is None:
+            xsize = self.x_size - xoff
+        if ysize is None:
+            ysize = self.y_size - yoff
+        n_times = len(np.arange(len(self.dates))[time_index].reshape(-1))
+        out = np.empty((n_times, ysize, xsize), dtype=self.variables[name])
+        for window in self.chunk_windows():
+            cxoff, cyoff, cxsize, cysize = window
+            x0, x1 = max(xoff, cxoff), min(xoff + xsize, cxoff + cxsize)
+            y0, y1 = max(yoff, cyoff), min(yoff + ysize, cyoff + cysize)
+            if x1 <= x0 or y1 <= y0:
+                continue
+            chunk = self._read_chunk(name, window, time_index).reshape((n_times, cysize, cxsize))
+            out[:, y0 - yoff : y1 - yoff, x0 - xoff : x1 - xoff] = chunk[:, y0 - cyoff : y1 - cyoff, x0 - cxoff : x1 - cxoff]
+        if isinstance(time_index, (int, np.integer)):
+            return out[0]
+        return out
+
+    def pixel_series(self, name, x, y):
+        """
+        Returns the time series of a layer at pixel (x, y) as a 1D array. Reads the whole chunk holding the pixel, as
+        the dates of a pixel are not stored next to each other; read windows to get the series of many pixels.
+        """
+        return self.read(name, x, y, 1, 1)[:, 0, 0]
+
+    def map_chunks(self, func, names, out_path, datatype=None, nodata=None):
+        """
+        Applies a time-series function to the whole cube chunk by chunk and writes the result to a raster on the grid
+        of the cube.
+
+        Parameters
+        ----------
+        func : callable
+            Called with a dict of the (time, y, x) series of each variable in names for one chunk; returns an array of
+            shape (y, x), or (bands, y, x) for a multi-band output.
+        names : list of str
+            The variables that func needs
+        out_path : str
+            The path of the output GeoTIFF
+        datatype : int, optional
+            The gdal datatype of the output. Defaults to the datatype returned by func for the first chunk.
+        nodata : number, optional
+            If present, set as the no-data value of every band
+
+        Returns
+        -------
+        out_path : str
+            The path of the output raster
+
+        """
+        out_raster = None
+        for window in self.chunk_windows():
+            xoff, yoff, xsize, ysize = window
+            result = np.asarray(func({name: self._read_chunk(name, window) for name in names}))
+            if result.ndim == 2:
+                result = result[np.newaxis, ...]
+            if out_raster is None:
+                if datatype is None:
+                    datatype = NumericTypeCodeToGDALTypeCode(result.dtype)
+                out_raster = gdal.GetDriverByName("GTiff").Create(
+                    out_path,
+                    self.x_size,
+                    self.y_size,
+                    result.shape[0],
+                    datatype,
+                    options=get_creation_options(datatype),
+                )
+                out_raster.SetGeoTransform(self.geotransform)
+                out_raster.SetProjection(self.projection)
+                if nodata is not None:
+                    for band_index in range(result.shape[0]):
+                        out_raster.GetRasterBand(band_index + 1).SetNoDataValue(nodata)
+            for band_index, band in enumerate(result):
+                out_raster.GetRasterBand(band_index + 1).WriteArray(band, xoff, yoff)
+        if out_raster is not None:
+            build_overviews(out_raster)
+        out_raster = None
+        return out_path
+
+
+def _write_index(cube_dir, index):
+    # write then rename, so an interruption never leaves a half-written index
+    index_path = os.path.join(cube_dir, CUBE_INDEX_NAME)
+    with open(index_path + ".tmp", "w") as index_file:
+        json.dump(index, index_file, indent=2)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def _window_of(array, window):
+    if array is None:
+        return None
+    xoff, yoff, xsize, ysize = window
+    return array[yoff : yoff + ysize, xoff : xoff + xsize]
+
+
+def run_lengths(mask, ignore=None):
+    """
+    Finds the runs of consecutive True values along the time axis of each pixel.
+
+    Parameters
+    ----------
+    mask : array_like
+        Boolean array of shape (time, y, x), e.g. `change_series > 0`
+    ignore : array_like, optional
+        Boolean array of the same shape marking time steps that neither extend nor break a run, e.g. cloud
+        (`change_series == -1`)
+
+    Returns
+    -------
+    longest : array_like
+        The length of the longest run of each pixel, of shape (y, x)
+    current : array_like
+        The length of the run still going at the last time step, of shape (y, x)
+
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape[0] == 0:
+        empty = np.zeros(mask.shape[1:], dtype=np.int32)
+        return empty, empty.copy()
+    breaks = ~mask if ignore is None else ~mask & ~np.asarray(ignore, dtype=bool)
+    counts = np.cumsum(mask, axis=0, dtype=np.int32)
+    # the count at the most recent break; runs are the counts since then
+    counts_at_break = np.maximum.accumulate(np.where(breaks, counts, 0), axis=0)
+    runs = counts - counts_at_break
+    return runs.max(axis=0), runs[-1]
+
+
+def first_true_index(mask):
+    """
+    Returns the first time step at which each pixel of a (time, y, x) boolean array is True, or -1 where it never is.
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.shape[0] == 0:
+        return np.full(mask.shape[1:], -1, dtype=np.int32)
+    return np.where(mask.any(axis=0), mask.argmax(axis=0), -1).astype(np.int32)
+
+
+def first_change_date(change_series):
+    """
+    Returns the earliest change date of each pixel of a (time, y, x) change series, in days since 2000-01-01, or 0
+    where no change was detected.
+    """
+    change_series = np.asarray(change_series)
+    if change_series.shape[0] == 0:
+        return np.zeros(change_series.shape[1:], dtype=np.int32)
+    dates = np.where(change_series > 0, change_series, np.iinfo(np.int32).max).min(axis=0)
+    return np.where(dates == np.iinfo(np.int32).max, 0, dates).astype(np.int32)
+
+
+def repeatability(change_series):
+    """
+    Returns the percentage of valid observations, from the first change on, that detected change again, for each pixel
+    of a (time, y, x) change series; 0 where no change was detected. Cloud and missing data (-1) are not counted.
+    """
+    change_series = np.asarray(change_series)
+    detected = change_series > 0
+    since_first_change = np.cumsum(detected, axis=0) > 0
+    valid = np.count_nonzero(since_first_change & (change_series >= 0), axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percentage = np.where(valid > 0, 100 * np.count_nonzero(detected, axis=0) / valid, 0)
+    return percentage.astype(np.int16)
+
+
+def summarise_change_series(change_series):
+    """
+    Summarises a (time, y, x) change series into the five bands of a time-series summary, of shape (5, y, x):
+
+    0. First change date, in days since 2000-01-01
+    1. Number of change detections
+    2. Longest run of consecutive change detections, not counting cloud
+    3. Current run of consecutive change detections, not counting cloud
+    4. Change detection repeatability in percent of valid observations since the first change
+
+    """
+    change_series = np.asarray(change_series)
+    longest, current = run_lengths(change_series > 0, ignore=change_series == -1)
+    return np.stack(
+        [
+            first_change_date(change_series),
+            np.count_nonzero(change_series > 0, axis=0),
+            longest,
+            current,
+            repeatability(change_series),
+        ]
+    ).astype(np.int32)
@@ -6,31 +6,36 @@ Needs: S2 L1 RGB and Cirrus mask
 """
 
 
-from osgeo import gdal
+from osgeo import gdal, gdal_array
 import numpy as np
 from pyeo_1 import raster_manipulation as ras
 
 
-def cirrus_correction(stacked_raster_path, out_path):
+def cirrus_correction(stacked_raster_path, out_path, mem_limit_mb=1024):
     stacked_raster = gdal.Open(stacked_raster_path)
-    ras_array = stacked_raster.GetVirtualMemArray()
-    r_band = ras_array[0]
-    g_band = ras_array[1]
-    b_band = ras_array[2]
-    cirrus_band = ras_array[3]
     out_raster = ras.create_matching_dataset(stacked_raster, out_path, bands=3)
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-
-    for ii, band in enumerate([r_band, g_band, b_band]):
-        out_array[ii, ...] = band - (
-            (cirrus_band - 100) * 12 / (np.log(cirrus_band - 100) + 1)
-        )
-
-    out_array = None
-    b_band = None
-    g_band = None
-    b_band = None
-    cirrus_band = None
-    out_array = None
+    out_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(
+        out_raster.GetRasterBand(1).DataType
+    )
+    # the r, g, b and cirrus bands and the correction, as float64
+    windows = ras.get_block_windows(
+        stacked_raster,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=5 * 8,
+    )
+    for xoff, yoff, xsize, ysize in windows:
+        r_band, g_band, b_band, cirrus_band = [
+            stacked_raster.GetRasterBand(band_index + 1)
+            .ReadAsArray(xoff, yoff, xsize, ysize)
+            .astype(np.float64)
+            for band_index in range(4)
+        ]
+        correction = (cirrus_band - 100) * 12 / (np.log(cirrus_band - 100) + 1)
+        for ii, band in enumerate([r_band, g_band, b_band]):
+            out_raster.GetRasterBand(ii + 1).WriteArray(
+                (band - correction).astype(out_dtype), xoff, yoff
+            )
+
+    ras.build_overviews(out_raster)
     out_raster = None
     stacked_raster = None
@@ -25,6 +25,7 @@ Function reference
 """
 import csv
 import glob
+import hashlib
 import logging
 import os
 from tempfile import TemporaryDirectory
@@ -39,6 +40,8 @@ import matplotlib
 import matplotlib.pyplot as plt
 import numpy as np
 import random
+from multiprocessing import Pool
+from multiprocessing.dummy import Pool as ThreadPool
 from scipy import sparse as sp
 import shutil
 from sklearn import ensemble as ens
@@ -55,13 +58,20 @@ from sklearn import metrics
 import sys
 
 from pyeo_1.coordinate_manipulation import get_local_top_left
-from pyeo_1.filesystem_utilities import get_mask_path
+from pyeo_1.filesystem_utilities import (
+    get_mask_path,
+    is_output_up_to_date,
+    record_output,
+)
 from pyeo_1.raster_manipulation import (
     stack_images,
     create_matching_dataset,
     apply_array_image_mask,
     get_masked_array,
+    get_block_windows,
+    get_creation_options,
 )
+from pyeo_1.exceptions import ClassificationException
 import pyeo_1.windows_compatability
 
 gdal.UseExceptions()
@@ -149,9 +159,11 @@ def classify_image(
     prob_out_path=None,
     apply_mask=False,
     out_format="GTiff",
-    chunks=4,
+    chunks=None,
     nodata=0,
     skip_existing=False,
+    mem_limit_mb=1024,
+    model=None,
 ):
     """
 
@@ -182,14 +194,26 @@ def classify_image(
         The raster format of the class image. Defaults to "GTiff" (geotif). See gdal docs for valid types.
 
     chunks : int, optional
-        The number of chunks the image is broken into prior to classification. The smaller this number, the faster
-        classification will run - but the more likely you are to get a outofmemory error. Default 10.
+        Deprecated and ignored; the image is now processed in block windows sized by mem_limit_mb. Kept so that
+        existing calls do not break. Default None.
 
     nodata : int, optional
         The value to write to masked pixels. Defaults to 0.
 
     skip_existing : bool, optional
-        If true, do not run if class_out_path already exists. Defaults to False.
+        If true, do not run if class_out_path already exists. Defaults to False. If a processing manifest is in use
+        (see :py:func:`pyeo_1.filesystem_utilities.use_processing_manifest`), class images it has a record of are
+        instead skipped only if neither the image, the model nor the parameters have changed.
+
+    mem_limit_mb : int, optional
+        The approximate ceiling, in MB, on the working memory used for each block window of the image. The image is
+        read, classified and written one block-aligned window at a time (see
+        :py:func:`pyeo_1.raster_manipulation.get_block_windows`), so peak memory use does not grow with the size of
+        the image. Defaults to 1024.
+
+    model : object, optional
+        An already loaded model to classify with instead of loading the one at model_path. Used by the worker
+        processes of :py:func:`classify_directory` so that each loads the model only once. Default None.
 
     Notes
     -----
@@ -202,7 +226,13 @@ def classify_image(
 
     """
 
-    if skip_existing:
+    classify_inputs = [image_path, model_path]
+    if apply_mask:
+        classify_inputs.append(get_mask_path(image_path))
+    classify_parameters = {"apply_mask": apply_mask, "nodata": nodata, "prob_out_path": prob_out_path}
+    if is_output_up_to_date(
+        class_out_path, "classify", classify_inputs, classify_parameters, skip_existing=skip_existing
+    ):
         log.info("Checking for existing classification {}".format(class_out_path))
         if os.path.isfile(class_out_path):
             try:
@@ -226,24 +256,29 @@ def classify_image(
     try:
         image = gdal.Open(image_path)
     except RuntimeError as e:
-        log.info("Exception: {}".format(e))
-        exit(1)
-    if chunks == None:
-        log.info("No chunk size given, attempting autochunk.")
-        chunks = autochunk(image)
-        log.info("Autochunk to {} chunks".format(chunks))
-    try:
-        # I.R.
-        # model = sklearn_joblib.load(model_path)
-        model = joblib.load(model_path)
-    except KeyError as e:
-        # log.warning("Sklearn joblib import failed,trying generic joblib")
-        log.warning("KeyError: joblib import failed: {}".format(e))
-        # model = joblib.load(model_path)
-    except TypeError as e:
-        log.warning("TypeError: joblib import failed: {}".format(e))
-        # log.warning("Sklearn joblib import failed,trying generic joblib: {}".format(e))
-        # model = joblib.load(model_path)
+        log.error("Could not open {}: {}".format(image_path, e))
+        raise
+    if image is None:
+        raise FileNotFoundError("Could not open {}".format(image_path))
+    if chunks is not None:
+        log.info(
+            "chunks={} is no longer used; classifying in block windows of up to {} MB instead.".format(
+                chunks, mem_limit_mb
+            )
+        )
+    if model is None:
+        try:
+            # I.R.
+            # model = sklearn_joblib.load(model_path)
+            model = joblib.load(model_path)
+        except KeyError as e:
+            # log.warning("Sklearn joblib import failed,trying generic joblib")
+            log.warning("KeyError: joblib import failed: {}".format(e))
+            # model = joblib.load(model_path)
+        except TypeError as e:
+            log.warning("TypeError: joblib import failed: {}".format(e))
+            # log.warning("Sklearn joblib import failed,trying generic joblib: {}".format(e))
+            # model = joblib.load(model_path)
     with TemporaryDirectory(dir=os.getcwd()) as td:
         class_out_temp = os.path.join(td, os.path.basename(class_out_path))
         class_out_image = create_matching_dataset(
@@ -263,106 +298,83 @@ def classify_image(
                 image, prob_out_temp, bands=model.n_classes_, datatype=gdal.GDT_Float32
             )
         model.n_cores = -1
-        image_array = image.GetVirtualMemArray()
+        mask = None
         if apply_mask:
             mask_path = get_mask_path(image_path)
             # log.info("Applying mask at {}".format(mask_path))
             mask = gdal.Open(mask_path)
-            mask_array = mask.GetVirtualMemArray()
-            image_array = apply_array_image_mask(image_array, mask_array)
-            mask_array = None
-            mask = None
-        # Mask out missing values from the classification
-        # at this point, image_array has dimensions [band, y, x]
-        image_array = reshape_raster_for_ml(image_array)
-        # Now it has dimensions [x * y, band] as needed for Scikit-Learn
-
-        # Determine where in the image array there are no missing values in any of the bands (axis 1)
-        # log.info("Finding good pixels without missing values")
-        # log.info("image_array.shape = {}".format(image_array.shape))
-        n_samples = image_array.shape[0]  # gives x * y dimension of the whole image
-        nbands = image_array.shape[1]  # gives number of bands
-        boo = np.where(image_array[:, 0] != nodata, True, False)
-        if nbands > 1:
-            for band in range(1, nbands, 1):
-                boo1 = np.where(image_array[:, band] != nodata, True, False)
-                boo = np.logical_and(boo, boo1)
-        good_indices = np.where(boo)[0]  # get indices where all bands contain data
-        good_sample_count = np.count_nonzero(boo)
-        log.info(
-            "Proportion of non-missing values: {:3.2f}%".format(
-                good_sample_count / n_samples * 100
-            )
-        )
-        good_samples = np.take(image_array, good_indices, axis=0).squeeze()
-        n_good_samples = len(good_samples)
-        classes = np.full(n_good_samples, nodata, dtype=np.ubyte)
+        # Estimate the working memory needed per pixel: the input bands, a float copy of them made by the model,
+        # the class output and, if requested, the class probabilities.
+        nbands = image.RasterCount
+        itemsize = gdal.GetDataTypeSize(image.GetRasterBand(1).DataType) // 8
+        bytes_per_pixel = nbands * (itemsize + 8) + 1
         if prob_out_path:
-            probs = np.full(
-                (n_good_samples, model.n_classes_), nodata, dtype=np.float32
-            )
-        chunk_size = int(n_good_samples / chunks)
-        chunk_resid = n_good_samples - (chunk_size * chunks)
+            bytes_per_pixel = bytes_per_pixel + model.n_classes_ * 12
+        windows = get_block_windows(
+            image,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=bytes_per_pixel,
+        )
         log.info(
-            "   Number of chunks {} Chunk size {} Chunk residual {}".format(
-                chunks, chunk_size, chunk_resid
+            "   Classifying {} block windows within a memory limit of {} MB".format(
+                len(windows), mem_limit_mb
             )
         )
-        # The chunks iterate over all values in the array [x * y, bands] always with all bands per chunk
-        for chunk_id in range(chunks):
-            offset = chunk_id * chunk_size
-            if chunk_id == chunks - 1:
-                chunk_size = chunk_size + chunk_resid
-            log.info(
-                "   Classifying chunk {} of size {}".format(chunk_id + 1, chunk_size)
+        class_band = class_out_image.GetRasterBand(1)
+        n_samples = image.RasterXSize * image.RasterYSize
+        good_sample_count = 0
+        for xoff, yoff, xsize, ysize in windows:
+            image_array = image.ReadAsArray(xoff, yoff, xsize, ysize)
+            if image_array.ndim == 2:
+                image_array = np.expand_dims(image_array, axis=0)
+            if mask is not None:
+                mask_array = mask.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+                image_array = apply_array_image_mask(image_array, mask_array)
+            # at this point, image_array has dimensions [band, y, x]
+            image_array = reshape_raster_for_ml(image_array)
+            # Now it has dimensions [x * y, band] as needed for Scikit-Learn
+            # Determine where in the window there are no missing values in any of the bands (axis 1)
+            good_mask = np.all(image_array != nodata, axis=1)
+            n_good = np.count_nonzero(good_mask)
+            good_sample_count = good_sample_count + n_good
+            classes = np.full(xsize * ysize, nodata, dtype=np.ubyte)
+            if n_good > 0:
+                # fancy indexing returns a writeable copy, avoiding the Pandas read-only buffer bug:
+                # https://stackoverflow.com/questions/53985535/pandas-valueerror-buffer-source-array-is-read-only
+                good_samples = image_array[good_mask]
+                classes[good_mask] = model.predict(good_samples)
+            class_band.WriteArray(
+                reshape_ml_out_to_raster(classes, xsize, ysize), xoff, yoff
             )
-            chunk_view = good_samples[offset : offset + chunk_size]
-            indices_view = good_indices[offset : offset + chunk_size]
-            out_view = classes[offset : offset + chunk_size]
-            chunk_view = (
-                chunk_view.copy()
-            )  # bug fix for Pandas bug: https://stackoverflow.com/questions/53985535/pandas-valueerror-buffer-source-array-is-read-only
-            indices_view = (
-                indices_view.copy()
-            )  # bug fix for Pandas bug: https://stackoverflow.com/questions/53985535/pandas-valueerror-buffer-source-array-is-read-only
-            out_view[:] = model.predict(chunk_view)
             if prob_out_path:
-                log.info("   Calculating probabilities")
-                prob_view = probs[offset : offset + chunk_size, :]
-                prob_view[:, :] = model.predict_proba(chunk_view)
-        class_out_array = np.full((n_samples), nodata)
-        for i, class_val in zip(good_indices, classes):
-            class_out_array[i] = class_val
-        class_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[
-            :, :
-        ] = reshape_ml_out_to_raster(
-            class_out_array, image.RasterXSize, image.RasterYSize
+                probs = np.full(
+                    (xsize * ysize, model.n_classes_), nodata, dtype=np.float32
+                )
+                if n_good > 0:
+                    probs[good_mask, :] = model.predict_proba(good_samples)
+                probs = reshape_prob_out_to_raster(probs, xsize, ysize)
+                for band_index in range(model.n_classes_):
+                    prob_out_image.GetRasterBand(band_index + 1).WriteArray(
+                        probs[band_index], xoff, yoff
+                    )
+        log.info(
+            "Proportion of non-missing values: {:3.2f}%".format(
+                good_sample_count / n_samples * 100
+            )
         )
+        mask = None
         if prob_out_path:
-            # log.info("   Creating probability array of size {}".format(n_samples * model.n_classes_))
-            prob_out_array = np.full((n_samples, model.n_classes_), nodata)
-            for i, prob_val in zip(good_indices, probs):
-                prob_out_array[i] = prob_val
-            # log.info("   Creating GDAL probability image")
-            # log.info("   N Classes = {}".format(prob_out_array.shape[1]))
-            # log.info("   Image X size = {}".format(image.RasterXSize))
-            # log.info("   Image Y size = {}".format(image.RasterYSize))
-            prob_out_image.GetVirtualMemArray(eAccess=gdal.GF_Write)[
-                :, :, :
-            ] = reshape_prob_out_to_raster(
-                prob_out_array, image.RasterXSize, image.RasterYSize
-            )
             prob_out_image = None
-            prob_out_array = None
             shutil.move(prob_out_temp, prob_out_path)
+        class_band = None
         class_out_image = None
-        class_out_array = None
         shutil.move(class_out_temp, class_out_path)
     # verify that the output file(s) have been created
     if not os.path.exists(class_out_path):
         log.error("Classification output file not found: {}".format(class_out_path))
     else:
         log.info("Created classification image file: {}".format(class_out_path))
+        record_output(class_out_path, "classify", classify_inputs, classify_parameters)
     if prob_out_path:
         if not os.path.exists(prob_out_path):
             log.error("Probability output file not found: {}".format(prob_out_path))
@@ -612,8 +624,10 @@ def classify_directory(
     prob_out_dir=None,
     apply_mask=False,
     out_type="GTiff",
-    chunks=4,
+    chunks=None,
     skip_existing=False,
+    mem_limit_mb=1024,
+    n_workers=1,
 ):
     """
     Classifies every file ending in .tif in in_dir using model at model_path. Outputs are saved
@@ -637,9 +651,20 @@ def classify_directory(
     out_type : str, optional
         The raster format of the class image. Defaults to "GTiff" (geotif). See gdal docs for valid datatypes.
     chunks : int, optional
-        The number of chunks to break each image into for processing. See :py:func:`classify_image`
+        Deprecated and ignored. See :py:func:`classify_image`
     skip_existing : boolean, optional
         If True, skips the classification if the output file already exists.
+    mem_limit_mb : int, optional
+        The memory ceiling in MB for each block window of an image. See :py:func:`classify_image`
+    n_workers : int, optional
+        The number of worker processes to classify images with. If greater than 1, the model is saved once as an
+        uncompressed joblib file that every worker memory-maps, and the images are handed out to the workers from a
+        shared queue. Each worker uses up to mem_limit_mb of memory. If None, uses all CPU cores. Defaults to 1.
+
+    Raises
+    ------
+    ClassificationException
+        If any image could not be classified by a worker process. The other images are still classified first.
     """
 
     log = logging.getLogger(__name__)
@@ -649,6 +674,7 @@ def classify_directory(
         log.info("Prob. files saved in {}".format(prob_out_dir))
     if skip_existing:
         log.info("Skipping existing files.")
+    jobs = []
     for image_path in glob.glob(in_dir + r"/*.tif"):
         image_name = os.path.basename(image_path)[:-4]
         class_out_path = os.path.join(class_out_dir, image_name + "_class.tif")
@@ -656,18 +682,86 @@ def classify_directory(
             prob_out_path = os.path.join(prob_out_dir, image_name + "_prob.tif")
         else:
             prob_out_path = None
-        classify_image(
-            image_path=image_path,
-            model_path=model_path,
-            class_out_path=class_out_path,
-            prob_out_path=prob_out_path,
-            apply_mask=apply_mask,
-            out_format=out_type,
-            chunks=chunks,
-            skip_existing=skip_existing,
+        jobs.append(
+            dict(
+                image_path=image_path,
+                model_path=model_path,
+                class_out_path=class_out_path,
+                prob_out_path=prob_out_path,
+                apply_mask=apply_mask,
+                out_format=out_type,
+                chunks=chunks,
+                skip_existing=skip_existing,
+                mem_limit_mb=mem_limit_mb,
+            )
+        )
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, len(jobs))
+    if n_workers <= 1:
+        for job in jobs:
+            classify_image(**job)
+        return
+    log.info("Classifying {} images with {} worker processes".format(len(jobs), n_workers))
+    with TemporaryDirectory(dir=os.getcwd()) as td:
+        # A compressed or pickled-by-reference model cannot be memory-mapped, so save an uncompressed copy
+        # that all workers share through the page cache.
+        shared_model_path = os.path.join(td, "shared_model.joblib")
+        joblib.dump(joblib.load(model_path), shared_model_path)
+        with Pool(
+            processes=n_workers,
+            initializer=_init_classification_worker,
+            initargs=(shared_model_path,),
+        ) as pool:
+            failures = []
+            for image_path, error in pool.imap_unordered(
+                _classify_image_in_worker, jobs
+            ):
+                if error is None:
+                    log.info("Worker finished classifying {}".format(image_path))
+                else:
+                    log.error(
+                        "Classification of {} failed in worker: {}".format(
+                            image_path, error
+                        )
+                    )
+                    failures.append(image_path)
+    if failures:
+        raise ClassificationException(
+            "Classification failed for {} of {} images: {}".format(
+                len(failures), len(jobs), ", ".join(sorted(failures))
+            )
         )
 
 
+_worker_model = None
+
+
+def _init_classification_worker(shared_model_path):
+    """
+    :meta private:
+    Pool initializer for :py:func:`classify_directory`. Memory-maps the shared model once per worker process.
+    """
+    global _worker_model
+    _worker_model = joblib.load(shared_model_path, mmap_mode="r")
+    # one process per core already, so stop the model spawning threads of its own
+    if hasattr(_worker_model, "n_jobs"):
+        _worker_model.n_jobs = 1
+
+
+def _classify_image_in_worker(job):
+    """
+    :meta private:
+    Classifies one image from the :py:func:`classify_directory` work queue with the worker's model.
+    Returns the image path and the error message, if any.
+    """
+    try:
+        classify_image(model=_worker_model, **job)
+    except Exception as e:
+        return job["image_path"], "{}".format(e)
+    return job["image_path"], None
+
+
 def reshape_raster_for_ml(image_array):
     """
     A low-level function that reshapes an array from gdal order `[band, y, x]` to scikit features order `[x*y, band]`
@@ -1193,7 +1287,14 @@ def raster_reclass_binary(img_path, rcl_value, outFn, outFmt="GTiff", write_out=
 
     if write_out:
         driver = gdal.GetDriverByName(str(outFmt))
-        out_ds = driver.Create(outFn, in_band.XSize, in_band.YSize, 1, in_band.DataType)
+        out_ds = driver.Create(
+            outFn,
+            in_band.XSize,
+            in_band.YSize,
+            1,
+            in_band.DataType,
+            options=get_creation_options(in_band.DataType, format=outFmt),
+        )
         out_ds.SetProjection(in_ds.GetProjection())
         out_ds.SetGeoTransform(in_ds.GetGeoTransform())
         # Todo: Check for existing files. Skip if exists or make overwrite optional.
@@ -1277,7 +1378,12 @@ def shapefile_to_raster(
         pixel_width = image_gt[1]
         # log.info("Shapefile coords during rasterisation: {},{},{},{}".format(x_min,x_max,y_min,y_max))
         target_ds = gdal.GetDriverByName("GTiff").Create(
-            out_path, x_res, y_res, 1, gdal.GDT_Int16
+            out_path,
+            x_res,
+            y_res,
+            1,
+            gdal.GDT_Int16,
+            options=get_creation_options(gdal.GDT_Int16),
         )
         target_ds.SetGeoTransform((x_min, pixel_width, 0, y_max, 0, -pixel_width))
         band = target_ds.GetRasterBand(1)
@@ -1301,6 +1407,287 @@ def shapefile_to_raster(
     return outraster_filename
 
 
+def _find_training_shapefile(raster_path):
+    """
+    :meta private:
+    Returns the path to the shapefile of the same name as a training raster, or None if there is none.
+    """
+    training_image_folder, training_image_name = os.path.split(raster_path)
+    shape_path_name = training_image_name[:-4] + ".shp"  # Strip the file extension
+    # find the full path to the shapefile, this can be in a subdirectory
+    shape_paths = [
+        f.path
+        for f in os.scandir(training_image_folder)
+        if f.is_file() and os.path.basename(f) == shape_path_name
+    ]
+    if len(shape_paths) == 0:
+        log.warning("{} not found. Skipping.".format(shape_path_name))
+        return None
+    if len(shape_paths) > 1:
+        log.warning(
+            "Several versions of {} exist. Using the first of these files.".format(
+                shape_path_name
+            )
+        )
+        for f in shape_paths:
+            log.info("  {}".format(f))
+    return shape_paths[0]
+
+
+def _training_pair_key(raster_path, shapefile_path, attribute):
+    """
+    :meta private:
+    Returns a hash identifying the training pixels of a tif/shp pair: the size and modification time of the raster,
+    and the contents of the shapefile's .shp, .shx, .dbf and .prj files.
+    """
+    key = hashlib.sha1()
+    raster_stat = os.stat(raster_path)
+    key.update(
+        "{}|{}|{}|{}".format(
+            os.path.abspath(raster_path),
+            raster_stat.st_size,
+            raster_stat.st_mtime_ns,
+            attribute,
+        ).encode()
+    )
+    for extension in (".shp", ".shx", ".dbf", ".prj"):
+        part_path = shapefile_path[:-4] + extension
+        if os.path.exists(part_path):
+            with open(part_path, "rb") as part:
+                for chunk in iter(lambda: part.read(1024 * 1024), b""):
+                    key.update(chunk)
+    return key.hexdigest()
+
+
+def _reproject_training_shapefile(shapefile_path, img_prj, epsg, attribute):
+    """
+    :meta private:
+    Writes a copy of a training shapefile in the projection img_prj and returns its path.
+    """
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    dataSource = driver.Open(shapefile_path, 1)
+    layer = dataSource.GetLayer()
+    sourceprj = layer.GetSpatialRef()
+    targetprj = osr.SpatialReference(wkt=img_prj)
+    transform = osr.CoordinateTransformation(sourceprj, targetprj)
+    to_fill = ogr.GetDriverByName("Esri Shapefile")
+    new_shapefile_path = shapefile_path[:-4] + "_" + str(epsg) + ".shp"
+    # Remove reprojected output shapefile if it already exists
+    if os.path.exists(new_shapefile_path):
+        log.warning(
+            "Reprojected shapefile already exists. Deleting previous version: {}".format(
+                new_shapefile_path
+            )
+        )
+        to_fill.DeleteDataSource(new_shapefile_path)
+    ds = to_fill.CreateDataSource(new_shapefile_path)
+    outlayer = ds.CreateLayer("", targetprj, ogr.wkbPolygon)
+    outlayer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
+    outlayer.CreateField(ogr.FieldDefn(attribute, ogr.OFTInteger))
+    i = 0
+    for feature in layer:
+        transformed = feature.GetGeometryRef()
+        transformed.Transform(transform)
+        geom = ogr.CreateGeometryFromWkb(transformed.ExportToWkb())
+        defn = outlayer.GetLayerDefn()
+        feat = ogr.Feature(defn)
+        feat.SetField("id", i)
+        feat.SetField(attribute, feature.GetField(attribute))
+        feat.SetGeometry(geom)
+        outlayer.CreateFeature(feat)
+        i += 1
+        feat = None
+    dataSource = None
+    ds = None
+    return new_shapefile_path
+
+
+def _extract_training_pair(raster_path, attribute, cache_dir):
+    """
+    :meta private:
+    Returns the training pixels of one tif/shp pair as (features, classes), where features has one row per labelled
+    pixel and one column per band. Reads them from cache_dir if this pair has been extracted before. Returns None if
+    the raster or its shapefile is missing.
+    """
+    # check whether both the tiff file and the shapefile exist
+    if not os.path.exists(raster_path):
+        log.warning("{} not found. Skipping.".format(raster_path))
+        return None
+    shapefile_path = _find_training_shapefile(raster_path)
+    if shapefile_path is None:
+        return None
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir, _training_pair_key(raster_path, shapefile_path, attribute) + ".npz"
+        )
+        if os.path.exists(cache_path):
+            log.info("Reading cached training pixels of {}".format(shapefile_path))
+            with np.load(cache_path) as cached:
+                return cached["features"], cached["classes"]
+    log.info("Analysing shapefile: {}".format(shapefile_path))
+    image = gdal.Open(raster_path)
+    # check that the two map projections have the same EPSG codes
+    img_prj = image.GetProjection()
+    epsg1 = osr.SpatialReference(wkt=img_prj).GetAttrValue("AUTHORITY", 1)
+    shp_extent, shp_crs, epsg2 = get_shp_extent(shapefile_path)
+    log.info("EPSG codes of the image and shapefile: {}, {}".format(epsg1, epsg2))
+    if not epsg1 == epsg2:
+        log.warning(
+            "Reprojecting shapefile. The EPSG codes of the image and shapefile are different."
+        )
+        log.warning("   Image has EPSG    : {}".format(epsg1))
+        log.warning("   Shapefile has EPSG: {}".format(epsg2))
+        rasterise_path = _reproject_training_shapefile(
+            shapefile_path, img_prj, epsg1, attribute
+        )
+    else:
+        rasterise_path = shapefile_path
+    with TemporaryDirectory(dir=os.getcwd()) as td:
+        # rasterise the shapefile
+        shape_raster_path = os.path.join(
+            td, os.path.basename(rasterise_path)[:-4] + "_rasterised.tif"
+        )
+        shape_raster_path = shapefile_to_raster(
+            rasterise_path,
+            raster_path,
+            shape_raster_path,
+            verbose=False,
+            nodata=0,
+            attribute=attribute,
+        )
+        rasterised_shapefile = gdal.Open(shape_raster_path)
+        shape_array = rasterised_shapefile.ReadAsArray()
+        rasterised_shapefile = None
+    # compose the X,Y pixel positions (feature dataset and training dataset)
+    # assumed that 0 = 'no class' value
+    rows, cols = np.nonzero(shape_array > 0)
+    classes = shape_array[rows, cols]
+    features = None
+    for band_index in range(image.RasterCount):
+        band_values = image.GetRasterBand(band_index + 1).ReadAsArray()[rows, cols]
+        if features is None:
+            features = np.empty(
+                (classes.size, image.RasterCount), dtype=band_values.dtype
+            )
+        features[:, band_index] = band_values
+    image = None
+    log.info(
+        "{} training pixels of {} classes in {}".format(
+            classes.size, np.unique(classes).size, shapefile_path
+        )
+    )
+    if cache_path is not None:
+        # written to a temporary file and moved into place, so an interrupted run never leaves a truncated cache
+        temp_cache_path = cache_path + ".tmp"
+        with open(temp_cache_path, "wb") as cache_file:
+            np.savez(cache_file, features=features, classes=classes)
+        os.replace(temp_cache_path, cache_path)
+    return features, classes
+
+
+def build_training_samples(
+    raster_paths, attribute="CODE", balanced=True, cache_dir=None, n_workers=None
+):
+    """
+    Extracts the labelled pixels from every tif/shp pair in raster_paths and optionally draws a balanced sample of
+    them. Pairs are extracted in parallel. If cache_dir is given, the pixels of each pair are cached there, keyed by
+    the raster's size and modification time and the shapefile's contents, so that a pair is only extracted again
+    once one of its files changes.
+
+    Parameters
+    ----------
+    raster_paths : list of str
+        Paths to the training rasters. Each needs a shapefile of matching name in the same directory.
+    attribute : str, optional
+        The attribute column of the shapefiles holding the class labels. Defaults to 'CODE'.
+    balanced : bool, optional
+        If True, keeps a random sample of at most ten times the size of the smallest class from each class.
+        Defaults to True.
+    cache_dir : str, optional
+        Directory to cache the extracted pixels of each pair in. Defaults to None (no caching).
+    n_workers : int, optional
+        The number of pairs to extract at the same time. Defaults to the number of CPUs.
+
+    Returns
+    -------
+    learning_data : np.ndarray
+        The training pixels, with one row per pixel and one column per band
+    classes : np.ndarray
+        The class label of each training pixel
+    labels : list
+        The class labels in the order they were found
+
+    """
+    log.info("Collecting training data from all tif/shp file pairs.")
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_workers = max(1, min(n_workers, len(raster_paths)))
+    with ThreadPool(n_workers) as pool:
+        pairs = pool.starmap(
+            _extract_training_pair,
+            [(raster_path, attribute, cache_dir) for raster_path in raster_paths],
+        )
+    pairs = [pair for pair in pairs if pair is not None]
+    if len(pairs) == 0:
+        raise FileNotFoundError(
+            "No training data found in {}".format(raster_paths)
+        )
+    # copy the pixels of all pairs into one preallocated array
+    n_pixels = sum(classes.size for features, classes in pairs)
+    learning_data = np.empty(
+        (n_pixels, pairs[0][0].shape[1]),
+        dtype=np.result_type(*[features.dtype for features, classes in pairs]),
+    )
+    classes = np.empty(
+        n_pixels, dtype=np.result_type(*[classes.dtype for features, classes in pairs])
+    )
+    offset = 0
+    for pair_features, pair_classes in pairs:
+        learning_data[offset : offset + pair_classes.size] = pair_features
+        classes[offset : offset + pair_classes.size] = pair_classes
+        offset += pair_classes.size
+    pairs = None
+
+    # get unique list of all class labels, in the order they were found
+    labels = list(dict.fromkeys(classes.tolist()))
+    counts = {c: np.count_nonzero(classes == c) for c in labels}
+    log.info("Training data collection complete.")
+    log.info("Training pixels by class:")
+    for c in labels:
+        log.info("  Class {} has {} training pixels".format(c, counts[c]))
+    smallest = min(counts.values())
+
+    if balanced:
+        log.info(
+            "Drawing a more balanced random sample of {} max. training pixels for each class.".format(
+                10 * smallest
+            )
+        )
+        rng = np.random.default_rng()
+        indices = []
+        for c in labels:
+            # draw a random sample of the indices where that class is found
+            class_indices = np.flatnonzero(classes == c)
+            if class_indices.size > 10 * smallest:
+                class_indices = rng.choice(class_indices, 10 * smallest, replace=False)
+            indices.append(class_indices)
+        indices = np.concatenate(indices)
+        classes = classes[indices]
+        learning_data = learning_data[indices]
+
+        log.info("After class balancing, training pixels by class:")
+        for c in labels:
+            log.info(
+                "  Class {} has {} training pixels".format(
+                    c, np.count_nonzero(classes == c)
+                )
+            )
+    return learning_data, classes, labels
+
+
 def train_rf_model(
     raster_paths,
     modelfile,
@@ -1311,6 +1698,8 @@ def train_rf_model(
     balanced=True,
     gridsearch=1,
     k_fold=5,
+    n_workers=None,
+    cache_dir=None,
 ):
     """
     Adapted from pygge.py
@@ -1332,195 +1721,33 @@ def train_rf_model(
       balanced (optional) = if True, use a balanced number of training pixels per class
       gridsearch : int, optional = Number of randomized random forests for gridsearch. Defaults to 1.
       k_fold : int, optional = Number of groups for k-fold validation during gridsearch. Defaults to 5.
+      n_workers : int, optional = Number of tif/shp pairs to extract training pixels from at the same time.
+        Defaults to the number of CPUs.
+      cache_dir : str, optional = Directory to cache the training pixels of each tif/shp pair in, so that only
+        pairs with changed files are extracted again when retraining. Defaults to the model file name with a
+        "_samples" suffix.
 
     Returns:
       random forest model object
     """
 
-    log.info("Collecting training data from all tif/shp file pairs.")
-    learning_data = []
-    labels = []
-    for raster_path in raster_paths:
-        # check whether both the tiff file and the shapefile exist
-        if not os.path.exists(raster_path):
-            log.warning("{} not found. Skipping.".format(raster_path))
-            continue
-        training_image_folder, training_image_name = os.path.split(raster_path)
-        training_image_name = training_image_name[:-4]  # Strip the file extension
-        shape_path_name = training_image_name + ".shp"
-        # find the full path to the shapefile, this can be in a subdirectory
-        shape_paths = [
-            f.path
-            for f in os.scandir(training_image_folder)
-            if f.is_file() and os.path.basename(f) == shape_path_name
-        ]
-        if len(shape_paths) == 0:
-            log.warning("{} not found. Skipping.".format(shape_path_name))
-        else:
-            if len(shape_paths) > 1:
-                log.warning(
-                    "Several versions of {} exist. Using the first of these files.".format(
-                        shape_path_name
-                    )
-                )
-                for f in shape_paths:
-                    log.info("  {}".format(f))
-            shapefile_path = shape_paths[0]
-            log.info("Analysing shapefile: {}".format(shapefile_path))
-            image = gdal.Open(raster_path)
-            image_array = image.GetVirtualMemArray(eAccess=gdal.GA_ReadOnly)
-            # check that the two map projections have the same EPSG codes
-            epsg1 = osr.SpatialReference(wkt=image.GetProjection()).GetAttrValue(
-                "AUTHORITY", 1
-            )
-            img_prj = image.GetProjection()
-            img_crs = osr.SpatialReference(wkt=img_prj)
-            shp_extent, shp_crs, epsg2 = get_shp_extent(shapefile_path)
-            log.info(
-                "EPSG codes of the image and shapefile: {}, {}".format(epsg1, epsg2)
-            )
-            if not epsg1 == epsg2:
-                log.warning(
-                    "Reprojecting shapefile. The EPSG codes of the image and shapefile are different."
-                )
-                log.warning("   Image has EPSG    : {}".format(epsg1))
-                log.warning("   Shapefile has EPSG: {}".format(epsg2))
-                driver = ogr.GetDriverByName("ESRI Shapefile")
-                dataSource = driver.Open(shapefile_path, 1)
-                layer = dataSource.GetLayer()
-                sourceprj = layer.GetSpatialRef()
-                targetprj = osr.SpatialReference(wkt=img_prj)
-                transform = osr.CoordinateTransformation(sourceprj, targetprj)
-                to_fill = ogr.GetDriverByName("Esri Shapefile")
-                new_shapefile_path = shapefile_path[:-4] + "_" + str(epsg1) + ".shp"
-                # Remove reprojected output shapefile if it already exists
-                if os.path.exists(new_shapefile_path):
-                    log.warning(
-                        "Reprojected shapefile already exists. Deleting previous version: {}".format(
-                            new_shapefile_path
-                        )
-                    )
-                    to_fill.DeleteDataSource(new_shapefile_path)
-                ds = to_fill.CreateDataSource(new_shapefile_path)
-                outlayer = ds.CreateLayer("", targetprj, ogr.wkbPolygon)
-                outlayer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
-                outlayer.CreateField(ogr.FieldDefn(attribute, ogr.OFTInteger))
-                i = 0
-                for feature in layer:
-                    transformed = feature.GetGeometryRef()
-                    transformed.Transform(transform)
-                    geom = ogr.CreateGeometryFromWkb(transformed.ExportToWkb())
-                    defn = outlayer.GetLayerDefn()
-                    feat = ogr.Feature(defn)
-                    feat.SetField("id", i)
-                    feat.SetField(attribute, feature.GetField(attribute))
-                    feat.SetGeometry(geom)
-                    outlayer.CreateFeature(feat)
-                    i += 1
-                    feat = None
-                dataSource = None
-                ds = None
-                shapefile_path = new_shapefile_path
-            with TemporaryDirectory(dir=os.getcwd()) as td:
-                # rasterise the shapefile
-                shape_raster_path = os.path.join(
-                    td, os.path.basename(shapefile_path)[:-4] + "_rasterised.tif"
-                )
-                # log.info("Shape raster path {}".format(shape_raster_path))
-                shape_raster_path = shapefile_to_raster(
-                    shapefile_path,
-                    raster_path,
-                    shape_raster_path,
-                    verbose=False,
-                    nodata=0,
-                    attribute=attribute,
-                )
-                rasterised_shapefile = gdal.Open(shape_raster_path)
-                shape_array = rasterised_shapefile.GetVirtualMemArray(
-                    eAccess=gdal.GA_ReadOnly
-                )
-                # read in the class labels
-                these_labels = list(np.unique(shape_array[shape_array > 0]))
-                nclasses = len(these_labels)
-                labels = labels + these_labels
-                log.info(
-                    "This training data shapefile includes {} classes: {}".format(
-                        nclasses, these_labels
-                    )
-                )
-                nbands = image.RasterCount
-                if nbands == 1:
-                    log.info("{} band in image file".format(nbands))
-                else:
-                    log.info("{} bands in image file".format(nbands))
-                if len(band_names) == nbands:
-                    log.info("  {}".format(band_names))
-                # compose the X,Y pixel positions (feature dataset and training dataset)
-                # assumed that 0 = 'no class' value
-                log.info(image_array.shape)
-                log.info(shape_array.shape)
-                for j in range(image_array.shape[0] - 1):
-                    log.info("\n{}".format(shape_array[j, :]))
-                X = image_array[:, shape_array > 0]
-                Y = shape_array[shape_array > 0].flatten()
-                log.info(X.shape)
-                log.info(Y.shape)
-                log.info("{} training pixels in shapefile".format(len(Y)))
-                shape_array = None
-                rasterised_shapefile = None
-            image_array = None
-            image = None
-
-            if learning_data == []:
-                learning_data = X.transpose()
-                classes = Y
-            else:
-                # log.info(learning_data.shape)
-                # log.info(X.shape)
-                learning_data = np.append(learning_data, X.transpose(), 0)
-                classes = np.append(classes, Y)
-                # log.info(learning_data.shape)
-                # log.info(classes.shape)
-
-    # get unique list of all class labels
-    labels = list(dict.fromkeys(labels))
-    log.info("Training data collection complete.")
-    log.info("Training pixels by class:")
-    smallest = 0
-    for c in labels:
-        found = len(classes[classes == c])
-        log.info("  Class {} has {} training pixels".format(c, found))
-        if found < smallest or smallest == 0:
-            smallest = found
-
-    if balanced:
-        indices = []
-        log.info(
-            "Drawing a more balanced random sample of {} max. training pixels for each class.".format(
-                10 * smallest
-            )
-        )
-        for c in labels:
-            # draw a random sample of the list indices where that class is found
-            if (
-                len([pos for pos, value in enumerate(classes) if value == c])
-                > 10 * smallest
-            ):
-                indices = indices + random.sample(
-                    [pos for pos, value in enumerate(classes) if value == c],
-                    10 * smallest,
-                )
-            else:
-                indices = indices + [
-                    pos for pos, value in enumerate(classes) if value == c
-                ]
-        classes = classes[indices]
-        learning_data = learning_data[indices]
-
-        log.info("After class balancing, training pixels by class:")
-        for c in labels:
-            found = len(classes[classes == c])
-            log.info("  Class {} has {} training pixels".format(c, found))
+    if cache_dir is None:
+        cache_dir = modelfile[:-4] + "_samples"
+    learning_data, classes, labels = build_training_samples(
+        raster_paths,
+        attribute=attribute,
+        balanced=balanced,
+        cache_dir=cache_dir,
+        n_workers=n_workers,
+    )
+    nbands = learning_data.shape[1]
+    nclasses = len(labels)
+    if nbands == 1:
+        log.info("{} band in image files".format(nbands))
+    else:
+        log.info("{} bands in image files".format(nbands))
+    if len(band_names) == nbands:
+        log.info("  {}".format(band_names))
 
     # TODO: Test this bit: save training data to file and produce basic signature statistics by class
     if len(band_names) != nbands:
@@ -1533,31 +1760,35 @@ def train_rf_model(
     sigfile = modelfile[:-4] + "_signatures.txt"
     log.info("Saving tab-delimited signature file: {}".format(sigfile))
     col_names = learning_df.columns.values.tolist()
+    signatures = learning_df.groupby("label")[band_names].agg(
+        ["min", "max", "mean", "std"]
+    )
     with open(sigfile, "w") as f:
         log.info("Signatures:")
         log.info("class, band, min, max, mean, stdev")
         f.write("class\tband\tmin\tmax\tmean\tstdev\n")
         for c in range(np.max(classes)):
-            if c + 1 in classes:
+            if c + 1 in signatures.index:
                 for b in band_names:
+                    signature = signatures.loc[c + 1, b]
                     log.info(
                         "{}, {}, {}, {}, {}, {}".format(
                             c + 1,
                             b,
-                            learning_df.groupby("label").min()[b][c + 1],
-                            learning_df.groupby("label").max()[b][c + 1],
-                            learning_df.groupby("label").mean()[b][c + 1],
-                            learning_df.groupby("label").std()[b][c + 1],
+                            signature["min"],
+                            signature["max"],
+                            signature["mean"],
+                            signature["std"],
                         )
                     )
                     f.write(
                         "{}\t{}\t{}\t{}\t{}\t{}\n".format(
                             c + 1,
                             b,
-                            learning_df.groupby("label").min()[b][c + 1],
-                            learning_df.groupby("label").max()[b][c + 1],
-                            learning_df.groupby("label").mean()[b][c + 1],
-                            learning_df.groupby("label").std()[b][c + 1],
+                            signature["min"],
+                            signature["max"],
+                            signature["mean"],
+                            signature["std"],
                         )
                     )
             else:
@@ -53,5 +53,13 @@ class InvalidDateFormatException(pyeo_1Exception):
     pass
 
 
+class DownloadIntegrityException(pyeo_1Exception):
+    pass
+
+
+class ClassificationException(pyeo_1Exception):
+    pass
+
+
 class TooManyRequests(requests.RequestException):
     """Too many requests; do exponential backoff"""
@@ -13,6 +13,12 @@ Key functions
 
 :py:func:`sort_by_timestamp` Sorts a set of files by timestamp
 
+:py:func:`use_catalogue` Answers file lookups from a persistent index of the files on disk
+
+:py:func:`use_processing_manifest` Lets processing stages skip outputs whose inputs and parameters have not changed
+
+:py:func:`resolve_safe_path` Returns a path to read a .SAFE product from, inside its zip archive if it has been zipped
+
 Function reference
 ------------------
 """
@@ -21,12 +27,15 @@ import configparser
 import datetime
 import datetime as dt
 import glob
+import hashlib
 import json
 import logging
 import os
 import sys
 import re
 import shutil
+import sqlite3
+import threading
 import zipfile
 
 import numpy as np
@@ -298,6 +307,20 @@ def config_path_to_config_dict(config_path: str):
     config_dict["watch_period_seconds"] = int(
         config["run_mode"]["watch_period_seconds"]
     )
+    config_dict["job_backend"] = config.get("run_mode", "job_backend", fallback="pbs")
+    config_dict["max_parallel_jobs"] = config.getint(
+        "run_mode", "max_parallel_jobs", fallback=4
+    )
+    config_dict["job_mem_limit_mb"] = config.getint(
+        "run_mode", "job_mem_limit_mb", fallback=0
+    )
+    config_dict["tile_job_mem_mb"] = config.getint(
+        "run_mode", "tile_job_mem_mb", fallback=0
+    )
+    config_dict["slurm_options"] = config.get("run_mode", "slurm_options", fallback="")
+    config_dict["resume_jobs"] = config.getboolean(
+        "run_mode", "resume_jobs", fallback=False
+    )
     
     config_dict["do_tile_intersection"] = config.getboolean("raster_processing_parameters", "do_tile_intersection")
 
@@ -347,6 +370,9 @@ def config_path_to_config_dict(config_path: str):
     config_dict["composite_end"] = config["forest_sentinel"]["composite_end"]
     config_dict["epsg"] = int(config["forest_sentinel"]["epsg"])
     config_dict["cloud_cover"] = int(config["forest_sentinel"]["cloud_cover"])
+    config_dict["query_resync_days"] = config.getint(
+        "forest_sentinel", "query_resync_days", fallback=-1
+    )
     config_dict["cloud_certainty_threshold"] = int(
         config["forest_sentinel"]["cloud_certainty_threshold"]
     )
@@ -380,6 +406,15 @@ def config_path_to_config_dict(config_path: str):
     )
     config_dict["sieve"] = int(config["raster_processing_parameters"]["sieve"])
     config_dict["chunks"] = int(config["raster_processing_parameters"]["chunks"])
+    config_dict["mem_limit_mb"] = config.getint(
+        "raster_processing_parameters", "mem_limit_mb", fallback=1024
+    )
+    config_dict["classification_workers"] = config.getint(
+        "raster_processing_parameters", "classification_workers", fallback=1
+    )
+    config_dict["output_profile"] = config.get(
+        "raster_processing_parameters", "output_profile", fallback="archive"
+    )
     config_dict["class_labels"] = json.loads(
         config["raster_processing_parameters"]["class_labels"]
     )
@@ -403,6 +438,9 @@ def config_path_to_config_dict(config_path: str):
     config_dict["log_dir"] = config["environment"]["log_dir"]
     config_dict["log_filename"] = config["environment"]["log_filename"]
     config_dict["sen2cor_path"] = config["environment"]["sen2cor_path"]
+    config_dict["sen2cor_workers"] = config.getint(
+        "environment", "sen2cor_workers", fallback=1
+    )
 
     config_dict["level_1_filename"] = config["vector_processing_parameters"][
         "level_1_filename"
@@ -417,6 +455,9 @@ def config_path_to_config_dict(config_path: str):
     config_dict["do_vectorise"] = config.getboolean(
         "vector_processing_parameters", "do_vectorise"
     )
+    config_dict["vectorise_workers"] = config.getint(
+        "vector_processing_parameters", "vectorise_workers", fallback=1
+    )
     config_dict["do_integrate"] = config.getboolean(
         "vector_processing_parameters", "do_integrate"
     )
@@ -545,6 +586,776 @@ def validate_config_file(config_path):
     pass
 
 
+class FileCatalogue:
+    """
+    A persistent SQLite index of the files and directories below the directories it is asked about, with the
+    timestamp, tile, relative orbit, processing baseline and product type parsed from each name.
+
+    The index is brought up to date incrementally: every directory records its modification time, and only
+    directories whose modification time has changed since they were last indexed are listed again. Each directory
+    looked up is brought up to date the first time, again after :py:meth:`invalidate`, and again whenever a lookup in
+    it finds nothing; other lookups are answered from indexed tables without touching the disk, so a pipeline
+    invalidates the catalogue once per stage. See :py:func:`use_catalogue`.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the SQLite database. Created if it does not exist.
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        # directories brought up to date since the catalogue was last invalidated
+        self._refreshed = set()
+        self._connect()
+
+    def _connect(self):
+        self._pid = os.getpid()
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS directories (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, directory TEXT, name TEXT, kind TEXT, is_dir INTEGER,
+                timestamp TEXT, tile TEXT, orbit TEXT, baseline TEXT, product_type TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_by_directory ON files (directory, timestamp);
+            CREATE INDEX IF NOT EXISTS files_by_product ON files (product_type, tile, timestamp);
+            """
+        )
+
+    def _connection(self):
+        # sqlite connections must not be shared with forked worker processes
+        if os.getpid() != self._pid:
+            self._connect()
+        return self._db
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+    def update(self, directory):
+        """
+        Brings the index of directory and everything below it up to date, listing only the directories that changed
+        since they were last indexed. Symbolic links to directories are recorded but not followed.
+
+        Parameters
+        ----------
+        directory : str
+            The directory to index
+
+        """
+        with self._lock:
+            db = self._connection()
+            with db:
+                pending = [os.path.abspath(directory)]
+                while pending:
+                    current = pending.pop()
+                    try:
+                        mtime_ns = os.stat(current).st_mtime_ns
+                    except OSError:
+                        self._forget(db, current)
+                        continue
+                    stored = db.execute(
+                        "SELECT mtime_ns FROM directories WHERE path = ?", (current,)
+                    ).fetchone()
+                    if stored is not None and stored[0] == mtime_ns:
+                        subdirectories = [
+                            row[0]
+                            for row in db.execute(
+                                "SELECT path FROM files WHERE directory = ? AND is_dir = 2",
+                                (current,),
+                            )
+                        ]
+                    else:
+                        subdirectories = self._scan(db, current, mtime_ns)
+                    pending.extend(subdirectories)
+            # a directory that does not exist yet is looked at again on the next lookup
+            if os.path.isdir(directory):
+                self._refreshed.add(os.path.abspath(directory))
+
+    def invalidate(self, directory=None):
+        """
+        Marks directory, and every directory above and below it, as possibly changed, so that the next lookup in
+        them brings the index up to date again. Call after a processing stage has written files that later lookups
+        need to find.
+
+        Parameters
+        ----------
+        directory : str, optional
+            The directory whose contents have changed. If None, the whole catalogue is invalidated.
+
+        """
+        with self._lock:
+            if directory is None:
+                self._refreshed.clear()
+                return
+            directory = os.path.abspath(directory)
+            self._refreshed = {
+                root
+                for root in self._refreshed
+                if root != directory
+                and not directory.startswith(os.path.join(root, ""))
+                and not root.startswith(os.path.join(directory, ""))
+            }
+
+    def _refresh(self, directory):
+        """
+        Brings the index of directory up to date unless that has been done since the last invalidation. Returns True
+        if the index was brought up to date.
+        """
+        with self._lock:
+            if os.path.abspath(directory) in self._refreshed:
+                return False
+            self.update(directory)
+            return True
+
+    def _lookup(self, directory, query):
+        """
+        Runs query against the index of directory. If it finds nothing and the index was not just brought up to date,
+        the index is brought up to date and query is run again, so that files written since are found.
+        """
+        with self._lock:
+            refreshed = self._refresh(directory)
+            result = query(self._connection())
+            if not result and not refreshed:
+                self.update(directory)
+                result = query(self._connection())
+        return result
+
+    def _scan(self, db, directory, mtime_ns):
+        """
+        Re-lists the entries of one directory, returning the subdirectories to descend into.
+        """
+        old_subdirectories = {
+            row[0]
+            for row in db.execute(
+                "SELECT path FROM files WHERE directory = ? AND is_dir > 0", (directory,)
+            )
+        }
+        rows = []
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                is_dir = entry.is_dir()
+                if is_dir and not entry.is_symlink():
+                    # 2 marks a directory that is descended into, 1 a symbolic link to a directory
+                    is_dir = 2
+                    subdirectories.append(entry.path)
+                rows.append(_catalogue_row(entry.path, directory, entry.name, int(is_dir)))
+        for vanished in old_subdirectories - {row[0] for row in rows}:
+            self._forget(db, vanished)
+        db.execute("DELETE FROM files WHERE directory = ?", (directory,))
+        db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        db.execute(
+            "INSERT OR REPLACE INTO directories VALUES (?, ?)", (directory, mtime_ns)
+        )
+        return subdirectories
+
+    @staticmethod
+    def _forget(db, directory):
+        """
+        Removes a directory and everything below it from the index.
+        """
+        lower, upper = _path_prefix_range(directory)
+        for table in ("files", "directories"):
+            db.execute(f"DELETE FROM {table} WHERE path = ?", (directory,))
+            db.execute(f"DELETE FROM {table} WHERE path > ? AND path < ?", (lower, upper))
+
+    def find_files(self, path, filepattern, dirpattern):
+        """
+        Returns the same list as :py:func:`get_filenames`: all files below path whose name contains filepattern and
+        whose directory contains dirpattern, sorted.
+        """
+        root = os.path.abspath(path)
+        lower, upper = _path_prefix_range(root)
+        rows = self._lookup(
+            root,
+            lambda db: db.execute(
+                "SELECT path, directory FROM files WHERE path > ? AND path < ? AND is_dir = 0 "
+                "AND instr(name, ?) > 0",
+                (lower, upper, filepattern),
+            ).fetchall(),
+        )
+        # match dirpattern against the directory as os.walk would have reported it from path
+        filelist = []
+        for file_path, directory in rows:
+            relative_directory = os.path.relpath(directory, root)
+            walk_root = path if relative_directory == "." else os.path.join(path, relative_directory)
+            if dirpattern in walk_root:
+                filelist.append(os.path.join(walk_root, os.path.basename(file_path)))
+        return sorted(filelist)
+
+    def find_safe_product(self, directory, product_type, timestamp, tile):
+        """
+        Returns the name of the first .SAFE product directly inside directory with the given product type
+        (e.g. "MSIL1C"), acquisition timestamp and tile, or None.
+        """
+        row = self._lookup(
+            directory,
+            lambda db: db.execute(
+                "SELECT name FROM files WHERE product_type = ? AND tile = ? AND timestamp = ? "
+                "AND directory = ? AND kind = 'safe' AND name GLOB 'S2[AB|]_*' ORDER BY name LIMIT 1",
+                (product_type, tile, timestamp, os.path.abspath(directory)),
+            ).fetchone(),
+        )
+        return None if row is None else row[0]
+
+    def find_preceding_image(self, directory, timestamp):
+        """
+        Returns the name of the most recent .tif directly inside directory with an acquisition timestamp before
+        timestamp (yyyymmddThhmmss), or None.
+        """
+        row = self._lookup(
+            directory,
+            lambda db: db.execute(
+                "SELECT name FROM files WHERE directory = ? AND timestamp < ? AND name GLOB '*.tif' "
+                "ORDER BY timestamp DESC, name DESC LIMIT 1",
+                (os.path.abspath(directory), timestamp),
+            ).fetchone(),
+        )
+        return None if row is None else row[0]
+
+
+def _path_prefix_range(directory):
+    """
+    :meta private:
+    Returns the bounds of the paths strictly below directory in sort order, for range queries on an indexed path column.
+    """
+    prefix = os.path.join(directory, "")
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _catalogue_row(path, directory, name, is_dir):
+    """
+    :meta private:
+    Parses the kind, timestamp, tile, orbit, baseline and product type of a file or directory name for the catalogue.
+    """
+    if is_dir:
+        kind = "safe" if name.endswith(".SAFE") else "directory"
+    elif name.endswith(".jp2"):
+        kind = "band"
+    elif name.endswith(".msk"):
+        kind = "mask"
+    elif not name.endswith(".tif"):
+        kind = "other"
+    elif name.startswith("report"):
+        kind = "report"
+    elif name.startswith("change") or name.startswith("dNDVI") or name.startswith("NDVI"):
+        kind = "change"
+    elif "class" in name:
+        kind = "classification"
+    elif name.startswith("composite"):
+        kind = "composite"
+    else:
+        kind = "image"
+
+    def first_match(regex):
+        match = re.search(regex, name)
+        return None if match is None else match.group(0)
+
+    return (
+        path,
+        directory,
+        name,
+        kind,
+        is_dir,
+        first_match(r"\d{8}T\d{6}"),
+        first_match(r"T\d{2}[A-Z]{3}"),
+        first_match(r"(?<=_)R\d{3}(?=_)"),
+        first_match(r"(?<=_)N\d{4}(?=_)"),
+        first_match(r"(?<=_)MSIL\d[A-Z](?=_)"),
+    )
+
+
+_catalogue = None
+
+
+def use_catalogue(db_path):
+    """
+    Makes :py:func:`get_filenames`, :py:func:`get_raster_paths`, :py:func:`get_l1_safe_file`,
+    :py:func:`get_l2_safe_file` and :py:func:`get_preceding_image_path` answer from a persistent
+    :py:class:`FileCatalogue` instead of walking the disk on every call.
+
+    Parameters
+    ----------
+    db_path : str or None
+        Path to the SQLite database of the catalogue, e.g. one per tile. If None, stops using a catalogue.
+
+    Returns
+    -------
+    catalogue : FileCatalogue or None
+        The catalogue now in use
+
+    """
+    global _catalogue
+    if _catalogue is not None:
+        _catalogue.close()
+    _catalogue = None if db_path is None else FileCatalogue(db_path)
+    return _catalogue
+
+
+def get_catalogue():
+    """
+    Returns the :py:class:`FileCatalogue` set by :py:func:`use_catalogue`, or None.
+    """
+    return _catalogue
+
+
+def invalidate_catalogue(directory=None):
+    """
+    Invalidates the :py:class:`FileCatalogue` set by :py:func:`use_catalogue`, if any, so that the next lookups see
+    files written since. See :py:meth:`FileCatalogue.invalidate`.
+
+    Parameters
+    ----------
+    directory : str, optional
+        The directory whose contents have changed. If None, the whole catalogue is invalidated.
+
+    """
+    if _catalogue is not None:
+        _catalogue.invalidate(directory)
+
+
+class ProcessingManifest:
+    """
+    A persistent SQLite record of the outputs of each processing stage of a tile: the stage that produced each output,
+    the parameters it was produced with and the size, modification time and content hash of every input it was
+    produced from. Stages ask the manifest whether an output is up to date before rebuilding it, so re-running a tile
+    redoes only the work whose inputs or parameters have changed. See :py:func:`use_processing_manifest`.
+
+    An output is recorded once per stage, so a stage that rewrites a file in place, such as compression, lists that
+    file as its own input and is recorded alongside the stage that first produced the file.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the SQLite database. Created if it does not exist.
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._lock = threading.RLock()
+        self._connect()
+
+    def _connect(self):
+        self._pid = os.getpid()
+        # worker processes of one tile may record outputs at the same time
+        self._db = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS outputs (
+                path TEXT, stage TEXT, parameters TEXT, recorded TEXT, PRIMARY KEY (path, stage)
+            );
+            CREATE TABLE IF NOT EXISTS inputs (
+                path TEXT, stage TEXT, input_path TEXT, size INTEGER, mtime_ns INTEGER, hash TEXT,
+                PRIMARY KEY (path, stage, input_path)
+            );
+            """
+        )
+
+    def _connection(self):
+        # sqlite connections must not be shared with forked worker processes
+        if os.getpid() != self._pid:
+            self._connect()
+        return self._db
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        with self._lock:
+            self._db.close()
+
+    def has_record(self, output_path, stage):
+        """
+        Returns True if output_path has been recorded as an output of stage.
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT 1 FROM outputs WHERE path = ? AND stage = ?",
+                (os.path.abspath(output_path), stage),
+            ).fetchone()
+        return row is not None
+
+    def is_up_to_date(self, output_path, stage, input_paths=(), parameters=None):
+        """
+        Returns True if output_path exists and was recorded as an output of stage, with the same parameters, from
+        the same input paths, none of which have changed since. An input whose modification time has changed but
+        whose size and content hash have not counts as unchanged.
+
+        Parameters
+        ----------
+        output_path : str
+            The output to check
+        stage : str
+            The name of the stage that produces it, e.g. "sieve"
+        input_paths : list of str, optional
+            The files or directories the output is produced from
+        parameters : dict, optional
+            The parameters of the stage that affect the output. Must be serialisable to json.
+
+        Returns
+        -------
+        up_to_date : bool
+
+        """
+        output_path = os.path.abspath(output_path)
+        if not os.path.exists(output_path):
+            return False
+        with self._lock:
+            db = self._connection()
+            row = db.execute(
+                "SELECT parameters FROM outputs WHERE path = ? AND stage = ?", (output_path, stage)
+            ).fetchone()
+            if row is None or row[0] != _manifest_parameters(parameters):
+                return False
+            recorded = {
+                input_path: (size, mtime_ns, file_hash)
+                for input_path, size, mtime_ns, file_hash in db.execute(
+                    "SELECT input_path, size, mtime_ns, hash FROM inputs WHERE path = ? AND stage = ?",
+                    (output_path, stage),
+                )
+            }
+            if set(recorded) != {os.path.abspath(path) for path in input_paths}:
+                return False
+            for input_path, (size, mtime_ns, file_hash) in recorded.items():
+                current_size, current_mtime_ns = _manifest_stat(input_path)
+                if current_size != size:
+                    return False
+                if current_mtime_ns == mtime_ns:
+                    continue
+                # touched or copied, but perhaps not changed
+                if file_hash is None or _manifest_hash(input_path) != file_hash:
+                    return False
+                with db:
+                    db.execute(
+                        "UPDATE inputs SET mtime_ns = ? WHERE path = ? AND stage = ? AND input_path = ?",
+                        (current_mtime_ns, output_path, stage, input_path),
+                    )
+        return True
+
+    def record(self, output_path, stage, input_paths=(), parameters=None):
+        """
+        Records output_path as an output of stage, fingerprinting its inputs as they are now. Call this once the
+        output has been written.
+
+        Parameters
+        ----------
+        output_path : str
+            The output that has been produced
+        stage : str
+            The name of the stage that produced it
+        input_paths : list of str, optional
+            The files or directories the output was produced from
+        parameters : dict, optional
+            The parameters of the stage that affect the output. Must be serialisable to json.
+
+        """
+        output_path = os.path.abspath(output_path)
+        rows = []
+        for input_path in sorted({os.path.abspath(path) for path in input_paths}):
+            size, mtime_ns = _manifest_stat(input_path)
+            file_hash = _manifest_hash(input_path) if size is not None and size >= 0 else None
+            rows.append((output_path, stage, input_path, size, mtime_ns, file_hash))
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute("DELETE FROM inputs WHERE path = ? AND stage = ?", (output_path, stage))
+                db.executemany("INSERT INTO inputs VALUES (?, ?, ?, ?, ?, ?)", rows)
+                db.execute(
+                    "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?)",
+                    (
+                        output_path,
+                        stage,
+                        _manifest_parameters(parameters),
+                        dt.datetime.now().isoformat(timespec="seconds"),
+                    ),
+                )
+
+    def forget(self, output_path, stage=None):
+        """
+        Removes the records of output_path, for one stage or for all of them, so that it is rebuilt.
+        """
+        output_path = os.path.abspath(output_path)
+        where = "path = ?" if stage is None else "path = ? AND stage = ?"
+        values = (output_path,) if stage is None else (output_path, stage)
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute(f"DELETE FROM inputs WHERE {where}", values)
+                db.execute(f"DELETE FROM outputs WHERE {where}", values)
+
+
+def _manifest_parameters(parameters):
+    """
+    :meta private:
+    Serialises stage parameters so that equal parameters always give the same string.
+    """
+    return json.dumps(parameters if parameters is not None else {}, sort_keys=True, default=str)
+
+
+def _manifest_stat(path):
+    """
+    :meta private:
+    Returns the size and modification time of a file, (None, mtime) for a directory and (-1, None) for a path that
+    does not exist. A .SAFE product that has been zipped is looked up through its archive.
+    """
+    if not os.path.exists(path):
+        archive_path = get_safe_archive_path(path) if path.rstrip("/\\").endswith(".SAFE") else None
+        if archive_path is None:
+            return -1, None
+        path = archive_path
+    stat = os.stat(path)
+    return (None if os.path.isdir(path) else stat.st_size), stat.st_mtime_ns
+
+
+def _manifest_hash(path):
+    """
+    :meta private:
+    Returns the blake2b hash of the contents of a file, or of the archive of a zipped .SAFE product.
+    """
+    if not os.path.exists(path):
+        path = get_safe_archive_path(path)
+    file_hash = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+_processing_manifest = None
+
+
+def use_processing_manifest(db_path):
+    """
+    Makes the processing stages that call :py:func:`is_output_up_to_date` and :py:func:`record_output` skip outputs
+    that a persistent :py:class:`ProcessingManifest` shows to be up to date, and rebuild those whose inputs or
+    parameters have changed.
+
+    Parameters
+    ----------
+    db_path : str or None
+        Path to the SQLite database of the manifest, e.g. one per tile. If None, stops using a manifest.
+
+    Returns
+    -------
+    manifest : ProcessingManifest or None
+        The manifest now in use
+
+    """
+    global _processing_manifest
+    if _processing_manifest is not None:
+        _processing_manifest.close()
+    _processing_manifest = None if db_path is None else ProcessingManifest(db_path)
+    return _processing_manifest
+
+
+def get_processing_manifest():
+    """
+    Returns the :py:class:`ProcessingManifest` set by :py:func:`use_processing_manifest`, or None.
+    """
+    return _processing_manifest
+
+
+def is_output_up_to_date(output_path, stage, input_paths=(), parameters=None, skip_existing=False):
+    """
+    Returns True if a processing stage can skip producing output_path. If a processing manifest is in use and has a
+    record of output_path from stage, the output is skipped only if that record shows it to be up to date. Otherwise,
+    as without a manifest, the output is skipped if skip_existing is True and the output exists.
+
+    Parameters
+    ----------
+    output_path : str
+        The output the stage would produce
+    stage : str
+        The name of the stage, e.g. "sieve"
+    input_paths : list of str, optional
+        The files or directories the output is produced from
+    parameters : dict, optional
+        The parameters of the stage that affect the output. Must be serialisable to json.
+    skip_existing : bool, optional
+        Whether to skip outputs that exist but that the manifest has no record of. Defaults to False.
+
+    Returns
+    -------
+    up_to_date : bool
+
+    """
+    manifest = _processing_manifest
+    if manifest is not None and manifest.has_record(output_path, stage):
+        return manifest.is_up_to_date(output_path, stage, input_paths, parameters)
+    return skip_existing and os.path.exists(output_path)
+
+
+def record_output(output_path, stage, input_paths=(), parameters=None):
+    """
+    Records output_path as produced by stage in the processing manifest in use, if there is one. See
+    :py:meth:`ProcessingManifest.record`.
+    """
+    if _processing_manifest is not None:
+        _processing_manifest.record(output_path, stage, input_paths, parameters)
+
+
+_zip_member_indexes = {}
+_zip_member_lock = threading.Lock()
+
+
+def get_zip_member_index(zip_path):
+    """
+    Returns the sorted names of the files in a zip archive. The index is read once and kept until the archive is
+    modified, so repeated lookups in an archived product do not re-read its central directory.
+
+    Parameters
+    ----------
+    zip_path : str
+        Path to the zip archive
+
+    Returns
+    -------
+    members : list of str
+        The path of each file in the archive, relative to the root of the archive, with '/' separators
+
+    """
+    stat = os.stat(zip_path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    with _zip_member_lock:
+        cached = _zip_member_indexes.get(zip_path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+    with zipfile.ZipFile(zip_path) as archive:
+        members = sorted(name for name in archive.namelist() if not name.endswith("/"))
+    with _zip_member_lock:
+        _zip_member_indexes[zip_path] = (signature, members)
+    return members
+
+
+def get_safe_archive_path(safe_path):
+    """
+    Returns the path to the zip archive of a .SAFE product, as written by :py:func:`zip_contents`
+    (`S2A_..._T36NXG_20230105T100000.zip`) or as downloaded (`S2A_..._T36NXG_20230105T100000.SAFE.zip`), or None if
+    there is none.
+    """
+    safe_path = safe_path.rstrip("/\\")
+    candidates = [safe_path + ".zip"]
+    if safe_path.endswith(".SAFE"):
+        candidates.insert(0, safe_path[: -len(".SAFE")] + ".zip")
+    for candidate in candidates:
+        if os.path.isfile(candidate):
+            return candidate
+    return None
+
+
+def resolve_safe_path(safe_path):
+    """
+    Returns a path that GDAL and :py:func:`get_filenames` can read the contents of a .SAFE product from. This is
+    safe_path itself if the product is a directory on disk, or a /vsizip/ path to the product inside its zip archive
+    if it has been archived with :py:func:`zip_contents` or was never extracted. Paths that are neither are returned
+    unchanged.
+
+    Parameters
+    ----------
+    safe_path : str
+        Path to a .SAFE product
+
+    Returns
+    -------
+    safe_root : str
+        The directory of the product, or the /vsizip/ path of its root inside the archive
+
+    """
+    if safe_path.startswith("/vsizip/") or os.path.isdir(safe_path):
+        return safe_path
+    zip_path = get_safe_archive_path(safe_path)
+    if zip_path is None:
+        return safe_path
+    safe_root = "/vsizip/" + os.path.abspath(zip_path).replace(os.sep, "/")
+    # downloaded archives hold the .SAFE directory itself, those of zip_contents only its contents
+    top_level = {member.split("/", 1)[0] for member in get_zip_member_index(zip_path)}
+    if len(top_level) == 1 and next(iter(top_level)).endswith(".SAFE"):
+        safe_root = safe_root + "/" + top_level.pop()
+    return safe_root
+
+
+def safe_exists(safe_path):
+    """
+    Returns True if a .SAFE product exists, either as a directory or as a zip archive readable with
+    :py:func:`resolve_safe_path`.
+    """
+    return os.path.exists(safe_path) or get_safe_archive_path(safe_path) is not None
+
+
+def _split_vsizip_path(path):
+    """
+    Splits a /vsizip/ path into the path of the archive and the path inside it.
+    """
+    inner_start = path.lower().index(".zip", len("/vsizip/")) + len(".zip")
+    return path[len("/vsizip/") : inner_start], path[inner_start:].strip("/")
+
+
+def _get_filenames_in_zip(path, filepattern, dirpattern):
+    """
+    The equivalent of :py:func:`get_filenames` for a /vsizip/ path, answered from the member index of the archive.
+    """
+    zip_path, inner_path = _split_vsizip_path(path)
+    archive_root = "/vsizip/" + zip_path
+    filelist = []
+    for member in get_zip_member_index(zip_path):
+        if inner_path and not member.startswith(inner_path + "/"):
+            continue
+        member_dir, _, name = member.rpartition("/")
+        root = archive_root + "/" + member_dir if member_dir else archive_root
+        if filepattern in name and dirpattern in root:
+            filelist.append(root + "/" + name)
+    return sorted(filelist)
+
+
+def glob_safe(safe_path, pattern):
+    """
+    Returns the files of a .SAFE product that match a glob pattern relative to the product root, e.g.
+    "GRANULE/*/IMG_DATA/*_B02.jp2", whether the product is a directory or a zip archive.
+
+    Parameters
+    ----------
+    safe_path : str
+        Path to the .SAFE product
+    pattern : str
+        Glob pattern relative to the root of the product, with '/' separators
+
+    Returns
+    -------
+    paths : list of str
+        The matching files, as paths on disk or /vsizip/ paths
+
+    """
+    safe_root = resolve_safe_path(safe_path)
+    if not safe_root.startswith("/vsizip/"):
+        return sorted(glob.glob(os.path.join(safe_root, pattern)))
+    import fnmatch
+
+    pattern_parts = pattern.split("/")
+    zip_path, inner_path = _split_vsizip_path(safe_root)
+    matches = []
+    for member in get_zip_member_index(zip_path):
+        if inner_path:
+            if not member.startswith(inner_path + "/"):
+                continue
+            member = member[len(inner_path) + 1 :]
+        member_parts = member.split("/")
+        if len(member_parts) == len(pattern_parts) and all(
+            fnmatch.fnmatchcase(part, part_pattern)
+            for part, part_pattern in zip(member_parts, pattern_parts)
+        ):
+            matches.append(safe_root + "/" + member)
+    return sorted(matches)
+
+
 def get_filenames(path, filepattern, dirpattern):
     """
     Finds all file names in a directory for which the file name matches a certain string pattern,
@@ -556,11 +1367,21 @@ def get_filenames(path, filepattern, dirpattern):
       dirpattern = string of the directory name pattern to search for
 
     Returns:
-      a list of all found files with the full path directory
+      a list of all found files with the full path directory. For a .SAFE product that has been zipped, these are
+      /vsizip/ paths into the archive; see resolve_safe_path.
     """
 
     log = logging.getLogger("pyeo_1")
 
+    # archived .SAFE products are searched inside their zip archive
+    if path.endswith(".SAFE"):
+        path = resolve_safe_path(path)
+    if path.startswith("/vsizip/"):
+        return _get_filenames_in_zip(path, filepattern, dirpattern)
+
+    if _catalogue is not None:
+        return _catalogue.find_files(path, filepattern, dirpattern)
+
     filelist = []
     for root, dirs, files in os.walk(path, topdown=True):
         # log.info("root, dirs, files: {}".format(root,dirs,files))
@@ -643,7 +1464,7 @@ def check_for_invalid_l2_data(l2_SAFE_file, resolution="10m"):
     Parameters
     ----------
     l2_SAFE_file : str
-        Path to the L2A file to check
+        Path to the L2A file to check, or to a .SAFE product that has been zipped
     resolution : {"10m", "20m", "60m"}
         The resolution of imagery to check. Defaults to 10m.
 
@@ -655,7 +1476,7 @@ def check_for_invalid_l2_data(l2_SAFE_file, resolution="10m"):
 
     log = logging.getLogger("pyeo_1")
 
-    if not os.path.exists(l2_SAFE_file):
+    if not safe_exists(l2_SAFE_file):
         log.info("{} does not exist.".format(l2_SAFE_file))
         return 2
 
@@ -737,14 +1558,14 @@ def check_for_invalid_l1_data(l1_SAFE_file):
     Parameters
     ----------
     l1_SAFE_file : str
-        Path to the L1 file to check
+        Path to the L1 file to check, or to a .SAFE product that has been zipped
 
     Returns
     -------
     result : int
         1 if imagery is valid, 0 if not and 2 if not a safe-file
     """
-    if not os.path.exists(l1_SAFE_file):
+    if not safe_exists(l1_SAFE_file):
         log.info("{} does not exist.".format(l1_SAFE_file))
         return 2
     if not l1_SAFE_file.endswith(".SAFE") or "L1C" not in l1_SAFE_file:
@@ -752,8 +1573,7 @@ def check_for_invalid_l1_data(l1_SAFE_file):
         return 2
     log.info("Checking {} for incomplete imagery".format(l1_SAFE_file))
     granule_path = r"GRANULE/*/IMG_DATA/*_B0[8,4,3,2]*.jp2"
-    image_glob = os.path.join(l1_SAFE_file, granule_path)
-    if len(glob.glob(image_glob)) == 4:
+    if len(glob_safe(l1_SAFE_file, granule_path)) == 4:
         log.info("All necessary bands are complete")
         return 1
     else:
@@ -963,6 +1783,13 @@ def get_preceding_image_path(target_image_name, search_dir):
 
     """
     target_time = get_image_acquisition_time(target_image_name)
+    if _catalogue is not None:
+        preceding_name = _catalogue.find_preceding_image(
+            search_dir, target_time.strftime("%Y%m%dT%H%M%S")
+        )
+        if preceding_name is None:
+            raise FileNotFoundError("No image older than {}".format(target_image_name))
+        return os.path.join(search_dir, preceding_name)
     image_paths = sort_by_timestamp(
         os.listdir(search_dir), recent_first=True
     )  # Sort image list newest first
@@ -1116,6 +1943,9 @@ def get_l1_safe_file(image_name, l1_dir):
     """
     timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
     granule = get_sen_2_image_tile(os.path.basename(image_name))
+    if _catalogue is not None:
+        safe_name = _catalogue.find_safe_product(l1_dir, "MSIL1C", timestamp, granule)
+        return None if safe_name is None else os.path.join(l1_dir, safe_name)
     safe_glob = "S2[A|B]_MSIL1C_{}_*_{}_*.SAFE".format(timestamp, granule)
     out = glob.glob(os.path.join(l1_dir, safe_glob))
     if len(out) == 0:
@@ -1143,6 +1973,9 @@ def get_l2_safe_file(image_name, l2_dir):
     """
     timestamp = get_sen_2_image_timestamp(os.path.basename(image_name))
     granule = get_sen_2_image_tile(os.path.basename(image_name))
+    if _catalogue is not None:
+        safe_name = _catalogue.find_safe_product(l2_dir, "MSIL2A", timestamp, granule)
+        return None if safe_name is None else os.path.join(l2_dir, safe_name)
     safe_glob = "S2[A|B]_MSIL2A_{}_*_{}_*.SAFE".format(timestamp, granule)
     out = glob.glob(os.path.join(l2_dir, safe_glob))
     if len(out) == 0:
@@ -0,0 +1,353 @@
+"""
+pyeo_1.job_scheduling
+=====================
+Runs batches of command-line jobs, such as the per-tile raster and vectorisation processes of the national pipeline,
+through an execution backend.
+
+Key functions
+-------------
+
+:py:class:`JobScheduler` Runs a set of jobs with dependencies, within limits on the number of jobs and memory in use.
+
+:py:func:`get_backend` Returns the backend named in the config: 'local', 'pbs' or 'slurm'.
+
+Backends
+--------
+
+Every backend turns a job into a process on this machine that returns when the job has finished:
+
+* :py:class:`LocalBackend` runs the job itself.
+* :py:class:`PBSBackend` submits it with `qsub -W block=true` (PBS Professional).
+* :py:class:`SlurmBackend` submits it with `sbatch --wait`.
+
+Each process is waited on by its own thread, which reports to the scheduler as soon as the job ends, so no queue
+polling is needed. Jobs are started once all the jobs they depend on have succeeded; jobs that depend on a failed job
+are skipped.
+
+Job ledger
+----------
+
+The scheduler records the state and return code of each job in a JSON ledger as it runs. When resuming, jobs the
+ledger records as done are not run again, so an interrupted batch can be restarted where it stopped.
+"""
+
+import datetime
+import json
+import logging
+import os
+import queue
+import shlex
+import subprocess
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+RUNNING = "running"
+
+
+class LocalBackend:
+    """
+    Runs jobs as subprocesses of this process.
+
+    Parameters
+    ----------
+    log_dir : str, optional
+        If present, the output of each job is written to `<log_dir>/<job name>_o.txt` and `_e.txt`
+    """
+
+    name = "local"
+
+    def __init__(self, log_dir=None):
+        self.log_dir = log_dir
+
+    def _output_paths(self, job_name):
+        return (
+            os.path.join(self.log_dir, job_name + "_o.txt"),
+            os.path.join(self.log_dir, job_name + "_e.txt"),
+        )
+
+    def launch(self, job):
+        """Starts a job and returns its subprocess.Popen"""
+        if not self.log_dir:
+            return subprocess.Popen(job["command"])
+        out_path, err_path = self._output_paths(job["name"])
+        with open(out_path, "w") as out_file, open(err_path, "w") as err_file:
+            return subprocess.Popen(job["command"], stdout=out_file, stderr=err_file)
+
+
+class PBSBackend(LocalBackend):
+    """
+    Submits jobs to a PBS Professional queue with `qsub -W block=true`, so that qsub returns when the job ends,
+    with the exit status of the job.
+
+    Parameters
+    ----------
+    log_dir : str
+        The directory for the `_o.txt` and `_e.txt` output of each job
+    resource_options : str, optional
+        The `-l` resource list for each job, e.g. 'walltime=24:00:00,select=1:ncpus=16:mem=64gb'
+    setup_command : str, optional
+        A shell command run before each job, e.g. to activate an environment
+    """
+
+    name = "pbs"
+
+    def __init__(self, log_dir, resource_options=None, setup_command=None):
+        super().__init__(log_dir)
+        self.resource_options = resource_options
+        self.setup_command = setup_command
+
+    def _job_script(self, job):
+        command = " ".join(shlex.quote(arg) for arg in job["command"])
+        if self.setup_command:
+            return "{}; {}\n".format(self.setup_command, command)
+        return command + "\n"
+
+    def launch(self, job):
+        out_path, err_path = self._output_paths(job["name"])
+        qsub_command = ["qsub", "-W", "block=true", "-N", job["name"], "-o", out_path, "-e", err_path]
+        if self.resource_options:
+            qsub_command += ["-l", self.resource_options]
+        proc = subprocess.Popen(
+            qsub_command, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, universal_newlines=True
+        )
+        proc.stdin.write(self._job_script(job))
+        proc.stdin.close()
+        return proc
+
+
+class SlurmBackend(PBSBackend):
+    """
+    Submits jobs to a SLURM queue with `sbatch --wait`, so that sbatch returns when the job ends, with the exit
+    status of the job.
+
+    Parameters
+    ----------
+    log_dir : str
+        The directory for the `_o.txt` and `_e.txt` output of each job
+    resource_options : str, optional
+        Further sbatch options for each job, e.g. '--time=24:00:00 --cpus-per-task=16 --mem=64G'
+    setup_command : str, optional
+        A shell command run before each job, e.g. to activate an environment
+    """
+
+    name = "slurm"
+
+    def launch(self, job):
+        out_path, err_path = self._output_paths(job["name"])
+        sbatch_command = ["sbatch", "--wait", "--job-name", job["name"], "--output", out_path, "--error", err_path]
+        if self.resource_options:
+            sbatch_command += shlex.split(self.resource_options)
+        sbatch_command += ["--wrap", self._job_script(job).strip()]
+        return subprocess.Popen(sbatch_command, stdout=subprocess.DEVNULL)
+
+
+def get_backend(name, log_dir, resource_options=None, setup_command=None):
+    """
+    Returns the execution backend called name.
+
+    Parameters
+    ----------
+    name : str
+        'local', 'pbs' or 'slurm'
+    log_dir : str
+        The directory for the output of each job
+    resource_options : str, optional
+        The resources to request for each job from a cluster queue
+    setup_command : str, optional
+        A shell command run before each job on a cluster node
+
+    Returns
+    -------
+    The backend
+
+    """
+    if name == "local":
+        return LocalBackend(log_dir)
+    if name == "pbs":
+        return PBSBackend(log_dir, resource_options, setup_command)
+    if name == "slurm":
+        return SlurmBackend(log_dir, resource_options, setup_command)
+    raise ValueError("Unknown job backend {}; use one of 'local', 'pbs' or 'slurm'".format(name))
+
+
+class JobScheduler:
+    """
+    Runs a set of jobs through a backend, starting each job once the jobs it depends on have succeeded.
+
+    Parameters
+    ----------
+    backend
+        A backend from :py:func:`get_backend`
+    max_jobs : int, optional
+        The most jobs to run at once. Defaults to 1.
+    mem_limit_mb : int, optional
+        If present, jobs are only started while the memory declared by the running jobs, plus that of the new job,
+        stays within this limit. A job is always started when none are running.
+    ledger_path : str, optional
+        If present, the state of every job is recorded in this JSON file as it changes
+    resume : bool, optional
+        If True, jobs already recorded as done in the ledger are not run again. Defaults to False.
+    timeout_hours : float, optional
+        If present, stop waiting for jobs after this long. Jobs still running are left to finish.
+    log : logging.Logger, optional
+        The logger to report to
+
+    Examples
+    --------
+    >>> scheduler = JobScheduler(LocalBackend(), max_jobs=4, mem_limit_mb=64000)
+    >>> scheduler.add_job("36NXG_raster", ["python", "acd_by_tile_raster.py", "pyeo_1.ini", "36NXG"], mem_mb=16000)
+    >>> scheduler.add_job("36NXG_vector", ["python", "acd_by_tile_vectorisation.py", "pyeo_1.ini", "36NXG"],
+    ...                   depends_on=["36NXG_raster"])
+    >>> scheduler.run()
+    {'36NXG_raster': 'done', '36NXG_vector': 'done'}
+
+    """
+
+    def __init__(
+        self,
+        backend,
+        max_jobs=1,
+        mem_limit_mb=None,
+        ledger_path=None,
+        resume=False,
+        timeout_hours=None,
+        log=log,
+    ):
+        self.backend = backend
+        self.max_jobs = max(max_jobs, 1)
+        self.mem_limit_mb = mem_limit_mb
+        self.ledger_path = ledger_path
+        self.timeout_hours = timeout_hours
+        self.log = log
+        self.jobs = {}
+        self.ledger = {}
+        if resume and ledger_path and os.path.exists(ledger_path):
+            with open(ledger_path) as ledger_file:
+                self.ledger = json.load(ledger_file)
+
+    def add_job(self, name, command, depends_on=(), mem_mb=0):
+        """
+        Adds a job to run.
+
+        Parameters
+        ----------
+        name : str
+            A unique name for the job
+        command : list of str
+            The command line to run
+        depends_on : list of str, optional
+            The names of jobs that must succeed before this one starts
+        mem_mb : int, optional
+            The memory the job is expected to use, counted against mem_limit_mb
+
+        """
+        if name in self.jobs:
+            raise ValueError("A job called {} has already been added".format(name))
+        self.jobs[name] = {
+            "name": name,
+            "command": list(command),
+            "depends_on": list(depends_on),
+            "mem_mb": mem_mb,
+        }
+
+    def _record(self, name, state, returncode=None):
+        self.ledger[name] = {
+            "state": state,
+            "returncode": returncode,
+            "command": self.jobs[name]["command"],
+            "time": datetime.datetime.now().strftime(r"%Y%m%dT%H%M%S"),
+        }
+        if self.ledger_path:
+            # write then rename, so an interruption never leaves a half-written ledger
+            temp_path = self.ledger_path + ".tmp"
+            with open(temp_path, "w") as ledger_file:
+                json.dump(self.ledger, ledger_file, indent=2)
+            os.replace(temp_path, self.ledger_path)
+
+    def _wait_for(self, name, proc, completions):
+        completions.put((name, proc.wait()))
+
+    def run(self):
+        """
+        Runs every job added, then returns a dict of the final state of each job: 'done', 'failed', 'skipped', or
+        'running' if the timeout passed first.
+        """
+        for name, job in self.jobs.items():
+            for dependency in job["depends_on"]:
+                if dependency not in self.jobs:
+                    raise ValueError("Job {} depends on unknown job {}".format(name, dependency))
+
+        states = {}
+        for name in self.jobs:
+            if self.ledger.get(name, {}).get("state") == DONE:
+                self.log.info("Job {} is already done according to the ledger; skipping".format(name))
+                states[name] = DONE
+        pending = [name for name in self.jobs if name not in states]
+        running = {}
+        completions = queue.Queue()
+        deadline = time.time() + self.timeout_hours * 3600 if self.timeout_hours else None
+
+        while pending or running:
+            # skip anything that can no longer run
+            for name in list(pending):
+                failed = [
+                    dependency
+                    for dependency in self.jobs[name]["depends_on"]
+                    if states.get(dependency) in (FAILED, SKIPPED)
+                ]
+                if failed:
+                    self.log.error("Skipping job {}: job {} did not succeed".format(name, failed[0]))
+                    states[name] = SKIPPED
+                    self._record(name, SKIPPED)
+                    pending.remove(name)
+
+            # start every ready job that fits
+            for name in list(pending):
+                job = self.jobs[name]
+                if not all(states.get(dependency) == DONE for dependency in job["depends_on"]):
+                    continue
+                if len(running) >= self.max_jobs:
+                    break
+                mem_in_use = sum(self.jobs[running_name]["mem_mb"] for running_name in running)
+                if running and self.mem_limit_mb and mem_in_use + job["mem_mb"] > self.mem_limit_mb:
+                    continue
+                self.log.info("Starting job {} with the {} backend".format(name, self.backend.name))
+                proc = self.backend.launch(job)
+                running[name] = proc
+                states[name] = RUNNING
+                self._record(name, RUNNING)
+                pending.remove(name)
+                threading.Thread(target=self._wait_for, args=(name, proc, completions), daemon=True).start()
+
+            if not running:
+                break
+
+            # block until a job finishes
+            timeout = max(deadline - time.time(), 0) if deadline else None
+            try:
+                name, returncode = completions.get(timeout=timeout)
+            except queue.Empty:
+                self.log.error(
+                    "Stopped waiting for jobs after {} hours; still running: {}".format(
+                        self.timeout_hours, ", ".join(running)
+                    )
+                )
+                break
+            del running[name]
+            states[name] = DONE if returncode == 0 else FAILED
+            self._record(name, states[name], returncode)
+            if returncode == 0:
+                self.log.info("Job {} finished".format(name))
+            else:
+                self.log.error("Job {} failed with return code {}".format(name, returncode))
+
+        for name in pending:
+            self.log.error("Job {} was not started".format(name))
+            states[name] = SKIPPED
+            self._record(name, SKIPPED)
+        return states
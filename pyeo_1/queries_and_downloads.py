@@ -8,6 +8,7 @@ Key functions
 :py:func:`check_for_s2_data_by_date` Queries the Sentinel 2 archive for products between two dates
 :py:func:`download_s2_data` Downloads Sentinel 2 data from Scihub by default
 :py:func:`query_dataspace_by_polygon` Queries the New Copernicus Dataspace API for products between two dates, that conform to the Area of Interest and maximum cloud cover supplied.
+:py:class:`DataspaceQueryCache` Keeps the results of Dataspace queries, so that later queries only ask for new dates
 
 SAFE files
 ----------
@@ -65,15 +66,17 @@ import logging
 import os
 import re
 import shutil
+import sqlite3
 import subprocess
 import sys
 import tarfile
+import threading
 import time
 from tqdm import tqdm
 import zipfile
 from multiprocessing.dummy import Pool
 from tempfile import TemporaryDirectory
-from urllib.parse import urlencode
+from urllib.parse import urlencode, urljoin
 from xml.etree import ElementTree
 
 import numpy as np
@@ -90,6 +93,7 @@ from osgeo import ogr, osr
 from pyeo_1.coordinate_manipulation import (get_vector_projection,
                                             reproject_vector)
 from pyeo_1.exceptions import (BadDataSourceExpection,
+                               DownloadIntegrityException,
                                InvalidDateFormatException,
                                InvalidGeometryFormatException,
                                NoL2DataAvailableException, TooManyRequests)
@@ -122,10 +126,19 @@ def query_dataspace_by_polygon(
     end_date: str,
     area_of_interest: str,
     max_records: int,
-    log: logging.Logger
+    log: logging.Logger,
+    cache_path: str = None,
+    resync_days: int = 7,
+    n_workers: int = 4,
+    session=None
 ) -> pd.DataFrame:
     """
     This function returns a DataFrame of available Sentinel-2 imagery from the Copernicus Dataspace API.
+    All pages of the search are fetched, the pages after the first concurrently.
+
+    If cache_path is given, the products found are kept in a :py:class:`DataspaceQueryCache` together with the date
+    range already searched for this area and cloud cover, and only the dates not searched yet are requested from the
+    API. Dates within resync_days of the last search are searched again, to pick up products published late.
 
     Parameters
     ----------
@@ -138,29 +151,102 @@ def query_dataspace_by_polygon(
     area_of_interest : str
         Region of interest centroid in WKT format
     max_records : int
-        Maximum records to return
-
+        Maximum records to return per page
+    log : logging.Logger
+        The logger to report to
+    cache_path : str, optional
+        Path to the SQLite query cache, e.g. one per tile. If None, every date is searched. Defaults to None.
+    resync_days : int, optional
+        The days before the last search that are searched again. Defaults to 7.
+    n_workers : int, optional
+        The number of pages to request at once. Defaults to 4.
+    session : requests.Session, optional
+        The session to send the requests with; anything with a requests-like get() method will do. Defaults to a new
+        requests.Session.
 
     Returns
     -------
-    None
+    response_dataframe : pd.DataFrame
+        The properties of each product found, one row per product
     """
 
-    request_string = build_dataspace_request_string(
-        max_cloud_cover=max_cloud_cover,
-        start_date=start_date,
-        end_date=end_date,
-        area_of_interest=area_of_interest,
-        max_records=max_records,
-    )
-    response = requests.get(request_string)
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    try:
+        if cache_path is None:
+            features = _query_dataspace_pages(
+                session, max_cloud_cover, start_date, end_date, area_of_interest, max_records, n_workers, log
+            )
+            return _dataspace_features_to_dataframe(features)
+
+        cache = DataspaceQueryCache(cache_path)
+        try:
+            query_key = cache.query_key(area_of_interest, max_cloud_cover)
+            for delta_start, delta_end, reaches_present in cache.missing_ranges(
+                query_key, start_date, end_date, resync_days
+            ):
+                log.info(f"Querying Dataspace for {delta_start} to {delta_end}; the rest is cached in {cache_path}")
+                features = _query_dataspace_pages(
+                    session, max_cloud_cover, delta_start, delta_end, area_of_interest, max_records, n_workers, log
+                )
+                cache.add(query_key, features, delta_start, delta_end, reaches_present)
+            return _dataspace_features_to_dataframe(cache.find(query_key, start_date, end_date))
+        finally:
+            cache.close()
+    finally:
+        if own_session:
+            session.close()
+
+
+def _query_dataspace_pages(session, max_cloud_cover, start_date, end_date, area_of_interest, max_records, n_workers,
+                           log) -> list:
+    """
+    Returns the features of every page of a Dataspace search. The first page reports the total number of results,
+    so the remaining pages are requested n_workers at a time.
+    """
+
+    def get_page(page):
+        request_string = build_dataspace_request_string(
+            max_cloud_cover=max_cloud_cover,
+            start_date=start_date,
+            end_date=end_date,
+            area_of_interest=area_of_interest,
+            max_records=max_records,
+            page=page,
+        )
+        return _get_dataspace_json(session, request_string, log)
+
+    first_page = get_page(1)
+    features = list(first_page["features"])
+    total_results = first_page.get("properties", {}).get("totalResults")
+    if total_results is not None:
+        n_pages = -(-total_results // max_records)
+        thread_pool = Pool(max(n_workers, 1))
+        pages = thread_pool.map(get_page, range(2, n_pages + 1))
+        thread_pool.close()
+        thread_pool.join()
+        for page in pages:
+            features.extend(page["features"])
+    else:
+        # no total given; keep asking until a page comes back short
+        page_number = 1
+        page = first_page
+        while len(page["features"]) == max_records:
+            page_number += 1
+            page = get_page(page_number)
+            features.extend(page["features"])
+    log.info(f"Dataspace returned {len(features)} products for {start_date} to {end_date}")
+    return features
+
+
+def _get_dataspace_json(session, request_string, log) -> dict:
+    """
+    Sends one Dataspace search request, exiting the pipeline if the API does not answer with a 200.
+    """
+    response = session.get(request_string)
     if response.status_code == 200:
-        response = response.json()["features"]
-        # log.info(json.dumps(response, indent=4))
-        # sys.exit(1)
-        response_dataframe = pd.DataFrame.from_dict(response)
-        response_dataframe = pd.DataFrame.from_records(response_dataframe["properties"])
-        return response_dataframe
+        return response.json()
     elif response.status_code == 401:
         log.error("Dataspace returned a 401 HTTP Status Code")
         log.error("Which means that user credentials for the Copernicus Dataspace Ecosystem are incorrect.")
@@ -173,12 +259,134 @@ def query_dataspace_by_polygon(
         # this could be improved by catching more specific status codes
         sys.exit(1)
 
+
+def _dataspace_features_to_dataframe(features: list) -> pd.DataFrame:
+    """
+    Turns Dataspace search features into a DataFrame of their properties, one row per product.
+    """
+    # the same product can turn up on two pages if the catalogue changes between requests
+    unique_features = {feature["id"]: feature for feature in features}
+    return pd.DataFrame.from_records([feature["properties"] for feature in unique_features.values()])
+
+
+class DataspaceQueryCache:
+    """
+    A persistent SQLite store of the products returned by Dataspace searches, with a record of the date range
+    already searched for each area of interest and maximum cloud cover. Used by
+    :py:func:`query_dataspace_by_polygon` so that repeated runs only request the dates they have not searched yet.
+
+    Parameters
+    ----------
+    db_path : str
+        Path to the SQLite database. Created if it does not exist.
+
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS products (
+                query_key TEXT, id TEXT, start_date TEXT, completion_date TEXT, feature TEXT,
+                PRIMARY KEY (query_key, id)
+            );
+            CREATE INDEX IF NOT EXISTS products_by_date ON products (query_key, start_date);
+            CREATE TABLE IF NOT EXISTS syncs (
+                query_key TEXT PRIMARY KEY, start_date TEXT, end_date TEXT, synced_at TEXT
+            );
+            """
+        )
+
+    def close(self):
+        """
+        Closes the database connection.
+        """
+        self._db.close()
+
+    @staticmethod
+    def query_key(area_of_interest, max_cloud_cover):
+        """
+        Returns the key the products and searches of one area of interest and maximum cloud cover are stored under.
+        """
+        return f"{area_of_interest}|cloudCover<={max_cloud_cover}"
+
+    def missing_ranges(self, query_key, start_date, end_date, resync_days=7):
+        """
+        Returns the date ranges (YYYY-MM-DD) that need searching to cover start_date to end_date, as a list of
+        (start, end, reaches_present) tuples. Dates within resync_days of the last search are counted as missing.
+        The ranges adjoin the dates already searched, so that the searched dates stay one unbroken range.
+        """
+        row = self._db.execute(
+            "SELECT start_date, end_date, synced_at FROM syncs WHERE query_key = ?", (query_key,)
+        ).fetchone()
+        if row is None:
+            return [(start_date, end_date, True)]
+        synced_start, synced_end, synced_at = row
+        resync_from = (dt.date.fromisoformat(synced_at) - dt.timedelta(days=resync_days)).isoformat()
+        final_end = min(synced_end, resync_from)
+        ranges = []
+        if start_date < synced_start:
+            ranges.append((start_date, synced_start, False))
+        if end_date > final_end:
+            ranges.append((final_end, end_date, True))
+        return ranges
+
+    def add(self, query_key, features, start_date, end_date, reaches_present=True):
+        """
+        Stores the features returned by a search of start_date to end_date and records those dates as searched.
+        Set reaches_present to False when the search ended before the dates last searched, so that the time of the
+        last search is kept.
+        """
+        today = dt.date.today().isoformat()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?)",
+                [
+                    (
+                        query_key,
+                        feature["id"],
+                        feature["properties"]["startDate"],
+                        feature["properties"]["completionDate"],
+                        json.dumps(feature),
+                    )
+                    for feature in features
+                ],
+            )
+            row = self._db.execute(
+                "SELECT start_date, end_date, synced_at FROM syncs WHERE query_key = ?", (query_key,)
+            ).fetchone()
+            if row is not None:
+                start_date = min(start_date, row[0])
+                end_date = max(end_date, row[1])
+                if not reaches_present:
+                    today = row[2]
+            self._db.execute(
+                "INSERT OR REPLACE INTO syncs VALUES (?, ?, ?, ?)", (query_key, start_date, end_date, today)
+            )
+
+    def find(self, query_key, start_date, end_date):
+        """
+        Returns the stored features that a search of start_date to end_date (YYYY-MM-DD) would return, in order of
+        acquisition.
+        """
+        # Dataspace counts products acquired at any time on end_date as within the search, so only the day of the
+        # full completion timestamp is compared
+        rows = self._db.execute(
+            "SELECT feature FROM products WHERE query_key = ? AND start_date >= ? "
+            "AND substr(completion_date, 1, 10) <= ? ORDER BY start_date",
+            (query_key, start_date, end_date),
+        )
+        return [json.loads(row[0]) for row in rows]
+
+
 def build_dataspace_request_string(
     max_cloud_cover: int,
     start_date: str,
     end_date: str,
     area_of_interest: str,
     max_records: int,
+    page: int = None,
 ) -> str:
     """
     This function builds the API product request string based on given properties and constraints.
@@ -195,6 +403,9 @@ def build_dataspace_request_string(
         Area of interest geometry as a string in WKT format
     max_records : int
         Maximum number of products to show per query (queries with very high numbers may not complete in time)
+    page : int, optional
+        If present, the page of results to return, counting from 1. The total number of results is then included in
+        the response.
 
     Returns
     -------
@@ -209,6 +420,8 @@ def build_dataspace_request_string(
     max_records_props = f"maxRecords={max_records}"
 
     request_string = f"{DATASPACE_API_ROOT}?{cloud_cover_props}&{start_date_props}&{end_date_props}&{geometry_props}&{max_records_props}"
+    if page is not None:
+        request_string = f"{request_string}&page={page}&exactCount=1"
     return request_string
 
 
@@ -273,7 +486,8 @@ def build_dataspace_request_string(
 
 def get_access_token(dataspace_username: str = None,
                      dataspace_password: str = None,
-                     refresh_token: str = None) -> str:
+                     refresh_token: str = None,
+                     token_url: str = DATASPACE_REFRESH_TOKEN_URL) -> str:
     """
 
     This function creates an access token to use during download for verification purposes.
@@ -290,6 +504,9 @@ def get_access_token(dataspace_username: str = None,
     refresh : bool
         Refreshes an old access token, Default false - returns new access token
 
+    token_url : str, optional
+        The Keycloak token endpoint. Defaults to DATASPACE_REFRESH_TOKEN_URL.
+
 
     Returns
     -------
@@ -308,7 +525,7 @@ def get_access_token(dataspace_username: str = None,
 
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
 
-        response = requests.post(DATASPACE_REFRESH_TOKEN_URL, data=payload, headers=headers).json()
+        response = requests.post(token_url, data=payload, headers=headers).json()
         
     else:
         payload = {
@@ -321,7 +538,7 @@ def get_access_token(dataspace_username: str = None,
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
         try:
             response = requests.post(
-                DATASPACE_REFRESH_TOKEN_URL, data=payload, headers=headers
+                token_url, data=payload, headers=headers
             ).json()
         except Exception as e:
             raise Exception(
@@ -331,6 +548,74 @@ def get_access_token(dataspace_username: str = None,
     return response
 
 
+class DataspaceAuth:
+    """
+    Holds a Copernicus Dataspace access token that is shared between download threads.
+
+    The access token is refreshed with the refresh token shortly before it expires, and a new token is requested
+    with the username and password once the refresh token has expired as well.
+
+    Parameters
+    ----------
+    dataspace_username : str
+        The username registered with the Copernicus Open Access Dataspace
+
+    dataspace_password : str
+        The password registered with the Copernicus Open Access Dataspace
+
+    token_url : str, optional
+        The Keycloak token endpoint. Defaults to DATASPACE_REFRESH_TOKEN_URL.
+
+    """
+
+    # seconds before expiry at which a token is treated as expired, to allow for slow redirects
+    expiry_margin = 60
+
+    def __init__(self,
+                 dataspace_username: str,
+                 dataspace_password: str,
+                 token_url: str = DATASPACE_REFRESH_TOKEN_URL):
+        self.dataspace_username = dataspace_username
+        self.dataspace_password = dataspace_password
+        self.token_url = token_url
+        self._lock = threading.Lock()
+        self._auth_response = None
+        self._expires_at = 0
+        self._refresh_expires_at = 0
+
+    def get_token(self) -> str:
+        """
+        Returns a valid access token, refreshing or recreating it if needed.
+        """
+        with self._lock:
+            now = time.time()
+            if now < self._expires_at - self.expiry_margin:
+                return self._auth_response["access_token"]
+            auth_response = None
+            if self._auth_response is not None and now < self._refresh_expires_at - self.expiry_margin:
+                auth_response = get_access_token(
+                    refresh_token=self._auth_response["refresh_token"],
+                    token_url=self.token_url,
+                )
+            if auth_response is None or "access_token" not in auth_response:
+                auth_response = get_access_token(
+                    dataspace_username=self.dataspace_username,
+                    dataspace_password=self.dataspace_password,
+                    token_url=self.token_url,
+                )
+            self._auth_response = auth_response
+            self._expires_at = now + auth_response.get("expires_in", 600)
+            self._refresh_expires_at = now + auth_response.get("refresh_expires_in", 3600)
+            return auth_response["access_token"]
+
+    def invalidate(self) -> None:
+        """
+        Forces the next call to get_token to refresh the access token, e.g. after the server rejected it.
+        """
+        with self._lock:
+            self._expires_at = 0
+
+
 
 # def download_s2_data_from_dataspace(product_df: pd.DataFrame,
 #                                     l1c_directory: str,
@@ -433,11 +718,16 @@ def download_s2_data_from_dataspace(product_df: pd.DataFrame,
                                     l2a_directory: str,
                                     dataspace_username: str,
                                     dataspace_password: str,
-                                    log: logging.Logger
+                                    log: logging.Logger,
+                                    n_workers: int = 4,
+                                    download_url: str = DATASPACE_DOWNLOAD_URL,
+                                    token_url: str = DATASPACE_REFRESH_TOKEN_URL,
+                                    on_l1c_ready=None
                                     ) -> None:
     """
     
     This is a function wraps around `download_dataspace_product`, providing the necessary directories dependent on product type (L1C/L2A).
+    Products are downloaded by up to n_workers threads that share one access token and one pooled requests.Session.
 
     Parameters
     ----------
@@ -460,102 +750,92 @@ def download_s2_data_from_dataspace(product_df: pd.DataFrame,
     log : logging.Logger
         Log object to write to.
 
+    n_workers : int, optional
+        The number of products to download concurrently. Defaults to 4, the Dataspace limit of concurrent
+        downloads per user.
+
+    download_url : str, optional
+        The OData products endpoint. Defaults to DATASPACE_DOWNLOAD_URL.
+
+    token_url : str, optional
+        The Keycloak token endpoint. Defaults to DATASPACE_REFRESH_TOKEN_URL.
+
+    on_l1c_ready : callable, optional
+        If present, called with the path to each L1C product as soon as it is on disk, including those already
+        downloaded; for example `raster_manipulation.Sen2CorPool.submit`, to atmospherically correct products
+        while the rest download.
+
     Returns
     ----------
     None
 
     """
-    # get auth_token needed to authenticate with CDSE API
-    # auth_response = get_access_token(
-    #     dataspace_username=dataspace_username,
-    #     dataspace_password=dataspace_password,
-    #     )
-    # print(f"auth response  :  {auth_response}")
-
-    # # wait for 60 seconds
-    # print("sleep for 60 seconds")
-    # time.sleep(60)
-    # print("awake after sleep")
-        
+    downloads = []
     for counter, product in enumerate(product_df.itertuples(index=False)):
-        log.info(f"    Checking {counter+1} of {len(product_df)} : {product.title}")        # if L1C have been passed, download to the l1c_directory
+        log.info(f"    Checking {counter+1} of {len(product_df)} : {product.title}")
+        # if L1C have been passed, download to the l1c_directory
         if product.processinglevel == "Level-1C":
-
             out_path = os.path.join(l1c_directory, product.title)
             if check_for_invalid_l1_data(out_path) == 1:
                 log.info(f"        {out_path} imagery already exists, skipping download")
+                if on_l1c_ready:
+                    on_l1c_ready(out_path)
                 # continue means skip the current iteration and move to the next iteration of the for loop
                 continue
-            try:
-                log.info(f"        Downloading : {product.title}")
-                download_dataspace_product(
-                    product_uuid=product.uuid,
-                    # auth_response=auth_response,
-                    dataspace_username=dataspace_username,
-                    dataspace_password=dataspace_password,
-                    product_name=product.title,
-                    safe_directory=l1c_directory,
-                    log=log
-                )
-            
-            except Exception as error:
-                log.error(f"Download from dataspace of L1C Product did not finish")
-                log.error(f"Received this error :  {error}")
-
-            # refresh
-            # auth_response = get_access_token(
-            # dataspace_username=dataspace_username,
-            # dataspace_password=dataspace_password,
-            # refresh_token=auth_response["refresh_token"],
-            # )
-            # # wait for 60 seconds
-            # print("sleep for 60")
-            # time.sleep(60)
-            # print("awake from sleep")
-
-            # print(f"original auth response: {auth_response}")
-            # print("---"*30)
-            # print(f"new auth response : {new_auth_response}")
-            
-        # if L2A have been passed, download to the l1c_directory
+            downloads.append((product, l1c_directory))
+
+        # if L2A have been passed, download to the l2a_directory
         elif product.processinglevel == "Level-2A":
             out_path = os.path.join(l2a_directory, product.title)
             if check_for_invalid_l2_data(out_path) == 1:
                 log.info(f"        {out_path} imagery already exists, skipping download")
                 # continue means to skip the current iteration and move to the next iteration of the for loop
                 continue
-            try:
-                log.info(f"        Downloading  : {product.title}")
-                download_dataspace_product(
-                    product_uuid=product.uuid,
-                    # auth_response=auth_response,
-                    dataspace_username=dataspace_username,
-                    dataspace_password=dataspace_password,
-                    product_name=product.title,
-                    safe_directory=l2a_directory,
-                    log=log
-                )
-            except Exception as error:
-                log.error(f"Download from dataspace of L2A Product did not finish")
-                log.error(f"Received error   {error}")
-
-            # # refresh
-            # auth_response = get_access_token(
-            # dataspace_username=dataspace_username,
-            # dataspace_password=dataspace_password,
-            # refresh_token=auth_response["refresh_token"],
-            # )
-            # print("sleep for 60")
-            # time.sleep(60)
-            # print("awake from sleep")
-            # print(f"original auth response: {auth_response}")
-            # print("---"*30)
-            # print(f"new auth response : {new_auth_response}")
+            downloads.append((product, l2a_directory))
 
         else:
             log.error(f"Neither 'Level-1C' or 'Level-2A' were in {product.processinglevel}")
             log.error("could be a bad data source, therefore skipping")
 
+    if len(downloads) == 0:
+        return
+
+    n_workers = max(min(n_workers, len(downloads)), 1)
+    auth = DataspaceAuth(dataspace_username, dataspace_password, token_url=token_url)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=n_workers, pool_maxsize=n_workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    def download(job):
+        product, safe_directory = job
+        try:
+            log.info(f"        Downloading : {product.title}")
+            download_dataspace_product(
+                product_uuid=product.uuid,
+                dataspace_username=dataspace_username,
+                dataspace_password=dataspace_password,
+                product_name=product.title,
+                safe_directory=safe_directory,
+                log=log,
+                session=session,
+                auth=auth,
+                download_url=download_url
+            )
+        except Exception as error:
+            log.error(f"Download from dataspace of {product.processinglevel} Product did not finish: {product.title}")
+            log.error(f"Received this error :  {error}")
+            return
+        if on_l1c_ready and product.processinglevel == "Level-1C":
+            on_l1c_ready(os.path.join(safe_directory, product.title))
+
+    log.info(f"    Downloading {len(downloads)} products with {n_workers} workers")
+    thread_pool = Pool(n_workers)
+    thread_pool.map(download, downloads)
+    thread_pool.close()
+    thread_pool.join()
+    session.close()
+
     return
 
 
@@ -625,163 +905,159 @@ def download_s2_data_from_dataspace(product_df: pd.DataFrame,
 #     return
 
 def download_dataspace_product(product_uuid: str,
-                            #    auth_response: dict,
                                dataspace_username,
                                dataspace_password,
                                product_name: str,
                                safe_directory: str,
-                               log: logging.Logger
+                               log: logging.Logger,
+                               session: requests.Session = None,
+                               auth: DataspaceAuth = None,
+                               download_url: str = DATASPACE_DOWNLOAD_URL,
+                               max_attempts: int = 3,
+                               chunk_size: int = 1024 * 1024
                                ) -> None:
     """
     This function downloads a given Sentinel product, with a given product UUID from the ESA servers.
 
+    The zipped product is streamed to `<safe_directory>/<product_name>.zip.part` in chunks. If that file already exists,
+    from an interrupted run or a failed attempt, the download resumes from its end with an HTTP Range request. Once
+    complete, the size and the CRCs of the archive are checked before it is unpacked into safe_directory.
+
     Parameters
     ----------
     product_uuid : str
         UUID of the product to download
-    auth_response : dict
-        Authentication Response
+    dataspace_username : str
+        The username registered with the Copernicus Open Access Dataspace, used if auth is not given
+    dataspace_password : str
+        The password registered with the Copernicus Open Access Dataspace, used if auth is not given
     product_name : str
         Name of the product
     safe_directory : str
         The directory (path) to write the SAFE files to
+    log : logging.Logger
+        Log object to write to.
+    session : requests.Session, optional
+        A session to reuse connections from. A new one is made if not given.
+    auth : DataspaceAuth, optional
+        A shared access token. A new one is made from the username and password if not given.
+    download_url : str, optional
+        The OData products endpoint. Defaults to DATASPACE_DOWNLOAD_URL.
+    max_attempts : int, optional
+        The number of times to try (and resume) the download before giving up. Defaults to 3.
+    chunk_size : int, optional
+        The number of bytes written to disk at a time. Defaults to 1 MB.
 
     Returns
     -------
     None
-    
-    """
 
-    # import requests
-    # session = requests.Session()
-    # session.headers.update({'Authorization': 'Bearer KEYCLOAK_TOKEN'})
-    # url = f"http://catalogue.dataspace.copernicus.eu/odata/v1/Products(db0c8ef3-8ec0-5185-a537-812dad3c58f8)/$value"
-    # response = session.get(url, allow_redirects=False)
-    # while response.status_code in (301, 302, 303, 307):
-    #     url = response.headers['Location']
-    #     response = session.get(url, allow_redirects=False)
+    Raises
+    ------
+    DownloadIntegrityException
+        If the downloaded archive is still incomplete or corrupt after max_attempts attempts.
 
-    # file = session.get(url, verify=False, allow_redirects=True)
+    """
+    if auth is None:
+        auth = DataspaceAuth(dataspace_username, dataspace_password)
+    if session is None:
+        session = requests.Session()
 
-    # with open(f"product.zip", 'wb') as p:
-    #     p.write(file.content)
+    url = f"{download_url}({product_uuid})/$value"
+    destination_path = os.path.join(safe_directory, product_name)
+    partial_path = f"{destination_path}.zip.part"
 
-    auth_response = get_access_token(
-        dataspace_username=dataspace_username,
-        dataspace_password=dataspace_password,
-        )
-    # log.info(f"auth response  :  {auth_response}")
-    # # wait for 60 seconds
-    # print("sleep for 60 seconds")
-    # time.sleep(60)
-    # print("awake after sleep")
-
-    ############################
-    # auth limited to 10 minutes
-    auth_access_token = auth_response["access_token"]
-    # # refresh limited to 1 hour
-    # refresh_token = auth_response.refresh_token
+    for attempt in range(1, max_attempts + 1):
+        try:
+            _stream_dataspace_product(session, auth, url, partial_path, chunk_size, log)
+            _check_downloaded_archive(partial_path, log)
+            break
+        except (requests.RequestException, DownloadIntegrityException) as error:
+            log.warning(f"  Attempt {attempt} of {max_attempts} to download {product_name} failed: {error}")
+            if attempt == max_attempts:
+                raise
+
+    log.info("    unpacking archive...")
+    with TemporaryDirectory(dir=safe_directory) as temp_dir:
+        with zipfile.ZipFile(partial_path) as archive:
+            archive.extractall(temp_dir)
+        # restructure paths
+        within_folder_path = glob.glob(os.path.join(temp_dir, "*"))
+        log.info(f"    moving {within_folder_path[0]} to {destination_path}")
+        shutil.move(src=within_folder_path[0], dst=destination_path)
+    os.remove(partial_path)
 
-    session = requests.Session()
-    session.headers.update({'Authorization': f"Bearer {auth_access_token}"})
-    url=f"{DATASPACE_DOWNLOAD_URL}({product_uuid})/$value"
-
-    log.info('Obtaining the download URL - via redirect from url constructed from uuid')
-    response = session.get(url, allow_redirects=False)
-    while response.status_code in (301, 302, 303, 307):
-        log.info(f"response.status_code: {response.status_code}")
-        log.info(f"download url = response.headers['Location']: {url}")
-        url = response.headers['Location']
-        response = session.get(url, allow_redirects=False)
-
-    log.info(f"Final response redirects to url: {url}")
-
-    log.info('Refresh access token as url redirect may take longer than 600s token expiry time')
-    auth_refresh_token = auth_response["refresh_token"]
-    auth_response = get_access_token(
-        dataspace_username=dataspace_username,
-        dataspace_password=dataspace_password,
-        refresh_token=auth_refresh_token,
-    )
-    auth_access_token = auth_response["access_token"]
-    session.headers.update({'Authorization': f"Bearer {auth_access_token}"})
+    return
 
-    log.info('Download the zipped image file')
-    file = session.get(url, verify=False, allow_redirects=True)
-    # log.info(f"file object: {dir(file)}")
 
-    min_file_size = 2000  # in bytes
-    if (len(file.content) <= min_file_size):
-        log.info(f'  Downloaded file too small, length: {len(file.content)} bytes, contents: {file.content}')
-        # TODO Check if == {"detail":"Expired signature!"}
-        #   If so re-authorise (using refresh token) and loop to try again
-
-    # total_size_in_bytes = int(response.headers.get("Content-Length", 0))
-    # block_size = 1024
-    # progress_bar = tqdm(total=total_size_in_bytes, unit="iB", unit_scale=True)
-
-    # my_temp_dir = os.path.join(os.path.expanduser('~'), '20230602_pyeo_temp_folder')
-    # log.info(f"my_temp_dir: {my_temp_dir}")
-    # with my_temp_dir as temp_dir:
-    with TemporaryDirectory(dir=os.path.expanduser('~')) as temp_dir:
-        temporary_path = f"{temp_dir}{os.sep}{product_name}.zip"
-        log.info(f"Downloaded file temporary_path: {temporary_path}")
-
-        with open(temporary_path, 'wb') as download:
-            # for data in file.iter_content(block_size):
-            #     download.write(data)
-            #     progress_bar.update(len(data))
-            download.write(file.content)
-        # progress_bar.close()
-        unzipped_path = os.path.splitext(temporary_path)[0]
-        # is the 'not a .zip' error here?
-        # zip_ref = zipfile.ZipFile(temporary_path, "r")
-        # zip_ref.extractall(unzipped_path)
-        # zip_ref.close()
-        destination_path = f"{safe_directory}{os.sep}{product_name}"
-        log.info(f"Downloaded file destination path: {destination_path}")
-        # if not os.path.exists(destination_path):
-        #     os.mkdir(destination_path)
-        # shutil.copyfile(src=temporary_path, dst=destination_path)
-
-        downloaded_file_size = os.path.getsize(temporary_path)
-        log.info(f"Downloaded file size: {downloaded_file_size} bytes")
-        if (downloaded_file_size < min_file_size):
-            log.info(f'  Downloaded file too small, contents are:')
-            file_dnld = open(temporary_path, 'r')
-            log.info(file_dnld.readline())
-            file_dnld.close()
-
-        log.info("    unpacking archive...")
-        shutil.unpack_archive(temporary_path, unzipped_path)
-
-        log.info(f"Unpacked Archive Path: {unzipped_path}")
-
-        # downloaded_file_size = os.path.getsize(unzipped_path)
-        # log.info(f"Downloaded unzipped file size: {downloaded_file_size} bytes")
-        # min_file_size = 2000  # in bytes
-        # if (downloaded_file_size < min_file_size):
-        #     log.info(f'  Downloaded unzipped file too small, contents are:')
-        #     file_dnld = open(unzipped_path, 'r')
-        #     log.info(file_dnld.readline())
-        #     file_dnld.close()
-
-        # no need to remove unzipped path because it is within temp_dir
-
-        # # restructure paths
-        within_folder_path = glob.glob(os.path.join(unzipped_path, "*"))
-        log.info(f"Downloaded file within_folder path: {within_folder_path[0]}")
-
-        # destination_path = f"{safe_directory}/{product_name}"
-        log.info("    moving directory...")
-        shutil.move(src=within_folder_path[0], dst=destination_path)
+def _stream_dataspace_product(session, auth, url, partial_path, chunk_size, log):
+    """
+    :meta private:
+    Streams the product at url to the end of partial_path, resuming with a Range request if partial_path exists.
+    Raises DownloadIntegrityException if the stream ends before the size announced by the server.
+    """
+    offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+    headers = {"Authorization": f"Bearer {auth.get_token()}"}
+    if offset > 0:
+        log.info(f"    resuming download of {partial_path} from byte {offset}")
+        headers["Range"] = f"bytes={offset}-"
+
+    # follow the redirects by hand so that the Authorization header reaches the download server
+    response = session.get(url, headers=headers, allow_redirects=False, stream=True)
+    while response.status_code in (301, 302, 303, 307, 308):
+        url = urljoin(url, response.headers["Location"])
+        response.close()
+        response = session.get(url, headers=headers, allow_redirects=False, stream=True)
+
+    with response:
+        if response.status_code == 401:
+            auth.invalidate()
+            raise requests.HTTPError("access token was rejected", response=response)
+        if response.status_code == 416:
+            # the requested range starts at the end of the file, so the partial file is already complete
+            return
+        response.raise_for_status()
 
-        # Debug code
-        # print("Exiting program to preserve temp_dir for checking contents...")
-        # sys.exit(1)
+        if response.status_code == 206:
+            mode = "ab"
+            expected_size = response.headers.get("Content-Range", "*").split("/")[-1]
+        else:
+            # the server ignored the Range header, so start again from the beginning
+            mode = "wb"
+            expected_size = response.headers.get("Content-Length", "*")
+        expected_size = int(expected_size) if expected_size.isdigit() else None
+
+        with open(partial_path, mode) as download:
+            for data in response.iter_content(chunk_size):
+                download.write(data)
+
+    downloaded_size = os.path.getsize(partial_path)
+    log.info(f"    downloaded {downloaded_size} of {expected_size} bytes to {partial_path}")
+    if expected_size is not None and downloaded_size != expected_size:
+        raise DownloadIntegrityException(
+            f"{partial_path} holds {downloaded_size} bytes, expected {expected_size}"
+        )
 
-    return
 
+def _check_downloaded_archive(partial_path, log):
+    """
+    :meta private:
+    Checks that partial_path is a zip archive with intact CRCs. Deletes it and raises DownloadIntegrityException
+    otherwise, so that the next attempt starts from scratch.
+    """
+    min_file_size = 2000  # in bytes
+    try:
+        with zipfile.ZipFile(partial_path) as archive:
+            bad_member = archive.testzip()
+    except zipfile.BadZipFile:
+        bad_member = "the archive"
+        if os.path.getsize(partial_path) < min_file_size:
+            # probably an error message from the server, e.g. {"detail":"Expired signature!"}
+            with open(partial_path, "r", errors="replace") as file_dnld:
+                log.info(f"  Downloaded file too small, contents are: {file_dnld.read()}")
+    if bad_member is not None:
+        os.remove(partial_path)
+        raise DownloadIntegrityException(f"{bad_member} in {partial_path} is corrupt")
 
 
 def filter_unique_dataspace_products(l1c_products: pd.DataFrame,
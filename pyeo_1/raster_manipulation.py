@@ -14,6 +14,12 @@ Key functions
 
 :py:func:`clip_raster` Clips a raster to a shapefile
 
+:py:func:`apply_raster_expression` Evaluates a band maths expression over several rasters, window by window
+
+:py:func:`render_class_map` Colours a class map with a class colour key, as an RGBA or paletted raster
+
+:py:func:`apply_mask_to_image` Applies a mask to an image block by block, warping the mask onto the image's grid once
+
 Rasters
 -------
 
@@ -31,6 +37,15 @@ Timestamps
 pyeo_1 uses the same timestamp convention as ESA: `yyyymmddThhmmss`; for example, 1PM on 27th December 2020 would be
 `20201227T130000`. All timestamps are in UTC
 
+Output profiles
+---------------
+
+Every raster written by this module is created with the tiling, compression and interleave of a named output profile
+from OUTPUT_PROFILES: 'scratch' (tiled, uncompressed), 'archive' (tiled, deflate compressed with a predictor matching
+the datatype; the default) or 'cog' (as archive, with larger blocks and overviews). Writers that take a `profile`
+argument use the profile set with `use_output_profile` when it is not given. Writers read and write their rasters in
+block windows, so every output can be written directly with a compressing profile.
+
 Supported datatypes
 -------------------
 
@@ -116,7 +131,9 @@ import sys
 import datetime
 import faulthandler
 import glob
+import json
 import logging
+from multiprocessing.dummy import Pool
 import numpy as np
 
 import os
@@ -128,9 +145,11 @@ from osgeo.gdal_array import (
 )
 
 import pdb
+import queue
 import re
 import shutil
 import subprocess
+import threading
 from skimage import morphology as morph
 from tempfile import TemporaryDirectory
 import scipy.ndimage as ndimage
@@ -146,6 +165,7 @@ from pyeo_1.coordinate_manipulation import (
     write_geometry,
     get_aoi_intersection,
     get_raster_bounds,
+    get_poly_intersection,
     align_bounds_to_whole_number,
     get_poly_bounding_rect,
     reproject_vector,
@@ -168,6 +188,10 @@ from pyeo_1.filesystem_utilities import (
     get_raster_paths,
     get_image_acquisition_time,
     serial_date_to_string,
+    glob_safe,
+    is_output_up_to_date,
+    record_output,
+    invalidate_catalogue,
 )
 from pyeo_1.exceptions import (
     CreateNewStacksException,
@@ -185,8 +209,185 @@ import pyeo_1.windows_compatability
 faulthandler.enable()
 
 
+# Named output profiles for every raster written by pyeo_1. Creation options are GTiff options; a PREDICTOR matching
+# the datatype is added to any profile that compresses. Overviews are added once a writer has filled its output.
+OUTPUT_PROFILES = {
+    "scratch": {
+        "creation_options": {
+            "TILED": "YES",
+            "BLOCKXSIZE": "256",
+            "BLOCKYSIZE": "256",
+            "BIGTIFF": "IF_SAFER",
+        },
+        "overview_levels": [],
+    },
+    "archive": {
+        "creation_options": {
+            "TILED": "YES",
+            "BLOCKXSIZE": "256",
+            "BLOCKYSIZE": "256",
+            "COMPRESS": "DEFLATE",
+            "ZLEVEL": "6",
+            "INTERLEAVE": "PIXEL",
+            "BIGTIFF": "IF_SAFER",
+        },
+        "overview_levels": [],
+    },
+    "cog": {
+        "creation_options": {
+            "TILED": "YES",
+            "BLOCKXSIZE": "512",
+            "BLOCKYSIZE": "512",
+            "COMPRESS": "DEFLATE",
+            "ZLEVEL": "6",
+            "INTERLEAVE": "PIXEL",
+            "BIGTIFF": "IF_SAFER",
+        },
+        "overview_levels": [2, 4, 8, 16, 32],
+        "overview_resampling": "NEAREST",
+    },
+}
+
+_output_profile = "archive"
+
+
+def use_output_profile(profile):
+    """
+    Sets the output profile used by every raster writer in pyeo_1 that is not given a profile explicitly.
+
+    Parameters
+    ----------
+    profile : str
+        The name of a profile in OUTPUT_PROFILES: 'scratch' (tiled, uncompressed), 'archive' (tiled, deflate
+        compressed; the default) or 'cog' (as archive, with larger blocks and overviews)
+
+    """
+    global _output_profile
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(
+            "Unknown output profile {}; choose from {}".format(
+                profile, list(OUTPUT_PROFILES)
+            )
+        )
+    _output_profile = profile
+
+
+def get_output_profile(profile=None):
+    """
+    Returns the settings of an output profile.
+
+    Parameters
+    ----------
+    profile : str, optional
+        The name of a profile in OUTPUT_PROFILES. Defaults to the profile set by use_output_profile.
+
+    Returns
+    -------
+    profile : dict
+        The profile's 'creation_options' and 'overview_levels'
+
+    """
+    if profile is None:
+        profile = _output_profile
+    if profile not in OUTPUT_PROFILES:
+        raise ValueError(
+            "Unknown output profile {}; choose from {}".format(
+                profile, list(OUTPUT_PROFILES)
+            )
+        )
+    return OUTPUT_PROFILES[profile]
+
+
+def get_creation_options(datatype, profile=None, format="GTiff"):
+    """
+    Returns the gdal creation options of an output profile for a new raster of the given datatype.
+
+    Parameters
+    ----------
+    datatype : gdal datatype
+        The datatype of the new raster; selects the compression predictor
+    profile : str, optional
+        The name of a profile in OUTPUT_PROFILES. Defaults to the profile set by use_output_profile.
+    format : str, optional
+        The gdal raster format of the new raster. Profiles only apply to 'GTiff'; other formats get no options.
+
+    Returns
+    -------
+    options : list of str
+        A list of 'KEY=VALUE' creation options
+
+    """
+    options = dict(get_output_profile(profile)["creation_options"])
+    if str(format).upper() != "GTIFF":
+        return []
+    if options.get("COMPRESS", "NONE") != "NONE":
+        if datatype in (gdal.GDT_Float32, gdal.GDT_Float64):
+            options["PREDICTOR"] = "3"
+        elif datatype in (
+            gdal.GDT_Byte,
+            gdal.GDT_UInt16,
+            gdal.GDT_Int16,
+            gdal.GDT_UInt32,
+            gdal.GDT_Int32,
+        ):
+            options["PREDICTOR"] = "2"
+    return ["{}={}".format(key, value) for key, value in options.items()]
+
+
+def build_overviews(raster, profile=None):
+    """
+    Adds internal overviews to a finished raster if its output profile asks for them.
+
+    Parameters
+    ----------
+    raster : str or gdal.Dataset
+        Path to the raster, or the open raster
+    profile : str, optional
+        The name of a profile in OUTPUT_PROFILES. Defaults to the profile set by use_output_profile.
+
+    """
+    settings = get_output_profile(profile)
+    if not settings["overview_levels"]:
+        return
+    if type(raster) is str:
+        raster = gdal.Open(raster, gdal.GA_Update)
+    raster.BuildOverviews(
+        settings.get("overview_resampling", "NEAREST"), settings["overview_levels"]
+    )
+    raster.FlushCache()
+
+
+def get_common_datatype(rasters, nodata_value=None):
+    """
+    Returns the smallest gdal datatype that can hold the values of every band of every raster without loss.
+
+    Parameters
+    ----------
+    rasters : list of gdal.Dataset
+        The rasters to find the common datatype of
+    nodata_value : number, optional
+        A nodata value that the datatype must also be able to hold.
+
+    Returns
+    -------
+    datatype : gdal datatype
+        The common datatype
+
+    """
+    dtypes = [
+        gdal_array.GDALTypeCodeToNumericTypeCode(
+            raster.GetRasterBand(band_index + 1).DataType
+        )
+        for raster in rasters
+        for band_index in range(raster.RasterCount)
+    ]
+    if nodata_value is not None:
+        dtypes.append(np.min_scalar_type(nodata_value))
+    return gdal_array.NumericTypeCodeToGDALTypeCode(np.result_type(*dtypes))
+
+
 def create_matching_dataset(
-    in_dataset, out_path, format="GTiff", bands=1, datatype=None
+    in_dataset, out_path, format="GTiff", bands=1, datatype=None, profile=None
 ):
     """
     Creates an empty gdal dataset with the same dimensions, projection and geotransform as in_dataset.
@@ -206,6 +407,9 @@ def create_matching_dataset(
     datatype : gdal constant, optional
         The datatype of the returned dataset. See the introduction for this module. Defaults to in_dataset's datatype
         if not supplied.
+    profile : str, optional
+        The output profile to create the dataset with - see the introduction for this module. Defaults to the
+        profile set by use_output_profile.
 
     Returns
     -------
@@ -231,11 +435,11 @@ def create_matching_dataset(
             ysize=in_dataset.RasterYSize,
             bands=bands,
             eType=datatype,
-            options=["BigTIFF=IF_NEEDED"],
+            options=get_creation_options(datatype, profile, format),
         )
     except:
         log.warning(
-            "GDAL option BigTIFF could not be set in create_matching_dataset. Trying without it."
+            "GDAL creation options could not be set in create_matching_dataset. Trying without them."
         )
         out_dataset = driver.Create(
             out_path,
@@ -249,7 +453,9 @@ def create_matching_dataset(
     return out_dataset
 
 
-def save_array_as_image(array, path, geotransform, projection, format="GTiff"):
+def save_array_as_image(
+    array, path, geotransform, projection, format="GTiff", profile=None
+):
     """
     Saves a given array as a geospatial image to disk in the format 'format'. The datatype will be of one corresponding
     to Array must be gdal format: [bands, y, x].
@@ -266,6 +472,9 @@ def save_array_as_image(array, path, geotransform, projection, format="GTiff"):
         The projection, as wkt, of the image to be saved. See note.
     format : str, optional
         The image format. Defaults to 'GTiff'; see note for other types.
+    profile : str, optional
+        The output profile to write the image with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile.
 
     Returns
     -------
@@ -284,16 +493,69 @@ def save_array_as_image(array, path, geotransform, projection, format="GTiff"):
         ysize=array.shape[1],
         bands=array.shape[0],
         eType=type_code,
+        options=get_creation_options(type_code, profile, format),
     )
     out_dataset.SetGeoTransform(geotransform)
     out_dataset.SetProjection(projection)
     out_array = out_dataset.GetVirtualMemArray(eAccess=gdal.GA_Update).squeeze()
     out_array[...] = array
     out_array = None
+    build_overviews(out_dataset, profile)
     out_dataset = None
     return path
 
 
+def get_block_windows(dataset, mem_limit=None, bytes_per_pixel=None):
+    """
+    Splits a gdal dataset into read windows that are aligned to the block structure of its first band and that each
+    fit within mem_limit bytes of working memory. Windows span the full width of the image wherever a single row of
+    blocks fits in mem_limit; otherwise rows of blocks are also split across columns.
+
+    Parameters
+    ----------
+    dataset : gdal.Dataset
+        The dataset to split into windows
+    mem_limit : int, optional
+        The maximum number of bytes a single window may occupy. Defaults to 256 MB.
+    bytes_per_pixel : int, optional
+        The number of bytes of working memory needed per pixel of a window, across all bands and any derived arrays.
+        Defaults to the size of one pixel across all bands of the dataset.
+
+    Returns
+    -------
+    windows : list of tuple
+        A list of (xoff, yoff, xsize, ysize) tuples covering the whole dataset, suitable for passing to ReadAsArray and
+        WriteArray.
+
+    """
+    if mem_limit is None:
+        mem_limit = 256 * 1024 * 1024
+    if bytes_per_pixel is None:
+        itemsize = gdal.GetDataTypeSize(dataset.GetRasterBand(1).DataType) // 8
+        bytes_per_pixel = max(itemsize, 1) * dataset.RasterCount
+    xsize = dataset.RasterXSize
+    ysize = dataset.RasterYSize
+    block_x, block_y = dataset.GetRasterBand(1).GetBlockSize()
+    block_x = min(max(block_x, 1), xsize)
+    block_y = min(max(block_y, 1), ysize)
+    max_pixels = max(int(mem_limit // bytes_per_pixel), 1)
+    if max_pixels >= xsize * block_y:
+        # full-width strips made up of as many block rows as will fit
+        win_x = xsize
+        win_y = min(max((max_pixels // xsize) // block_y, 1) * block_y, ysize)
+    else:
+        # a single block row is too big, so split it into groups of whole blocks
+        win_y = block_y
+        win_x = min(max((max_pixels // block_y) // block_x, 1) * block_x, xsize)
+    windows = []
+    for yoff in range(0, ysize, win_y):
+        ys = min(win_y, ysize - yoff)
+        for xoff in range(0, xsize, win_x):
+            xs = min(win_x, xsize - xoff)
+            windows.append((xoff, yoff, xs, ys))
+    return windows
+
+
 def create_new_stacks(image_dir, stack_dir):
     """
     For each granule present in image_dir Saves the result in stacked_dir.
@@ -424,8 +686,10 @@ def stack_images(
     out_raster_path,
     geometry_mode="intersect",
     format="GTiff",
-    datatype=gdal.GDT_Int32,
+    datatype=None,
     nodata_value=0,
+    profile=None,
+    mem_limit_mb=1024,
 ):
     """
     When provided with a list of rasters, will stack them into a single raster. The number of
@@ -447,7 +711,15 @@ def stack_images(
     format : str, optional
         The GDAL image format for the output. Defaults to 'GTiff'
     datatype : gdal datatype, optional
-        The datatype of the gdal array - see introduction. Defaults to gdal.GDT_Int32.
+        The datatype of the gdal array - see introduction. Defaults to the smallest datatype that holds every input
+        band and nodata_value without loss (see get_common_datatype), so that uint16 reflectances stay uint16.
+    nodata_value : number, optional
+        The value of output pixels that no input covers. Defaults to 0.
+    profile : str, optional
+        The output profile to write the image with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile.
+    mem_limit_mb : int, optional
+        The maximum working memory in megabytes used for one window of one output band. Defaults to 1024.
 
     """
     # TODO: Confirm the union works, and confirm that nondata defaults to 0.
@@ -456,6 +728,8 @@ def stack_images(
         raise StackImagesException("stack_images requires at least two input images")
     rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
     total_layers = sum(raster.RasterCount for raster in rasters)
+    if datatype is None:
+        datatype = get_common_datatype(rasters, nodata_value)
     projection = rasters[0].GetProjection()
     in_gt = rasters[0].GetGeoTransform()
     x_res = in_gt[1]
@@ -474,39 +748,53 @@ def stack_images(
         projection,
         format,
         datatype,
+        profile=profile,
+    )
+    out_dtype = GDALTypeCodeToNumericTypeCode(datatype)
+    # every block of the output is written once, so the stack can go straight into a compressed profile
+    windows = get_block_windows(
+        out_raster,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=2 * np.dtype(out_dtype).itemsize,
     )
-
-    # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    out_raster_array[...] = nodata_value
     present_layer = 0
     for i, in_raster in enumerate(rasters):
         log.info("  {}".format(raster_paths[i]))
-        in_raster_array = in_raster.GetVirtualMemArray()
+        # the part of the output this input covers, in the pixels of each
+        in_polygon = get_poly_intersection(
+            get_raster_bounds(in_raster), combined_polygons
+        )
         out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-            out_raster, combined_polygons
+            out_raster, in_polygon
         )
         in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-            in_raster, combined_polygons
+            in_raster, in_polygon
         )
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        # Gdal does band, y, x
-        out_raster_view = out_raster_array[
-            present_layer : present_layer + in_raster.RasterCount,
-            out_y_min:out_y_max,
-            out_x_min:out_x_max,
-        ]
-        in_raster_view = in_raster_array[
-            0 : in_raster.RasterCount, in_y_min:in_y_max, in_x_min:in_x_max
-        ]
-        out_raster_view[...] = in_raster_view
-        out_raster_view = None
-        in_raster_view = None
+        for band_index in range(in_raster.RasterCount):
+            in_band = in_raster.GetRasterBand(band_index + 1)
+            out_band = out_raster.GetRasterBand(present_layer + band_index + 1)
+            for xoff, yoff, xsize, ysize in windows:
+                out_array = np.full((ysize, xsize), nodata_value, dtype=out_dtype)
+                # the part of this window that the input covers, in output pixels
+                x_start = max(xoff, out_x_min)
+                x_stop = min(xoff + xsize, out_x_max, out_x_min + in_x_max - in_x_min)
+                y_start = max(yoff, out_y_min)
+                y_stop = min(yoff + ysize, out_y_max, out_y_min + in_y_max - in_y_min)
+                if x_start < x_stop and y_start < y_stop:
+                    out_array[
+                        y_start - yoff : y_stop - yoff, x_start - xoff : x_stop - xoff
+                    ] = in_band.ReadAsArray(
+                        in_x_min + x_start - out_x_min,
+                        in_y_min + y_start - out_y_min,
+                        x_stop - x_start,
+                        y_stop - y_start,
+                    )
+                out_band.WriteArray(out_array, xoff, yoff)
+            in_band = None
+            out_band = None
         present_layer += in_raster.RasterCount
-        in_raster_array = None
         in_raster = None
-    out_raster_array = None
+    build_overviews(out_raster, profile)
     out_raster = None
 
 
@@ -556,17 +844,19 @@ def average_images(
     out_raster_path,
     geometry_mode="intersect",
     format="GTiff",
-    datatype=gdal.GDT_Int32):
+    datatype=gdal.GDT_Int32,
+    mem_limit_mb=1024,
+):
     """
-    When provided with a list of rasters, will stack them into a single raster. The number of
-    bands in the output is equal to the total number of bands in the input. Geotransform and projection
+    When provided with a list of rasters, will average them into a single raster. The number of
+    bands in the output is equal to the largest number of bands in the inputs. Geotransform and projection
     are taken from the first raster in the list; there may be unexpected behavior if multiple differing
-    projections are provided.
+    projections are provided. The average is computed and written one block window at a time.
 
     Parameters
     ----------
     raster_paths : list of str
-        A list of paths to the rasters to be stacked, in order.
+        A list of paths to the rasters to be averaged.
     out_raster_path : str
         The path to the saved output raster.
     geometry_mode : {'intersect' or 'union'}, optional
@@ -576,13 +866,15 @@ def average_images(
     format : str
         The GDAL image format for the output. Defaults to 'GTiff'
     datatype : gdal datatype
-        The datatype of the gdal array - see note. Defaults to gdal.GDT_Int32
+        The datatype of the gdal array - see note. Defaults to gdal.GDT_Int32. Averages are rounded for integer
+        datatypes.
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     """
-    # TODO: Confirm the union works, and confirm that nondata defaults to 0.
-    log.info("Stacking images {}".format(raster_paths))
+    log.info("Averaging images {}".format(raster_paths))
     if len(raster_paths) <= 1:
-        raise StackImagesException("stack_images requires at least two input images")
+        raise StackImagesException("average_images requires at least two input images")
     rasters = [gdal.Open(raster_path) for raster_path in raster_paths]
     most_rasters = max(raster.RasterCount for raster in rasters)
     projection = rasters[0].GetProjection()
@@ -606,35 +898,35 @@ def average_images(
     )
     if out_raster is None:
         log.error("Could not create: {}".format(out_raster_path))
-
-    # I've done some magic here. GetVirtualMemArray lets you change a raster directly without copying
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    if len(out_raster_array.shape == 2):
-        out_raster_array = np.expand_dims(out_raster_array, 3)
-    present_layer = 0
-    for i, in_raster in enumerate(rasters):
-        log.info("Stacking image {}".format(i))
-        in_raster_array = in_raster.GetVirtualMemArray()
-        out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-            out_raster, combined_polygons
-        )
-        in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-            in_raster, combined_polygons
-        )
-        if len(in_raster_array.shape) == 2:
-            in_raster_array = np.expand_dims(in_raster_array, 0)
-        # Gdal does band, y, x
-        out_raster_view = out_raster_array[:out_y_min:out_y_max, out_x_min:out_x_max]
-        in_raster_view = in_raster_array[:in_y_min:in_y_max, in_x_min:in_x_max]
-        out_raster_view[...] = out_raster_view + in_raster_view  # add up
-        out_raster_view = None
-        in_raster_view = None
-        present_layer += in_raster.RasterCount
-        in_raster_array = None
-        in_raster = None
-    out_raster_view[...] = out_raster_view / len(rasters)  # calculate average
-    out_raster_array = None
+    out_dtype = GDALTypeCodeToNumericTypeCode(datatype)
+    offsets = [_pixel_offset_in(in_raster, out_raster) for in_raster in rasters]
+    # the float64 sum and one float64 input block for every band
+    windows = get_block_windows(
+        out_raster,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=most_rasters * 16,
+    )
+    for window in windows:
+        xoff, yoff, xs, ys = window
+        total = np.zeros((most_rasters, ys, xs), dtype=np.float64)
+        for i, in_raster in enumerate(rasters):
+            overlap = _window_overlap(window, offsets[i], in_raster)
+            if not overlap:
+                continue
+            read_x, read_y, block_x, block_y, w, h = overlap
+            n_bands = in_raster.RasterCount
+            total[:n_bands, block_y : block_y + h, block_x : block_x + w] += in_raster.ReadAsArray(
+                read_x, read_y, w, h
+            ).reshape((n_bands, h, w))
+        average = total / len(rasters)
+        if np.issubdtype(out_dtype, np.integer):
+            average = np.rint(average)
+        average = average.astype(out_dtype)
+        for band in range(most_rasters):
+            out_raster.GetRasterBand(band + 1).WriteArray(average[band], xoff, yoff)
+    build_overviews(out_raster)
     out_raster = None
+    rasters = None
 
 
 def trim_image(in_raster_path, out_raster_path, polygon, format="GTiff"):
@@ -690,7 +982,12 @@ def trim_image(in_raster_path, out_raster_path, polygon, format="GTiff"):
 
 
 def mosaic_images(
-    raster_path, out_raster_path, format="GTiff", datatype=gdal.GDT_Int32, nodata=0
+    raster_path,
+    out_raster_path,
+    format="GTiff",
+    datatype=gdal.GDT_Int32,
+    nodata=0,
+    mem_limit_mb=1024,
 ):
     """
     Mosaics multiple images in the directory raster_path with the same number of layers into one single image.
@@ -710,6 +1007,8 @@ def mosaic_images(
         The datatype of the output raster. Defaults to gdal.GDT_Int32
     nodata : number
         The input nodata value; any pixels in raster_paths with this value will be ignored. Defaults to 0.
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window of the mosaic. Defaults to 1024.
 
     """
 
@@ -786,36 +1085,75 @@ def mosaic_images(
             nodata=nodata,
         )
         log.info("New empty image mosaic created at {}".format(out_raster_file))
-        out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write)
-        out_raster_array[...] = nodata
-        old_nodata = nodata
-        for i, raster in enumerate(rasters):
-            log.info(
-                "Now mosaicking raster no. {} out of {}".format(i + 1, len(rasters))
-            )
-            in_raster_array = raster.GetVirtualMemArray()
-            if len(in_raster_array.shape) == 2:
-                in_raster_array = np.expand_dims(in_raster_array, 0)
-            if np.isnan(old_nodata):
-                nodata = (
-                    np.nan_to_num(in_raster_array).max() + 1
-                )  # This is turning into a _real_ hack now
-                in_raster_array = np.nan_to_num(in_raster_array, nan=nodata, copy=True)
-            in_bounds = get_raster_bounds(raster)
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-                out_raster, in_bounds
-            )
-            out_raster_view = out_raster_array[
-                :, out_y_min:out_y_max, out_x_min:out_x_max
-            ]
-            np.copyto(out_raster_view, in_raster_array, where=in_raster_array != nodata)
-            in_raster_array = None
-            out_raster_view = None
+        out_dtype = GDALTypeCodeToNumericTypeCode(datatype)
+        offsets = [_pixel_offset_in(raster, out_raster) for raster in rasters]
+        # the output block, one input block and its validity mask
+        windows = get_block_windows(
+            out_raster,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=layers * (np.dtype(out_dtype).itemsize + 9),
+        )
+        log.info(
+            "Mosaicking {} rasters in {} block windows".format(len(rasters), len(windows))
+        )
+        for window in windows:
+            xoff, yoff, xs, ys = window
+            out_block = np.full((layers, ys, xs), nodata, dtype=out_dtype)
+            for i, raster in enumerate(rasters):
+                overlap = _window_overlap(window, offsets[i], raster)
+                if not overlap:
+                    continue
+                read_x, read_y, block_x, block_y, w, h = overlap
+                in_block = raster.ReadAsArray(read_x, read_y, w, h).reshape(
+                    (layers, h, w)
+                )
+                if np.isnan(nodata):
+                    valid = np.logical_not(np.isnan(in_block))
+                else:
+                    valid = in_block != nodata
+                np.copyto(
+                    out_block[:, block_y : block_y + h, block_x : block_x + w],
+                    in_block,
+                    where=valid,
+                    casting="unsafe",
+                )
+            for band in range(layers):
+                out_raster.GetRasterBand(band + 1).WriteArray(out_block[band], xoff, yoff)
+        build_overviews(out_raster)
         log.info("Raster mosaicking done")
-        out_raster_array = None
         out_raster = None
 
 
+def _pixel_offset_in(raster, target):
+    """
+    :meta private:
+    Returns the (xoff, yoff) of the top-left pixel of raster in the pixel grid of target. Both must share a resolution.
+    """
+    raster_gt = raster.GetGeoTransform()
+    target_gt = target.GetGeoTransform()
+    return (
+        int(round((raster_gt[0] - target_gt[0]) / target_gt[1])),
+        int(round((raster_gt[3] - target_gt[3]) / target_gt[5])),
+    )
+
+
+def _window_overlap(window, offset, raster):
+    """
+    :meta private:
+    Returns the part of an output window covered by a raster placed at offset in the output grid, as
+    (read_xoff, read_yoff, block_xoff, block_yoff, xsize, ysize) - where to read in the raster and where to put it in
+    the window - or None if they do not overlap.
+    """
+    xoff, yoff, xs, ys = window
+    x0 = max(xoff, offset[0])
+    y0 = max(yoff, offset[1])
+    x1 = min(xoff + xs, offset[0] + raster.RasterXSize)
+    y1 = min(yoff + ys, offset[1] + raster.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return x0 - offset[0], y0 - offset[1], x0 - xoff, y0 - yoff, x1 - x0, y1 - y0
+
+
 def update_composite_with_images(
     composite_in_path,
     in_raster_path_list,
@@ -823,10 +1161,14 @@ def update_composite_with_images(
     format="GTiff",
     generate_date_image=True,
     missing=0,
+    mem_limit_mb=1024,
 ):
     """
     Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Will also create a mask and
     (optionally) a date image in the same directory.
+    The composite is built one block window at a time, in the datatype of the input composite: for each window only the
+    overlapping parts of the previous composite and the input rasters are read, and the composite and date image are
+    written together.
 
     Parameters
     ----------
@@ -841,6 +1183,8 @@ def update_composite_with_images(
     generate_date_image : bool, optional
         If true, generates a single-layer raster containing the dates of each image detected - see below.
     missing : missing value to be ignored, 0 by default
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     Returns
     -------
@@ -850,11 +1194,11 @@ def update_composite_with_images(
     Notes:
 
     If generate_date_images is True, an raster ending with the suffix .date will be created; each pixel will contain the
-    timestamp (yyyymmdd) of the date that pixel was last seen in the composite.
+    timestamp (yyyymmdd) of the date that pixel was last seen in the composite. Dates are carried over from the date
+    image of the input composite, if there is one.
 
     """
     log = logging.getLogger(__name__)
-    driver = gdal.GetDriverByName(str(format))
     in_raster_list = [gdal.Open(raster) for raster in in_raster_path_list]
     in_composite = gdal.Open(composite_in_path)
     projection = in_composite.GetProjection()
@@ -865,8 +1209,9 @@ def update_composite_with_images(
     temp_band = in_composite.GetRasterBand(1)
     datatype = temp_band.DataType
     temp_band = None
+    out_dtype = GDALTypeCodeToNumericTypeCode(datatype)
 
-    # Creating output image + array
+    # Creating output image
     log.info("Creating updated composite at {}".format(composite_out_path))
     log.info("  based on previous composite {}".format(composite_in_path))
     log.info(
@@ -889,67 +1234,96 @@ def update_composite_with_images(
         format,
         datatype,
     )
+    composite_offset = _pixel_offset_in(in_composite, composite_image)
+    in_offsets = [_pixel_offset_in(in_raster, composite_image) for in_raster in in_raster_list]
+
     if generate_date_image:
         time_out_path = composite_out_path.rsplit(".")[0] + ".dates"
         dates_image = create_matching_dataset(
             composite_image, time_out_path, bands=1, datatype=gdal.GDT_UInt32
         )
-        dates_array = dates_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Write
-        ).squeeze()
-
-    output_array = composite_image.GetVirtualMemArray(
-        eAccess=gdal.gdalconst.GF_Write, datatype=gdal.GDT_Float32
+        # Gets timestamp of each image as integer in form yyyymmdd
+        in_dates = [
+            np.uint32(get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0])
+            for in_raster in in_raster_list
+        ]
+        in_dates_path = composite_in_path.rsplit(".")[0] + ".dates"
+        in_dates_image = gdal.Open(in_dates_path) if os.path.exists(in_dates_path) else None
+        if in_dates_image is not None:
+            log.info("  carrying over the dates in {}".format(in_dates_path))
+            in_dates_offset = _pixel_offset_in(in_dates_image, composite_image)
+
+    # the output block and one input block in the composite datatype, plus the dates and the validity mask
+    itemsize = np.dtype(out_dtype).itemsize
+    windows = get_block_windows(
+        composite_image,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=2 * n_bands * (itemsize + 1) + 4,
     )
-    if len(output_array.shape) == 2:
-        output_array = np.expand_dims(output_array, 0)
-
-    in_composite_array = get_array(in_composite)
-    # TODO: check this works
-    np.copyto(output_array, in_composite_array)
-
-    for i, in_raster in enumerate(in_raster_list):
-        # Get a view of in_raster according to output_array
-        log.info("Adding {} to composite".format(in_raster_path_list[i]))
-        in_bounds = align_bounds_to_whole_number(get_raster_bounds(in_raster))
-        x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(
-            composite_image, in_bounds
-        )
-        output_view = output_array[:, y_min:y_max, x_min:x_max]
-
-        # Move every pixel except missing values in in_raster to output_view
-        in_array = get_array(in_raster)
-        log.info("Type of in_array: {}".format(in_array.dtype))
-        log.info("Type of output_view: {}".format(output_view.dtype))
-        np.copyto(
-            output_view, in_array, where=np.where(in_array == missing, False, True)
-        )
-
-        # Save dates in date_image if needed
+    for in_raster_path in in_raster_path_list:
+        log.info("Adding {} to composite".format(in_raster_path))
+    log.info("Updating the composite in {} block windows".format(len(windows)))
+    for window in windows:
+        xoff, yoff, xs, ys = window
+        out_block = np.zeros((n_bands, ys, xs), dtype=out_dtype)
+        overlap = _window_overlap(window, composite_offset, in_composite)
+        if overlap:
+            read_x, read_y, block_x, block_y, w, h = overlap
+            out_block[:, block_y : block_y + h, block_x : block_x + w] = in_composite.ReadAsArray(
+                read_x, read_y, w, h
+            ).reshape((n_bands, h, w))
         if generate_date_image:
-            dates_view = dates_array[y_min:y_max, x_min:x_max]
-            # Gets timestamp as integer in form yyyymmdd
-            date = np.uint32(
-                get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0]
+            dates_block = np.zeros((ys, xs), dtype=np.uint32)
+            if in_dates_image is not None:
+                overlap = _window_overlap(window, in_dates_offset, in_dates_image)
+                if overlap:
+                    read_x, read_y, block_x, block_y, w, h = overlap
+                    dates_block[block_y : block_y + h, block_x : block_x + w] = in_dates_image.ReadAsArray(
+                        read_x, read_y, w, h
+                    )
+
+        for i, in_raster in enumerate(in_raster_list):
+            overlap = _window_overlap(window, in_offsets[i], in_raster)
+            if not overlap:
+                continue
+            read_x, read_y, block_x, block_y, w, h = overlap
+            in_block = in_raster.ReadAsArray(read_x, read_y, w, h).reshape((n_bands, h, w))
+            # Move every pixel except missing values in in_raster to the output block
+            valid = in_block != missing
+            np.copyto(
+                out_block[:, block_y : block_y + h, block_x : block_x + w],
+                in_block,
+                where=valid,
+                casting="unsafe",
             )
-            dates_view[np.logical_not(in_masked.mask[0, ...])] = date
-            dates_view = None
+            # Save dates in date_image if needed
+            if generate_date_image:
+                dates_block[block_y : block_y + h, block_x : block_x + w][valid[0]] = in_dates[i]
 
-        # Deallocate
-        output_view = None
-        in_masked = None
+        for band in range(n_bands):
+            composite_image.GetRasterBand(band + 1).WriteArray(out_block[band], xoff, yoff)
+        if generate_date_image:
+            dates_image.GetRasterBand(1).WriteArray(dates_block, xoff, yoff)
 
-    output_array = None
-    dates_array = None
-    dates_image = None
+    build_overviews(composite_image)
+    if generate_date_image:
+        build_overviews(dates_image)
+        dates_image = None
+        in_dates_image = None
     composite_image = None
+    in_composite = None
+    in_raster_list = None
 
     log.info("Composite update done.")
     return composite_out_path
 
 
 def composite_images_with_mask(
-    in_raster_path_list, composite_out_path, format="GTiff", generate_date_image=True
+    in_raster_path_list,
+    composite_out_path,
+    format="GTiff",
+    generate_date_image=True,
+    mem_limit_mb=1024,
 ):
     """
     Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Will also create a mask and
@@ -965,6 +1339,8 @@ def composite_images_with_mask(
         The gdal format of the image. Defaults to "GTiff"
     generate_date_image : bool, optional
         If true, generates a single-layer raster containing the dates of each image detected - see below.
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window of the composite. Defaults to 1024.
 
     Returns
     -------
@@ -1023,49 +1399,67 @@ def composite_images_with_mask(
         dates_image = create_matching_dataset(
             composite_image, time_out_path, bands=1, datatype=gdal.GDT_UInt32
         )
-        dates_array = dates_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Write
-        ).squeeze()
-
-    output_array = composite_image.GetVirtualMemArray(eAccess=gdal.gdalconst.GF_Write)
-    if len(output_array.shape) == 2:
-        output_array = np.expand_dims(output_array, 0)
+        # Gets timestamp of each image as integer in form yyyymmdd
+        in_dates = [
+            np.uint32(get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0])
+            for in_raster in in_raster_list
+        ]
 
     mask_paths = []
-
+    in_masks = []
     for i, in_raster in enumerate(in_raster_list):
         mask_paths.append(get_mask_path(in_raster_path_list[i]))
-
-        # Get a view of in_raster according to output_array
         log.info("Adding {} to composite".format(in_raster_path_list[i]))
-        in_bounds = align_bounds_to_whole_number(get_raster_bounds(in_raster))
-        x_min, x_max, y_min, y_max = pixel_bounds_from_polygon(
-            composite_image, in_bounds
-        )
-        output_view = output_array[:, y_min:y_max, x_min:x_max]
-
-        # Move every unmasked pixel in in_raster to output_view
         log.info("Mask for {} at {}".format(in_raster_path_list[i], mask_paths[i]))
-        in_masked = get_masked_array(in_raster, mask_paths[i])
-        np.copyto(output_view, in_masked, where=np.logical_not(in_masked.mask))
+        in_masks.append(gdal.Open(mask_paths[i]))
+    in_offsets = [
+        _pixel_offset_in(in_raster, composite_image) for in_raster in in_raster_list
+    ]
 
-        # Save dates in date_image if needed
+    # the output block and one input block in the composite datatype, plus its mask, validity mask and the dates
+    out_dtype = GDALTypeCodeToNumericTypeCode(datatype)
+    windows = get_block_windows(
+        composite_image,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=n_bands * (2 * np.dtype(out_dtype).itemsize + 2) + 4,
+    )
+    for window in windows:
+        xoff, yoff, xs, ys = window
+        out_block = np.zeros((n_bands, ys, xs), dtype=out_dtype)
         if generate_date_image:
-            dates_view = dates_array[y_min:y_max, x_min:x_max]
-            # Gets timestamp as integer in form yyyymmdd
-            date = np.uint32(
-                get_sen_2_image_timestamp(in_raster.GetFileList()[0]).split("T")[0]
+            dates_block = np.zeros((ys, xs), dtype=np.uint32)
+        for i, in_raster in enumerate(in_raster_list):
+            overlap = _window_overlap(window, in_offsets[i], in_raster)
+            if not overlap:
+                continue
+            read_x, read_y, block_x, block_y, w, h = overlap
+            in_block = in_raster.ReadAsArray(read_x, read_y, w, h).reshape(
+                (n_bands, h, w)
             )
-            dates_view[np.logical_not(in_masked.mask[0, ...])] = date
-            dates_view = None
-
-        # Deallocate
-        output_view = None
-        in_masked = None
+            # Masked pixels are 0 in the multiplicative mask; a single-band mask applies to every band
+            valid = np.broadcast_to(
+                in_masks[i].ReadAsArray(read_x, read_y, w, h) != 0, in_block.shape
+            )
+            # Move every unmasked pixel in in_raster to the output block
+            np.copyto(
+                out_block[:, block_y : block_y + h, block_x : block_x + w],
+                in_block,
+                where=valid,
+                casting="unsafe",
+            )
+            # Save dates in date_image if needed
+            if generate_date_image:
+                dates_block[block_y : block_y + h, block_x : block_x + w][valid[0]] = in_dates[i]
+        for band in range(n_bands):
+            composite_image.GetRasterBand(band + 1).WriteArray(out_block[band], xoff, yoff)
+        if generate_date_image:
+            dates_image.GetRasterBand(1).WriteArray(dates_block, xoff, yoff)
 
-    output_array = None
-    dates_array = None
-    dates_image = None
+    build_overviews(composite_image)
+    if generate_date_image:
+        build_overviews(dates_image)
+        dates_image = None
+    in_masks = None
     composite_image = None
 
     log.info("Composite done")
@@ -1217,14 +1611,15 @@ def clever_composite_images(
     in_raster_path_list,
     composite_out_path,
     format="GTiff",
-    chunks=10,
+    chunks=None,
     generate_date_image=True,
     missing_data_value=0,
+    mem_limit_mb=1024,
 ):
     """
     Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Will also create
-    (optionally) a date image in the same directory. Processes raster stacks by splitting them into a number of chunks
-    to avoid memory allocation errors.
+    (optionally) a date image in the same directory. Processes the raster stack in a single pass over block windows
+    to avoid memory allocation errors; see :py:func:`median_composite_of_raster_list`.
 
     Parameters
     ----------
@@ -1234,10 +1629,14 @@ def clever_composite_images(
         The path of the output image
     format : str, optional
         The gdal format of the image. Defaults to "GTiff"
+    chunks : int, optional
+        Deprecated and ignored; the window size is set by mem_limit_mb.
     generate_date_image : bool, optional
         If true, generates a single-layer raster containing the dates of each image detected - see below.
     missing_data_value : int, optional
         Value for no data encoding, will be ignored in calculating the median
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     Returns
     -------
@@ -1252,236 +1651,181 @@ def clever_composite_images(
 
     """
 
-    def median_of_raster_list(
-        in_raster_path_list,
-        out_raster_path,
-        band=1,
-        chunks=10,
-        missing_data_value=0,
-        format="GTiff",
-    ):
-        """
-        Calculates the median of each pixel in a list of rasters with one band of the same dimensions and map projection.
-        Excludes missing data values from the calculations. Processes raster stacks by splitting them into a number of chunks
-        to avoid memory allocation errors.
-
-        Parameters
-        ----------
-        in_raster_path_list : list of str
-            A list of paths to rasters
-        out_raster_path : str
-            The path of the output raster
-        band : int, optional
-            The number of the band to be processed, starting at 1. Defaults to band 1.
-        missing_data_value : number, optional
-            Value for no data encoding, will be ignored in calculating the median
-        format : str, optional
-            Raster format for GDAL
-        """
-
-        log = logging.getLogger(__name__)
-        in_raster = gdal.Open(in_raster_path_list[0])
-        driver = gdal.GetDriverByName(str(format))
-        projection = in_raster.GetProjection()
-        in_gt = in_raster.GetGeoTransform()
-        log.info(
-            f"I.R. 20230430 clever_composite_images() in_raster_path_list[0].geotransform = {in_raster.GetGeoTransform()}"
-        )
-        n_bands = in_raster.RasterCount
-        temp_band = in_raster.GetRasterBand(1)
-        datatype = temp_band.DataType
-        xsize = in_raster.RasterXSize
-        ysize = in_raster.RasterYSize
-        temp_band = None
-        in_raster = None
-        # check that all input rasters have the same size
-        good_rasters = []
-        for f in in_raster_path_list:
-            in_raster = gdal.Open(f)
-            log.info(
-                f"I.R. 20230430 clever_composite_images() in_raster_path_list.geotransform = {in_raster.GetGeoTransform()}"
-            )
-            f_n_bands = in_raster.RasterCount
-            f_xsize = in_raster.RasterXSize
-            f_ysize = in_raster.RasterYSize
-            in_raster = None
-            if n_bands != f_n_bands:
-                log.error("Raster band numbers are different. Skipping {}".format(f))
-                continue
-            if xsize != f_xsize:
-                log.error("Raster x sizes are different. Skipping {}".format(f))
-                continue
-            if ysize != f_ysize:
-                log.error("Raster y sizes are different. Skipping {}".format(f))
-                continue
-            good_rasters = good_rasters + [f]
-        in_raster_path_list = good_rasters.copy()
-
-        # determine chunk size
-        chunksize = int(np.ceil(ysize / chunks))
-        # create output raster file and copy metadata from first raster in the list
-        result = driver.Create(
-            out_raster_path, xsize=xsize, ysize=ysize, bands=1, eType=datatype
-        )
-        result.SetGeoTransform(in_gt)
-        result.SetProjection(projection)
-        log.info(
-            "Chunk processing. {} chunks of size {}, {}.".format(
-                chunks, chunksize, xsize
-            )
-        )
-        for ch in range(chunks):
-            log.info("Processing chunk {}".format(ch))
-            xoff = 0
-            yoff = ch * chunksize
-            xs = xsize
-            # work out the size of the last chunk (residual)
-            if ch < chunks - 1:
-                ys = chunksize
-            else:
-                ys = ysize - ch * chunksize
-            # log.info("xoff, yoff, xsize, ysize: {}, {}, {}, {}".format(xoff,yoff,xs,ys))
-            res = []  # reset the list of arrays that will contain the band rasters
-            for f in in_raster_path_list:
-                log.info("Opening band {} from raster {}".format(band, f))
-                ds = gdal.Open(f)
-                b = ds.GetRasterBand(band).ReadAsArray(xoff, yoff, xs, ys)
-                if ds == None:
-                    log.error(
-                        "Opening band {} from raster {} failed. Skipping.".format(
-                            band, f
-                        )
-                    )
-                else:
-                    res.append(b)
-                ds = None
-            # for i, this_res in enumerate(res):
-            #    log.info("raster {} is {} and is of type {}".format(i, this_res, type(this_res)))
-            #    log.info("raster {} has dimensions {}".format(i, this_res.shape))
-            stacked = np.dstack(res)
-            # TODO: make sure this catches all pixels with missing values
-            if missing_data_value is not None:
-                ma = np.ma.masked_equal(stacked, missing_data_value)
-                stacked[ma.mask] = np.nan
-            with warnings.catch_warnings():
-                warnings.filterwarnings("error")
-            try:
-                median_raster = np.nanmedian(stacked, axis=-1)
-            except ValueError as e:
-                log.warning(
-                    "Likely all NaN slice encountered in chunk processing: {}".format(e)
-                )
-                median_raster = np.full_like(stacked[:, :, 0], missing_data_value)
-            # catch pixels where all raster layers have NaN values and set them to missing_data_value
-            all_nan_locations = np.isnan(stacked).all(axis=-1)
-            median_raster[all_nan_locations] = missing_data_value
-            b = result.GetRasterBand(1).ReadAsArray()
-            # log.info("Broadcasting from [{}:{}, {}:{}]".format(0, median_raster.shape[0], 0, median_raster.shape[1]))
-            # log.info("             into [{}:{}, {}:{}]".format(yoff, yoff+ys, xoff, xoff+xs))
-            b[yoff : (yoff + ys), xoff : (xoff + xs)] = median_raster
-            result.GetRasterBand(1).WriteArray(b)
-        result = None
-        res = None
-        b = None
-        median_raster = None
-        return
-
-    in_raster = gdal.Open(in_raster_path_list[0])
-    n_bands = in_raster.RasterCount
-    in_raster = None
     log.info("-------------------------------------------------")
     log.info("Creating median composite at {}".format(composite_out_path))
     log.info("-------------------------------------------------")
     log.info("Using {} input raster files:".format(len(in_raster_path_list)))
     for i in in_raster_path_list:
         log.info("   {}".format(i))
-    # use raster stacking to calculate the median over all masked raster files and all 4 bands
-    with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-        tmpfiles = []
-        for band in range(n_bands):
-            log.info(
-                "Band {} - calculating median composite across all images using raster stacking".format(
-                    band + 1
-                )
-            )
-            log.info("   Ignoring missing data value of {}".format(missing_data_value))
-            tmpfile = os.path.join(
-                td,
-                os.path.basename("tmp_" + composite_out_path).split(".")[0]
-                + "_band"
-                + str(band + 1)
-                + ".tif",
-            )
-            # tmpfile = os.path.abspath(composite_out_path.split('.')[0] + '_tmp_band' + str(band+1) + '.tif')
-            tmpfiles.append(tmpfile)
-            median_of_raster_list(
-                in_raster_path_list,
-                tmpfile,
-                band=band + 1,
-                chunks=chunks,
-                missing_data_value=missing_data_value,
-            )
-            # log some image stats
-            get_stats_from_raster_file(tmpfile)
-        log.info("Finished median calculations.")
-        # Aggregating band composites into a single tiff file
-        log.info("Aggretating band composites into a single raster file.")
-        stack_images(tmpfiles, composite_out_path, geometry_mode="intersect")
-        get_stats_from_raster_file(composite_out_path)
-
-    log.info(
-        f"I.R. 20230430 clever_composite_images() Fixing composite geotransform to ensure it matches first of contributing images"
+    log.info("   Ignoring missing data value of {}".format(missing_data_value))
+    median_composite_of_raster_list(
+        in_raster_path_list,
+        composite_out_path,
+        format=format,
+        missing_data_value=missing_data_value,
+        mem_limit_mb=mem_limit_mb,
     )
-    in_raster = gdal.Open(in_raster_path_list[0])
-    in_gt = in_raster.GetGeoTransform()
-    composite_raster = gdal.Open(composite_out_path)
-    composite_raster.SetGeoTransform(in_gt)
-    in_raster = None
-    composite_raster = None
-
+    log.info("Finished median calculations.")
+    get_stats_from_raster_file(composite_out_path)
     log.info("-------------------------------------------------")
     log.info("Median composite done")
     log.info("-------------------------------------------------")
     return composite_out_path
 
 
-def clever_composite_images_with_mask(
+def median_composite_of_raster_list(
     in_raster_path_list,
-    composite_out_path,
+    out_raster_path,
     format="GTiff",
-    chunks=10,
-    generate_date_image=True,
     missing_data_value=0,
+    mem_limit_mb=1024,
 ):
     """
-    Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Will also create a mask and
-    (optionally) a date image in the same directory. Processes raster stacks by splitting them into a number of chunks
-    to avoid memory allocation errors.
+    Calculates the per-band median of each pixel in a list of rasters with the same number of bands, dimensions and map
+    projection, excluding missing data values. All input rasters are kept open and read one block window at a time;
+    every band of a window is composited together on a (time, band, y, x) cube and written to the multi-band output
+    once. Rasters whose band count or size does not match the first raster in the list are skipped.
 
     Parameters
     ----------
     in_raster_path_list : list of str
-        A list of paths to rasters.
-    composite_out_path : str
-        The path of the output image
+        A list of paths to rasters
+    out_raster_path : str
+        The path of the output raster. Takes its geotransform, projection and datatype from the first raster; medians
+        that fall between two values are rounded to the nearest integer for integer datatypes.
     format : str, optional
-        The gdal format of the image. Defaults to "GTiff"
-    generate_date_image : bool, optional
-        If true, generates a single-layer raster containing the dates of each image detected - see below.
-    missing_data_value : int, optional
-        Value for no data encoding, will be ignored in calculating the median
+        Raster format for GDAL. Defaults to "GTiff".
+    missing_data_value : number, optional
+        Value for no data encoding, will be ignored in calculating the median. Pixels that are missing in every raster
+        are set to this value.
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     Returns
     -------
-    composite_path : str
-        The path to the composite.
-
-    Notes
-    -----
-    Masks are assumed to be a multiplicative .msk file with the same path as their corresponding image; see REFERENCE.
-    All images must have the same number of layers and resolution, but do not have to be perfectly co-registered.
-    If it does not exist, composite_out_path will be created. Takes projection, resolution, etc. from first band
-    of first raster in list. Will reproject images and masks if they do not match initial raster.
+    out_raster_path : str
+        The path to the median composite
+
+    Raises
+    ------
+    ValueError
+        If in_raster_path_list is empty or none of its rasters can be composited.
+
+    """
+    if len(in_raster_path_list) == 0:
+        raise ValueError("No rasters to composite into {}".format(out_raster_path))
+    first_raster = gdal.Open(in_raster_path_list[0])
+    n_bands = first_raster.RasterCount
+    xsize = first_raster.RasterXSize
+    ysize = first_raster.RasterYSize
+    # check that all input rasters have the same size
+    in_rasters = []
+    for f in in_raster_path_list:
+        in_raster = gdal.Open(f)
+        if in_raster is None:
+            log.error("Opening raster {} failed. Skipping.".format(f))
+            continue
+        if n_bands != in_raster.RasterCount:
+            log.error("Raster band numbers are different. Skipping {}".format(f))
+            continue
+        if xsize != in_raster.RasterXSize:
+            log.error("Raster x sizes are different. Skipping {}".format(f))
+            continue
+        if ysize != in_raster.RasterYSize:
+            log.error("Raster y sizes are different. Skipping {}".format(f))
+            continue
+        in_rasters.append(in_raster)
+    if len(in_rasters) == 0:
+        raise ValueError(
+            "None of the {} rasters could be composited into {}".format(
+                len(in_raster_path_list), out_raster_path
+            )
+        )
+    out_raster = create_matching_dataset(
+        first_raster, out_raster_path, format=format, bands=n_bands
+    )
+    out_dtype = GDALTypeCodeToNumericTypeCode(
+        first_raster.GetRasterBand(1).DataType
+    )
+    # the float64 cube, the nan mask and the median for every band of every raster
+    bytes_per_pixel = n_bands * (len(in_rasters) * 9 + 16)
+    windows = get_block_windows(
+        first_raster,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=bytes_per_pixel,
+    )
+    log.info(
+        "Compositing {} rasters in {} block windows.".format(
+            len(in_rasters), len(windows)
+        )
+    )
+    for xoff, yoff, xs, ys in windows:
+        cube = np.empty((len(in_rasters), n_bands, ys, xs), dtype=np.float64)
+        for i, in_raster in enumerate(in_rasters):
+            cube[i] = in_raster.ReadAsArray(xoff, yoff, xs, ys).reshape(
+                (n_bands, ys, xs)
+            )
+        if missing_data_value is not None:
+            cube[cube == missing_data_value] = np.nan
+        with warnings.catch_warnings():
+            # all-NaN slices are expected where every image is missing
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            median = np.nanmedian(cube, axis=0)
+        if missing_data_value is None:
+            median[np.isnan(median)] = 0
+        else:
+            median[np.isnan(median)] = missing_data_value
+        if np.issubdtype(out_dtype, np.integer):
+            median = np.rint(median)
+        median = median.astype(out_dtype)
+        for band in range(n_bands):
+            out_raster.GetRasterBand(band + 1).WriteArray(median[band], xoff, yoff)
+    out_raster = None
+    in_rasters = None
+    first_raster = None
+    return out_raster_path
+
+
+def clever_composite_images_with_mask(
+    in_raster_path_list,
+    composite_out_path,
+    format="GTiff",
+    chunks=None,
+    generate_date_image=True,
+    missing_data_value=0,
+    mem_limit_mb=1024,
+):
+    """
+    Works down in_raster_path_list, updating pixels in composite_out_path if not masked. Will also create a mask and
+    (optionally) a date image in the same directory. Processes the raster stack in a single pass over block windows
+    to avoid memory allocation errors; see :py:func:`median_composite_of_raster_list`.
+
+    Parameters
+    ----------
+    in_raster_path_list : list of str
+        A list of paths to rasters.
+    composite_out_path : str
+        The path of the output image
+    format : str, optional
+        The gdal format of the image. Defaults to "GTiff"
+    generate_date_image : bool, optional
+        If true, generates a single-layer raster containing the dates of each image detected - see below.
+    missing_data_value : int, optional
+        Value for no data encoding, will be ignored in calculating the median
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
+
+    Returns
+    -------
+    composite_path : str
+        The path to the composite.
+
+    Notes
+    -----
+    Masks are assumed to be a multiplicative .msk file with the same path as their corresponding image; see REFERENCE.
+    All images must have the same number of layers and resolution, but do not have to be perfectly co-registered.
+    If it does not exist, composite_out_path will be created. Takes projection, resolution, etc. from first band
+    of first raster in list. Will reproject images and masks if they do not match initial raster.
 
     If generate_date_images is True, an raster ending with the suffix .date will be created; each pixel will contain the
     timestamp (yyyymmdd) of the date that pixel was last seen in the composite.
@@ -1490,91 +1834,6 @@ def clever_composite_images_with_mask(
 
     """
 
-    def median_of_raster_list(
-        in_raster_path_list,
-        out_raster_path,
-        band=1,
-        chunks=10,
-        missing_data_value=0,
-        format="GTiff",
-    ):
-        """
-        Calculates the median of each pixel in a list of rasters with one band of the same dimensions and map projection.
-        Excludes missing data values from the calculations. Processes raster stacks by splitting them into a number of chunks
-        to avoid memory allocation errors.
-
-        Parameters
-        ----------
-        in_raster_path_list : list of str
-            A list of paths to rasters
-        out_raster_path : str
-            The path of the output raster
-        band : int, optional
-            The number of the band to be processed, starting at 1. Defaults to band 1.
-        missing_data_value : number, optional
-            Value for no data encoding, will be ignored in calculating the median
-        format : str, optional
-            Raster format for GDAL
-        """
-
-        in_raster = gdal.Open(in_raster_path_list[0])
-        driver = gdal.GetDriverByName(str(format))
-        projection = in_raster.GetProjection()
-        in_gt = in_raster.GetGeoTransform()
-        temp_band = in_raster.GetRasterBand(1)
-        datatype = temp_band.DataType
-        xsize = in_raster.RasterXSize
-        ysize = in_raster.RasterYSize
-        temp_band = None
-        in_raster = None
-        chunksize = int(np.ceil(ysize / chunks))
-        # create output raster file and copy metadata from first raster in the list
-        result = driver.Create(
-            out_raster_path, xsize=xsize, ysize=ysize, bands=1, eType=datatype
-        )
-        result.SetGeoTransform(in_gt)
-        result.SetProjection(projection)
-        log.info(
-            "Chunk processing. {} chunks of size {}, {}.".format(
-                chunks, chunksize, xsize
-            )
-        )
-        for ch in range(chunks):
-            log.info("Processing chunk {}".format(ch))
-            xoff = 0
-            yoff = ch * chunksize
-            xs = xsize
-            # work out the size of the last chunk (residual)
-            if ch < chunks - 1:
-                ys = chunksize
-            else:
-                ys = ysize - ch * chunksize
-            # log.info("xoff, yoff, xsize, ysize: {}, {}, {}, {}".format(xoff,yoff,xs,ys))
-            res = []  # reset the stack of band rasters from all time slices
-            for f in in_raster_path_list:
-                # log.info("Opening raster {}".format(f))
-                ds = gdal.Open(f)
-                b = ds.GetRasterBand(band).ReadAsArray(xoff, yoff, xs, ys)
-                res.append(b)
-                ds = None
-            stacked = np.dstack(res)
-            if missing_data_value is not None:
-                ma = np.ma.masked_equal(stacked, missing_data_value)
-                stacked[ma.mask] = np.nan
-            median_raster = np.nanmedian(stacked, axis=-1)
-            # catch pixels where all rasters have NaN values and set them to missing_data_value
-            all_nan_locations = np.isnan(stacked).all(axis=-1)
-            median_raster[all_nan_locations] = missing_data_value
-            b = result.GetRasterBand(1).ReadAsArray()
-            # log.info("Broadcasting from [{}:{}, {}:{}]".format(0, median_raster.shape[0], 0, median_raster.shape[1]))
-            # log.info("             into [{}:{}, {}:{}]".format(yoff, yoff+ys, xoff, xoff+xs))
-            b[yoff : (yoff + ys), xoff : (xoff + xs)] = median_raster
-            result.GetRasterBand(1).WriteArray(b)
-        result = None
-        res = None
-        b = None
-        median_raster = None
-
     log = logging.getLogger(__name__)
     driver = gdal.GetDriverByName(str(format))
     in_raster_list = [gdal.Open(raster) for raster in in_raster_path_list]
@@ -1628,37 +1887,17 @@ def clever_composite_images_with_mask(
             get_stats_from_raster_file(masked_image_path)
             log.info("Finished application of masks to rasters.")
 
-    # use raster stacking to calculate the median over all masked raster files and all 4 bands
     log.info("Beginning median calculations.")
-    tmpfiles = []
-    for band in range(n_bands):
-        log.info(
-            "Band {} - calculating median composite across all images using raster stacking".format(
-                band + 1
-            )
-        )
-        log.info("   Ignoring missing data value of {}".format(missing_data_value))
-        tmpfile = os.path.abspath(
-            composite_out_path.split(".")[0] + "_tmp_band" + str(band + 1) + ".tif"
-        )
-        tmpfiles.append(tmpfile)
-        median_of_raster_list(
-            masked_image_paths,
-            tmpfile,
-            band=band + 1,
-            chunks=chunks,
-            missing_data_value=missing_data_value,
-        )
-        # log some image stats
-        get_stats_from_raster_file(tmpfile)
+    log.info("   Ignoring missing data value of {}".format(missing_data_value))
+    median_composite_of_raster_list(
+        masked_image_paths,
+        composite_out_path,
+        format=format,
+        missing_data_value=missing_data_value,
+        mem_limit_mb=mem_limit_mb,
+    )
     log.info("Finished median calculations.")
-
-    # Aggretating band composites into a single tiff file
-    log.info("Aggretating band composites into a single raster file.")
-    stack_images(tmpfiles, composite_out_path, geometry_mode="intersect")
     get_stats_from_raster_file(composite_out_path)
-    for tmpfile in tmpfiles:
-        os.remove(tmpfile)
     log.info("Median composite done")
     log.info(
         "Creating composite mask at {}".format(
@@ -1710,6 +1949,7 @@ def reproject_image(
     driver="GTiff",
     memory=2e3,
     do_post_resample=True,
+    profile=None,
 ):
     """
     Creates a new, reprojected image from in_raster using the gdal.ReprojectImage function.
@@ -1728,6 +1968,9 @@ def reproject_image(
         The amount of memory to give to the reprojection. Defaults to 2e3
     do_post_resample : bool, optional
         If set to false, do not resample the image back to the original projection. Defaults to True
+    profile : str, optional
+        The output profile to write the image with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile.
 
     Notes
     -----
@@ -1759,11 +2002,16 @@ def reproject_image(
         dstSRS=new_projection,
         warpMemoryLimit=memory,
         format=driver,
+        creationOptions=get_creation_options(
+            in_raster.GetRasterBand(1).DataType, profile, driver
+        ),
     )
     # After warping, image has irregular gt; resample back to previous pixel size
     # TODO: Make this an option
     if do_post_resample:
-        resample_image_in_place(out_raster_path, res)
+        resample_image_in_place(out_raster_path, res, profile=profile)
+    else:
+        build_overviews(out_raster_path, profile)
     return out_raster_path
 
 
@@ -1820,9 +2068,10 @@ def clever_composite_directory(
     image_dir,
     composite_out_dir,
     format="GTiff",
-    chunks=10,
+    chunks=None,
     generate_date_images=False,
     missing_data_value=0,
+    mem_limit_mb=1024,
 ):
     """
     Using clever_composite_images, creates a composite containing every image in image_dir. This will
@@ -1841,6 +2090,8 @@ def clever_composite_directory(
         Defaults to False.
     missing_data_value : int, optional
         Value for no data encoding, will be ignored in calculating the median
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window of the composite. Defaults to 1024.
 
     Returns
     -------
@@ -1882,6 +2133,7 @@ def clever_composite_directory(
         chunks=chunks,
         generate_date_image=generate_date_images,
         missing_data_value=missing_data_value,
+        mem_limit_mb=mem_limit_mb,
     )
     return composite_out_path
 
@@ -1890,9 +2142,10 @@ def clever_composite_directory_with_masks(
     image_dir,
     composite_out_dir,
     format="GTiff",
-    chunks=10,
+    chunks=None,
     generate_date_images=False,
     missing_data_value=0,
+    mem_limit_mb=1024,
 ):
     """
     Using clever_composite_images_with_mask, creates a composite containing every image in image_dir. This will
@@ -1911,6 +2164,8 @@ def clever_composite_directory_with_masks(
         Defaults to False.
     missing_data_value : int, optional
         Value for no data encoding, will be ignored in calculating the median
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window of the composite. Defaults to 1024.
 
     Returns
     -------
@@ -1951,6 +2206,7 @@ def clever_composite_directory_with_masks(
         chunks=chunks,
         generate_date_image=generate_date_images,
         missing_data_value=missing_data_value,
+        mem_limit_mb=mem_limit_mb,
     )
     return composite_out_path
 
@@ -2061,7 +2317,13 @@ def stack_and_trim_images(old_image_path, new_image_path, aoi_path, out_image):
 
 
 def clip_raster(
-    raster_path, aoi_path, out_path, srs_id=4326, flip_x_y=False, dest_nodata=0
+    raster_path,
+    aoi_path,
+    out_path,
+    srs_id=4326,
+    flip_x_y=False,
+    dest_nodata=0,
+    profile=None,
 ):
     """
     Clips a raster at raster_path to a shapefile given by aoi_path. Assumes a shapefile only has one polygon.
@@ -2081,6 +2343,9 @@ def clip_raster(
         Default is False.
     dest_nodata : number, optional
         The fill value for outside of the clipped area. Defaults to 0.
+    profile : str, optional
+        The output profile to write the clipped raster with - see the introduction for this module. Defaults to the
+        profile set by use_output_profile.
     """
 
     # TODO: Set values outside clip to 0 or to NaN - in irregular polygons
@@ -2118,9 +2383,13 @@ def clip_raster(
             height=height_pix,
             dstSRS=srs,
             dstNodata=dest_nodata,
+            creationOptions=get_creation_options(
+                raster.GetRasterBand(1).DataType, profile
+            ),
         )
         out = gdal.Warp(out_path, raster, options=clip_spec)
         out.SetGeoTransform(new_geotransform)
+        build_overviews(out, profile)
         out = None
 
 
@@ -2167,6 +2436,7 @@ def create_new_image_from_polygon(
     format="GTiff",
     datatype=gdal.GDT_Int32,
     nodata=0,
+    profile=None,
 ):
     """
     Returns an empty image that covers the extent of the input polygon.
@@ -2189,6 +2459,11 @@ def create_new_image_from_polygon(
         The gdal raster format of the output image. Defaults to "Gtiff"
     datatype : gdal datatype, optional
         The gdal datatype of the output image. Defaults to gdal.GDT_Int32
+    nodata : number, optional
+        The value to fill the new image with. Defaults to 0.
+    profile : str, optional
+        The output profile to create the image with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile.
 
     Returns
     -------
@@ -2209,6 +2484,7 @@ def create_new_image_from_polygon(
         ysize=final_height_pixels,
         bands=bands,
         eType=datatype,
+        options=get_creation_options(datatype, profile, format),
     )
     out_raster.SetGeoTransform([bounds_x_min, x_res, 0, bounds_y_max, 0, y_res * -1])
     out_raster.SetProjection(projection)
@@ -2216,13 +2492,14 @@ def create_new_image_from_polygon(
         band = out_raster.GetRasterBand(band_index)
         band.SetNoDataValue(nodata)
         band = None
-    arr = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    arr[...] = nodata
-    arr = None
+    if nodata != 0:
+        # blocks of a new raster read as 0 until they are written
+        for band_index in range(1, bands + 1):
+            out_raster.GetRasterBand(band_index).Fill(nodata)
     return out_raster
 
 
-def resample_image_in_place(image_path, new_res):
+def resample_image_in_place(image_path, new_res, profile=None):
     """
     Resamples an image in-place using gdalwarp to new_res in metres.
     WARNING: This will make a permanent change to an image! Use with care.
@@ -2235,19 +2512,29 @@ def resample_image_in_place(image_path, new_res):
     new_res : number
         Pixel edge size in meters
 
+    profile : str, optional
+        The output profile to rewrite the image with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile.
+
     """
     image = gdal.Open(image_path, gdal.GA_ReadOnly)
     if image.RasterXSize == new_res and image.RasterYSize == new_res:
         log.info("Image already has {}m resolution: {}".format(new_res, image_path))
         image = None
         return
+    datatype = image.GetRasterBand(1).DataType
     image = None
     # log.info("Resampling to {}m resolution: {}".format(new_res, image_path))
     with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
         # Remember this is used for masks, so any averaging resample strat will cock things up.
-        args = gdal.WarpOptions(xRes=new_res, yRes=new_res)
+        args = gdal.WarpOptions(
+            xRes=new_res,
+            yRes=new_res,
+            creationOptions=get_creation_options(datatype, profile),
+        )
         temp_image = os.path.join(td, "temp_image.tif")
         gdal.Warp(temp_image, image_path, options=args)
+        build_overviews(temp_image, profile)
 
         # Windows permissions.
         if sys.platform.startswith("win"):
@@ -2370,6 +2657,221 @@ def get_extent_as_shp(in_ras_path, out_shp_path):
     return out_shp_path
 
 
+def _promote_for_arithmetic(array):
+    """
+    Widens integer arrays so that sums, differences and products of them cannot wrap around: 8 and 16 bit integers
+    become int32 and 32 bit integers int64. Floats are returned unchanged.
+    """
+    if array.dtype.kind == "u" or array.dtype.kind == "i":
+        return array.astype(np.int32 if array.dtype.itemsize < 4 else np.int64)
+    if array.dtype.kind == "b":
+        return array.astype(np.int32)
+    return array
+
+
+def _fits_dtype(value, dtype):
+    """
+    Whether value can be stored as dtype without being rounded, wrapped around or overflowing.
+
+    :meta private:
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in "iu":
+        info = np.iinfo(dtype)
+        return float(value).is_integer() and info.min <= value <= info.max
+    if dtype.kind == "f":
+        return not np.isfinite(value) or abs(value) <= np.finfo(dtype).max
+    return True
+
+
+def apply_raster_expression(
+    expression,
+    inputs,
+    out_path,
+    out_datatype=None,
+    out_nodata=None,
+    mem_limit_mb=1024,
+    n_workers=1,
+    out_format="GTiff",
+):
+    """
+    Evaluates a raster-algebra expression over named bands of one or more rasters, block by block, and writes the
+    result to a new raster.
+
+    Each input is read one window at a time; integer inputs are widened before evaluation (see below), pixels that are
+    nodata in any input stay nodata in the output, and the windows can be evaluated on a pool of threads while the
+    main thread writes the results.
+
+    Parameters
+    ----------
+    expression : str or callable
+        Either a numpy expression over the input names, e.g. "(nir - red) / (nir + red)", with numpy available as
+        np; or a vectorised function called with the input arrays as keyword arguments. Either returns an array of
+        shape (y, x), or (bands, y, x) for a multi-band output.
+    inputs : dict
+        The arrays to evaluate over, by name. Each value is a raster path (band 1), a (path, band) tuple with the band
+        counting from 1, or a list of either, which gives a (n, y, x) stack, e.g. for sums over many rasters. All
+        rasters must have the same size.
+    out_path : str
+        The path of the output raster. It takes its size, geotransform and projection from the first input.
+    out_datatype : gdal datatype, optional
+        The datatype of the output. Defaults to the datatype of the result of the expression.
+    out_nodata : number, optional
+        The nodata value of the output, written where any input is nodata and where the result is not finite.
+        Defaults to the nodata value of the first input that has one; if none has, nodata is not propagated. A
+        ValueError is raised if it cannot be stored as out_datatype.
+    mem_limit_mb : number, optional
+        The approximate memory ceiling, in MB, of each window, per worker. Defaults to 1024.
+    n_workers : int, optional
+        The number of windows to evaluate at once. Defaults to 1.
+    out_format : str, optional
+        The gdal format of the output. Defaults to 'GTiff'.
+
+    Returns
+    -------
+    out_path : str
+        The path of the output raster
+
+    Notes
+    -----
+    Integers are widened before evaluation so that arithmetic cannot wrap around: 8 and 16 bit integers become int32
+    and 32 bit integers int64. The result then follows numpy type promotion, e.g. division gives float64. Give
+    out_datatype to store it more compactly; floats written to an integer out_datatype are rounded to the nearest
+    integer.
+
+    Examples
+    --------
+    NDVI of a stacked image, and the sum of a list of change maps:
+
+    >>> apply_raster_expression("(nir - red) / (nir + red)", {"red": ("image.tif", 3), "nir": ("image.tif", 4)},
+    ...                         "ndvi.tif", out_datatype=gdal.GDT_Float32)
+    >>> apply_raster_expression("maps.sum(axis=0)", {"maps": change_map_paths}, "n_changes.tif")
+
+    """
+    sources = {}
+    for name, source in inputs.items():
+        is_stack = isinstance(source, list)
+        sources[name] = (
+            is_stack,
+            [
+                (item, 1) if isinstance(item, str) else tuple(item)
+                for item in (source if is_stack else [source])
+            ],
+        )
+    paths = sorted({path for _, bands in sources.values() for path, _ in bands})
+    first_path = next(iter(sources.values()))[1][0][0]
+
+    template = gdal.Open(first_path)
+    nodata_values = {}
+    for path in paths:
+        raster = gdal.Open(path)
+        if (raster.RasterXSize, raster.RasterYSize) != (template.RasterXSize, template.RasterYSize):
+            raise ValueError(
+                "{} is {} x {} pixels but {} is {} x {}".format(
+                    path, raster.RasterXSize, raster.RasterYSize,
+                    first_path, template.RasterXSize, template.RasterYSize,
+                )
+            )
+        for _, bands in sources.values():
+            for band_path, band in bands:
+                if band_path == path:
+                    nodata_values[(path, band)] = raster.GetRasterBand(band).GetNoDataValue()
+        raster = None
+    if out_nodata is None:
+        out_nodata = next(
+            (nodata_values[band] for _, bands in sources.values() for band in bands if nodata_values[band] is not None),
+            None,
+        )
+    if out_nodata is not None and float(out_nodata).is_integer():
+        # gdal reports nodata values as floats; whole ones are kept integral so they do not turn integer results
+        # into floats
+        out_nodata = int(out_nodata)
+
+    n_arrays = sum(len(bands) for _, bands in sources.values())
+    windows = get_block_windows(
+        template,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=8 * (n_arrays + 2),
+    )
+    if isinstance(expression, str):
+        code = compile(expression, "<raster expression>", "eval")
+        function = lambda **arrays: eval(code, {"np": np}, arrays)
+    else:
+        function = expression
+
+    # gdal datasets must not be shared between threads, so each thread opens its own
+    thread_rasters = threading.local()
+
+    def evaluate(window):
+        if not hasattr(thread_rasters, "rasters"):
+            thread_rasters.rasters = {path: gdal.Open(path) for path in paths}
+        xoff, yoff, xsize, ysize = window
+        arrays = {}
+        nodata_mask = np.zeros((ysize, xsize), dtype=bool)
+        for name, (is_stack, bands) in sources.items():
+            band_arrays = []
+            for path, band in bands:
+                band_array = thread_rasters.rasters[path].GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize)
+                if nodata_values[(path, band)] is not None:
+                    nodata_mask |= band_array == nodata_values[(path, band)]
+                band_arrays.append(_promote_for_arithmetic(band_array))
+            arrays[name] = np.stack(band_arrays) if is_stack else band_arrays[0]
+        with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+            result = np.asarray(function(**arrays))
+        if result.ndim == 2:
+            result = result[np.newaxis, ...]
+        if out_nodata is not None:
+            if result.dtype.kind == "f":
+                nodata_mask = nodata_mask | ~np.isfinite(result).all(axis=0)
+            # widened only as far as the nodata value needs, e.g. uint8 to int16 for -9999, so it is never wrapped
+            nodata_dtype = np.result_type(result.dtype, np.min_scalar_type(out_nodata))
+            result = np.where(nodata_mask, nodata_dtype.type(out_nodata), result.astype(nodata_dtype, copy=False))
+        return window, result
+
+    # the first window fixes the datatype and band count of the output
+    first_window, first_result = evaluate(windows[0])
+    if out_datatype is None:
+        if first_result.dtype == np.bool_:
+            out_datatype = gdal.GDT_Byte
+        else:
+            out_datatype = NumericTypeCodeToGDALTypeCode(first_result.dtype)
+        if out_datatype is None:
+            # e.g. int64 before gdal 3.5
+            out_datatype = gdal.GDT_Float64
+    out_dtype = np.dtype(GDALTypeCodeToNumericTypeCode(out_datatype))
+    if out_nodata is not None and not _fits_dtype(out_nodata, out_dtype):
+        raise ValueError("The nodata value {} cannot be stored as {}".format(out_nodata, out_dtype.name))
+    out_raster = create_matching_dataset(
+        template, out_path, format=out_format, bands=first_result.shape[0], datatype=out_datatype
+    )
+    if out_nodata is not None:
+        for band_index in range(first_result.shape[0]):
+            out_raster.GetRasterBand(band_index + 1).SetNoDataValue(out_nodata)
+    template = None
+
+    def write(window, result):
+        xoff, yoff, _, _ = window
+        if out_dtype.kind in "iu" and result.dtype.kind == "f":
+            # astype would truncate towards zero
+            result = np.rint(result)
+        for band_index, band_array in enumerate(result):
+            out_raster.GetRasterBand(band_index + 1).WriteArray(band_array.astype(out_dtype, copy=False), xoff, yoff)
+
+    write(first_window, first_result)
+    if n_workers > 1 and len(windows) > 1:
+        thread_pool = Pool(n_workers)
+        for window, result in thread_pool.imap_unordered(evaluate, windows[1:]):
+            write(window, result)
+        thread_pool.close()
+        thread_pool.join()
+    else:
+        for window in windows[1:]:
+            write(*evaluate(window))
+    build_overviews(out_raster)
+    out_raster = None
+    return out_path
+
+
 def calc_ndvi(raster_path, output_path):
     """
     Creates a raster of NDVI from the input raster at output_path
@@ -2379,25 +2881,18 @@ def calc_ndvi(raster_path, output_path):
     raster_path : str
         Path to a raster with blue, green, red and infrared bands (in that order)
     output_path : str
-        Path to a location to save the output raster
+        Path to a location to save the output raster. Pixels that are nodata in the input are set to -9999, the
+        nodata value of the output.
 
     """
-    raster = gdal.Open(raster_path)
-    out_raster = create_matching_dataset(raster, output_path, datatype=gdal.GDT_Float32)
-    array = raster.GetVirtualMemArray()
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    R = array[2, ...]
-    I = array[3, ...]
-    out_array[...] = (R - I) / (R + I)
-
-    out_array[...] = np.where(out_array == -2147483648, 0, out_array)
-
-    R = None
-    I = None
-    array = None
-    out_array = None
-    raster = None
-    out_raster = None
+    # pixels where R + I is 0 are set to 0; nodata is outside the NDVI range so that an NDVI of 0 stays valid
+    apply_raster_expression(
+        "np.nan_to_num((R - I) / (R + I), nan=0, posinf=0, neginf=0)",
+        {"R": (raster_path, 3), "I": (raster_path, 4)},
+        output_path,
+        out_datatype=gdal.GDT_Float32,
+        out_nodata=-9999,
+    )
 
 
 def apply_band_function(
@@ -2405,14 +2900,16 @@ def apply_band_function(
 ):
     """
     Applys an arbitrary band mathematics function to an image at in_path and saves the result at out_map.
-    Function should be a function object of the form f(band_input_A, band_input_B, ...)
+    Function should be a function object of the form f(band_input_A, band_input_B, ...), working on whole arrays.
+    The image is processed in windows by :py:func:`apply_raster_expression`.
 
     Parameters
     ----------
     in_path : str
         The image to process
     function : Func
-    bands
+    bands : list of int
+        The bands to pass to function, counting from 0
     out_path
     out_datatype
 
@@ -2429,19 +2926,13 @@ def apply_band_function(
     >>> apply_band_function("my_raster.tif", ndvi_function, [0,1], "my_ndvi.tif")
 
     """
-    raster = gdal.Open(in_path)
-    out_raster = create_matching_dataset(
-        raster, out_path=out_path, datatype=out_datatype
+    names = ["band_{}".format(band) for band in bands]
+    apply_raster_expression(
+        lambda **arrays: function(*[arrays[name] for name in names]),
+        {name: (in_path, band + 1) for name, band in zip(names, bands)},
+        out_path,
+        out_datatype=out_datatype,
     )
-    array = raster.GetVirtualMemArray()
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    band_views = [array[band, ...] for band in bands]
-    out_array[...] = function(*band_views)
-    out_array = None
-    for view in band_views:
-        view = None
-    raster = None
-    out_raster = None
 
 
 def ndvi_function(r, i):
@@ -2456,13 +2947,16 @@ def ndvi_function(r, i):
     -------
 
     """
-    return (r - i) / (r + i)
+    return (1.0 * r - i) / (1.0 * r + i)
 
 
-def apply_image_function(in_paths, out_path, function, out_datatype=gdal.GDT_Int32):
+def apply_image_function(
+    in_paths, out_path, function, out_datatype=gdal.GDT_Int32, vectorised=False, n_workers=1
+):
     """
     Applies a pixel-wise function across every image. Assumes each image is exactly contiguous and, for now,
-    single-banded. function() should take a list of values and return a single value.
+    single-banded. function() should take a list of values and return a single value. The images are processed in
+    windows by :py:func:`apply_raster_expression`.
 
     Parameters
     ----------
@@ -2472,36 +2966,35 @@ def apply_image_function(in_paths, out_path, function, out_datatype=gdal.GDT_Int
         The path to the
     function : function
         The function to apply to the list of images. Must take a list of numbers as an input and return a value.
+        If vectorised is True, it is instead called once per window with an (n_images, y, x) array and an axis=0
+        keyword, like np.sum, and must return a (y, x) array.
     out_datatype : gdal datatype, optional
         The datatype of the final raster. Defaults to gdal.gdt_Int32
+    vectorised : bool, optional
+        If True, function works on whole windows; see function. This is much faster than calling it once per pixel.
+        Defaults to False.
+    n_workers : int, optional
+        The number of windows to process at once. Defaults to 1.
 
     Examples
     --------
     Producing a raster where each pixel contains the sum of the corresponding pixels in a list of other rasters
 
-    >>> def sum_function(pixels_in):
-    ...     return np.sum(pixels_in)
     >>> in_paths = os.listdir("my_raster_dir")
-    >>> apply_image_function(in_paths, "sum_raster.tif", sum_function)
+    >>> apply_image_function(in_paths, "sum_raster.tif", np.sum, vectorised=True)
 
     """
-    rasters = [gdal.Open(in_path) for in_path in in_paths]
-    raster_arrays = [raster.GetVirtualMemArray() for raster in rasters]
-    in_array = np.stack(raster_arrays, axis=0)
-
-    out_raster = create_matching_dataset(
-        rasters[0], out_path=out_path, datatype=out_datatype
+    if vectorised:
+        expression = lambda images: function(images, axis=0)
+    else:
+        expression = lambda images: np.apply_along_axis(function, 0, images)
+    apply_raster_expression(
+        expression,
+        {"images": list(in_paths)},
+        out_path,
+        out_datatype=out_datatype,
+        n_workers=n_workers,
     )
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
-    out_array[...] = np.apply_along_axis(function, 0, in_array)
-
-    # Deallocating. Not taking any chances here.
-    out_array = None
-    out_raster = None
-    in_array = None
-    for raster_array, raster in zip(raster_arrays, rasters):
-        raster_array = None
-        raster = None
 
 
 def sum_function(pixels_in):
@@ -2510,7 +3003,8 @@ def sum_function(pixels_in):
 
 def raster_sum(inRstList, outFn, outFmt="GTiff"):
     """Creates a raster stack from a list of rasters. Adapted from Chris Gerard's
-    book 'Geoprocessing with Python'. The output data type is the same as the input data type.
+    book 'Geoprocessing with Python'. The output data type is widened from the input data type so that the sum
+    cannot wrap around: Int32 for 8 and 16 bit integer inputs, 64 bit for 32 bit integers.
 
     Parameters
     ----------
@@ -2528,36 +3022,17 @@ def raster_sum(inRstList, outFn, outFmt="GTiff"):
     log = logging.getLogger(__name__)
     log.info("Starting raster sum function.")
 
-    # open 1st band to get info
-    in_ds = gdal.Open(inRstList[0])
-    in_band = in_ds.GetRasterBand(1)
-
-    # Get raster shape
-    rst_dim = (in_band.YSize, in_band.XSize)
-
-    # initiate empty array
-    empty_arr = np.empty(rst_dim, dtype=np.uint8)
-
-    for i, rst in enumerate(inRstList):
-        # Todo: Check that dimensions and shape of both arrays are the same in the first loop.
-        ds = gdal.Open(rst)
-        bnd = ds.GetRasterBand(1)
-        arr = bnd.ReadAsArray()
-        empty_arr = empty_arr + arr
-
-    # Create a 1 band GeoTiff with the same properties as the input raster
-    driver = gdal.GetDriverByName(str(outFmt))
-    out_ds = driver.Create(outFn, in_band.XSize, in_band.YSize, 1, in_band.DataType)
-    out_ds.SetProjection(in_ds.GetProjection())
-    out_ds.SetGeoTransform(in_ds.GetGeoTransform())
-
-    out_ds.GetRasterBand(1).WriteArray(empty_arr)
-
-    # write the data to disk
-    out_ds.FlushCache()
+    # sum one window at a time in the widened datatype of the stack, since e.g. 256 Byte maps can sum past 255
+    apply_raster_expression(
+        "rasters.sum(axis=0, dtype=rasters.dtype)",
+        {"rasters": list(inRstList)},
+        outFn,
+        out_format=outFmt,
+    )
 
     # Compute statistics on each output band setting ComputeStatistics to false calculates stats on all pixels
     # not estimates
+    out_ds = gdal.Open(outFn, gdal.GA_Update)
     out_ds.GetRasterBand(1).ComputeStatistics(False)
 
     out_ds.BuildOverviews("average", [2, 4, 8, 16, 32])
@@ -2659,7 +3134,7 @@ def open_dataset_from_safe(safe_file_path, band, resolution="10m"):
     Parameters
     ----------
     safe_file_path : str
-        The path to the .SAFE file
+        The path to the .SAFE file. If it has been zipped, the band is read from inside the archive.
     band : int
         The band to open
     resolution : {'10m', '20m', '60m'}, optional
@@ -2676,8 +3151,7 @@ def open_dataset_from_safe(safe_file_path, band, resolution="10m"):
     )
     # edited by hb91
     # image_glob = r"GRANULE/*/IMG_DATA/*_{}.jp2".format(band)
-    fp_glob = os.path.join(safe_file_path, image_glob)
-    image_file_path = glob.glob(fp_glob)
+    image_file_path = glob_safe(safe_file_path, image_glob)
     out = gdal.Open(image_file_path[0])
     return out
 
@@ -2791,10 +3265,13 @@ def apply_scl_cloud_mask(
     haze=None,
     epsg=None,
     skip_existing=False,
+    apply_offset=False,
+    mem_limit_mb=1024,
 ):
     """
     For every .SAFE folder in l2_dir, creates a cloud-masked raster band for each selected band
     based on the SCL layer. Applies a rough haze correction based on thresholding the blue band (optional).
+    Each product is processed by preprocess_l2a_safe_file, which writes only the final image.
 
     Parameters
     ----------
@@ -2816,108 +3293,252 @@ def apply_scl_cloud_mask(
     epsg : int
         EPSG code of the map projection / CRS if output rasters shall be reprojected (warped)
     skip_existing : boolean
-        If True, skip cloud masking if a file already exists. If False, overwrite it.
-
-    """
+        If True, skip cloud masking if a file already exists. If False, overwrite it. If a processing manifest is in
+        use (see :py:func:`pyeo_1.filesystem_utilities.use_processing_manifest`), files it has a record of are instead
+        skipped only if neither the product nor the masking parameters have changed.
+    apply_offset : boolean, optional
+        If True, also applies the processing baseline 0400 offset correction to products that need it and marks their
+        output files as offset (see apply_processing_baseline_offset_correction_to_tiff_file_directory). Defaults to
+        False.
+    mem_limit_mb : number, optional
+        The maximum amount of memory, in MB, to use for each block of the image. Defaults to 1024.
+
+    """
+    l2_dir_contents = os.listdir(l2_dir)
     safe_file_path_list = [
         os.path.join(l2_dir, safe_file_path)
-        for safe_file_path in os.listdir(l2_dir)
+        for safe_file_path in l2_dir_contents
         if safe_file_path.endswith(".SAFE")
     ]
+    # zipped products are read from inside their archive, without extracting them
+    for zip_name in l2_dir_contents:
+        if zip_name.startswith("S2") and "MSIL2A" in zip_name and zip_name.endswith(".zip"):
+            safe_name = zip_name[: -len(".zip")]
+            if not safe_name.endswith(".SAFE"):
+                safe_name = safe_name + ".SAFE"
+            if safe_name not in l2_dir_contents:
+                safe_file_path_list.append(os.path.join(l2_dir, safe_name))
     for l2_safe_file in safe_file_path_list:
         log.info("  L2A raster file: {}".format(l2_safe_file))
         f = get_sen_2_granule_id(l2_safe_file)
-        pattern = (
-            f.split("_")[0]
-            + "_"
-            + f.split("_")[1]
-            + "_"
-            + f.split("_")[2]
-            + "_"
-            + f.split("_")[3]
-            + "_"
-            + f.split("_")[4]
-            + "_"
-            + f.split("_")[5]
+        out_path = os.path.join(out_dir, f + ".tif")
+        # the output is looked up under the name preprocess_l2a_safe_file gives it, which marks offset products
+        expected_path = _offset_output_path(out_path, apply_offset)
+        mask_parameters = {
+            "scl_classes": scl_classes,
+            "buffer_size": buffer_size,
+            "bands": bands,
+            "out_resolution": out_resolution,
+            "haze": haze,
+            "epsg": epsg,
+            "apply_offset": apply_offset,
+        }
+        if is_output_up_to_date(
+            expected_path,
+            "cloud_mask",
+            [l2_safe_file],
+            mask_parameters,
+            skip_existing=skip_existing,
+        ):
+            log.info("  Skipping band merging for: {}".format(f))
+            log.info("  Found stacked file: {}".format(expected_path))
+        else:
+            written_path = preprocess_l2a_safe_file(
+                l2_safe_file,
+                out_path,
+                scl_classes,
+                buffer_size=buffer_size,
+                bands=bands,
+                out_resolution=out_resolution,
+                haze=haze,
+                epsg=epsg,
+                apply_offset=apply_offset,
+                mem_limit_mb=mem_limit_mb,
+            )
+            if os.path.exists(written_path):
+                record_output(written_path, "cloud_mask", [l2_safe_file], mask_parameters)
+            # out_dir has changed, so lookups in it must not be answered from the catalogue
+            invalidate_catalogue(out_dir)
+    return
+
+
+def _offset_output_path(out_path, apply_offset):
+    """
+    :meta private:
+    Returns the path preprocess_l2a_safe_file writes out_path to. If apply_offset is True and the processing baseline
+    in the file name is 0400 or later, the baseline is changed from 0XXX to AXXX to mark the image as offset.
+    """
+    out_name = os.path.basename(out_path)
+    baseline = out_name[28:32]
+    if (
+        apply_offset
+        and baseline[:1] != "A"
+        and baseline[1:].isdigit()
+        and int(baseline[1:]) >= 400
+    ):
+        return os.path.join(
+            os.path.dirname(out_path), out_name[:28] + "A" + baseline[1:] + out_name[32:]
         )
-        # log.info("  Granule ID  : {}".format(f))
-        # log.info("  File pattern: {}".format(pattern))
-        # Find existing matching files in the output directory
-        df = get_raster_paths([out_dir], filepatterns=[pattern], dirpattern="")
-        for i in range(len(df)):
-            if df[pattern][i] != "" and skip_existing:
-                log.info("  Skipping band merging for: {}".format(f))
-                log.info("  Found stacked file: {}".format(df[pattern][i][0]))
-            else:
-                out_path = os.path.join(
-                    out_dir, get_sen_2_granule_id(l2_safe_file) + ".tif"
+    return out_path
+
+
+def preprocess_l2a_safe_file(
+    l2_safe_file,
+    out_path,
+    scl_classes,
+    buffer_size=0,
+    bands=("B02", "B03", "B04", "B08"),
+    out_resolution=10,
+    haze=None,
+    epsg=None,
+    apply_offset=False,
+    BOA_ADD_OFFSET=-1000,
+    mem_limit_mb=1024,
+):
+    """
+    Cloud-masks the selected bands of a single L2A .SAFE product with its SCL layer and writes them to one compressed,
+    tiled geotiff. The bands and the SCL layer are stacked in a virtual raster that resamples (and, if epsg is given,
+    reprojects) them on the fly; the SCL mask, the optional haze mask and the optional processing baseline offset are
+    then applied block by block in memory, so no intermediate full-size images are written.
+
+    Parameters
+    ----------
+    l2_safe_file : str
+        Path to the L2A .SAFE product
+    out_path : str
+        Path to the new image. If the offset is applied, the processing baseline in the file name is changed from
+        0XXX to AXXX, as in apply_processing_baseline_offset_correction_to_tiff_file_directory.
+    scl_classes : list of int
+        values of classes to be masked out
+    buffer_size : int, optional
+        The buffer to apply to the masks, in pixels of the output image - defaults to 0
+    bands : list of str, optional
+        List of names of bands to include in the final raster. Defaults to ("B02", "B03", "B04", "B08")
+    out_resolution : number, optional
+        Resolution to resample every band to - units are defined by the image projection. Default is 10.
+    haze : number, optional
+        Threshold if a haze filter is to be applied. If specified, all pixel values where the first band > haze after
+        cloud masking will be masked out. Defaults to None.
+    epsg : int, optional
+        EPSG code of the map projection / CRS if the output raster shall be reprojected (warped)
+    apply_offset : bool, optional
+        If True and the product's processing baseline is 0400 or later, offsets all bands by BOA_ADD_OFFSET after
+        clipping them to the range -BOA_ADD_OFFSET to 10000. Defaults to False.
+    BOA_ADD_OFFSET : int, optional
+        The offset to apply. Defaults to -1000.
+    mem_limit_mb : number, optional
+        The maximum amount of memory, in MB, to use for each block of the image. Defaults to 1024.
+
+    Returns
+    -------
+    out_path : str
+        The path to the new image
+
+    """
+    granule_id = get_sen_2_granule_id(l2_safe_file)
+    band_paths = [
+        get_sen_2_band_path(l2_safe_file, band, out_resolution) for band in bands
+    ]
+    scl_path = get_raster_paths([l2_safe_file], filepatterns=["SCL"], dirpattern="R20m")[
+        "SCL"
+    ][0][0]
+    offset_path = _offset_output_path(out_path, apply_offset)
+    do_offset = offset_path != out_path
+    out_path = offset_path
+    n_bands = len(bands)
+    if buffer_size > 10:
+        halo = 10 * int(buffer_size / 10)
+        if halo != buffer_size:
+            log.warning("Approximating buffer size as {}".format(halo))
+    else:
+        halo = buffer_size
+    if haze is not None:
+        # the haze mask is buffered from an already buffered cloud mask
+        halo = 2 * halo
+
+    with TemporaryDirectory(dir=os.path.expanduser('~')) as temp_dir:
+        stack_path = os.path.join(temp_dir, granule_id + "_stack.vrt")
+        # the SCL layer is resampled along with the bands and read as the last band of the stack
+        stack = gdal.BuildVRT(
+            stack_path,
+            band_paths + [scl_path],
+            separate=True,
+            xRes=out_resolution,
+            yRes=out_resolution,
+            resampleAlg="nearest",
+        )
+        if epsg is not None:
+            proj = osr.SpatialReference()
+            proj.ImportFromEPSG(epsg)
+            if not proj.IsSame(osr.SpatialReference(wkt=stack.GetProjection())):
+                log.info("Reprojecting {} to EPSG code {}".format(granule_id, epsg))
+                stack = None
+                stack = gdal.Warp(
+                    os.path.join(temp_dir, granule_id + "_warped.vrt"),
+                    stack_path,
+                    format="VRT",
+                    dstSRS=proj.ExportToWkt(),
+                    xRes=out_resolution,
+                    yRes=out_resolution,
+                    resampleAlg="near",
                 )
-                with TemporaryDirectory(dir=os.path.expanduser('~')) as temp_dir:
-                    stacked_file = os.path.join(
-                        temp_dir, get_sen_2_granule_id(l2_safe_file) + "_stacked.tif"
-                    )
-                    masked_file = os.path.join(
-                        temp_dir,
-                        get_sen_2_granule_id(l2_safe_file) + "_stacked_masked.tif",
-                    )
-                    stack_sentinel_2_bands(
-                        l2_safe_file,
-                        stacked_file,
-                        bands=bands,
-                        out_resolution=out_resolution,
-                    )
-                    mask_path = get_mask_path(stacked_file)
-                    create_mask_from_scl_layer(
-                        l2_safe_file, mask_path, scl_classes, buffer_size=buffer_size
+
+        log.info("Writing cloud-masked image {}".format(out_path))
+        out_raster = gdal.GetDriverByName("GTiff").Create(
+            out_path,
+            xsize=stack.RasterXSize,
+            ysize=stack.RasterYSize,
+            bands=n_bands,
+            eType=stack.GetRasterBand(1).DataType,
+            options=get_creation_options(stack.GetRasterBand(1).DataType),
+        )
+        out_raster.SetGeoTransform(stack.GetGeoTransform())
+        out_raster.SetProjection(stack.GetProjection())
+        for band_index, band_label in enumerate(bands):
+            out_raster.GetRasterBand(band_index + 1).SetDescription(band_label)
+
+        windows = get_block_windows(
+            out_raster,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=8 * (n_bands + 2),
+        )
+        scl_band = stack.GetRasterBand(n_bands + 1)
+        for xoff, yoff, xsize, ysize in windows:
+            # masks are built over the window plus a halo so that buffering matches buffering the whole image
+            x0 = max(xoff - halo, 0)
+            y0 = max(yoff - halo, 0)
+            x1 = min(xoff + xsize + halo, stack.RasterXSize)
+            y1 = min(yoff + ysize + halo, stack.RasterYSize)
+            scl_array = scl_band.ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+            mask_array = np.logical_not(np.isin(scl_array, scl_classes))
+            if buffer_size:
+                mask_array = buffer_mask_array(mask_array, buffer_size)
+            if haze is not None:
+                blue_array = stack.GetRasterBand(1).ReadAsArray(
+                    x0, y0, x1 - x0, y1 - y0
+                )
+                haze_mask_array = np.less(np.where(mask_array, blue_array, 0), haze)
+                if buffer_size:
+                    haze_mask_array = buffer_mask_array(haze_mask_array, buffer_size)
+                mask_array &= haze_mask_array
+            mask_array = mask_array[
+                yoff - y0 : yoff - y0 + ysize, xoff - x0 : xoff - x0 + xsize
+            ]
+            for band_index in range(n_bands):
+                band_array = stack.GetRasterBand(band_index + 1).ReadAsArray(
+                    xoff, yoff, xsize, ysize
+                )
+                band_array[~mask_array] = 0
+                if do_offset:
+                    band_array = np.clip(band_array, -BOA_ADD_OFFSET, 10000) - (
+                        -BOA_ADD_OFFSET
                     )
-                    apply_mask_to_image(mask_path, stacked_file, masked_file)
-                    if haze is not None:
-                        log.info(
-                            "Applying haze mask to pixels where B02 > {}. Assumes B02 is band 1 in the stacked image.".format(
-                                haze
-                            )
-                        )
-                        haze_masked_file = os.path.join(
-                            temp_dir,
-                            get_sen_2_granule_id(l2_safe_file)
-                            + "_stacked_masked_haze.tif",
-                        )
-                        haze_mask_path = get_mask_path(haze_masked_file)
-                        create_mask_from_band(
-                            masked_file,
-                            haze_mask_path,
-                            band=1,
-                            threshold=haze,
-                            relation="smaller",
-                            buffer_size=buffer_size,
-                        )
-                        apply_mask_to_image(
-                            haze_mask_path, masked_file, haze_masked_file
-                        )
-                        shutil.move(haze_masked_file, masked_file)
-                    resample_image_in_place(masked_file, out_resolution)
-                    if epsg is not None:
-                        log.info(
-                            "Reprojecting stacked and masked image to EPSG code {}".format(
-                                epsg
-                            )
-                        )
-                        # log.info(f"GDAL_DATA: {os.environ['GDAL_DATA']}")
-                        # log.info(f"PROJ_LIB: {os.environ['PROJ_LIB']}")
-                        # os.environ['GDAL_DATA'] = r'C:\Users\ir81\.conda\envs\pyeo_env_pcwe\Library\share\gdal'
-                        # os.environ['PROJ_LIB'] = r'C:\Users\ir81\.conda\envs\pyeo_env_pcwe\Library\share\proj'
-                        # log.info(f"GDAL_DATA: {os.environ['GDAL_DATA']}")
-                        # log.info(f"PROJ_LIB: {os.environ['PROJ_LIB']}")
-                        
-                        proj = osr.SpatialReference()
-                        proj.ImportFromEPSG(epsg)
-                        wkt = proj.ExportToWkt()
-                        log.info(f'epsg: {epsg}, wkt: {wkt}')
-
-                        reproject_image(masked_file, out_path, wkt)
-                    else:
-                        shutil.move(masked_file, out_path)
-    return
+                out_raster.GetRasterBand(band_index + 1).WriteArray(
+                    band_array, xoff, yoff
+                )
+        out_raster = None
+        stack = None
+    return out_path
 
 
 # Added I.R. 20220607 START
@@ -3267,6 +3888,7 @@ def preprocess_landsat_images(
         ysize=first_ls_array.shape[0],
         bands=n_bands,
         eType=first_ls_raster.GetRasterBand(1).DataType,
+        options=get_creation_options(first_ls_raster.GetRasterBand(1).DataType),
     )
     out_image.SetGeoTransform(first_ls_raster.GetGeoTransform())
     out_image.SetProjection(first_ls_raster.GetProjection())
@@ -3306,7 +3928,7 @@ def stack_sentinel_2_bands(
     Parameters
     ----------
     safe_dir : str
-        Path to the .SAFE file to stack
+        Path to the .SAFE file to stack. If it has been zipped, the bands are read from inside the archive.
     out_image_path : str
         Location of the new image
     bands : list of str, optional
@@ -3333,9 +3955,15 @@ def stack_sentinel_2_bands(
         new_band_paths = []
         for band_path in band_paths:
             if get_image_resolution(band_path) != out_resolution:
-                resample_path = os.path.join(resample_dir, os.path.basename(band_path))
-                shutil.copy(band_path, resample_path)
-                resample_image_in_place(resample_path, out_resolution)
+                # resampled straight from the band, which may be a /vsizip/ path inside an archived product
+                resample_path = os.path.join(
+                    resample_dir, os.path.splitext(os.path.basename(band_path))[0] + ".tif"
+                )
+                gdal.Warp(
+                    resample_path,
+                    band_path,
+                    options=gdal.WarpOptions(xRes=out_resolution, yRes=out_resolution),
+                )
                 new_band_paths.append(resample_path)
             else:
                 new_band_paths.append(band_path)
@@ -3428,7 +4056,8 @@ def get_sen_2_band_path(safe_dir, band, resolution=None):
     Parameters
     ----------
     safe_dir : str
-        Path to the directory containing the raster
+        Path to the directory containing the raster. If the .SAFE product has been zipped, a /vsizip/ path into the
+        archive is returned.
     band : str
         The band identifier ('B01', 'B02', ect)
     resolution : int, optional
@@ -3609,6 +4238,8 @@ def apply_sen2cor(
     sen2cor_path,
     delete_unprocessed_image=False,
     log=logging.getLogger(__name__),
+    sen2cor_home=None,
+    max_retries=0,
 ):
     """
     Applies sen2cor to the SAFE file at image_path. Returns the path to the new product.
@@ -3621,6 +4252,12 @@ def apply_sen2cor(
         Path to the l2a_process script (Linux) or l2a_process.exe (Windows)
     delete_unprocessed_image : bool, optional
         If True, delete the unprocessed image after processing is done. Defaults to False.
+    sen2cor_home : str, optional
+        If present, runs sen2cor with SEN2COR_HOME set to this directory, so that concurrent runs do not share
+        configuration and log files. Defaults to the SEN2COR_HOME of this process.
+    max_retries : int, optional
+        The number of times to rerun sen2cor on an image after it reports a CRITICAL error or exits
+        abnormally. Defaults to 0.
 
     Returns
     -------
@@ -3629,52 +4266,71 @@ def apply_sen2cor(
 
     """
     # Here be OS magic. Since sen2cor runs in its own process, Python has to spin around and wait
-    # for it; since it's doing that, it may as well be logging the output from sen2cor. This
-    # approach can be multithreaded in future to process multiple image (1 per core) but that
-    # will take some work to make sure they all finish before the program moves on.
+    # for it; since it's doing that, it may as well be logging the output from sen2cor. Several
+    # of these can run at once from the threads of a Sen2CorPool.
     # added sen2cor_path by hb91
     # gipp_path = os.path.join(os.path.dirname(__file__), "L2A_GIPP.xml")
     # out_dir = os.path.dirname(image_path)
-    now_time = (
-        datetime.datetime.now()
-    )  # I can't think of a better way of getting the new outpath from sen2cor
-    timestamp = now_time.strftime(r"%Y%m%dT%H%M%S")
     version = get_sen2cor_version(sen2cor_path)
-    out_path = build_sen2cor_output_path(image_path, timestamp, version)
-    # The application of sen2cor below with the option --GIP_L2A caused an unspecified metadata error in the xml file.
-    # Removing it resolves this problem.
-
-    # I.R. 20220509
-    log.info("Calling sen2cor:")
-    log.info(sen2cor_path + " " + image_path + " --output_dir " + out_path)
-    sen2cor_proc = subprocess.Popen(
-        [sen2cor_path, image_path, "--output_dir", out_path],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-    )
-
-    # log.info("#I.R. 20220509 Removed explicit setting of --output_dir: calling sen2cor:")
-    # log.info(sen2cor_path + " " + image_path)
-    # sen2cor_proc = subprocess.Popen([sen2cor_path, image_path],
-    # stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-    # universal_newlines=True)
-
-    # log.info(sen2cor_path + " " + image_path + " --output_dir " + os.path.dirname(image_path) + " --GIP_L2A " + gipp_path)
-    # sen2cor_proc = subprocess.Popen([sen2cor_path, image_path, '--output_dir', os.path.dirname(image_path),
-    #                                 '--GIP_L2A', gipp_path],
-    #                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-    #                                universal_newlines=True)
+    env = os.environ.copy()
+    if sen2cor_home:
+        env["SEN2COR_HOME"] = sen2cor_home
+    image_name = os.path.basename(image_path.rstrip(os.sep))
+    for attempt in range(max_retries + 1):
+        now_time = (
+            datetime.datetime.now()
+        )  # I can't think of a better way of getting the new outpath from sen2cor
+        timestamp = now_time.strftime(r"%Y%m%dT%H%M%S")
+        out_path = build_sen2cor_output_path(image_path, timestamp, version)
+        # The application of sen2cor below with the option --GIP_L2A caused an unspecified metadata error in the xml file.
+        # Removing it resolves this problem.
+
+        # I.R. 20220509
+        log.info("Calling sen2cor:")
+        log.info(sen2cor_path + " " + image_path + " --output_dir " + out_path)
+        # stderr is merged into stdout so that a full stderr pipe cannot stall sen2cor
+        sen2cor_proc = subprocess.Popen(
+            [sen2cor_path, image_path, "--output_dir", out_path],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            universal_newlines=True,
+            env=env,
+        )
 
-    while True:
-        nextline = sen2cor_proc.stdout.readline()
-        if len(nextline) > 0:
-            log.info(nextline)
-        if nextline == "" and sen2cor_proc.poll() is not None:
-            break    
-        if "CRITICAL" in nextline:
-            # log.error(nextline)
-            raise subprocess.CalledProcessError(-1, "L2A_Process")
+        # log.info("#I.R. 20220509 Removed explicit setting of --output_dir: calling sen2cor:")
+        # log.info(sen2cor_path + " " + image_path)
+        # sen2cor_proc = subprocess.Popen([sen2cor_path, image_path],
+        # stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        # universal_newlines=True)
+
+        # log.info(sen2cor_path + " " + image_path + " --output_dir " + os.path.dirname(image_path) + " --GIP_L2A " + gipp_path)
+        # sen2cor_proc = subprocess.Popen([sen2cor_path, image_path, '--output_dir', os.path.dirname(image_path),
+        #                                 '--GIP_L2A', gipp_path],
+        #                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        #                                universal_newlines=True)
+
+        failed = False
+        for nextline in sen2cor_proc.stdout:
+            # lines are tagged with the image, as several sen2cor runs may share the log
+            log.info("{}: {}".format(image_name, nextline.rstrip()))
+            if "CRITICAL" in nextline:
+                failed = True
+                sen2cor_proc.kill()
+                break
+        sen2cor_proc.stdout.close()
+        sen2cor_proc.wait()
+        # a run that was killed, e.g. for running out of memory, is retried like one that reported an error
+        if not failed and sen2cor_proc.returncode == 0:
+            break
+        if os.path.exists(out_path):
+            shutil.rmtree(out_path, ignore_errors=True)
+        if attempt == max_retries:
+            raise subprocess.CalledProcessError(sen2cor_proc.returncode, "L2A_Process")
+        log.warning(
+            "sen2cor failed for {} with exit code {}; retrying ({} of {})".format(
+                image_path, sen2cor_proc.returncode, attempt + 1, max_retries
+            )
+        )
 
     log.info("sen2cor processing finished for {}".format(image_path))
     log.info("Checking for presence of band raster files in {}".format(out_path))
@@ -3724,6 +4380,10 @@ def build_sen2cor_output_path(image_path, timestamp, version):
     return out_path
 
 
+# The version of each sen2cor executable, so that it is only asked for once per process
+_sen2cor_versions = {}
+
+
 def get_sen2cor_version(sen2cor_path):
     """
     Gets the version number of sen2cor from the help string.
@@ -3740,6 +4400,9 @@ def get_sen2cor_version(sen2cor_path):
 
     """
 
+    if sen2cor_path in _sen2cor_versions:
+        return _sen2cor_versions[sen2cor_path]
+
     proc = subprocess.run([sen2cor_path, "--help"], stdout=subprocess.PIPE)
 
     help_string = proc.stdout.decode("utf-8")
@@ -3748,25 +4411,223 @@ def get_sen2cor_version(sen2cor_path):
     # Returns the three character string as group 1.
     version_regex = r"Version: (\d+.\d+.\d+)"
     match = re.search(version_regex, help_string)
-    if match:
-        return match.group(1)
-    else:
+    if not match:
         version_regex = r"Sen2Cor (\d+.\d+.\d+)"
         match = re.search(version_regex, help_string)
-        if match:
-            return match.group(1)
-        else:
+        if not match:
             raise FileNotFoundError(
                 "Version information not found; please check your sen2cor path."
             )
+    _sen2cor_versions[sen2cor_path] = match.group(1)
+    return match.group(1)
 
 
-def atmospheric_correction(
-    in_directory,
+def _atmospherically_correct_image(
+    image_path,
     out_directory,
     sen2cor_path,
     delete_unprocessed_image=False,
     log=logging.getLogger(__name__),
+    sen2cor_home=None,
+    max_retries=0,
+):
+    """
+    Runs sen2cor on one L1C image and moves the result to out_directory, unless a product for it is already there.
+    Returns the path to the L2A image in out_directory, or None if correction failed.
+    """
+    image = os.path.basename(image_path.rstrip(os.sep))
+    log.info("   image path = " + image_path)
+    # update the product discriminator part of the output file name
+    # see https://sentinels.copernicus.eu/web/sentinel/user-guides/sentinel-2-msi/naming-convention
+    image_timestamp = datetime.datetime.now().strftime(r"%Y%m%dT%H%M%S")
+    log.info("   out_directory = " + out_directory)
+    out_name = build_sen2cor_output_path(image, image_timestamp, get_sen2cor_version(sen2cor_path))
+    log.info("   out name = " + out_name)
+    out_path = os.path.join(out_directory, os.path.basename(out_name))
+    log.info("   out path = " + out_path)
+    out_glob = out_path.rpartition("_")[0] + "*"
+    log.info("   out glob = " + out_glob)
+    existing_paths = glob.glob(out_glob)
+    if existing_paths:
+        log.info("Skipping atmospheric correction of {}. Already done.".format(image))
+        return existing_paths[0]
+    log.info("Atmospheric correction of {}".format(image))
+    try:
+        l2_path = apply_sen2cor(
+            image_path,
+            sen2cor_path,
+            delete_unprocessed_image=delete_unprocessed_image,
+            log=log,
+            sen2cor_home=sen2cor_home,
+            max_retries=max_retries,
+        )
+    except (subprocess.CalledProcessError, BadS2Exception):
+        log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
+        return None
+    l2_name = os.path.basename(l2_path)
+    log.info("Changing L2A path: {}".format(l2_path))
+    log.info("  to new L2A path: {}".format(os.path.join(out_directory, l2_name)))
+    if not os.path.exists(l2_path):
+        log.error("L2A path not found after atmospheric correction with Sen2Cor: {}".format(l2_path))
+        return None
+    os.rename(l2_path, os.path.join(out_directory, l2_name))
+    return os.path.join(out_directory, l2_name)
+
+
+class Sen2CorPool:
+    """
+    Runs sen2cor on up to n_workers L1C images at once, each worker in its own thread driving its own sen2cor process.
+
+    Images are queued with :py:meth:`submit`, which blocks while the queue is full; a downloader that submits each
+    product as it arrives is therefore held back to the pace of atmospheric correction while both run at once.
+    Each worker runs sen2cor with SEN2COR_HOME set to its own subdirectory of sen2cor_home, so that concurrent runs
+    do not share configuration and log files. Sen2cor output from every worker goes to log, tagged with the image.
+
+    Parameters
+    ----------
+    out_directory : str
+        Path to the directory that will contain the new L2A images
+    sen2cor_path : str
+        Path to the l2a_process script (Linux) or l2a_process.exe (Windows)
+    n_workers : int, optional
+        The number of sen2cor processes to run at once. Defaults to 1.
+    max_queue_size : int, optional
+        The number of images that can wait for a worker before :py:meth:`submit` blocks. Defaults to n_workers.
+    max_retries : int, optional
+        The number of times to rerun sen2cor on an image after it reports a CRITICAL error or exits
+        abnormally. Defaults to 1.
+    delete_unprocessed_image : bool, optional
+        If True, delete each L1C image after processing is done. Defaults to False.
+    sen2cor_home : str, optional
+        The directory to hold the SEN2COR_HOME of each worker. Defaults to the SEN2COR_HOME of this process, or
+        ~/sen2cor. With a single worker and no sen2cor_home, sen2cor uses the SEN2COR_HOME of this process.
+    log : optional
+        if a logger object is provided, the pool will pass statements to that logger, otherwise the default namespace
+        logger is used.
+
+    Examples
+    --------
+    >>> with Sen2CorPool(l2_dir, sen2cor_path, n_workers=8) as pool:
+    ...     for image_path in l1_image_paths:
+    ...         pool.submit(image_path)
+    >>> pool.results
+    {'.../S2A_MSIL1C_...SAFE': '.../S2A_MSIL2A_...SAFE', ...}
+
+    """
+
+    def __init__(
+        self,
+        out_directory,
+        sen2cor_path,
+        n_workers=1,
+        max_queue_size=None,
+        max_retries=1,
+        delete_unprocessed_image=False,
+        sen2cor_home=None,
+        log=logging.getLogger(__name__),
+    ):
+        self.out_directory = out_directory
+        self.sen2cor_path = sen2cor_path
+        self.max_retries = max_retries
+        self.delete_unprocessed_image = delete_unprocessed_image
+        self.log = log
+        self.results = {}
+        self._submitted = set()
+        self._lock = threading.Lock()
+        n_workers = max(n_workers, 1)
+        self._queue = queue.Queue(maxsize=max_queue_size or n_workers)
+        worker_homes = self._make_worker_homes(n_workers, sen2cor_home)
+        self._workers = [
+            threading.Thread(target=self._work, args=(worker_home,), daemon=True)
+            for worker_home in worker_homes
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _make_worker_homes(self, n_workers, sen2cor_home):
+        if n_workers == 1 and not sen2cor_home:
+            return [None]
+        if not sen2cor_home:
+            sen2cor_home = os.environ.get(
+                "SEN2COR_HOME", os.path.join(os.path.expanduser("~"), "sen2cor")
+            )
+        worker_homes = []
+        for worker_index in range(n_workers):
+            worker_home = os.path.join(sen2cor_home, "worker_{}".format(worker_index))
+            os.makedirs(worker_home, exist_ok=True)
+            # start each worker from the shared configuration, if there is one
+            shared_cfg = os.path.join(sen2cor_home, "cfg")
+            worker_cfg = os.path.join(worker_home, "cfg")
+            if os.path.isdir(shared_cfg) and not os.path.exists(worker_cfg):
+                shutil.copytree(shared_cfg, worker_cfg)
+            worker_homes.append(worker_home)
+        self.log.info(
+            "Running {} sen2cor workers with SEN2COR_HOME in {}".format(
+                n_workers, sen2cor_home
+            )
+        )
+        return worker_homes
+
+    def _work(self, worker_home):
+        while True:
+            image_path = self._queue.get()
+            try:
+                if image_path is None:
+                    return
+                l2_path = _atmospherically_correct_image(
+                    image_path,
+                    self.out_directory,
+                    self.sen2cor_path,
+                    delete_unprocessed_image=self.delete_unprocessed_image,
+                    log=self.log,
+                    sen2cor_home=worker_home,
+                    max_retries=self.max_retries,
+                )
+                with self._lock:
+                    self.results[image_path] = l2_path
+            except Exception as error:
+                self.log.error("Atmospheric correction of {} raised {}".format(image_path, error))
+                with self._lock:
+                    self.results[image_path] = None
+            finally:
+                self._queue.task_done()
+
+    def submit(self, image_path):
+        """Queues an L1C image for atmospheric correction, blocking while the queue is full. Repeats are ignored."""
+        # the same product may arrive from a downloader and from a directory listing, with or without .SAFE
+        image_key = os.path.normpath(image_path)
+        if image_key.endswith(".SAFE"):
+            image_key = image_key[: -len(".SAFE")]
+        with self._lock:
+            if image_key in self._submitted:
+                return
+            self._submitted.add(image_key)
+        self._queue.put(image_path)
+
+    def join(self):
+        """Waits for every queued image to be corrected and stops the workers. Returns the results."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        return self.results
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.join()
+
+
+def atmospheric_correction(
+    in_directory,
+    out_directory,
+    sen2cor_path,
+    delete_unprocessed_image=False,
+    log=logging.getLogger(__name__),
+    n_workers=1,
+    max_retries=1,
+    sen2cor_home=None,
 ):
     """
     Applies Sen2cor atmospheric correction to each L1C image in in_directory
@@ -3783,51 +4644,57 @@ def atmospheric_correction(
         If True, delete the unprocessed image after processing is done. Defaults to False.
     log : optional
         if a logger object is provided, `atmospheric_correction` will pass statements to that logger, otherwise the default namespace logger is used.
+    n_workers : int, optional
+        The number of images to correct at once. See :py:class:`Sen2CorPool`. Defaults to 1.
+    max_retries : int, optional
+        The number of times to rerun sen2cor on an image after it reports a CRITICAL error or exits
+        abnormally. Defaults to 1.
+    sen2cor_home : str, optional
+        The directory to hold the SEN2COR_HOME of each worker. See :py:class:`Sen2CorPool`.
+
+    Returns
+    -------
+    results : dict
+        The path to the L2A image made from each L1C image path, or None where correction failed.
     """
 
-    # log = logging.getLogger(__name__)
     images = [
         image for image in os.listdir(in_directory) if image.startswith("MSIL1C", 4)
     ]
-    # Opportunity for multithreading here
-    for image in images:
-        # log.info("Atmospheric correction of {}".format(image))
-        # log.info("   sen2cor path = " + sen2cor_path)
-        image_path = os.path.join(in_directory, image)
-        log.info("   image path = " + image_path)
-        # update the product discriminator part of the output file name
-        # see https://sentinels.copernicus.eu/web/sentinel/user-guides/sentinel-2-msi/naming-convention
-        image_timestamp = datetime.datetime.now().strftime(r"%Y%m%dT%H%M%S")
-        # log.info("   sen2cor processing time stamp = " + image_timestamp)
-        log.info("   out_directory = " + out_directory)
-        out_name = build_sen2cor_output_path(image, image_timestamp, get_sen2cor_version(sen2cor_path))
-        log.info("   out name = " + out_name)
-        out_path = os.path.join(out_directory, os.path.basename(out_name))
-        log.info("   out path = " + out_path)
-        out_glob = out_path.rpartition("_")[0] + "*"
-        log.info("   out glob = " + out_glob)
-        if glob.glob(out_glob):
-            log.info("Skipping atmospheric correction of {}. Already done.".format(image))
-            continue
-        else:
-            log.info("Atmospheric correction of {}".format(image))
-            try:
-                l2_path = apply_sen2cor(
-                    image_path,
-                    sen2cor_path,
-                    delete_unprocessed_image=delete_unprocessed_image,
-                    log=log,
-                )
-                l2_name = os.path.basename(l2_path)
-                log.info("Changing L2A path: {}".format(l2_path))
-                log.info("  to new L2A path: {}".format(os.path.join(out_directory, l2_name)))
-                if os.path.exists(l2_path):
-                    os.rename(l2_path, os.path.join(out_directory, l2_name))
-                else:
-                    log.error("L2A path not found after atmospheric correction with Sen2Cor: {}".format(l2_path))
-            except (subprocess.CalledProcessError, BadS2Exception):
-                log.error("Atmospheric correction failed for {}. Moving on to next image.".format(image))
-    return
+    with Sen2CorPool(
+        out_directory,
+        sen2cor_path,
+        n_workers=n_workers,
+        max_retries=max_retries,
+        delete_unprocessed_image=delete_unprocessed_image,
+        sen2cor_home=sen2cor_home,
+        log=log,
+    ) as pool:
+        for image in images:
+            pool.submit(os.path.join(in_directory, image))
+    return pool.results
+
+
+def _write_mask_by_window(in_image, out_path, mask_func, datatype=None, mem_limit_mb=1024):
+    """
+    :meta private:
+    Creates a single-band raster matching in_image at out_path and fills it one block window at a time with
+    mask_func applied to the same window of the first band of in_image.
+    """
+    mask_image = create_matching_dataset(in_image, out_path, datatype=datatype)
+    in_band = in_image.GetRasterBand(1)
+    out_band = mask_image.GetRasterBand(1)
+    out_dtype = GDALTypeCodeToNumericTypeCode(out_band.DataType)
+    windows = get_block_windows(
+        in_image, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=24
+    )
+    for xoff, yoff, xs, ys in windows:
+        mask_block = mask_func(in_band.ReadAsArray(xoff, yoff, xs, ys))
+        out_band.WriteArray(mask_block.astype(out_dtype), xoff, yoff)
+    out_band = None
+    in_band = None
+    build_overviews(mask_image)
+    mask_image = None
 
 
 def create_mask_from_model(
@@ -3866,16 +4733,15 @@ def create_mask_from_model(
         )
         temp_mask_path = os.path.join(td, "cat_mask.tif")
         classify_image(image_path, model_path, temp_mask_path, num_chunks=num_chunks)
-        temp_mask = gdal.Open(temp_mask_path, gdal.GA_Update)
-        temp_mask_array = temp_mask.GetVirtualMemArray()
+        temp_mask = gdal.Open(temp_mask_path)
         mask_path = get_mask_path(image_path)
-        mask = create_matching_dataset(temp_mask, mask_path, datatype=gdal.GDT_Byte)
-        mask_array = mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-        mask_array[:, :] = np.where(temp_mask_array != model_clear, 0, 1)
-        temp_mask_array = None
-        mask_array = None
+        _write_mask_by_window(
+            temp_mask,
+            mask_path,
+            lambda class_block: class_block == model_clear,
+            datatype=gdal.GDT_Byte,
+        )
         temp_mask = None
-        mask = None
         if buffer_size:
             buffer_mask_in_place(mask_path, buffer_size)
         log.info("Cloud mask for {} saved in {}".format(image_path, mask_path))
@@ -3892,7 +4758,7 @@ def create_mask_from_confidence_layer(
     Parameters
     ----------
     l2_safe_path : str
-        Path to the L1
+        Path to the L2A .SAFE product, which may have been zipped
     out_path : str
         Path to the new path
     cloud_conf_threshold : int, optional
@@ -3923,9 +4789,10 @@ def create_mask_from_confidence_layer(
         # cloud_glob = "GRANULE/*/QI_DATA/*CLD*_20m.jp2"  # This should match both old and new mask formats
         # cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
         cloud_image = gdal.Open(cloud_path)
-        cloud_confidence_array = cloud_image.GetVirtualMemArray()
-        mask_array = cloud_confidence_array < cloud_conf_threshold
-        cloud_confidence_array = None
+
+        def mask_func(cloud_confidence_block):
+            return cloud_confidence_block < cloud_conf_threshold
+
     else:
         cloud_paths = get_filenames(l2_safe_path, "_SCL_20m.jp2", "R20m")
         if not cloud_paths:
@@ -3938,15 +4805,12 @@ def create_mask_from_confidence_layer(
         # cloud_glob = "GRANULE/*/IMG_DATA/R20m/*SCL*_20m.jp2"  # This should match both old and new mask formats
         # cloud_path = glob.glob(os.path.join(l2_safe_path, cloud_glob))[0]
         cloud_image = gdal.Open(cloud_path)
-        scl_array = cloud_image.GetVirtualMemArray()
-        mask_array = np.isin(scl_array, (4, 5, 6))
 
-    mask_image = create_matching_dataset(cloud_image, out_path)
-    mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    np.copyto(mask_image_array, mask_array)
-    mask_image_array = None
+        def mask_func(scl_block):
+            return np.isin(scl_block, (4, 5, 6))
+
+    _write_mask_by_window(cloud_image, out_path, mask_func)
     cloud_image = None
-    mask_image = None
     resample_image_in_place(out_path, 10)
     if buffer_size:
         buffer_mask_in_place(out_path, buffer_size)
@@ -4007,14 +4871,12 @@ def create_mask_from_scl_layer(l2_safe_path, out_path, scl_classes, buffer_size=
     # scl_path = glob.glob(os.path.join(l2_safe_path, scl_glob))[0]
     log.info("  Opening SCL image: {}".format(scl_path))
     scl_image = gdal.Open(scl_path)
-    scl_array = scl_image.GetVirtualMemArray()
-    mask_array = np.logical_not(np.isin(scl_array, (scl_classes)))
-    mask_image = create_matching_dataset(scl_image, out_path)
-    mask_image_array = mask_image.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    np.copyto(mask_image_array, mask_array)
-    mask_image_array = None
+    _write_mask_by_window(
+        scl_image,
+        out_path,
+        lambda scl_block: np.logical_not(np.isin(scl_block, (scl_classes))),
+    )
     scl_image = None
-    mask_image = None
     resample_image_in_place(out_path, 10)
     if buffer_size:
         buffer_mask_in_place(out_path, buffer_size)
@@ -4133,7 +4995,7 @@ def create_mask_from_band(
     return out_path
 
 
-def add_masks(mask_paths, out_path, geometry_func="union"):
+def add_masks(mask_paths, out_path, geometry_func="union", mem_limit_mb=1024):
     """
     Creates a raster file by adding a list of mask files containing 0 and 1 values
 
@@ -4143,6 +5005,8 @@ def add_masks(mask_paths, out_path, geometry_func="union"):
         List of strings containing the full directory paths and file names of all masks to be added
     geometry_func : {'intersect' or 'union'}
         How to handle non-overlapping masks. Defaults to 'union'
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     Returns
     -------
@@ -4168,6 +5032,8 @@ def add_masks(mask_paths, out_path, geometry_func="union"):
     y_res = gt[5] * -1  # Y res is -ve in geotransform
     bands = 1
     projection = masks[0].GetProjection()
+    if geometry_func not in ("intersect", "union"):
+        raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
     out_raster = create_new_image_from_polygon(
         combined_polygon,
         out_path,
@@ -4177,42 +5043,290 @@ def add_masks(mask_paths, out_path, geometry_func="union"):
         projection,
         datatype=gdal.GDT_Byte,
     )
-    out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write).squeeze()
-    out_array[:, :] = 1
-    for mask_index, in_mask in enumerate(masks):
-        in_mask_array = in_mask.GetVirtualMemArray().squeeze()
-        if geometry_func == "intersect":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-                out_raster, combined_polygon
-            )
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-                in_mask, combined_polygon
-            )
-        elif geometry_func == "union":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-                out_raster, get_raster_bounds(in_mask)
-            )
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-                in_mask, get_raster_bounds(in_mask)
-            )
-        else:
-            raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
-        out_view = out_array[out_y_min:out_y_max, out_x_min:out_x_max]
-        in_mask_view = in_mask_array[in_y_min:in_y_max, in_x_min:in_x_max]
-        if mask_index == 0:
-            out_view[:, :] = in_mask_view
-        else:
-            out_view[:, :] = np.add(out_view, in_mask_view, dtype=np.uint8)
-        in_mask_view = None
-        out_view = None
-        in_mask_array = None
-    out_array = None
+    out_band = out_raster.GetRasterBand(1)
+    # each mask covers its own extent; within an intersection that is the whole output
+    offsets = [_pixel_offset_in(in_mask, out_raster) for in_mask in masks]
+    windows = get_block_windows(
+        out_raster, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=3
+    )
+    for window in windows:
+        xoff, yoff, xs, ys = window
+        out_block = np.ones((ys, xs), dtype=np.uint8)
+        for mask_index, in_mask in enumerate(masks):
+            overlap = _window_overlap(window, offsets[mask_index], in_mask)
+            if not overlap:
+                continue
+            read_x, read_y, block_x, block_y, w, h = overlap
+            in_mask_block = in_mask.GetRasterBand(1).ReadAsArray(read_x, read_y, w, h)
+            out_view = out_block[block_y : block_y + h, block_x : block_x + w]
+            if mask_index == 0:
+                out_view[:, :] = in_mask_block
+            else:
+                out_view[:, :] = np.add(out_view, in_mask_block, dtype=np.uint8)
+        out_band.WriteArray(out_block, xoff, yoff)
+    out_band = None
+    build_overviews(out_raster)
     out_raster = None
     for mask in masks:
         mask = None
     return out_path
 
 
+def get_change_report_manifest_path(report_path):
+    """
+    Returns the path of the manifest that records which class images have been folded into a change report, i.e.
+    report_path with its extension replaced by _manifest.json.
+
+    Parameters
+    ----------
+    report_path : str
+        The path to the report raster
+
+    Returns
+    -------
+    manifest_path : str
+        The path to the manifest
+
+    """
+    return os.path.splitext(report_path)[0] + "_manifest.json"
+
+
+def save_change_report_manifest(report_path, report_settings, class_image_paths):
+    """
+    Writes the manifest of a change report produced by :py:func:`__change_from_class_maps`. The report layers that
+    hold counts and first-change dates are the accumulator state of the report; the manifest records the settings
+    they were built with and every class image folded into them, so that later runs can add only new images.
+
+    Parameters
+    ----------
+    report_path : str
+        The path to the report raster
+    report_settings : dict
+        The settings the report was built with, e.g. the baseline class composite, change_from and change_to classes
+        and the dNDVI threshold. Must be serialisable to json.
+    class_image_paths : list of str
+        The class images whose change layers have been folded into the report
+
+    Returns
+    -------
+    manifest_path : str
+        The path to the manifest
+
+    """
+    manifest_path = get_change_report_manifest_path(report_path)
+    manifest = {
+        "settings": report_settings,
+        "class_images": sorted(
+            set(os.path.basename(path) for path in class_image_paths),
+            key=get_image_acquisition_time,
+        ),
+    }
+    # written to a temporary file first so that an interrupted run never leaves a truncated manifest behind
+    temp_manifest_path = manifest_path + ".tmp"
+    with open(temp_manifest_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    os.replace(temp_manifest_path, manifest_path)
+    return manifest_path
+
+
+def get_change_report_increment(report_path, class_image_paths, report_settings):
+    """
+    Decides whether an existing change report can be extended incrementally and, if so, which class images still need
+    to be folded into it.
+
+    Some report layers only count observations made after the first detected change, so the report can only be
+    extended with images acquired after every image it already contains. If the manifest is missing, the settings
+    differ, or a new image predates the latest folded image, the report has to be rebuilt.
+
+    Parameters
+    ----------
+    report_path : str
+        The path to the existing report raster
+    class_image_paths : list of str
+        All class images that the report should contain
+    report_settings : dict
+        The settings the report should be built with. See :py:func:`save_change_report_manifest`.
+
+    Returns
+    -------
+    new_class_image_paths : list of str or None
+        The class images, sorted by acquisition time, that are not yet in the report, or None if the report must be
+        rebuilt from scratch.
+
+    """
+    manifest_path = get_change_report_manifest_path(report_path)
+    if not os.path.exists(report_path) or not os.path.exists(manifest_path):
+        log.info("No manifest found for report {}".format(report_path))
+        return None
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError) as e:
+        log.warning("Could not read report manifest {}: {}".format(manifest_path, e))
+        return None
+    if manifest.get("settings") != json.loads(json.dumps(report_settings)):
+        log.info("Report settings have changed since {} was built.".format(report_path))
+        return None
+    # class images that have been folded in may since have been deleted; their contribution is kept in the report
+    folded_names = set(manifest.get("class_images", []))
+    new_class_image_paths = sorted(
+        [
+            path
+            for path in class_image_paths
+            if os.path.basename(path) not in folded_names
+        ],
+        key=lambda path: get_image_acquisition_time(os.path.basename(path)),
+    )
+    if len(folded_names) > 0 and len(new_class_image_paths) > 0:
+        latest_folded = max(get_image_acquisition_time(name) for name in folded_names)
+        earliest_new = get_image_acquisition_time(
+            os.path.basename(new_class_image_paths[0])
+        )
+        if earliest_new <= latest_folded:
+            log.info(
+                "New class image {} predates the latest image in the report.".format(
+                    new_class_image_paths[0]
+                )
+            )
+            return None
+    return new_class_image_paths
+
+
+# Decision thresholds used to build the change report layers in :py:func:`update_change_report_layers`.
+# Override them by passing a dict with any of these keys as report_thresholds to :py:func:`__change_from_class_maps`.
+DEFAULT_CHANGE_REPORT_THRESHOLDS = {
+    # Absolute number of valid detections for classifier opinion to be accepted.
+    "minimum_required_validated_detections_threshold": 5,
+    # Absolute number of dNDVI change detections for classifier opinion to be accepted.
+    "minimum_required_dNDVI_detections_threshold": 5,
+    # Absolute number of classifier-only detections for opinion to be accepted
+    "minimum_required_classifier_detections_threshold": 5,
+    "percentage_probability_threshold": 50,
+    "minimum_required_FROM_detections_threshold": 2,
+    "minimum_required_TO_detections_threshold": 2,
+}
+
+
+def update_change_report_layers(
+    report_array,
+    change_array,
+    dNDVI_array,
+    new_class_array,
+    change_from,
+    change_to,
+    dNDVI_threshold,
+    dNDVI_scale_factor=100,
+    report_thresholds=None,
+):
+    """
+    Updates all 18 layers of a change report in place with one change layer. Works on any window of the report, so
+    that :py:func:`__change_from_class_maps` can stream the report block by block.
+
+    The layers are:
+
+    0. Total Image Count
+    1. Occluded Image Count (cloud or out-of-orbit)
+    2. Classifier Change Detection Count
+    3. First-Change date of a combined classifier and dNDVI validated change detection
+    4. Combined Classifier+dNDVI Validated Change Detection Count
+    5. Combined Classifier+dNDVI Validated No Change Detection Count
+    6. Cloud Occlusion Count after the first change
+    7. Valid Image Count since the first change
+    8. Change Detection Repeatability in percent of valid images
+    9. Binary time-series decision on layers 8 and 4
+    10. First-change date masked by layer 9
+    11. dNDVI Only Change Detection Count
+    12. Binary time-series decision on dNDVI only
+    13. Binary time-series decision on the classifier only
+    14. Binary time-series decision on classifier AND dNDVI
+    15. FROM Classification Count
+    16. TO Classification Count
+    17. Binary decision on FROM and TO Classification Counts
+
+    Layers 0-6, 11, 15 and 16 accumulate over calls; the others are recomputed from them on each call.
+
+    Parameters
+    ----------
+    report_array : array_like
+        Int16 array of shape (18, y, x) holding the report window. Updated in place.
+    change_array : array_like
+        The change layer window, of shape (y, x). See :py:func:`__change_from_class_maps`.
+    dNDVI_array : array_like
+        The scaled dNDVI window, of shape (y, x).
+    new_class_array : array_like
+        The window of the newer class image, of shape (y, x).
+    change_from : list of int
+        The class codes to count as 'from' classes
+    change_to : list of int
+        The class codes to count as 'to' classes
+    dNDVI_threshold : float
+        A change is confirmed where the unscaled dNDVI is below this threshold.
+    dNDVI_scale_factor : int, optional
+        The multiplier that was used to scale dNDVI_array to integers. Defaults to 100.
+    report_thresholds : dict, optional
+        Decision thresholds overriding :py:data:`DEFAULT_CHANGE_REPORT_THRESHOLDS`.
+
+    Returns
+    -------
+    report_array : array_like
+        The updated report window
+
+    """
+    thresholds = dict(DEFAULT_CHANGE_REPORT_THRESHOLDS)
+    if report_thresholds is not None:
+        thresholds.update(report_thresholds)
+    report = report_array
+    changed = change_array > 0
+    occluded = change_array == -1
+    dNDVI_confirmed = dNDVI_array < int(dNDVI_threshold * dNDVI_scale_factor)
+    validated = changed & dNDVI_confirmed
+
+    # layer 0 counts every image at every pixel; counts are never negative, so the >= 0 test selects all locations
+    np.add(report[0], 1, out=report[0], where=report[0] >= 0)
+    np.add(report[1], 1, out=report[1], where=occluded)
+    np.add(report[2], 1, out=report[2], where=changed)
+
+    # record the first validated change date, or keep the earlier of the two dates
+    locs = (report[3] == 0) & validated
+    report[3, locs] = change_array[locs]
+    locs = (report[3] > 0) & validated
+    report[3, locs] = np.minimum(report[3, locs], change_array[locs])
+
+    first_change = report[3] > 0
+    np.add(report[4], 1, out=report[4], where=validated & first_change)
+    np.add(report[5], 1, out=report[5], where=(change_array == 0) & first_change)
+    np.add(report[6], 1, out=report[6], where=occluded & first_change)
+
+    report[7, first_change] = report[4, first_change] + report[5, first_change]
+    report[8, first_change] = (100 * report[4, first_change]) / report[
+        7, first_change
+    ]
+    report[9] = (
+        report[8] >= thresholds["percentage_probability_threshold"]
+    ) & (
+        report[4] >= thresholds["minimum_required_validated_detections_threshold"]
+    )
+    report[10] = report[3] * report[9]
+
+    np.add(
+        report[11], 1, out=report[11], where=(change_array >= 0) & dNDVI_confirmed
+    )
+    report[12] = (
+        report[11] >= thresholds["minimum_required_dNDVI_detections_threshold"]
+    )
+    report[13] = (
+        report[2] >= thresholds["minimum_required_classifier_detections_threshold"]
+    )
+    report[14] = (report[12] > 0) & (report[13] > 0)
+
+    np.add(report[15], 1, out=report[15], where=np.isin(new_class_array, change_from))
+    np.add(report[16], 1, out=report[16], where=np.isin(new_class_array, change_to))
+    report[17] = (
+        report[15] >= thresholds["minimum_required_FROM_detections_threshold"]
+    ) & (report[16] >= thresholds["minimum_required_TO_detections_threshold"])
+    return report_array
+
+
 def __change_from_class_maps(
     old_class_path,
     new_class_path,
@@ -4228,6 +5342,8 @@ def __change_from_class_maps(
     viband1=None,
     viband2=None,
     dNDVI_threshold=None,
+    report_thresholds=None,
+    mem_limit_mb=1024,
     log=logging.getLogger(__name__),
 ):
     """
@@ -4242,10 +5358,7 @@ def __change_from_class_maps(
     in the change images. Pixel values are the acquisition date of the detected change of interest or zero.
     Optionally, changes will be confirmed by thresholding a vegetation index calculated from two bands if the difference between
     the more recent date and the older date is below the confirmation threshold (e.g. NDVI < -0.2).
-    It then updates the report file which has three layers:
-      (1) pixels show the earliest change detection date (expressed as the number of days since 1/1/2000)
-      (2) pixels show the number of change detections (summed up over time)
-      (3) pixels show the number of consecutive change detections, omitting cloudy observations but resetting counter when no change is detected
+    It then updates the 18 layers of the report file block by block, as described in :py:func:`update_change_report_layers`.
 
     Parameters
     ----------
@@ -4295,6 +5408,13 @@ def __change_from_class_maps(
         If given, this is the threhold for checking change detections based on the vegetation index:
         A change pixel is confirmed if vi < threshold and discarded otherwise.
 
+    report_thresholds : dict, optional
+        Decision thresholds for the report layers, overriding any of the keys in DEFAULT_CHANGE_REPORT_THRESHOLDS.
+        See :py:func:`update_change_report_layers`.
+
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block of the report that is updated. Defaults to 1024.
+
     log : (Optional)
         If not provided, the default namespace logger will be used.
         Otherwise, the logger passed will be used to print statements to.
@@ -4367,9 +5487,6 @@ def __change_from_class_maps(
             )
             log.info("added mask path {}".format(added_mask_path))
             new_class_image = gdal.Open(new_class_path, gdal.GA_ReadOnly)
-            new_class_array = new_class_image.GetVirtualMemArray(
-                eAccess=gdal.gdalconst.GF_Read
-            ).squeeze()
 
             change_image = create_matching_dataset(
                 in_dataset=new_class_image,
@@ -4378,10 +5495,6 @@ def __change_from_class_maps(
                 bands=1,
                 datatype=gdal.GDT_Int32,
             )
-            change_array = change_image.GetVirtualMemArray(
-                eAccess=gdal.gdalconst.GF_Write
-            ).squeeze()
-
             dNDVI_image = create_matching_dataset(
                 new_class_image,
                 dNDVI_raster,
@@ -4389,10 +5502,6 @@ def __change_from_class_maps(
                 bands=1,
                 datatype=gdal.GDT_Int32,
             )
-            dNDVI_array = dNDVI_image.GetVirtualMemArray(
-                eAccess=gdal.gdalconst.GF_Write
-            ).squeeze()
-
             NDVI_image = create_matching_dataset(
                 new_class_image,
                 NDVI_raster,
@@ -4400,14 +5509,8 @@ def __change_from_class_maps(
                 bands=1,
                 datatype=gdal.GDT_Int32,
             )
-            NDVI_array = NDVI_image.GetVirtualMemArray(
-                eAccess=gdal.gdalconst.GF_Write
-            ).squeeze()
 
             added_mask = gdal.Open(added_mask_path, gdal.GA_ReadOnly)
-            added_mask_array = added_mask.GetVirtualMemArray(
-                eAccess=gdal.gdalconst.GF_Read
-            ).squeeze()
             # Gets timestamp as integer in form yyyymmdd
             new_date = get_image_acquisition_time(new_class_path)
             reference_date = datetime.datetime(2000, 1, 1, 0, 0, 0, 0)
@@ -4418,11 +5521,9 @@ def __change_from_class_maps(
             # Matt: added serial_date_to_string function
             log.info("date of change in days since 2000-01-01 = {}".format(date))
             log.info(f"date of change  : {serial_date_to_string(int(date))}")
-            # replace all pixels != 2 with 0 and all pixels == 2 with the new acquisition date
-            change_array[np.where(added_mask_array == 2)] = date
-            change_array[np.where(added_mask_array != 2)] = 0
-            # set clouds and missing values in latest class image to -1 in the change layer
-            change_array[np.where(new_class_array == 0)] = -1
+
+            old_image = None
+            new_image = None
             if (
                 viband1 is not None
                 and viband2 is not None
@@ -4455,34 +5556,9 @@ def __change_from_class_maps(
                 ][0]
                 if len(old_image_path) > 0:
                     log.info("Found old satellite image: {}".format(old_image_path))
-                    # open file and read bands
                     old_image = gdal.Open(
                         os.path.join(old_image_dir, old_image_path), gdal.GA_ReadOnly
                     )
-                    log.info("old image successfully read")
-                    old_image_array = old_image.GetVirtualMemArray(
-                        eAccess=gdal.gdalconst.GF_Read
-                    ).squeeze()
-                    log.info(
-                        "old image successfully read as a Virtual Memory Array and squeezed"
-                    )
-                    # calculate composite VI (N.B. -1 because array starts numbering with 0 and GDAL numbers bands from 1
-                    with np.errstate(divide="ignore", invalid="ignore"):
-                        vi_old = np.true_divide(
-                            (
-                                1.0 * old_image_array[viband1 - 1, :, :]
-                                - 1.0 * old_image_array[viband2 - 1, :, :]
-                            ),
-                            (
-                                1.0 * old_image_array[viband1 - 1, :, :]
-                                + 1.0 * old_image_array[viband2 - 1, :, :]
-                            ),
-                        )
-                        vi_old[vi_old == np.inf] = 0
-                        vi_old = np.nan_to_num(vi_old)
-                    old_image_array = None
-                    old_image = None
-                    log.info("old image successfully closed, therefore, saved")
                     # get change image file name and find bands in change image
                     new_timestamp = (
                         pyeo_1.filesystem_utilities.get_image_acquisition_time(
@@ -4502,61 +5578,10 @@ def __change_from_class_maps(
 
                     if len(new_image_path) > 0:
                         log.info("Found new satellite image: {}".format(new_image_path))
-                        # open file and read bands
                         new_image = gdal.Open(
                             os.path.join(new_image_dir, new_image_path),
                             gdal.GA_ReadOnly,
                         )
-                        new_image_array = new_image.GetVirtualMemArray(
-                            eAccess=gdal.gdalconst.GF_Read
-                        ).squeeze()
-                        # calculate change image VI
-                        with np.errstate(divide="ignore", invalid="ignore"):
-                            vi_new = np.true_divide(
-                                (
-                                    1.0 * new_image_array[viband1 - 1, :, :]
-                                    - 1.0 * new_image_array[viband2 - 1, :, :]
-                                ),
-                                (
-                                    1.0 * new_image_array[viband1 - 1, :, :]
-                                    + 1.0 * new_image_array[viband2 - 1, :, :]
-                                ),
-                            )
-                            vi_new[vi_new == np.inf] = 0
-                            vi_new = np.nan_to_num(
-                                vi_new
-                            )  # I.R. Replaces NaN with zero and infinity with large finite numbers
-
-                        # calculate dVI = new minus old VI
-                        dvi = vi_new - vi_old
-
-                        # I.R. 20230501 Force cloud masked or out-of-orbit (no data) regions of ndvi to -1
-                        vi_new[new_image_array[viband1 - 1, :, :] == 0] = -1
-
-                        # I.R. 20230501 Force cloud masked or out-of-orbit (no data) regions of dNDVI to 1
-                        dvi[new_image_array[viband1 - 1, :, :] == 0] = 1
-
-                        # I.R. Sets all values where the VI difference exceeds the threshold to a distictive negative value
-                        # to indicate a decision of 'no change' and as a record that this was due to the dNDVI test failing
-                        # change_array[np.where(dvi >= dNDVI_threshold)] = -2
-
-                        # I.R. 20230421+ START: Save NDVI and dNDVI of change image to disk for analysis
-                        # dNDVI_scale_factor = (
-                        #     100  # Multiplier used to scale dNDVI to integer range
-                        # )
-                        np.copyto(dNDVI_array, (dvi * dNDVI_scale_factor).astype(int))
-                        NDVI_scale_factor = (
-                            100  # Multiplier used to scale NDVI to integer range
-                        )
-                        np.copyto(NDVI_array, (vi_new * NDVI_scale_factor).astype(int))
-                        # I.R. 20230421 END
-
-                        new_image_array = None
-                        new_image = None
-                        dvi = None
-                        vi_new = None
-                        vi_old = None
-
                     else:
                         log.error(
                             "Did not find a new satellite image with name pattern: {}".format(
@@ -4575,16 +5600,75 @@ def __change_from_class_maps(
                     log.error(
                         "Skipping vegetation index calculation and confirmation of change detections."
                     )
+
+            def read_vi_bands(image, xoff, yoff, xsize, ysize):
+                # viband1 and viband2 are GDAL band numbers, starting from 1
+                return (
+                    1.0 * image.GetRasterBand(viband1).ReadAsArray(xoff, yoff, xsize, ysize),
+                    1.0 * image.GetRasterBand(viband2).ReadAsArray(xoff, yoff, xsize, ysize),
+                )
+
+            NDVI_scale_factor = 100  # Multiplier used to scale NDVI to integer range
+            # all input and output layers are on the grid of the new class image
+            windows = get_block_windows(
+                new_class_image,
+                mem_limit=int(mem_limit_mb * 1024 * 1024),
+                bytes_per_pixel=6 * 8 + 3 * 4 + 2,
+            )
+            for xoff, yoff, xsize, ysize in windows:
+                new_class_block = new_class_image.GetRasterBand(1).ReadAsArray(
+                    xoff, yoff, xsize, ysize
+                )
+                added_mask_block = added_mask.GetRasterBand(1).ReadAsArray(
+                    xoff, yoff, xsize, ysize
+                )
+                # replace all pixels != 2 with 0 and all pixels == 2 with the new acquisition date
+                change_block = np.where(added_mask_block == 2, date, 0).astype(np.int32)
+                # set clouds and missing values in latest class image to -1 in the change layer
+                change_block[new_class_block == 0] = -1
+                dNDVI_block = np.zeros((ysize, xsize), dtype=np.int32)
+                NDVI_block = np.zeros((ysize, xsize), dtype=np.int32)
+                if old_image is not None and new_image is not None:
+                    old_band1, old_band2 = read_vi_bands(old_image, xoff, yoff, xsize, ysize)
+                    new_band1, new_band2 = read_vi_bands(new_image, xoff, yoff, xsize, ysize)
+                    with np.errstate(divide="ignore", invalid="ignore"):
+                        # calculate composite VI
+                        vi_old = np.true_divide(old_band1 - old_band2, old_band1 + old_band2)
+                        vi_old[vi_old == np.inf] = 0
+                        vi_old = np.nan_to_num(vi_old)
+                        # calculate change image VI
+                        vi_new = np.true_divide(new_band1 - new_band2, new_band1 + new_band2)
+                        vi_new[vi_new == np.inf] = 0
+                        vi_new = np.nan_to_num(
+                            vi_new
+                        )  # I.R. Replaces NaN with zero and infinity with large finite numbers
+
+                    # calculate dVI = new minus old VI
+                    dvi = vi_new - vi_old
+
+                    # I.R. 20230501 Force cloud masked or out-of-orbit (no data) regions of ndvi to -1
+                    vi_new[new_band1 == 0] = -1
+
+                    # I.R. 20230501 Force cloud masked or out-of-orbit (no data) regions of dNDVI to 1
+                    dvi[new_band1 == 0] = 1
+
+                    # I.R. 20230421+ START: Save NDVI and dNDVI of change image to disk for analysis
+                    dNDVI_block[...] = (dvi * dNDVI_scale_factor).astype(int)
+                    NDVI_block[...] = (vi_new * NDVI_scale_factor).astype(int)
+                    # I.R. 20230421 END
+                change_image.GetRasterBand(1).WriteArray(change_block, xoff, yoff)
+                dNDVI_image.GetRasterBand(1).WriteArray(dNDVI_block, xoff, yoff)
+                NDVI_image.GetRasterBand(1).WriteArray(NDVI_block, xoff, yoff)
+
             # save change layer
-            new_class_array = None
+            for image in (change_image, dNDVI_image, NDVI_image):
+                build_overviews(image)
+            old_image = None
+            new_image = None
             new_class_image = None
-            added_mask_array = None
             added_mask = None
-            change_array = None
             change_image = None
-            dNDVI_array = None
             dNDVI_image = None
-            NDVI_array = None
             NDVI_image = None
         else:
             log.info(
@@ -4639,32 +5723,8 @@ def __change_from_class_maps(
         # I.R. 20220611 END
 
         # I.R. 20230421+ START
-        log.info(f"***   Loading data arrays required to build report layers   ***")
-
-        new_class_image = gdal.Open(new_class_path, gdal.GA_ReadOnly)
-        new_class_array = new_class_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Read
-        ).squeeze()
-
-        change_image = gdal.Open(change_raster, gdal.GA_ReadOnly)
-        change_array = change_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Read
-        ).squeeze()
-
-        dNDVI_image = gdal.Open(dNDVI_raster, gdal.GA_ReadOnly)
-        dNDVI_array = dNDVI_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Read
-        ).squeeze()
-
-        NDVI_image = gdal.Open(NDVI_raster, gdal.GA_ReadOnly)
-        NDVI_array = NDVI_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Read
-        ).squeeze()
-
         report_image = gdal.Open(report_path, gdal.GA_Update)
-        out_report_array = report_image.GetVirtualMemArray(
-            eAccess=gdal.GA_Update
-        ).squeeze()
+        change_image = gdal.Open(change_raster, gdal.GA_ReadOnly)
         reference_projection = report_image.GetProjection()
         projection = change_image.GetProjection()
         if projection != reference_projection:
@@ -4676,247 +5736,54 @@ def __change_from_class_maps(
             change_image = None
             report_image = None
             return -1
+        new_class_image = gdal.Open(new_class_path, gdal.GA_ReadOnly)
+        dNDVI_image = gdal.Open(dNDVI_raster, gdal.GA_ReadOnly)
 
-        log.info(f"***   Starting build of report layers:   ***")
-
-        # If kept as a feature move these parameters into .ini file
-        minimum_required_validated_detections_threshold = 5  #  Absolute number of valid detections for classifier opinion to be accepted.
-        minimum_required_dNDVI_detections_threshold = 5  #  Absolute number of dNDVI change detections for classifier opinion to be accepted.
-        minimum_required_classifier_detections_threshold = 5  # Absolute number of classifier-only detections for opinion to be accepted
-        percentage_probability_threshold = 50
-        minimum_required_FROM_detections_threshold = 2
-        minimum_required_TO_detections_threshold = 2
-
-        log.info(
-            f"percentage_probability_threshold:   {percentage_probability_threshold}"
-        )
-        log.info(
-            f"minimum_required_validated_detections_threshold: {minimum_required_validated_detections_threshold}"
-        )
-        log.info(
-            f"minimum_required_dNDVI_detections_threshold: {minimum_required_dNDVI_detections_threshold}"
-        )
-        log.info(
-            f"minimum_required_classifier_detections_threshold: {minimum_required_classifier_detections_threshold}"
-        )
-        log.info(
-            f"minimum_required_FROM_detections_threshold: {minimum_required_FROM_detections_threshold}"
-        )
-        log.info(
-            f"minimum_required_TO_detections_threshold: {minimum_required_TO_detections_threshold}"
-        )
-
-        log.info("Build Report Layers")
-
-        # Layer 0
-        log.info(
-            "Layer 0: Total Image Count: Counts the number of images processed per pixel - number of available images within overall cloud percentage cover limit set in pyeo_1.ini file"
-        )
-        locs = (
-            out_report_array[0, :, :] >= 0
-        )  # i.e. locs covers all locations - an inefficient global counter but useful for computed fields and when viewing in QGIS
-        out_report_array[0, locs] = out_report_array[0, locs] + 1
-
-        # Layer 1
-        log.info(
-            "Layer 1: Occluded Image Count: Counts number of cloud occluded (or out-of-orbit) images that are thus unavailable for classification and analysis"
-        )
-        locs = change_array == -1
-        out_report_array[1, locs] = out_report_array[1, locs] + 1
-
-        # Layer 2
-        log.info(
-            "Layer 2: Classifier Change Detection Count: Count if a from/to change of classification was detected"
-        )
-        locs = change_array > 0
-        out_report_array[2, locs] = out_report_array[2, locs] + 1
-
-        # Layer 3
-        log.info(
-            "Layer 3: First-Change Trigger for Combined Classifier+dNDVI Validated Change Detection: Records earliest date of a classification change detection where values are greater than zero (not missing data and not cloud)"
-        )
-        # where layer 2 is zero and the change array contains a value > 0, this date will be burned into the report layer 2
-        locs = (
-            (out_report_array[3, :, :] == 0)
-            & (change_array > 0)
-            & (dNDVI_array < int(dNDVI_threshold * dNDVI_scale_factor))
-        )  # Base on dNDVI validated change detections
-        out_report_array[3, locs] = change_array[locs]
-        # where layer 3 is non-zero it is set to the earlier date
-        locs = (
-            (out_report_array[3, :, :] > 0)
-            & (change_array > 0)
-            & (dNDVI_array < int(dNDVI_threshold * dNDVI_scale_factor))
-        )  # Base on dNDVI validated change detections
-        out_report_array[3, locs] = np.minimum(
-            out_report_array[3, locs], change_array[locs]
-        )
-
-        # Layer 4:
-        log.info(
-            "Layer 4: Combined Classifier+dNDVI Validated Change Detection Count: Count if a change was detected after a first change has already been detected"
-        )
-        locs = (
-            (change_array > 0)
-            & (dNDVI_array < int(dNDVI_threshold * dNDVI_scale_factor))
-            & (out_report_array[3, :, :] > 0)
-        )
-        out_report_array[4, locs] = out_report_array[4, locs] + 1
-
-        # Layer 5:
-        log.info(
-            "Layer 5: Combined Classifier+dNDVI Validated No Change Detection Count: Count if a no change was detected after a first change has already been detected"
-        )
-        locs = (change_array == 0) & (out_report_array[3, :, :] > 0)
-        out_report_array[5, locs] = out_report_array[5, locs] + 1
-
-        # Layer 6:
-        log.info(
-            "Layer 6: Cloud Occlusion Count: Count if a cloud occlusion (or out-of-orbit) occured after a first change has already been detected"
-        )
-        locs = (change_array == -1) & (out_report_array[3, :, :] > 0)
-        out_report_array[6, locs] = out_report_array[6, locs] + 1
-
-        # Compute following report measures only for pixels where first change has been detected (to avoid division by zero)
-        # NOTE: (INEFFICIENT! All computed layers should be generated in a separate stage after iteration through the change layers has been completed)
-        locs = out_report_array[3, :, :] > 0
-
-        # Layer 7:
-        log.info(
-            "Layer 7: Valid Image Count: Total number of valid (no cloud) images for this pixel since first change was detected"
-        )
-        # = total change + change_filtered + nochange
-        out_report_array[7, locs] = (
-            out_report_array[4, locs] + out_report_array[5, locs]
-        )
-
-        # Layer 8:
-        log.info(
-            "Layer 8: Change Detection Repeatability: Repeatability of change detection after first change is detected - as a percentage of available valid images"
-        )
-        # = ratio change/(change + nochange) for pixels where first change has been detected
-        out_report_array[8, locs] = (
-            100 * out_report_array[4, locs]
-        ) / out_report_array[
-            7, locs
-        ]  # Base on dNDVI validated change detections
-
-        # Layer 9:
-        log.info(
-            "Layer 9: Binary time-series decision: Based on percentage_probability_threshold and minimum_required_validated_detections_threshold"
-        )
-        out_report_array[9, :, :] = 0  ## Reset from previous calls
-        locs_binarise = (
-            out_report_array[8, :, :] >= percentage_probability_threshold
-        ) & (
-            out_report_array[4, :, :] >= minimum_required_validated_detections_threshold
-        )  # Base on dNDVI validated change detections
-        out_report_array[
-            9, locs_binarise
-        ] = 1  # Assumes empty array layer initialised to zero
-
-        # Layer 10
-        log.info(
-            "Layer 10: Binary time-series decision by first-change date: First change date masked by Binary Decision - Layer 9"
-        )
-        out_report_array[10, :, :] = (
-            out_report_array[3, :, :] * out_report_array[9, :, :]
-        )
-
-        # Layer 11:
-        log.info(
-            "Layer 11: dNDVI Only Change Detection Count: Count if a change was detected by the dNDVI test and that not cloud occluded (or out-of-orbit)"
-        )
-        locs = (change_array >= 0) & (
-            dNDVI_array < int(dNDVI_threshold * dNDVI_scale_factor)
-        )
-        out_report_array[11, locs] = out_report_array[11, locs] + 1
-
-        # Layer 12:
-        log.info(
-            "Layer 12: Binary time-series decision: Based on dNDVI Only and minimum_required_dNDVI_detections_threshold"
-        )
-        out_report_array[12, :, :] = 0  ## Reset from previous calls
-        # locs_binarise = (out_report_array[8, :, :] >= percentage_probability_threshold) & (out_report_array[6, :, :] >= minimum_required_validated_detections_threshold)
-        locs_binarise = (
-            out_report_array[11, :, :] >= minimum_required_dNDVI_detections_threshold
-        )
-        out_report_array[
-            12, locs_binarise
-        ] = 1  # Assumes empty array layer initialised to zero
-
-        # Layer 13:
-        log.info("Layer 13: Binary time-series decision: Based on Classifier Only")
-        out_report_array[13, :, :] = 0  ## Reset from previous calls
-        locs_binarise = (
-            out_report_array[2, :, :]
-            >= minimum_required_classifier_detections_threshold
-        )
-        out_report_array[
-            13, locs_binarise
-        ] = 1  # Assumes empty array layer initialised to zero
+        thresholds = dict(DEFAULT_CHANGE_REPORT_THRESHOLDS)
+        if report_thresholds is not None:
+            thresholds.update(report_thresholds)
+        for name, value in thresholds.items():
+            log.info(f"{name}: {value}")
 
-        # Layer 14:
-        log.info(
-            "Layer 14: Combined Classifier+dNDVI Binary time-series decision: Based on Classifier AND dNDVI opinion"
-        )
-        out_report_array[14, :, :] = 0  ## Reset from previous calls
-        locs_binarise = (out_report_array[12, :, :] > 0) & (
-            out_report_array[13, :, :] > 0
-        )
-        out_report_array[
-            14, locs_binarise
-        ] = 1  # Assumes empty array layer initialised to zero
-
-        # Layer 15:
-        log.info("Layer 15: FROM Classification Count")
-        # Assumes layer was initialised to zero when report file was created above e.g. with out_report_array[15, :, :] = 0
-        locs_from = np.isin(
-            new_class_array, change_from
-        )  # change_from parameter holds a list of classes
-        # locs_from = np.nonzero(np.isin(new_class_array, change_from))  # change_from parameter holds a list of classes
-        out_report_array[15, locs_from] = (
-            out_report_array[15, locs_from] + 1
-        )  # Assumes empty array layer initialised to zero
-
-        # Layer 16:
-        log.info("Layer 16: TO Classification Count")
-        # Assumes layer was initialised to zero when report file was created above e.g. with out_report_array[16, :, :] = 0
-        locs_to = np.isin(
-            new_class_array, change_to
-        )  # change_from parameter holds a list of classes
-        # locs_to = np.nonzero(np.isin(new_class_array, change_to))  # change_to parameter holds a list of classes
-        out_report_array[16, locs_to] = (
-            out_report_array[16, locs_to] + 1
-        )  # Assumes empty array layer initialised to zero
-
-        # Layer 17:
-        log.info(
-            "Layer 17: Binary Decision Thresholds on FROM and TO Classification Counts"
+        log.info(f"***   Building report layers block by block   ***")
+        report_bands = [
+            report_image.GetRasterBand(band_index + 1)
+            for band_index in range(report_image.RasterCount)
+        ]
+        change_band = change_image.GetRasterBand(1)
+        dNDVI_band = dNDVI_image.GetRasterBand(1)
+        new_class_band = new_class_image.GetRasterBand(1)
+        # the report layers, their temporaries, the three input layers and the boolean masks built from them
+        bytes_per_pixel = report_image.RasterCount * 2 * 2 + 3 * 4 + 8
+        windows = get_block_windows(
+            report_image,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=bytes_per_pixel,
         )
-        out_report_array[17, :, :] = 0  ## Reset from previous calls
-        locs_tofrom = (
-            out_report_array[15, :, :] >= minimum_required_FROM_detections_threshold
-        ) & (out_report_array[16, :, :] >= minimum_required_TO_detections_threshold)
-        out_report_array[
-            17, locs_tofrom
-        ] = 1  # Assumes empty array layer initialised to zero
-
-        # ORIGINAL CODE
-        # increase counter if a change was detected
-        # locs = ( change_array > 0 )
-        # out_report_array[2, locs] = out_report_array[2, locs] + 1
-        # # reset the counter if no change was detected
-        # locs = ( change_array == 0 )
-        # out_report_array[2, locs] = out_report_array[2, locs] - 1
-
-        # I.R. 20220603/20230421 END
-
-        change_array = None
+        for xoff, yoff, xsize, ysize in windows:
+            report_array = report_image.ReadAsArray(xoff, yoff, xsize, ysize)
+            update_change_report_layers(
+                report_array,
+                change_band.ReadAsArray(xoff, yoff, xsize, ysize),
+                dNDVI_band.ReadAsArray(xoff, yoff, xsize, ysize),
+                new_class_band.ReadAsArray(xoff, yoff, xsize, ysize),
+                change_from,
+                change_to,
+                dNDVI_threshold,
+                dNDVI_scale_factor=dNDVI_scale_factor,
+                report_thresholds=thresholds,
+            )
+            for band_index, band in enumerate(report_bands):
+                band.WriteArray(report_array[band_index], xoff, yoff)
+        # I.R. 20230421 END
+
+        report_bands = None
+        change_band = None
+        dNDVI_band = None
+        new_class_band = None
+        new_class_image = None
         change_image = None
-        dNDVI_array = None
         dNDVI_image = None
-        out_report_array = None
         report_image = None
     return change_raster
 
@@ -5000,13 +5867,7 @@ def change_from_class_maps(
             datatype=gdal.GDT_UInt32,
         )
         new_class_image = None
-        change_array = change_image.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Write
-        ).squeeze()
         added_mask = gdal.Open(added_mask_path, gdal.GA_ReadOnly)
-        added_mask_array = added_mask.GetVirtualMemArray(
-            eAccess=gdal.gdalconst.GF_Read
-        ).squeeze()
         # Gets timestamp as integer in form yyyymmdd
         new_date = get_image_acquisition_time(new_class_path)
         reference_date = datetime.datetime(2000, 1, 1, 0, 0, 0, 0)
@@ -5015,12 +5876,17 @@ def change_from_class_maps(
             date_difference.total_seconds() / 60 / 60 / 24
         )  # convert to 24-hour days
         log.info("date = {}".format(date))
-        # replace all pixels != 2 with 0 and all pixels == 2 with the new acquisition date
-        change_array[np.where(added_mask_array == 2)] = date
-        change_array[np.where(added_mask_array != 2)] = 0
-        added_mask_array = None
+        windows = get_block_windows(change_image, bytes_per_pixel=6)
+        for xoff, yoff, xsize, ysize in windows:
+            added_mask_block = added_mask.GetRasterBand(1).ReadAsArray(
+                xoff, yoff, xsize, ysize
+            )
+            # replace all pixels != 2 with 0 and all pixels == 2 with the new acquisition date
+            change_image.GetRasterBand(1).WriteArray(
+                np.where(added_mask_block == 2, date, 0).astype(np.uint32), xoff, yoff
+            )
+        build_overviews(change_image)
         added_mask = None
-        change_array = None
         change_image = None
     return change_raster
 
@@ -5113,7 +5979,14 @@ def array2raster(raster_file, new_raster_file, array):
     rows = raster.RasterYSize
     bands = raster.RasterCount
     driver = gdal.GetDriverByName(str("GTiff"))
-    outRaster = driver.Create(new_raster_file, cols, rows, bands, gdal.GDT_Float32)
+    outRaster = driver.Create(
+        new_raster_file,
+        cols,
+        rows,
+        bands,
+        gdal.GDT_Float32,
+        options=get_creation_options(gdal.GDT_Float32),
+    )
     outRaster.SetGeoTransform((originX, pixelWidth, 0, originY, 0, pixelHeight))
     for band in range(bands):
         outband = outRaster.GetRasterBand(band + 1)
@@ -5124,13 +5997,103 @@ def array2raster(raster_file, new_raster_file, array):
     outRaster.SetProjection(outRasterSRS.ExportToWkt())
 
 
-def apply_mask_to_image(mask_path, image_path, masked_image_path):
+# Warped views of masks on the grid of the images they are applied to, so that each is only built once per grid
+_aligned_masks = {}
+_aligned_masks_lock = threading.Lock()
+_ALIGNED_MASK_CACHE_SIZE = 32
+
+
+def _same_grid(raster_a, raster_b, tolerance=0.000001):
+    """
+    :meta private:
+    Returns True if two rasters have the same size, projection and, to within tolerance, geotransform.
+    """
+    if (raster_a.RasterXSize, raster_a.RasterYSize) != (raster_b.RasterXSize, raster_b.RasterYSize):
+        return False
+    if any(
+        abs(a - b) > tolerance
+        for a, b in zip(raster_a.GetGeoTransform(), raster_b.GetGeoTransform())
+    ):
+        return False
+    projection_a = osr.SpatialReference(wkt=raster_a.GetProjectionRef())
+    projection_b = osr.SpatialReference(wkt=raster_b.GetProjectionRef())
+    return bool(projection_a.IsSame(projection_b))
+
+
+def get_aligned_mask(mask_path, image):
+    """
+    Returns a path to read mask_path from on exactly the pixel grid of image. This is mask_path itself if the two
+    already share a grid, to within rounding errors in the geotransform; otherwise it is an in-memory warped VRT of
+    the mask, reprojected and resampled bilinearly onto the image's grid. The VRT is built once per mask and grid and
+    reused for as long as the mask file is unchanged, so applying one mask to many images on the same grid warps it
+    only once, and only the windows that are read are ever resampled.
+
+    Parameters
+    ----------
+    mask_path : str
+        Path to the mask
+    image : gdal.Dataset
+        The image whose grid the mask should be read on
+
+    Returns
+    -------
+    aligned_mask_path : str
+        The path to read the aligned mask from
+
+    """
+    mask = gdal.Open(mask_path)
+    if mask is None:
+        raise FileNotFoundError("Mask not found: {}".format(mask_path))
+    if _same_grid(mask, image):
+        return mask_path
+    mask = None
+    mask_stat = os.stat(mask_path)
+    key = (
+        os.path.abspath(mask_path),
+        mask_stat.st_mtime_ns,
+        mask_stat.st_size,
+        image.GetProjectionRef(),
+        tuple(image.GetGeoTransform()),
+        image.RasterXSize,
+        image.RasterYSize,
+    )
+    with _aligned_masks_lock:
+        if key in _aligned_masks:
+            return _aligned_masks[key]
+        if len(_aligned_masks) >= _ALIGNED_MASK_CACHE_SIZE:
+            oldest_key = next(iter(_aligned_masks))
+            gdal.Unlink(_aligned_masks.pop(oldest_key))
+        geotransform = image.GetGeoTransform()
+        x_min = geotransform[0]
+        y_max = geotransform[3]
+        x_max = x_min + geotransform[1] * image.RasterXSize
+        y_min = y_max + geotransform[5] * image.RasterYSize
+        aligned_mask_path = "/vsimem/aligned_mask_{:x}.vrt".format(hash(key) & 0xFFFFFFFFFFFF)
+        gdal.Warp(
+            aligned_mask_path,
+            mask_path,
+            options=gdal.WarpOptions(
+                format="VRT",
+                dstSRS=image.GetProjectionRef(),
+                outputBounds=(x_min, y_min, x_max, y_max),
+                width=image.RasterXSize,
+                height=image.RasterYSize,
+                outputType=gdal.GDT_Float32,
+                resampleAlg="bilinear",
+            ),
+        )
+        _aligned_masks[key] = aligned_mask_path
+    return aligned_mask_path
+
+
+def apply_mask_to_image(mask_path, image_path, masked_image_path, mem_limit_mb=1024):
     """
-    Applies a mask of 0 and 1 values to a raster image with one or more bands in Geotiff format
-    by multiplying each pixel value with the mask value.
+    Applies a mask of 0 and 1 values to a raster image with one or more bands in Geotiff format, setting every band
+    to 0 wherever the mask is 0.
 
-    After:
-        https://pcjericks.github.io/py-gdalogr-cookbook/raster_layers.html
+    The image is read, masked and written one block window at a time, so memory use does not grow with the size of
+    the image. If the mask is not on the image's grid, it is read through a warped view that is built once per grid;
+    see :py:func:`get_aligned_mask`. The masked image has the datatype of the image.
 
     Parameters
     ----------
@@ -5143,94 +6106,35 @@ def apply_mask_to_image(mask_path, image_path, masked_image_path):
     masked_image_path : str
         Path and file name of the masked raster image file that will be created
 
+    mem_limit_mb : number, optional
+        The approximate memory ceiling, in MB, of each window. Defaults to 1024.
+
     """
-    log = logging.getLogger(__name__)
-    # log.info("Applying mask {} to raster image {}.".format(mask_path, image_path))
-    mask = gdal.Open(mask_path)
-    if mask == None:
-        raise FileNotFoundError("Mask not found: {}".format(mask_path))
-    # make the name of the masked output image
-    # log.info("   masked raster image will be created at {}.".format(masked_image_path))
-    # gdal read raster as array
-    image_as_array = raster2array(image_path)
-    # reproject the mask into the same shape and projection as the raster file if necessary
-    raster = gdal.Open(image_path)
-    geotransform_of_image = raster.GetGeoTransform()
-    bands = raster.RasterCount
-    cols = raster.RasterXSize
-    rows = raster.RasterYSize
-    pixelWidth = geotransform_of_image[1]
-    pixelHeight = geotransform_of_image[5]
-    mask = gdal.Open(mask_path, gdal.GA_Update)
-    geotransform_of_mask = mask.GetGeoTransform()
-    if geotransform_of_image != geotransform_of_mask:
-        flag = True  # True means the two geotransforms are almost identical and only have small rounding errors
-        for g in range(len(geotransform_of_mask)):
-            if geotransform_of_image[g] - geotransform_of_mask[g] > 0.000001:
-                flag = False  # raise exception
-        if not flag:
-            with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-                temp_path_1 = os.path.join(td, "reproj_mask_temp.tif")
-                # log.info("Geotransforms do not match. Reprojecting {} to {}.".format(mask_path, temp_path_1))
-                reproject_image(
-                    mask_path,
-                    temp_path_1,
-                    raster.GetProjectionRef(),
-                    do_post_resample=False,
-                )
-                # log.info("Output file exists? {}".format(str(os.path.exists(temp_path_1))))
-                temp_path_2 = os.path.join(
-                    td,
-                    os.path.basename(mask_path).split(".")[0] + "_warped_clipped.tif",
-                )
-                # log.info("Clipping {} to {} using extent from {}".format(temp_path_1, temp_path_2, image_path))
-                clip_raster_to_intersection(
-                    temp_path_1, image_path, temp_path_2, is_landsat=False
-                )
-                mask_path = mask_path.split(".")[0] + "_warped_clipped_resampled.tif"
-                ds = gdal.Open(temp_path_2)
-                ds_out = gdal.Translate(
-                    mask_path,
-                    ds,
-                    format="GTiff",
-                    outputType=gdal.GDT_Float32,
-                    width=cols,
-                    height=rows,
-                    resampleAlg="bilinear",
-                )
-                ds = None
-                ds_out = None
-                mask = None
-                mask = gdal.Open(mask_path, gdal.GA_Update)
-        else:
-            # copy the geotransform of the raster to the mask for consistency
-            mask.SetGeoTransform(geotransform_of_image)
-
-    geotransform_of_mask = mask.GetGeoTransform()
-    if geotransform_of_image != geotransform_of_mask:
-        flag = True  # True means the two geotransforms are almost identical and only have small rounding errors
-        for g in range(len(geotransform_of_mask)):
-            if geotransform_of_image[g] - geotransform_of_mask[g] > 0.000001:
-                flag = False  # raise exception
-        if not flag:
-            log.warning(
-                "Could not bring the mask file into exactly the same projection as the image. Check co-registration visually."
-            )
-            log.warning(mask_path)
-            log.warning(geotransform_of_mask)
-            log.warning(geotransform_of_image)
-        else:
-            # copy the geotransform of the raster to the mask for consistency
-            mask.SetGeoTransform(geotransform_of_image)
-    mask_as_array = raster2array(mask_path)
-    for band in range(bands):
-        image_as_array[band, mask_as_array == 0] = 0
-    array2raster(image_path, masked_image_path, image_as_array)
+    image = gdal.Open(image_path)
+    mask = gdal.Open(get_aligned_mask(mask_path, image))
+    mask_band = mask.GetRasterBand(1)
+    bands = image.RasterCount
+    out_image = create_matching_dataset(image, masked_image_path, bands=bands)
+    itemsize = gdal.GetDataTypeSize(image.GetRasterBand(1).DataType) // 8
+    for xoff, yoff, xsize, ysize in get_block_windows(
+        image,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=max(itemsize, 1) * bands + 8,
+    ):
+        masked = mask_band.ReadAsArray(xoff, yoff, xsize, ysize) == 0
+        for band_index in range(bands):
+            block = image.GetRasterBand(band_index + 1).ReadAsArray(xoff, yoff, xsize, ysize)
+            np.copyto(block, 0, where=masked)
+            out_image.GetRasterBand(band_index + 1).WriteArray(block, xoff, yoff)
+    out_image = None
+    mask = None
+    image = None
 
 
-def apply_mask_to_dir(mask_path, image_dir, masked_image_dir):
+def apply_mask_to_dir(mask_path, image_dir, masked_image_dir, mem_limit_mb=1024):
     """
-    Iterates over all raster images in image_dir and applies the mask to each image.
+    Iterates over all raster images in image_dir and applies the mask to each image. The mask is warped onto each
+    grid of images only once; see :py:func:`get_aligned_mask`.
 
     Parameters
     ----------
@@ -5242,6 +6146,9 @@ def apply_mask_to_dir(mask_path, image_dir, masked_image_dir):
 
     masked_image_dir : str
         Path and directory name in which the masked raster image files will be created
+
+    mem_limit_mb : number, optional
+        The approximate memory ceiling, in MB, of each window. Defaults to 1024.
     """
 
     log = logging.getLogger(__name__)
@@ -5256,11 +6163,17 @@ def apply_mask_to_dir(mask_path, image_dir, masked_image_dir):
         masked_image_path = os.path.join(
             masked_image_dir, os.path.basename(image_file).split(".")[0] + "_masked.tif"
         )
-        apply_mask_to_image(mask_path, image_dir + "/" + image_file, masked_image_path)
+        apply_mask_to_image(
+            mask_path, image_dir + "/" + image_file, masked_image_path, mem_limit_mb=mem_limit_mb
+        )
 
 
 def combine_masks(
-    mask_paths, out_path, combination_func="and", geometry_func="intersect"
+    mask_paths,
+    out_path,
+    combination_func="and",
+    geometry_func="intersect",
+    mem_limit_mb=1024,
 ):
     """
     ORs or ANDs several masks. Gets metadata from top mask. Assumes that masks are a
@@ -5279,6 +6192,8 @@ def combine_masks(
         ..in the corresponding pixels in the list of masks. Defaults to 'and'
     geometry_func : {'intersect' or 'union'}
         How to handle non-overlapping masks. Defaults to 'intersect'
+    mem_limit_mb : int, optional
+        The approximate memory ceiling in MB for each block window. Defaults to 1024.
 
     Returns
     -------
@@ -5307,6 +6222,12 @@ def combine_masks(
     y_res = gt[5] * -1  # Y res is -ve in geotransform
     bands = 1
     projection = masks[0].GetProjection()
+    if geometry_func not in ("intersect", "union"):
+        raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
+    if combination_func not in ("or", "and", "nor"):
+        raise Exception(
+            "Invalid combination_func; valid values are 'or', 'and', and 'nor'"
+        )
     out_mask = create_new_image_from_polygon(
         combined_polygon,
         out_path,
@@ -5320,58 +6241,42 @@ def combine_masks(
 
     # This bit here is similar to stack_raster, but different enough to not be worth spinning into a combination_func
     # I might reconsider this later, but I think it'll overcomplicate things.
-    out_mask_array = out_mask.GetVirtualMemArray(eAccess=gdal.GF_Write)
-    out_mask_array = (
-        out_mask_array.squeeze()
-    )  # This here to account for unaccountable extra dimension Windows patch adds
-    out_mask_array[:, :] = 1
-    for mask_index, in_mask in enumerate(masks):
-        in_mask_array = in_mask.GetVirtualMemArray()
-        in_mask_array = in_mask_array.squeeze()  # See previous comment
-        if geometry_func == "intersect":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-                out_mask, combined_polygon
-            )
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-                in_mask, combined_polygon
-            )
-        elif geometry_func == "union":
-            out_x_min, out_x_max, out_y_min, out_y_max = pixel_bounds_from_polygon(
-                out_mask, get_raster_bounds(in_mask)
-            )
-            in_x_min, in_x_max, in_y_min, in_y_max = pixel_bounds_from_polygon(
-                in_mask, get_raster_bounds(in_mask)
-            )
-        else:
-            raise Exception("Invalid geometry_func; can be 'intersect' or 'union'")
-        out_mask_view = out_mask_array[out_y_min:out_y_max, out_x_min:out_x_max]
-        in_mask_view = in_mask_array[in_y_min:in_y_max, in_x_min:in_x_max]
-        if mask_index == 0:
-            out_mask_view[:, :] = in_mask_view
-        else:
-            if combination_func == "or":
+    out_band = out_mask.GetRasterBand(1)
+    # each mask covers its own extent; within an intersection that is the whole output
+    offsets = [_pixel_offset_in(in_mask, out_mask) for in_mask in masks]
+    windows = get_block_windows(
+        out_mask, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=3
+    )
+    for window in windows:
+        xoff, yoff, xs, ys = window
+        out_block = np.ones((ys, xs), dtype=np.uint8)
+        for mask_index, in_mask in enumerate(masks):
+            overlap = _window_overlap(window, offsets[mask_index], in_mask)
+            if not overlap:
+                continue
+            read_x, read_y, block_x, block_y, w, h = overlap
+            in_mask_block = in_mask.GetRasterBand(1).ReadAsArray(read_x, read_y, w, h)
+            out_mask_view = out_block[block_y : block_y + h, block_x : block_x + w]
+            if mask_index == 0:
+                out_mask_view[:, :] = in_mask_block
+            elif combination_func == "or":
                 out_mask_view[:, :] = np.bitwise_or(
-                    out_mask_view, in_mask_view, dtype=np.uint8
+                    out_mask_view, in_mask_block, dtype=np.uint8
                 )
             elif combination_func == "and":
                 out_mask_view[:, :] = np.bitwise_and(
-                    out_mask_view, in_mask_view, dtype=np.uint8
+                    out_mask_view, in_mask_block, dtype=np.uint8
                 )
-            elif combination_func == "nor":
+            else:
                 out_mask_view[:, :] = np.bitwise_not(
-                    np.bitwise_or(out_mask_view, in_mask_view, dtype=np.uint8),
+                    np.bitwise_or(out_mask_view, in_mask_block, dtype=np.uint8),
                     dtype=np.uint8,
                 )
-            else:
-                raise Exception(
-                    "Invalid combination_func; valid values are 'or', 'and', and 'nor'"
-                )
-        in_mask_view = None
-        out_mask_view = None
-        in_mask_array = None
-        in_mask = None
-    out_mask_array = None
+        out_band.WriteArray(out_block, xoff, yoff)
+    out_band = None
+    build_overviews(out_mask)
     out_mask = None
+    masks = None
     return out_path
 
 
@@ -5391,22 +6296,48 @@ def buffer_mask_in_place(mask_path, buffer_size, cache=None):
     # log.info("Buffering {} with buffer size {}".format(mask_path, buffer_size))
     mask = gdal.Open(mask_path, gdal.GA_Update)
     mask_array = mask.GetVirtualMemArray(eAccess=gdal.GA_Update)
+    if buffer_size > 10 and int(buffer_size / 10) * 10 != buffer_size:
+        log.warning(
+            "Approximating buffer size as 10*{} = {}".format(
+                int(buffer_size / 10), 10 * int(buffer_size / 10)
+            )
+        )
+    cache = buffer_mask_array(mask_array.squeeze(), buffer_size, cache=cache)
+    np.copyto(mask_array, cache)
+    mask_array = None
+    mask = None
+
+
+def buffer_mask_array(mask_array, buffer_size, cache=None):
+    """
+    Expands the masked (0) areas of a 2d mask array by buffer_size pixels. Buffers larger than 10 pixels are
+    approximated as 10 erosions with a disk of a tenth of the radius.
+
+    Parameters
+    ----------
+    mask_array : array_like
+        A 2d multiplicative mask (0; masked, 1; unmasked)
+    buffer_size : int
+        The radius of the buffer, in pixel units of the mask
+    cache : array_like, optional
+        A boolean array of the same shape as mask_array to write the result to
+
+    Returns
+    -------
+    buffered_mask : array_like
+        A boolean array of the buffered mask
+
+    """
     if buffer_size > 10:
         bfs = int(buffer_size / 10)
-        if bfs * 10 != buffer_size:
-            log.warning("Approximating buffer size as 10*{} = {}".format(bfs, 10 * bfs))
         if cache is None:
-            cache = np.empty(mask_array.squeeze().shape, dtype=bool)
+            cache = np.empty(mask_array.shape, dtype=bool)
         ndimage.binary_erosion(
-            mask_array.squeeze(), structure=morph.disk(bfs), iterations=10, output=cache
+            mask_array, structure=morph.disk(bfs), iterations=10, output=cache
         )
     else:
-        cache = morph.binary_erosion(
-            mask_array.squeeze(), footprint=morph.disk(buffer_size)
-        )
-    np.copyto(mask_array, cache)
-    mask_array = None
-    mask = None
+        cache = morph.binary_erosion(mask_array, footprint=morph.disk(buffer_size))
+    return cache
 
 
 def apply_array_image_mask(array, mask, fill_value=0):
@@ -5572,6 +6503,172 @@ def scale_to_uint8(x, percentiles=[0, 100]):
     return xscaled.astype(np.uint8)
 
 
+# Class, R, G, B, A, label. The colours used for quicklooks of class maps with up to 13 classes.
+QUICKLOOK_CLASS_KEY = (
+    ["0", "0", "0", "0", "0", "No data"],
+    ["1", "0", "100", "0", "255", "Primary Forest"],
+    ["2", "154", "205", "50", "255", "Plantation Forest"],
+    ["3", "139", "69", "19", "255", "Bare Soil"],
+    ["4", "189", "183", "107", "255", "Crops"],
+    ["5", "240", "230", "140", "255", "Grassland"],
+    ["6", "0", "0", "205", "255", "Open Water"],
+    ["7", "128", "0", "0", "255", "Burn Scar"],
+    ["8", "255", "255", "255", "255", "Cloud"],
+    ["9", "60", "60", "60", "255", "Cloud Shadow"],
+    ["10", "128", "128", "128", "255", "Haze"],
+    ["11", "46", "139", "87", "255", "Open Woodland"],
+    ["12", "92", "145", "92", "255", "Toby's Woodland"],
+)
+
+
+def get_viridis_class_key(n_classes):
+    """
+    Returns a class colour key that spreads the viridis colour map over classes 0 to n_classes - 1.
+
+    Parameters
+    ----------
+    n_classes : int
+        The number of classes to colour, up to 255
+
+    Returns
+    -------
+    class_key : list of list
+        A class colour key; see :py:func:`class_key_to_lut`
+
+    """
+    viridis = cm.get_cmap("viridis", max(min(n_classes, 255), 1))
+    return [
+        [str(index)] + [str(int(channel * 255)) for channel in color] + [""]
+        for index, color in enumerate(viridis.colors)
+    ]
+
+
+def class_key_to_lut(class_key):
+    """
+    Turns a class colour key into a lookup table of RGBA colours indexed by class value. Classes missing from the key
+    are transparent. The table has one extra, transparent, row at the end for pixels outside the range of the key.
+
+    Parameters
+    ----------
+    class_key : list of list
+        Rows of [class, R, G, B, A, label], as strings or numbers, with classes from 0 upwards. The label is optional.
+
+    Returns
+    -------
+    lut : np.ndarray
+        A uint8 array of shape (max class + 2, 4)
+
+    """
+    classes = [int(row[0]) for row in class_key]
+    if min(classes) < 0:
+        raise ValueError("Class values in a colour key must not be negative")
+    lut = np.zeros((max(classes) + 2, 4), dtype=np.uint8)
+    for class_value, row in zip(classes, class_key):
+        lut[class_value] = [int(channel) for channel in row[1:5]]
+    return lut
+
+
+def class_key_to_color_table(class_key):
+    """
+    Turns a class colour key into a gdal colour table, for writing paletted Byte rasters.
+
+    Parameters
+    ----------
+    class_key : list of list
+        Rows of [class, R, G, B, A, label]; see :py:func:`class_key_to_lut`. Classes must be no higher than 254.
+
+    Returns
+    -------
+    color_table : gdal.ColorTable
+        A colour table with an entry for every value up to the highest class, plus one transparent entry above it.
+
+    """
+    lut = class_key_to_lut(class_key)
+    if len(lut) > 256:
+        raise ValueError("A paletted raster can only hold classes up to 254")
+    color_table = gdal.ColorTable()
+    for index, color in enumerate(lut):
+        color_table.SetColorEntry(index, tuple(int(channel) for channel in color))
+    return color_table
+
+
+def render_class_map(
+    class_path,
+    out_path,
+    class_key,
+    mode="rgba",
+    overview_levels=(2, 4, 8, 16, 32),
+    mem_limit_mb=1024,
+):
+    """
+    Colours a single-band class map with a class colour key, one block window at a time. Each window is coloured with
+    a single indexed lookup into the table from :py:func:`class_key_to_lut`; pixels whose class is not in the key are
+    transparent.
+
+    Parameters
+    ----------
+    class_path : str
+        Path to the class map. The first band is used.
+    out_path : str
+        Path to the Byte GeoTIFF to write.
+    class_key : list of list
+        Rows of [class, R, G, B, A, label]; see :py:func:`class_key_to_lut`.
+    mode : {'rgba', 'rgb', 'palette'}, optional
+        'rgba' and 'rgb' write four or three colour bands. 'palette' writes a single band of class values with the
+        key as its colour table, which is a quarter of the size but needs classes no higher than 254. Defaults to
+        'rgba'.
+    overview_levels : list of int, optional
+        The overview (pyramid) levels to build, with nearest neighbour resampling so that no new colours appear. Pass
+        None or an empty list for none. Defaults to (2, 4, 8, 16, 32).
+    mem_limit_mb : number, optional
+        The approximate memory ceiling, in MB, of each window. Defaults to 1024.
+
+    Returns
+    -------
+    out_path : str
+        The path of the coloured raster
+
+    """
+    if mode not in ("rgba", "rgb", "palette"):
+        raise ValueError("mode must be 'rgba', 'rgb' or 'palette', not {}".format(mode))
+    lut = class_key_to_lut(class_key)
+    outside_key = len(lut) - 1
+    class_raster = gdal.Open(class_path)
+    class_band = class_raster.GetRasterBand(1)
+    n_bands = {"rgba": 4, "rgb": 3, "palette": 1}[mode]
+    out_raster = create_matching_dataset(
+        class_raster, out_path, bands=n_bands, datatype=gdal.GDT_Byte
+    )
+    if mode == "palette":
+        out_raster.GetRasterBand(1).SetRasterColorTable(class_key_to_color_table(class_key))
+        out_raster.GetRasterBand(1).SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    else:
+        for band_index, interpretation in enumerate(
+            (gdal.GCI_RedBand, gdal.GCI_GreenBand, gdal.GCI_BlueBand, gdal.GCI_AlphaBand)[:n_bands]
+        ):
+            out_raster.GetRasterBand(band_index + 1).SetRasterColorInterpretation(interpretation)
+
+    for xoff, yoff, xsize, ysize in get_block_windows(
+        class_raster, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=16
+    ):
+        classes = class_band.ReadAsArray(xoff, yoff, xsize, ysize)
+        indexes = np.where((classes < 0) | (classes >= outside_key), outside_key, classes).astype(
+            np.intp, copy=False
+        )
+        if mode == "palette":
+            out_raster.GetRasterBand(1).WriteArray(indexes.astype(np.uint8), xoff, yoff)
+            continue
+        colors = lut[indexes]
+        for band_index in range(n_bands):
+            out_raster.GetRasterBand(band_index + 1).WriteArray(colors[..., band_index], xoff, yoff)
+
+    if overview_levels:
+        out_raster.BuildOverviews("NEAREST", list(overview_levels))
+    out_raster = None
+    class_raster = None
+    return out_path
+
+
 def create_quicklook(
     in_raster_path,
     out_raster_path,
@@ -5601,6 +6698,11 @@ def create_quicklook(
         List of the band numbers to be displayed as RGB. Will be ignored if only one band is in the image raster.
     nodata : number (optional)
         Missing data value.
+    scale_factors : list of list, optional
+        The gdal scaling of RGB images, as [[src_min, src_max, dst_min, dst_max]]. Defaults to [[0, 2000, 0, 255]].
+
+    Rasters with fewer than 3 bands are taken to be class maps and coloured with :py:func:`render_class_map`, using
+    QUICKLOOK_CLASS_KEY for up to 13 classes and viridis for more.
 
     Returns
     -------
@@ -5612,14 +6714,74 @@ def create_quicklook(
     # heightPct --- height of the output raster in percentage (100 = original height)
     # xRes --- output horizontal resolution
     # yRes --- output vertical resolution
+    quicklook_parameters = {
+        "width": width,
+        "height": height,
+        "format": format,
+        "bands": bands,
+        "nodata": nodata,
+        "scale_factors": scale_factors,
+    }
+    if is_output_up_to_date(out_raster_path, "quicklook", [in_raster_path], quicklook_parameters):
+        log.info("Quicklook is up to date: {}".format(out_raster_path))
+        return out_raster_path
+    try:
+        image = gdal.Open(in_raster_path, gdal.GA_ReadOnly)
+    except RuntimeError as e:
+        log.error("Error opening raster file: {}    /   {}".format(in_raster_path, e))
+        return
+
+    if image.RasterCount < 3:
+        # class maps are shrunk first and then coloured with a lookup table, so only the quicklook's own pixels
+        # are ever coloured
+        try:
+            class_band = image.RasterCount
+            band_max = int(image.GetRasterBand(class_band).ComputeRasterMinMax(False)[1])
+            if band_max < 13:
+                log.info("Using custom colour table for up to 12 classes (0..11)")
+                class_key = QUICKLOOK_CLASS_KEY
+            else:
+                class_key = get_viridis_class_key(band_max)
+            with TemporaryDirectory(dir=os.path.expanduser("~")) as td:
+                small_path = os.path.join(td, "quicklook_classes.tif")
+                colour_path = os.path.join(td, "quicklook_colours.tif")
+                gdal.Translate(
+                    small_path,
+                    image,
+                    options=gdal.TranslateOptions(
+                        format="GTiff",
+                        bandList=[class_band],
+                        width=width,
+                        height=height,
+                        resampleAlg="nearest",
+                    ),
+                )
+                render_class_map(small_path, colour_path, class_key, overview_levels=None)
+                driver = gdal.GetDriverByName(format)
+                driver.CreateCopy(out_raster_path, gdal.Open(colour_path), 0)
+            record_output(out_raster_path, "quicklook", [in_raster_path], quicklook_parameters)
+        except Exception as e:
+            log.error("An error occurred: {}".format(e))
+            log.error("  Skipping quicklook for image: {}".format(out_raster_path))
+            return
+        finally:
+            image = None
+        return out_raster_path
+
     with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
         try:
-            image = gdal.Open(in_raster_path, gdal.GA_ReadOnly)
             tmpfile_path = os.path.join(
                 td, os.path.basename(in_raster_path)[:-4] + "_copy.tif"
             )
             driver = gdal.GetDriverByName("GTiff")
-            driver.CreateCopy(tmpfile_path, image, 0)
+            driver.CreateCopy(
+                tmpfile_path,
+                image,
+                0,
+                options=get_creation_options(
+                    image.GetRasterBand(1).DataType, profile="scratch"
+                ),
+            )
             image = None
             image = gdal.Open(tmpfile_path, gdal.GA_Update)
         except RuntimeError as e:
@@ -5627,109 +6789,54 @@ def create_quicklook(
                 "Error opening raster file: {}    /   {}".format(in_raster_path, e)
             )
             return
-        # TODO: check data type of the in_raster - currently crashes when looking at images from the probabilities folder (wrong data type)
-        if image.RasterCount < 3:
-            # log.info("Raster count is {}. Using band 1.".format(image.RasterCount))
-            bands = [image.RasterCount]
-            alg = "nearest"
-            palette = "rgba"
-            band = image.GetRasterBand(1)
-            data = band.ReadAsArray()
-            scale_factors = None
-            output_type = gdal.GDT_Byte
-        else:
-            alg = None
-            palette = None
-            output_type = gdal.GDT_Byte
-            if scale_factors is None:
-                scale_factors = [[0, 2000, 0, 255]]  # this is specific to Sentinel-2
-            # log.info("Scaling values from {}...{} to {}...{}".format(scale_factors[0][0], scale_factors[0][1], scale_factors[0][2], scale_factors[0][3]))
+        if scale_factors is None:
+            scale_factors = [[0, 2000, 0, 255]]  # this is specific to Sentinel-2
+        # log.info("Scaling values from {}...{} to {}...{}".format(scale_factors[0][0], scale_factors[0][1], scale_factors[0][2], scale_factors[0][3]))
 
         # All the options that gdal.Translate() takes are listed here: gdal.org/python/osgeo.gdal-module.html#TranslateOptions
         kwargs = {
             "format": format,
-            "outputType": output_type,
+            "outputType": gdal.GDT_Byte,
             "bandList": bands,
             "noData": nodata,
             "width": width,
             "height": height,
-            "resampleAlg": alg,
+            "resampleAlg": None,
             "scaleParams": scale_factors,
-            "rgbExpand": palette,
+            "rgbExpand": None,
         }
+        # the returned dataset is not kept, so it is closed and flushed to disk straight away
+        gdal.Translate(
+            out_raster_path, image, options=gdal.TranslateOptions(**kwargs)
+        )
+        image = None
+    record_output(out_raster_path, "quicklook", [in_raster_path], quicklook_parameters)
+    return out_raster_path
 
-        if image.RasterCount < 3:
-            try:
-                # histo = np.array(band.GetHistogram())
-                # log.info("Histogram: {}".format(np.where(histo > 0)[0]))
-                # log.info("           {}".format(histo[np.where(histo > 0)]))
-                # log.info("Band data min, max: {}, {}".format(data.min(), data.max()))
-                colors = gdal.ColorTable()
-                # TODO: load a colour table (QGIS style file) from file if specified as an option by the function call
-                """
-                Comment: A *.qml file contains:
-                <colorPalette>
-                <paletteEntry label="0" color="#000000" alpha="255" value="0"/>
-                <paletteEntry label="1" color="#287d28" alpha="255" value="1"/>
-                <paletteEntry label="3" color="#c28540" alpha="255" value="3"/>
-                <paletteEntry label="4" color="#e1de0b" alpha="255" value="4"/>
-                <paletteEntry label="5" color="#bbdc00" alpha="255" value="5"/>
-                <paletteEntry label="11" color="#69de33" alpha="255" value="11"/>
-                <paletteEntry label="12" color="#3cd24b" alpha="255" value="12"/>
-                </colorPalette>
-                """
-
-                if data.max() < 13:
-                    log.info("Using custom colour table for up to 12 classes (0..11)")
-                    colors.SetColorEntry(0, (0, 0, 0, 0))  # no data
-                    colors.SetColorEntry(1, (0, 100, 0, 255))  # Primary Forest
-                    colors.SetColorEntry(2, (154, 205, 50, 255))  # plantation Forest
-                    colors.SetColorEntry(3, (139, 69, 19, 255))  # Bare Soil
-                    colors.SetColorEntry(4, (189, 183, 107, 255))  # Crops
-                    colors.SetColorEntry(5, (240, 230, 140, 255))  # Grassland
-                    colors.SetColorEntry(6, (0, 0, 205, 255))  # Open Water
-                    colors.SetColorEntry(7, (128, 0, 0, 255))  # Burn Scar
-                    colors.SetColorEntry(8, (255, 255, 255, 255))  # cloud
-                    colors.SetColorEntry(9, (60, 60, 60, 255))  # cloud shadow
-                    colors.SetColorEntry(10, (128, 128, 128, 255))  # Haze
-                    colors.SetColorEntry(11, (46, 139, 87, 255))  # Open Woodland
-                    colors.SetColorEntry(12, (92, 145, 92, 255))  # Toby's Woodland
-                else:
-                    # log.info("Using viridis colour table for {} classes".format(data.max()))
-                    viridis = cm.get_cmap("viridis", min(data.max(), 255))
-                    for index, color in enumerate(viridis.colors):
-                        colors.SetColorEntry(
-                            index,
-                            (
-                                int(color[0] * 255),
-                                int(color[1] * 255),
-                                int(color[2] * 255),
-                                int(color[3] * 255),
-                            ),
-                        )
-                band.SetRasterColorTable(colors)
-                band.WriteArray(data)
-                out_image = gdal.Translate(
-                    out_raster_path, image, options=gdal.TranslateOptions(**kwargs)
-                )
-                driver = gdal.GetDriverByName("PNG")
-                driver.CreateCopy(out_raster_path, out_image, 0)
-                data = None
-                out_image = None
-                image = None
-                band = None
-            except Exception as e:
-                log.error("An error occurred: {}".format(e))
-                log.error("  Skipping quicklook for image: {}".format(out_raster_path))
-                image = None
-                return
-        else:
-            out_image = gdal.Translate(
-                out_raster_path, image, options=gdal.TranslateOptions(**kwargs)
-            )
-            out_image = None
-            image = None
-        return out_raster_path
+
+def _write_combined_dates(date_images, out_raster, mem_limit_mb=1024):
+    """
+    :meta private:
+    Writes the earliest change detection date and the number of change detections over date_images into the two
+    bands of out_raster, one block window at a time. All rasters must share the grid of out_raster.
+    """
+    windows = get_block_windows(
+        out_raster,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=2 * 4 + 4 + 8 + 2,
+    )
+    for xoff, yoff, xsize, ysize in windows:
+        out_block = np.zeros((2, ysize, xsize), dtype=np.uint32)  # [bands, y, x]
+        for date_image in date_images:
+            date_block = date_image.GetRasterBand(1).ReadAsArray(xoff, yoff, xsize, ysize)
+            locs = (out_block[0, :, :] > 0) & (date_block > 0)
+            out_block[0, locs] = np.minimum(out_block[0, locs], date_block[locs])
+            locs = (out_block[0, :, :] == 0) & (date_block > 0)
+            out_block[0, locs] = date_block[locs]
+            out_block[1, :, :] += date_block > 0
+        for band in range(2):
+            out_raster.GetRasterBand(band + 1).WriteArray(out_block[band], xoff, yoff)
+    build_overviews(out_raster)
 
 
 def __combine_date_maps(date_image_paths, output_product):
@@ -5813,34 +6920,7 @@ def __combine_date_maps(date_image_paths, output_product):
         bands=2,
         datatype=gdal.GDT_UInt32,
     )
-    # Squeeze() to account for unaccountable extra dimension Windows patch adds
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write).squeeze()
-    out_raster_array[:, :, :] = 0  # [bands, y, x]
-    reference_projection = date_images[0].GetProjection()
-    time_steps = len(date_images)
-    for index, date_image in enumerate(date_images):
-        # TODO: *** within this processing loop, update the report layers indicating the length of temporal sequences of confirmed values
-        projection = date_image.GetProjection()
-        if projection != reference_projection:
-            log.warning(
-                "Skipping image with a different map projection: {} is not the same as {}".format(
-                    date_image, date_images[0]
-                )
-            )
-            time_steps = time_steps - 1
-            continue
-        date_array = date_image.GetVirtualMemArray().squeeze()
-        locs = (out_raster_array[0, :, :] > 0) & (date_array > 0)
-        out_raster_array[0, locs] = np.minimum(
-            out_raster_array[0, locs], date_array[locs]
-        )
-        locs = (out_raster_array[0, :, :] == 0) & (date_array > 0)
-        out_raster_array[0, locs] = date_array[locs]
-        date_mask = np.where(date_array > 0, 1, 0)
-        # log.info("Types: {} and {}".format(type(out_raster_array[1, 0, 0]), type(date_mask[0,0]))
-        out_raster_array[1, :, :] = np.add(out_raster_array[1, :, :], date_mask)
-        date_array = None
-        date_mask = None
+    _write_combined_dates(date_images, out_raster)
 
     """
     REMOVE THIS
@@ -5865,7 +6945,6 @@ def __combine_date_maps(date_image_paths, output_product):
     data_cube = None
     """
 
-    out_raster_array = None
     out_raster = None
     date_images = None
     return output_product
@@ -5947,32 +7026,7 @@ def combine_date_maps(date_image_paths, output_product):
         bands=2,
         datatype=gdal.GDT_UInt32,
     )
-    # Squeeze() to account for unaccountable extra dimension Windows patch adds
-    out_raster_array = out_raster.GetVirtualMemArray(eAccess=gdal.GF_Write).squeeze()
-    out_raster_array[:, :, :] = 0  # [bands, y, x]
-    reference_projection = date_images[0].GetProjection()
-    for index, date_image in enumerate(date_images):
-        projection = date_image.GetProjection()
-        if projection != reference_projection:
-            log.warning(
-                "Skipping image with a different map projection: {} is not the same as {}".format(
-                    date_image, date_images[0]
-                )
-            )
-            continue
-        date_array = date_image.GetVirtualMemArray().squeeze()
-        locs = (out_raster_array[0, :, :] > 0) & (date_array > 0)
-        out_raster_array[0, locs] = np.minimum(
-            out_raster_array[0, locs], date_array[locs]
-        )
-        locs = (out_raster_array[0, :, :] == 0) & (date_array > 0)
-        out_raster_array[0, locs] = date_array[locs]
-        date_mask = np.where(date_array > 0, 1, 0)
-        # log.info("Types: {} and {}".format(type(out_raster_array[1, 0, 0]), type(date_mask[0,0]))
-        out_raster_array[1, :, :] = np.add(out_raster_array[1, :, :], date_mask)
-        date_array = None
-        date_mask = None
-    out_raster_array = None
+    _write_combined_dates(date_images, out_raster)
     out_raster = None
     date_images = None
     return output_product
@@ -5993,13 +7047,18 @@ def sieve_image(image_path, out_path, neighbours=8, sieve=10, skip_existing=Fals
     sieve : int
         Number of pixels in a class polygon. Only polygons below this threshold will be removed. See GDAL Sieve documentation.
     skip_existing : boolean, optional
-        If True, skips the classification if the output file already exists.
+        If True, skips the sieve if the output file already exists. If a processing manifest is in use (see
+        :py:func:`pyeo_1.filesystem_utilities.use_processing_manifest`), outputs it has a record of are instead
+        skipped only if neither the class image nor the sieve parameters have changed.
     """
 
     if neighbours != 4 and neighbours != 8:
         log.warning("Invalid neighbour connectedness for sieve. Changing value to 4.")
         neighbours = 4
-    if os.path.exists(out_path) and skip_existing:
+    sieve_parameters = {"neighbours": neighbours, "sieve": sieve}
+    if is_output_up_to_date(
+        out_path, "sieve", [image_path], sieve_parameters, skip_existing=skip_existing
+    ):
         log.info("File exists. Skipping sieve stage. {}".format(out_path))
         return
     try:
@@ -6018,6 +7077,8 @@ def sieve_image(image_path, out_path, neighbours=8, sieve=10, skip_existing=Fals
         in_band = None
         out_band = None
         image = None
+        out_image = None
+        record_output(out_path, "sieve", [image_path], sieve_parameters)
     except:
         log.warning(
             "Could not open file for sieve filtering. Skipping. {}".format(image_path)
@@ -6075,9 +7136,11 @@ def sieve_directory(
     return out_image_paths
 
 
-def compress_tiff(in_path, out_path):
+def compress_tiff(in_path, out_path, profile=None):
     """
-    Compresses a Geotiff file using gdal.
+    Compresses a Geotiff file using gdal, rewriting it with the tiling, compression and overviews of an output
+    profile. If in_path and out_path are the same and the file already has the profile's compression and block size,
+    as it will when written by pyeo_1 with that profile, it is left as it is.
 
     Parameters
     ----------
@@ -6085,16 +7148,58 @@ def compress_tiff(in_path, out_path):
         The path to the input GeoTiff file.
     out_path : str
         The path to the output GeoTiff file.
-    """
+    profile : str, optional
+        The output profile to rewrite the file with - see the introduction for this module. Defaults to the profile
+        set by use_output_profile, or to 'archive' if that profile does not compress.
+    """
+    if profile is None:
+        profile = _output_profile
+        if get_output_profile(profile)["creation_options"].get("COMPRESS", "NONE") == "NONE":
+            profile = "archive"
+    settings = get_output_profile(profile)
+    creation_options = settings["creation_options"]
+    # a file compressed in place is its own input, so it is compressed again whenever it has been rewritten
+    if is_output_up_to_date(out_path, "compress", [in_path], {"profile": profile}):
+        log.info("{} is unchanged since it was compressed".format(out_path))
+        return
+    try:
+        image = gdal.Open(in_path)
+        datatype = image.GetRasterBand(1).DataType
+        compression = image.GetMetadataItem("COMPRESSION", "IMAGE_STRUCTURE") or "NONE"
+        block_size = image.GetRasterBand(1).GetBlockSize()
+        has_overviews = image.GetRasterBand(1).GetOverviewCount() > 0
+        image = None
+    except (RuntimeError, AttributeError) as e:
+        log.error("Error opening GeoTiff file: {}".format(in_path))
+        log.error("  {}".format(e))
+        return
+    if (
+        os.path.abspath(in_path) == os.path.abspath(out_path)
+        and compression.upper() == creation_options.get("COMPRESS", "NONE")
+        and block_size
+        == [
+            int(creation_options.get("BLOCKXSIZE", 0)),
+            int(creation_options.get("BLOCKYSIZE", 0)),
+        ]
+        and (has_overviews or not settings["overview_levels"])
+    ):
+        log.info("{} already matches output profile {}".format(in_path, profile))
+        record_output(out_path, "compress", [in_path], {"profile": profile})
+        return
     with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
         try:
             tmp_path = os.path.join(td, "tmp_compressed.tif")
-            # translateoptions = gdal.TranslateOptions(gdal.ParseCommandLine("-of GTiff -co COMPRESS=DEFLATE -co LZW -co OVERVIEWS=NONE"))
-            translateoptions = gdal.TranslateOptions(
-                gdal.ParseCommandLine("-of Gtiff -co COMPRESS=LZW")
+            gdal.Translate(
+                tmp_path,
+                in_path,
+                options=gdal.TranslateOptions(
+                    format="GTiff",
+                    creationOptions=get_creation_options(datatype, profile),
+                ),
             )
-            gdal.Translate(tmp_path, in_path, options=translateoptions)
+            build_overviews(tmp_path, profile)
             shutil.move(tmp_path, out_path)
+            record_output(out_path, "compress", [in_path], {"profile": profile})
         except RuntimeError as e:
             log.error("Error opening GeoTiff file: {}".format(in_path))
             log.error("  {}".format(e))
@@ -6119,7 +7224,14 @@ def write_n_band_tiff(tiff_paths: list, output_path: str) -> None:
     num_bands = len(tiff_paths)
 
     driver = gdal.GetDriverByName("GTiff")
-    output = driver.Create(output_path, num_cols, num_rows, num_bands, gdal.GDT_Byte)
+    output = driver.Create(
+        output_path,
+        num_cols,
+        num_rows,
+        num_bands,
+        gdal.GDT_Byte,
+        options=get_creation_options(gdal.GDT_Byte),
+    )
 
     for band_num, input_path in enumerate(tiff_paths):
         input_image = gdal.Open(input_path)
@@ -6138,6 +7250,7 @@ def write_n_band_tiff(tiff_paths: list, output_path: str) -> None:
 
     output.SetGeoTransform(reference.GetGeoTransform())
     output.SetProjection(reference.GetProjection())
+    build_overviews(output)
 
     output = None
 
@@ -24,7 +24,6 @@ import datetime as dt
 import calendar
 from pysolar import solar
 import pytz
-from scipy import stats
 
 import logging
 
@@ -84,6 +83,9 @@ def _generate_latlon_transformer(raster):
     native_projection.ImportFromWkt(raster.GetProjection())
     latlon_projection = osr.SpatialReference()
     latlon_projection.ImportFromEPSG(4326)
+    if hasattr(osr, "OAMS_TRADITIONAL_GIS_ORDER"):
+        # always return lon, lat whatever the GDAL version
+        latlon_projection.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
     geotransform = raster.GetGeoTransform()
     return (
         osr.CoordinateTransformation(native_projection, latlon_projection),
@@ -94,25 +96,137 @@ def _generate_latlon_transformer(raster):
 def generate_latlon(x, y, geotransform, transformer):
     x_geo, y_geo = cm.pixel_to_point_coordinates([y, x], geotransform)
     lon, lat, _ = transformer.TransformPoint(x_geo, y_geo)
-    return np.fromiter((lat, lon), np.half)
+    return np.fromiter((lat, lon), np.float32)
 
 
-def _generate_latlon_arrays(array, transformer, geotransform):
-    def generate_latlon_for_here(x, y):
-        return generate_latlon(x, y, geotransform, transformer)
+def _generate_grid_positions(size, grid_spacing):
+    """Pixel positions of the nodes of a coarse grid along one axis, always including the first and last pixel"""
+    return np.unique(np.append(np.arange(0, size, grid_spacing), size - 1))
 
-    # The crude way. Ask someone if it is doable.
-    # Turns out it's not, at least not this way.
-    # Time for more linspace!
 
-    latlon_array = np.empty((array.size, 2))
-    x_list = np.arange(array.shape[0])
-    y_list = np.arange(array.shape[1])
-    x_mesh, y_mesh = np.meshgrid(x_list, y_list)
-    x_mesh = x_mesh.ravel()
-    y_mesh = y_mesh.ravel()
-    latlon_array[..., :] = list(map(generate_latlon_for_here, x_mesh, y_mesh))
-    return latlon_array[0], latlon_array[1]
+def _generate_latlon_grid(transformer, geotransform, x_size, y_size, grid_spacing=100):
+    """
+    Transforms the top-left corners of every grid_spacing-th pixel of a raster to lat-lon in one call.
+    Returns the pixel rows and columns of the grid nodes and the latitude and longitude of each node.
+    """
+    grid_rows = _generate_grid_positions(y_size, grid_spacing)
+    grid_cols = _generate_grid_positions(x_size, grid_spacing)
+    col_mesh, row_mesh = np.meshgrid(grid_cols, grid_rows)
+    x_geo = geotransform[0] + col_mesh * geotransform[1] + row_mesh * geotransform[2]
+    y_geo = geotransform[3] + col_mesh * geotransform[4] + row_mesh * geotransform[5]
+    points = np.array(
+        transformer.TransformPoints(
+            np.stack((x_geo.ravel(), y_geo.ravel()), axis=1).tolist()
+        )
+    )
+    lon_grid = points[:, 0].reshape(col_mesh.shape)
+    lat_grid = points[:, 1].reshape(col_mesh.shape)
+    return grid_rows, grid_cols, lat_grid, lon_grid
+
+
+def _interpolate_grid(grid_values, grid_rows, grid_cols, xoff, yoff, x_size, y_size):
+    """
+    Bilinearly interpolates values on a coarse grid of pixel positions to every pixel of a window.
+    Returns a float32 array of shape (y_size, x_size).
+    """
+    cols = np.arange(xoff, xoff + x_size)
+    rows = np.arange(yoff, yoff + y_size)
+    along_x = np.stack(
+        [np.interp(cols, grid_cols, row_values) for row_values in grid_values]
+    )
+    if len(grid_rows) == 1:
+        return np.broadcast_to(along_x, (y_size, x_size)).astype(np.float32)
+    lower = np.clip(
+        np.searchsorted(grid_rows, rows, side="right") - 1, 0, len(grid_rows) - 2
+    )
+    weight = (rows - grid_rows[lower]) / (grid_rows[lower + 1] - grid_rows[lower])
+    return (
+        (1 - weight)[:, np.newaxis] * along_x[lower]
+        + weight[:, np.newaxis] * along_x[lower + 1]
+    ).astype(np.float32)
+
+
+def _generate_latlon_arrays(array, transformer, geotransform, grid_spacing=100):
+    """
+    Returns the latitude and longitude of every pixel of array, interpolated from a coarse grid of transformed points.
+    """
+    y_size, x_size = array.shape[-2:]
+    grid_rows, grid_cols, lat_grid, lon_grid = _generate_latlon_grid(
+        transformer, geotransform, x_size, y_size, grid_spacing
+    )
+    lat_array = _interpolate_grid(lat_grid, grid_rows, grid_cols, 0, 0, x_size, y_size)
+    lon_array = _interpolate_grid(lon_grid, grid_rows, grid_cols, 0, 0, x_size, y_size)
+    return lat_array, lon_array
+
+
+def get_solar_angle_grid(raster, raster_datetime, grid_spacing=100):
+    """
+    Calculates the solar zenith and azimuth angles on a coarse grid over a raster. Pysolar is called once for the
+    whole grid; the angles for individual pixels are interpolated from it with :py:func:`interpolate_solar_angles`.
+
+    Parameters
+    ----------
+    raster : gdal.Dataset
+        The raster to cover
+    raster_datetime
+        The time of the image, with timezone set
+    grid_spacing : int, optional
+        The distance between grid nodes in pixels. Defaults to 100.
+
+    Returns
+    -------
+    A dict of the pixel 'rows' and 'cols' of the grid nodes and the 'zenith' angle and the sine and cosine of the
+    azimuth angle ('sin_azimuth', 'cos_azimuth') at each node. The azimuth is kept as sine and cosine so that it can
+    be interpolated across north.
+
+    """
+    transformer, geotransform = _generate_latlon_transformer(raster)
+    grid_rows, grid_cols, lat_grid, lon_grid = _generate_latlon_grid(
+        transformer, geotransform, raster.RasterXSize, raster.RasterYSize, grid_spacing
+    )
+    azimuth_grid = calc_azimuth_array(lat_grid, lon_grid, raster_datetime)
+    altitude_grid = calc_altitude_array(lat_grid, lon_grid, raster_datetime)
+    return {
+        "rows": grid_rows,
+        "cols": grid_cols,
+        "zenith": 90 - altitude_grid,
+        "sin_azimuth": _deg_sin(azimuth_grid),
+        "cos_azimuth": _deg_cos(azimuth_grid),
+    }
+
+
+def interpolate_solar_angles(solar_grid, xoff, yoff, x_size, y_size):
+    """
+    Interpolates a grid from :py:func:`get_solar_angle_grid` to every pixel of a window.
+    Returns float32 arrays of the zenith angle and the sine and cosine of the azimuth angle.
+    """
+    zenith, sin_azimuth, cos_azimuth = [
+        _interpolate_grid(
+            solar_grid[name],
+            solar_grid["rows"],
+            solar_grid["cols"],
+            xoff,
+            yoff,
+            x_size,
+            y_size,
+        )
+        for name in ("zenith", "sin_azimuth", "cos_azimuth")
+    ]
+    # renormalise the interpolated azimuth direction
+    norm = np.hypot(sin_azimuth, cos_azimuth)
+    norm[norm == 0] = 1
+    return zenith, sin_azimuth / norm, cos_azimuth / norm
+
+
+def _ic_from_solar_angles(zenith, sin_azimuth, cos_azimuth, slope, aspect):
+    """The illumination condition of equation 9, with cos(azimuth - aspect) expanded for interpolated azimuths"""
+    cos_relative_azimuth = cos_azimuth * _deg_cos(aspect) + sin_azimuth * _deg_sin(
+        aspect
+    )
+    return (
+        _deg_cos(zenith) * _deg_cos(slope)
+        + _deg_sin(zenith) * _deg_sin(slope) * cos_relative_azimuth
+    ).astype(np.float32)
 
 
 def generate_slope_and_aspect_rasters(dem_raster_path, out_directory):
@@ -126,19 +240,31 @@ def generate_slope_and_aspect_rasters(dem_raster_path, out_directory):
 
 
 def calculate_ic_array(
-    slope_raster_path, aspect_raster_path, raster_datetime, ic_raster_out_path=None
+    slope_raster_path,
+    aspect_raster_path,
+    raster_datetime,
+    ic_raster_out_path=None,
+    grid_spacing=100,
+    mem_limit_mb=1024,
 ):
     """
-    Given a slope and an aspect raster, creates an array of the illumination conditions as specified in https://ieeexplore.ieee.org/document/8356797, equation 9. The Pysolar library is used to calculate solar position.
+    Given a slope and an aspect raster, creates an array of the illumination conditions as specified in https://ieeexplore.ieee.org/document/8356797, equation 9. The Pysolar library is used to calculate solar position
+    on a coarse grid, which is interpolated to every pixel; the calculation itself runs block by block.
 
     Parameters
     ----------
-    dem_raster_path : str
-        The path to a raster containing the DEM in question
+    slope_raster_path : str
+        The path to a raster containing the slope of the DEM in degrees
+    aspect_raster_path : str
+        The path to a raster containing the aspect of the DEM in degrees
     raster_datetime
         The time of day _with timezone set_ for the
     ic_raster_out_path : str
         If present, saves a raster of the illumination condition
+    grid_spacing : int, optional
+        The distance in pixels between the points at which the solar position is calculated. Defaults to 100.
+    mem_limit_mb : number, optional
+        The maximum amount of memory, in MB, to use for each block. Defaults to 1024.
 
     Returns
     -------
@@ -146,60 +272,61 @@ def calculate_ic_array(
     Each pixel is a value between -1 and 1
 
     """
-
-    with TemporaryDirectory() as td:
-        slope_image = gdal.Open(slope_raster_path)
-        slope_array = (
-            slope_image.ReadAsArray()
-        )  # This is returned, so we can't use GetVirtualMemArray()
-        aspect_image = gdal.Open(aspect_raster_path)
-        aspect_array = aspect_image.GetVirtualMemArray()
-
-        print("Calculating latlon arrays (this takes a while, for some reason.")
-        transformer, geotransform = _generate_latlon_transformer(slope_image)
-        lat_array, lon_array = _generate_latlon_arrays(
-            aspect_array, transformer, geotransform
+    slope_image = gdal.Open(slope_raster_path)
+    aspect_image = gdal.Open(aspect_raster_path)
+    solar_grid = get_solar_angle_grid(slope_image, raster_datetime, grid_spacing)
+    shape = (slope_image.RasterYSize, slope_image.RasterXSize)
+    ic_array = np.empty(shape, dtype=np.float32)
+    zenith_array = np.empty(shape, dtype=np.float32)
+    slope_array = np.empty(shape, dtype=np.float32)
+    windows = ras.get_block_windows(
+        slope_image, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=40
+    )
+    for xoff, yoff, x_size, y_size in windows:
+        window = np.s_[yoff : yoff + y_size, xoff : xoff + x_size]
+        zenith, sin_azimuth, cos_azimuth = interpolate_solar_angles(
+            solar_grid, xoff, yoff, x_size, y_size
         )
-
-        print("pixels to process: {}".format(np.product(lat_array.shape)))
-        ic_array, zenith_array = ic_calculation(
-            lat_array, lon_array, aspect_array, slope_array, raster_datetime
+        slope_array[window] = slope_image.GetRasterBand(1).ReadAsArray(
+            xoff, yoff, x_size, y_size
         )
+        ic_array[window] = _ic_from_solar_angles(
+            zenith,
+            sin_azimuth,
+            cos_azimuth,
+            slope_array[window],
+            aspect_image.GetRasterBand(1).ReadAsArray(xoff, yoff, x_size, y_size),
+        )
+        zenith_array[window] = zenith
 
-        if ic_raster_out_path:
-            ras.save_array_as_image(
-                ic_array,
-                ic_raster_out_path,
-                aspect_image.GetGeoTransform(),
-                aspect_image.GetProjection(),
-            )
-        return ic_array, zenith_array, slope_array
+    if ic_raster_out_path:
+        ras.save_array_as_image(
+            ic_array,
+            ic_raster_out_path,
+            aspect_image.GetGeoTransform(),
+            aspect_image.GetProjection(),
+        )
+    return ic_array, zenith_array, slope_array
 
 
 def calc_azimuth_array(lat_array, lon_array, raster_datetime):
-    def calc_azimuth_for_datetime(lat, lon):
-        return solar.get_azimuth_fast(lat, lon, raster_datetime).astype(
-            np.dtype("float32")
-        )
-
-    return np.array(list(map(calc_azimuth_for_datetime, lat_array, lon_array)))
+    return np.asarray(
+        solar.get_azimuth_fast(lat_array, lon_array, raster_datetime),
+        dtype=np.float32,
+    )
 
 
 def calc_altitude_array(lat_array, lon_array, raster_datetime):
-    def calc_altitude_for_datetime(lat, lon):
-        return solar.get_altitude_fast(lat, lon, raster_datetime).astype(
-            np.dtype("float32")
-        )
-
-    return np.array(list(map(calc_altitude_for_datetime, lat_array, lon_array)))
+    return np.asarray(
+        solar.get_altitude_fast(lat_array, lon_array, raster_datetime),
+        dtype=np.float32,
+    )
 
 
 def ic_calculation(lat_array, lon_array, aspect_array, slope_array, raster_datetime):
-    print("Precomputing azimuth, altitude and and zenith arrays")
     azimuth_array = calc_azimuth_array(lat_array, lon_array, raster_datetime)
     altitude_array = calc_altitude_array(lat_array, lon_array, raster_datetime)
     zenith_array = 90 - altitude_array
-    print("Beginning IC calculation.")
     ic_array = _deg_cos(zenith_array) * _deg_cos(slope_array) + _deg_sin(
         zenith_array
     ) * _deg_sin(slope_array) * _deg_cos(azimuth_array - aspect_array)
@@ -228,20 +355,29 @@ def build_sample_array(raster_array, slope_array, red_band_index, ir_band_index)
 
 
 def do_terrain_correction(
-    raster_path, dem_path, out_raster_path, raster_datetime, is_landsat=False
+    raster_path,
+    dem_path,
+    out_raster_path,
+    raster_datetime,
+    is_landsat=False,
+    grid_spacing=100,
+    mem_limit_mb=1024,
 ):
     """
     Corrects for shadow effects due to terrain features.
     Algorithm:
 
     * Generate slope and aspect from DEM using gdaldem
-    * Calculate solar position from datatake sensing start and location of image
+    * Calculate solar position from datatake sensing start and location of image, on a coarse grid
     * Calculate the correction factor for that image from the sun zenith angle, azimuth angle, DEM aspect and DEM slope
     * Build a mask of green areas using NDVI
     * Perform a linear regression based on that IC calculation and the contents of the L2 image to get ground slope(?)
     * Correct pixel p in original image with following: p_out = p_in - (ground_slope*(IC-cos(sun_zenith)))
     * Write to output
 
+    The image is processed in float32, block by block, in two passes: the first accumulates the regression of every
+    band against the illumination condition and the second applies the correction.
+
     Parameters
     ----------
     raster_path
@@ -252,28 +388,40 @@ def do_terrain_correction(
         The path to the output.
     raster_datetime
         A datetime.DateTime object **with timezone set**
+    is_landsat
+        Landsat reflectance scaling is not implemented; must be False.
+    grid_spacing
+        The distance in pixels between the points at which the solar position is calculated. Defaults to 100.
+    mem_limit_mb
+        The maximum amount of memory, in MB, to use for each block. Defaults to 1024.
+
+    Raises
+    ------
+    ValueError
+        If is_landsat is True.
 
     """
+    if is_landsat:
+        # The magic numbers from the original paper for this were never confirmed:
+        # ref_multi_this_band = 2.0e-5
+        # ref_add_this_band = -0.1
+        # ref_array = (ref_multi_this_band * in_array + ref_add_this_band) / _deg_cos(zenith_array.T)
+        raise ValueError(
+            "do_terrain_correction only supports Sentinel-2 images; Landsat reflectance scaling is not available, "
+            "so is_landsat must be False for {}".format(raster_path)
+        )
 
     with TemporaryDirectory() as td:
         in_raster = gdal.Open(raster_path)
-        in_array = in_raster.GetVirtualMemArray()
+        n_bands = in_raster.RasterCount
         out_raster = ras.create_matching_dataset(
             in_raster,
             out_raster_path,
-            bands=in_raster.RasterCount,
+            bands=n_bands,
             datatype=gdal.GDT_Float32,
         )
-        out_array = out_raster.GetVirtualMemArray(eAccess=gdal.GA_Update)
 
-        # These are being saved for convenience of ras.save_array_as_image
-        # Using globals like this is a Bad Idea in real code
-        global DEBUG_PROJECTION
-        global DEBUG_GT
-        DEBUG_PROJECTION = in_raster.GetProjection()
-        DEBUG_GT = in_raster.GetGeoTransform()
-
-        print("Preprocessing DEM")
+        log.info("Preprocessing DEM")
         # If we resample then extract slope and angle, then they have Weird Holes in them that correspond to the centre
         # of pixels. So we need to extract then preprocess -_-
         slope_raster_path, angle_raster_path = generate_slope_and_aspect_rasters(
@@ -281,52 +429,86 @@ def do_terrain_correction(
         )
         slope_raster_path = preprocess_dem(slope_raster_path, raster_path, td)
         angle_raster_path = preprocess_dem(angle_raster_path, raster_path, td)
-        ic_array, zenith_array, slope_array = calculate_ic_array(
-            slope_raster_path, angle_raster_path, raster_datetime, "ic_array.tif"
-        )
-
-        if is_landsat:
-            in_array = in_array.T
-
-        if len(in_array.shape) == 2:
-            in_array = np.expand_dims(in_array, 0)
-
-        if is_landsat:
-            print("Calculating reflectance array")
-            # Oh no, magic numbers. I think these were from the original paper? Are they for Landsat?
-        # ref_multi_this_band = 2.0e-5
-        # ref_add_this_band = -0.1
-        # ref_array = (ref_multi_this_band * in_array + ref_add_this_band) / _deg_cos(zenith_array.T)
-        else:
-            print("Meatball reflectance test")
-            ref_array = np.divide(
-                in_array, 10000, dtype=np.half
-            )  # This number straight from Sahid.
-            # ref_array = in_array
+        slope_image = gdal.Open(slope_raster_path)
+        aspect_image = gdal.Open(angle_raster_path)
 
-        print("Calculating sample array")
-        sample_array = build_sample_array(
-            ref_array, slope_array, red_band_index=2, ir_band_index=3
-        )
-        ras.save_array_as_image(
-            sample_array.astype(np.short),
-            "sample_array.tif",
-            DEBUG_GT,
-            DEBUG_PROJECTION,
+        log.info("Calculating solar angles on a {} pixel grid".format(grid_spacing))
+        solar_grid = get_solar_angle_grid(in_raster, raster_datetime, grid_spacing)
+        windows = ras.get_block_windows(
+            in_raster,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=4 * (3 * n_bands + 8),
         )
-        band_indicies = sample_array[0, ...].nonzero()
 
-        print("Beginning linear regression")
-        for i, band in enumerate(sample_array[:, ...]):
-            print("Processing band {} of {}".format(i + 1, ref_array.shape[0]))
-            out_array[i, ...] = correct_reflectance(
-                band, band_indicies, i, ic_array, ref_array, zenith_array
+        def read_window(xoff, yoff, x_size, y_size):
+            # reflectance (this number straight from Sahid), illumination condition, cos(zenith) and sample array
+            ref_array = np.divide(
+                in_raster.ReadAsArray(xoff, yoff, x_size, y_size),
+                10000,
+                dtype=np.float32,
             )
+            if ref_array.ndim == 2:
+                ref_array = np.expand_dims(ref_array, 0)
+            zenith, sin_azimuth, cos_azimuth = interpolate_solar_angles(
+                solar_grid, xoff, yoff, x_size, y_size
+            )
+            slope_array = slope_image.GetRasterBand(1).ReadAsArray(
+                xoff, yoff, x_size, y_size
+            )
+            aspect_array = aspect_image.GetRasterBand(1).ReadAsArray(
+                xoff, yoff, x_size, y_size
+            )
+            ic_array = _ic_from_solar_angles(
+                zenith, sin_azimuth, cos_azimuth, slope_array, aspect_array
+            )
+            with np.errstate(divide="ignore", invalid="ignore"):
+                sample_array = build_sample_array(
+                    ref_array, slope_array, red_band_index=2, ir_band_index=3
+                )
+            return ref_array, ic_array, _deg_cos(zenith), sample_array
+
+        log.info("Accumulating linear regression of reflectance on illumination")
+        # n, sum(ic), sum(ic^2), sum(band) and sum(ic*band) for each band
+        sums = np.zeros((n_bands, 5))
+        for xoff, yoff, x_size, y_size in windows:
+            ref_array, ic_array, cos_zenith, sample_array = read_window(
+                xoff, yoff, x_size, y_size
+            )
+            band_indicies = sample_array[0, ...].nonzero()
+            ic_samples = ic_array[band_indicies].astype(np.float64)
+            for i, band in enumerate(sample_array):
+                band_samples = band[band_indicies].astype(np.float64)
+                sums[i] += (
+                    ic_samples.size,
+                    ic_samples.sum(),
+                    np.dot(ic_samples, ic_samples),
+                    band_samples.sum(),
+                    np.dot(ic_samples, band_samples),
+                )
+        n, sum_ic, sum_ic2, sum_band, sum_ic_band = sums.T
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slopes = (n * sum_ic_band - sum_ic * sum_band) / (n * sum_ic2 - sum_ic**2)
+        slopes = np.nan_to_num(slopes)
+        log.info("Regression slopes by band: {}".format(slopes))
+
+        log.info("Applying terrain correction")
+        for xoff, yoff, x_size, y_size in windows:
+            ref_array, ic_array, cos_zenith, sample_array = read_window(
+                xoff, yoff, x_size, y_size
+            )
+            for i, band in enumerate(sample_array):
+                out_raster.GetRasterBand(i + 1).WriteArray(
+                    correct_reflectance(
+                        band, slopes[i], ic_array, cos_zenith, ref_array[i, ...]
+                    ),
+                    xoff,
+                    yoff,
+                )
 
-    out_array = None
-    out_raster = None
-    ref_array = None
-    in_raster = None
+        out_raster = None
+        slope_image = None
+        aspect_image = None
+        in_raster = None
 
 
 def preprocess_dem(dem_path, raster_path, out_directory):
@@ -345,13 +527,10 @@ def preprocess_dem(dem_path, raster_path, out_directory):
     return clipped_dem_path
 
 
-def correct_reflectance(band, band_indicies, i, ic_array, ref_array, zenith_array):
-    import joblib
-
-    ic_for_linregress = ic_array[band_indicies[0], band_indicies[1]].ravel()
-    band_for_linregress = band[band_indicies[0], band_indicies[1]].ravel()
-    slope, _, _, _, _ = stats.linregress(ic_for_linregress, band_for_linregress)
-    corrected_band = band - (slope * (ic_array - _deg_cos(zenith_array)))
-    joblib.dump(ic_for_linregress, f"{i}_ic")
-    joblib.dump(band_for_linregress, f"{i}_band")
-    return np.where(band > 0, corrected_band, ref_array[i, ...])
+def correct_reflectance(band, band_slope, ic_array, cos_zenith_array, ref_band):
+    """
+    Applies p_out = p_in - (ground_slope*(IC-cos(sun_zenith))) to the sampled pixels of one band, falling back to the
+    uncorrected reflectance elsewhere.
+    """
+    corrected_band = band - (band_slope * (ic_array - cos_zenith_array))
+    return np.where(band > 0, corrected_band, ref_band)
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from osgeo import gdal, osr
+
+import pyeo_1.change_cube as change_cube
+
+
+def _write_template(path, x_size, y_size):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    raster = gdal.GetDriverByName("GTiff").Create(str(path), x_size, y_size, 1, gdal.GDT_Int32)
+    raster.SetGeoTransform([500000, 10, 0, 9000000, 0, -10])
+    raster.SetProjection(srs.ExportToWkt())
+    raster = None
+    return str(path)
+
+
+def test_change_cube_append_and_read(tmp_path):
+    template_path = _write_template(tmp_path / "template.tif", 45, 30)
+    cube = change_cube.ChangeCube.create(str(tmp_path / "cube"), template_path, chunk_size=16)
+    rng = np.random.default_rng(0)
+    change = rng.integers(-1, 3, (3, 30, 45)).astype(np.int32)
+    ndvi = rng.integers(-100, 100, (3, 30, 45)).astype(np.int16)
+    dates = ["20230105T074151", "20230115T074151", "20230204T074151"]
+    for date, change_layer, ndvi_layer in zip(dates, change, ndvi):
+        assert cube.append(date, {"change": change_layer, "NDVI": ndvi_layer})
+    assert not cube.append(dates[1], {"change": change[1]})
+    with pytest.raises(ValueError):
+        cube.append("20221231T000000", {"change": change[0]})
+
+    # reopening sees the same data, across chunk boundaries and along time
+    cube = change_cube.ChangeCube(str(tmp_path / "cube"))
+    assert cube.dates == dates
+    assert np.array_equal(cube.read("change"), change)
+    assert np.array_equal(cube.read("NDVI", 10, 5, 20, 20, time_index=slice(1, 3)), ndvi[1:3, 5:25, 10:30])
+    assert np.array_equal(cube.read("change", time_index=2), change[2])
+    assert np.array_equal(cube.pixel_series("NDVI", 40, 29), ndvi[:, 29, 40])
+    assert not cube.read("dNDVI").any()
+
+    out_path = cube.map_chunks(
+        lambda series: change_cube.summarise_change_series(series["change"]), ["change"], str(tmp_path / "summary.tif")
+    )
+    assert np.array_equal(gdal.Open(out_path).ReadAsArray(), change_cube.summarise_change_series(change))
+
+
+def test_time_series_operations():
+    # one pixel per column: 0 no change, -1 cloud, otherwise the change date
+    change = np.array(
+        [
+            [5, 0, 5, 0],
+            [6, -1, -1, 0],
+            [0, 7, 7, 0],
+            [8, 8, 8, 0],
+        ]
+    )[:, np.newaxis, :]
+    longest, current = change_cube.run_lengths(change > 0, ignore=change == -1)
+    assert longest.tolist() == [[2, 2, 3, 0]]
+    assert current.tolist() == [[1, 2, 3, 0]]
+    assert change_cube.first_true_index(change > 0).tolist() == [[0, 2, 0, -1]]
+    assert change_cube.first_change_date(change).tolist() == [[5, 7, 5, 0]]
+    assert change_cube.repeatability(change).tolist() == [[75, 100, 100, 0]]
@@ -1,11 +1,12 @@
 import glob
 import os
 
-from osgeo import gdal
+from osgeo import gdal, ogr, osr
 import numpy as np
 import pytest
 
 import pyeo_1.classification
+import pyeo_1.exceptions
 
 
 @pytest.mark.slow
@@ -32,3 +33,85 @@ def test_raster_reclass_binary():
     out_filename = 'test_outputs/class_composite_T36NYF_20180112T075259_20180117T075241_rcl.tif'
     a = pyeo_1.classification.raster_reclass_binary(test_image_name, test_value, outFn=out_filename)
     assert np.all(np.unique(a) == [0, 1])
+
+
+def test_build_training_samples(tmp_path, monkeypatch):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    raster_path = str(tmp_path / "training.tif")
+    raster = gdal.GetDriverByName("GTiff").Create(raster_path, 20, 10, 2, gdal.GDT_UInt16)
+    raster.SetGeoTransform([500000, 10, 0, 9000100, 0, -10])
+    raster.SetProjection(srs.ExportToWkt())
+    band_values = np.arange(400, dtype=np.uint16).reshape(2, 10, 20)
+    for band_index in range(2):
+        raster.GetRasterBand(band_index + 1).WriteArray(band_values[band_index])
+    raster = None
+
+    shapefile = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(str(tmp_path / "training.shp"))
+    layer = shapefile.CreateLayer("training", srs=srs, geom_type=ogr.wkbPolygon)
+    layer.CreateField(ogr.FieldDefn("CODE", ogr.OFTInteger))
+    # pixel windows as (col1, col2, row1, row2) and their class
+    windows = {1: (0, 10, 0, 10), 2: (15, 16, 2, 4)}
+    for code, (col1, col2, row1, row2) in windows.items():
+        x1, x2 = 500000 + col1 * 10, 500000 + col2 * 10
+        y1, y2 = 9000100 - row1 * 10, 9000100 - row2 * 10
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetField("CODE", code)
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(
+            f"POLYGON(({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))"))
+        layer.CreateFeature(feature)
+    shapefile = None
+
+    cache_dir = str(tmp_path / "cache")
+    monkeypatch.chdir(tmp_path)
+    learning_data, classes, labels = pyeo_1.classification.build_training_samples(
+        [raster_path], balanced=False, cache_dir=cache_dir)
+    assert sorted(labels) == [1, 2]
+    assert np.count_nonzero(classes == 1) == 100 and np.count_nonzero(classes == 2) == 2
+    class_2_pixels = learning_data[classes == 2]
+    assert sorted(class_2_pixels[:, 1].tolist()) == sorted(band_values[1, 2:4, 15].tolist())
+    cached = os.listdir(cache_dir)
+    assert len(cached) == 1 and cached[0].endswith(".npz")
+
+    # a second run reads the cache and draws at most ten times the smallest class from each class
+    monkeypatch.setattr(pyeo_1.classification, "shapefile_to_raster", None)
+    learning_data, classes, labels = pyeo_1.classification.build_training_samples(
+        [raster_path], balanced=True, cache_dir=cache_dir)
+    assert np.count_nonzero(classes == 1) == 20 and np.count_nonzero(classes == 2) == 2
+    assert learning_data.shape == (22, 2)
+
+
+def test_classify_directory_with_workers(tmp_path, monkeypatch):
+    import joblib
+    from sklearn.ensemble import RandomForestClassifier
+
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    in_dir = tmp_path / "images"
+    in_dir.mkdir()
+    out_dir = tmp_path / "classified"
+    out_dir.mkdir()
+    rng = np.random.default_rng(0)
+    for name in ("first", "second", "third"):
+        raster = gdal.GetDriverByName("GTiff").Create(str(in_dir / (name + ".tif")), 30, 20, 2, gdal.GDT_UInt16)
+        raster.SetGeoTransform([500000, 10, 0, 9000200, 0, -10])
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index in range(2):
+            raster.GetRasterBand(band_index + 1).WriteArray(rng.integers(1, 1000, (20, 30)).astype(np.uint16))
+        raster = None
+    model = RandomForestClassifier(n_estimators=3, random_state=0)
+    model.fit(rng.integers(1, 1000, (50, 2)), np.arange(50) % 2 + 1)
+    model_path = str(tmp_path / "model.pkl")
+    joblib.dump(model, model_path)
+    monkeypatch.chdir(tmp_path)
+
+    pyeo_1.classification.classify_directory(str(in_dir), model_path, str(out_dir), n_workers=2)
+    assert sorted(os.listdir(out_dir)) == ["first_class.tif", "second_class.tif", "third_class.tif"]
+
+    # a failure in a worker is raised once the other images are done
+    (in_dir / "broken.tif").write_bytes(b"not a raster")
+    for path in out_dir.iterdir():
+        path.unlink()
+    with pytest.raises(pyeo_1.exceptions.ClassificationException):
+        pyeo_1.classification.classify_directory(str(in_dir), model_path, str(out_dir), n_workers=2)
+    assert sorted(os.listdir(out_dir)) == ["first_class.tif", "second_class.tif", "third_class.tif"]
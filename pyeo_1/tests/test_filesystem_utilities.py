@@ -1,4 +1,5 @@
 import os
+import zipfile
 
 import pyeo_1.filesystem_utilities
 
@@ -17,3 +18,116 @@ def test_l2_validation():
     test_wrong = "test_data/S2A_MSIL2A_20170922T025541_N0205_R032_T48MXU_20170922T031550.SAFE"
     assert pyeo_1.filesystem_utilities.check_for_invalid_l2_data(test_wrong) == 0
 
+
+
+def test_file_catalogue(tmp_path):
+    fu = pyeo_1.filesystem_utilities
+    l1_dir = tmp_path / "L1C"
+    l2_dir = tmp_path / "L2A"
+    l1_name = "S2A_MSIL1C_20230101T074151_N0509_R092_T36NXG_20230101T094052.SAFE"
+    l2_name = "S2A_MSIL2A_20230101T074151_N0509_R092_T36NXG_20230101T110830.SAFE"
+    band_dir = l2_dir / l2_name / "GRANULE" / "L2A_T36NXG" / "IMG_DATA" / "R10m"
+    band_dir.mkdir(parents=True)
+    (l1_dir / l1_name).mkdir(parents=True)
+    for band in ("B02", "B03"):
+        (band_dir / f"T36NXG_20230101T074151_{band}_10m.jp2").touch()
+    for name in ("S2A_MSIL2A_20221201T074151_N0509_R092_T36NXG_20221201T110830.tif",
+                 "S2A_MSIL2A_20221215T074151_N0509_R092_T36NXG_20221215T110830.tif"):
+        (tmp_path / name).touch()
+
+    walked = [fu.get_filenames(str(l2_dir / l2_name), "B02", "R10m"),
+              fu.get_l1_safe_file(l2_name, str(l1_dir)),
+              fu.get_l2_safe_file(l1_name, str(l2_dir)),
+              fu.get_preceding_image_path(l2_name, str(tmp_path))]
+    catalogue = fu.use_catalogue(str(tmp_path / "catalogue.sqlite"))
+    try:
+        assert [fu.get_filenames(str(l2_dir / l2_name), "B02", "R10m"),
+                fu.get_l1_safe_file(l2_name, str(l1_dir)),
+                fu.get_l2_safe_file(l1_name, str(l2_dir)),
+                fu.get_preceding_image_path(l2_name, str(tmp_path))] == walked
+        assert walked[3].endswith("20221215T110830.tif")
+        # lookups that find something in directories already indexed do not touch the disk until the catalogue is
+        # invalidated; lookups that find nothing bring the index up to date and try again
+        (band_dir / "T36NXG_20230101T074151_B04_10m.jp2").touch()
+        (tmp_path / "S2A_MSIL2A_20221220T074151_N0509_R092_T36NXG_20221220T110830.tif").touch()
+        (tmp_path / "S2A_MSIL2A_20221225T074151_N0509_R092_T36NXG_20221225T110830.TIF").touch()
+        assert len(fu.get_filenames(str(l2_dir / l2_name), "B04", "R10m")) == 1
+        assert fu.get_preceding_image_path(l2_name, str(tmp_path)).endswith("20221215T110830.tif")
+        # a directory that does not exist yet is indexed once it does
+        later_dir = tmp_path / "later"
+        assert fu.get_filenames(str(later_dir), "B02", "") == []
+        later_dir.mkdir()
+        (later_dir / "T36NXG_20230101T074151_B02_10m.jp2").touch()
+        assert len(fu.get_filenames(str(later_dir), "B02", "")) == 1
+        fu.invalidate_catalogue(str(band_dir))
+        assert len(fu.get_filenames(str(l2_dir / l2_name), "B04", "R10m")) == 1
+        fu.invalidate_catalogue()
+        # new files are picked up from the changed directory modification times; .TIF is not a .tif
+        assert fu.get_preceding_image_path(l2_name, str(tmp_path)).endswith("20221220T110830.tif")
+        os.remove(band_dir / "T36NXG_20230101T074151_B02_10m.jp2")
+        fu.invalidate_catalogue()
+        assert fu.get_filenames(str(l2_dir), "B02", "R10m") == []
+        assert catalogue.find_safe_product(str(l1_dir), "MSIL2A", "20230101T074151", "T36NXG") is None
+    finally:
+        fu.use_catalogue(None)
+
+
+def test_zipped_safe_lookups(tmp_path):
+    l1_name = "S2A_MSIL1C_20230105T074151_N0509_R092_T36NXG_20230105T094052"
+    l2_name = "S2A_MSIL2A_20230105T074151_N0509_R092_T36NXG_20230105T100000"
+    granule = "GRANULE/L2A_T36NXG_A039432_20230105T075402/IMG_DATA"
+    l2_bands = [f"R10m/T36NXG_20230105T074151_{band}_10m.jp2" for band in ("B02", "B03", "B04", "B08")]
+    l2_bands.append("R20m/T36NXG_20230105T074151_SCL_20m.jp2")
+    l1_bands = [f"T36NXG_20230105T074151_{band}.jp2" for band in ("B02", "B03", "B04", "B08")]
+    # zip_contents archives the contents of a product, a download the .SAFE directory itself
+    with zipfile.ZipFile(tmp_path / f"{l2_name}.zip", "w") as archive:
+        for band in l2_bands:
+            archive.writestr(f"{granule}/{band}", "")
+    with zipfile.ZipFile(tmp_path / f"{l1_name}.SAFE.zip", "w") as archive:
+        for band in l1_bands:
+            archive.writestr(f"{l1_name}.SAFE/{granule}/{band}", "")
+
+    l2_safe = str(tmp_path / f"{l2_name}.SAFE")
+    l1_safe = str(tmp_path / f"{l1_name}.SAFE")
+    assert pyeo_1.filesystem_utilities.resolve_safe_path(l2_safe) == "/vsizip/" + str(tmp_path / f"{l2_name}.zip")
+    assert pyeo_1.filesystem_utilities.check_for_invalid_l2_data(l2_safe) == 1
+    assert pyeo_1.filesystem_utilities.check_for_invalid_l1_data(l1_safe) == 1
+    assert pyeo_1.filesystem_utilities.get_filenames(l2_safe, "SCL", "R20m") == [
+        f"/vsizip/{tmp_path}/{l2_name}.zip/{granule}/R20m/T36NXG_20230105T074151_SCL_20m.jp2"
+    ]
+    assert pyeo_1.filesystem_utilities.glob_safe(l1_safe, "GRANULE/*/IMG_DATA/*_B02.jp2") == [
+        f"/vsizip/{tmp_path}/{l1_name}.SAFE.zip/{l1_name}.SAFE/{granule}/T36NXG_20230105T074151_B02.jp2"
+    ]
+
+
+def test_processing_manifest(tmp_path):
+    in_path = tmp_path / "class.tif"
+    in_path.write_bytes(b"classes")
+    out_path = tmp_path / "class_sieved.tif"
+    out_path.write_bytes(b"sieved")
+    futils = pyeo_1.filesystem_utilities
+    try:
+        futils.use_processing_manifest(str(tmp_path / "manifest.sqlite"))
+        # without a record, skip_existing decides as before
+        assert not futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 10})
+        assert futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 10}, skip_existing=True)
+
+        futils.record_output(str(out_path), "sieve", [str(in_path)], {"sieve": 10})
+        assert futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 10})
+        assert not futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 20}, skip_existing=True)
+        assert not futils.is_output_up_to_date(str(out_path), "sieve", [], {"sieve": 10})
+
+        # touching an input does not make the output stale, changing it does
+        stat = os.stat(in_path)
+        os.utime(in_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        assert futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 10})
+        in_path.write_bytes(b"CLASSES")
+        assert not futils.is_output_up_to_date(str(out_path), "sieve", [str(in_path)], {"sieve": 10}, skip_existing=True)
+
+        # a stage that rewrites its output in place lists it as its own input
+        futils.record_output(str(out_path), "compress", [str(out_path)], {"profile": "archive"})
+        assert futils.is_output_up_to_date(str(out_path), "compress", [str(out_path)], {"profile": "archive"})
+        out_path.write_bytes(b"sieved again")
+        assert not futils.is_output_up_to_date(str(out_path), "compress", [str(out_path)], {"profile": "archive"})
+    finally:
+        futils.use_processing_manifest(None)
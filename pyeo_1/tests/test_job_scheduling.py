@@ -0,0 +1,69 @@
+import json
+import sys
+
+import pyeo_1.job_scheduling as job_scheduling
+
+
+def _append_command(path, text, exit_code=0):
+    return [
+        sys.executable,
+        "-c",
+        f"open({str(path)!r}, 'a').write({text!r} + '\\n'); raise SystemExit({exit_code})",
+    ]
+
+
+def test_job_scheduler_dependencies_and_ledger(tmp_path):
+    order_path = tmp_path / "order.txt"
+    ledger_path = str(tmp_path / "ledger.json")
+    scheduler = job_scheduling.JobScheduler(
+        job_scheduling.LocalBackend(str(tmp_path)), max_jobs=2, ledger_path=ledger_path
+    )
+    scheduler.add_job("a_vector", _append_command(order_path, "a_vector"), depends_on=["a_raster"])
+    scheduler.add_job("a_raster", _append_command(order_path, "a_raster"))
+    scheduler.add_job("b_raster", _append_command(order_path, "b_raster", exit_code=1))
+    scheduler.add_job("b_vector", _append_command(order_path, "b_vector"), depends_on=["b_raster"])
+
+    states = scheduler.run()
+
+    assert states == {"a_raster": "done", "a_vector": "done", "b_raster": "failed", "b_vector": "skipped"}
+    order = order_path.read_text().split()
+    assert order.index("a_raster") < order.index("a_vector")
+    assert "b_vector" not in order
+    with open(ledger_path) as ledger_file:
+        assert json.load(ledger_file)["b_raster"]["returncode"] == 1
+
+    # resuming runs only the jobs that did not finish
+    scheduler = job_scheduling.JobScheduler(
+        job_scheduling.LocalBackend(str(tmp_path)), ledger_path=ledger_path, resume=True
+    )
+    scheduler.add_job("a_raster", _append_command(order_path, "a_raster"))
+    scheduler.add_job("b_raster", _append_command(order_path, "b_raster"))
+    assert scheduler.run() == {"a_raster": "done", "b_raster": "done"}
+    assert order_path.read_text().split().count("a_raster") == 1
+
+
+class _CountingBackend(job_scheduling.LocalBackend):
+    """A local backend that records the most jobs it has had running at once"""
+
+    def __init__(self):
+        super().__init__()
+        self.procs = []
+        self.most_running = 0
+
+    def launch(self, job):
+        proc = super().launch(job)
+        self.procs.append(proc)
+        running = [proc for proc in self.procs if proc.poll() is None]
+        self.most_running = max(self.most_running, len(running))
+        return proc
+
+
+def test_job_scheduler_memory_limit():
+    sleep_command = [sys.executable, "-c", "import time; time.sleep(0.5)"]
+    for mem_limit_mb, most_running in ((1000, 1), (None, 3)):
+        backend = _CountingBackend()
+        scheduler = job_scheduling.JobScheduler(backend, max_jobs=3, mem_limit_mb=mem_limit_mb)
+        for name in ("first", "second", "third"):
+            scheduler.add_job(name, sleep_command, mem_mb=600)
+        assert scheduler.run() == {"first": "done", "second": "done", "third": "done"}
+        assert backend.most_running == most_running
@@ -128,3 +128,199 @@ def test_download_s2_pairs(monkeypatch):
     l2_dir = "test_data/test_pairs/L2"
     test_conf = load_test_conf()
     pyeo_1.queries_and_downloads.download_s2_pairs(l1_dir, l2_dir, test_conf)
+
+
+def _serve_dataspace_product(archive_bytes, received_ranges):
+    # a local stand-in for the Dataspace token endpoint and the redirecting product download endpoint
+    import json
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers["Content-Length"]))
+            body = json.dumps({"access_token": "token", "refresh_token": "refresh",
+                               "expires_in": 600, "refresh_expires_in": 3600}).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.startswith("/odata"):
+                self.send_response(307)
+                self.send_header("Location", "/download/product.zip")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            assert self.headers["Authorization"] == "Bearer token"
+            start = 0
+            if self.headers["Range"]:
+                received_ranges.append(self.headers["Range"])
+                start = int(self.headers["Range"].split("=")[1].split("-")[0])
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{len(archive_bytes) - 1}/{len(archive_bytes)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Length", str(len(archive_bytes) - start))
+            self.end_headers()
+            self.wfile.write(archive_bytes[start:])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_download_dataspace_product_resumes(tmp_path):
+    import io
+    import logging
+    import zipfile
+
+    product_name = "S2A_MSIL1C_20230101T074151_N0509_R092_T36NXG_20230101T094052.SAFE"
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zipped:
+        zipped.writestr(f"{product_name}/manifest.safe", "manifest" * 1000)
+    archive_bytes = archive.getvalue()
+    # simulate a download that was interrupted after 100 bytes
+    with open(tmp_path / f"{product_name}.zip.part", "wb") as partial:
+        partial.write(archive_bytes[:100])
+
+    received_ranges = []
+    server = _serve_dataspace_product(archive_bytes, received_ranges)
+    root_url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        pyeo_1.queries_and_downloads.download_dataspace_product(
+            product_uuid="1234",
+            dataspace_username="user",
+            dataspace_password="pass",
+            product_name=product_name,
+            safe_directory=str(tmp_path),
+            log=logging.getLogger(__name__),
+            auth=pyeo_1.queries_and_downloads.DataspaceAuth("user", "pass", token_url=f"{root_url}/token"),
+            download_url=f"{root_url}/odata/Products",
+        )
+    finally:
+        server.shutdown()
+
+    assert received_ranges == ["bytes=100-"]
+    assert (tmp_path / product_name / "manifest.safe").read_text() == "manifest" * 1000
+    assert not (tmp_path / f"{product_name}.zip.part").exists()
+
+
+def test_download_dataspace_reports_l1c_products(tmp_path):
+    import io
+    import logging
+    import zipfile
+
+    import pandas as pd
+
+    l1c_dir = tmp_path / "L1C"
+    l2a_dir = tmp_path / "L2A"
+    l2a_dir.mkdir()
+    # one L1C product is already on disk, the other is downloaded
+    existing_name = "S2A_MSIL1C_20221225T074151_N0509_R092_T36NXG_20221225T094052.SAFE"
+    band_dir = l1c_dir / existing_name / "GRANULE" / "L1C_T36NXG" / "IMG_DATA"
+    band_dir.mkdir(parents=True)
+    for band in ("B02", "B03", "B04", "B08"):
+        (band_dir / f"T36NXG_20221225T074151_{band}.jp2").touch()
+    new_name = "S2A_MSIL1C_20230101T074151_N0509_R092_T36NXG_20230101T094052.SAFE"
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zipped:
+        zipped.writestr(f"{new_name}/manifest.safe", "manifest")
+    product_df = pd.DataFrame({"title": [existing_name, new_name], "processinglevel": ["Level-1C", "Level-1C"],
+                               "uuid": ["1234", "5678"]})
+
+    server = _serve_dataspace_product(archive.getvalue(), [])
+    root_url = f"http://127.0.0.1:{server.server_address[1]}"
+    ready = []
+    try:
+        pyeo_1.queries_and_downloads.download_s2_data_from_dataspace(
+            product_df, str(l1c_dir), str(l2a_dir), "user", "pass", logging.getLogger(__name__),
+            n_workers=2, download_url=f"{root_url}/odata/Products", token_url=f"{root_url}/token",
+            on_l1c_ready=ready.append,
+        )
+    finally:
+        server.shutdown()
+
+    # every L1C product is handed on, e.g. to Sen2CorPool.submit, once it is on disk
+    assert sorted(ready) == [str(l1c_dir / existing_name), str(l1c_dir / new_name)]
+    assert (l1c_dir / new_name / "manifest.safe").exists()
+
+
+class _RecordedDataspaceSession:
+    """Answers Dataspace searches from a list of recorded features, counting the requests made"""
+
+    def __init__(self, features):
+        self.features = features
+        self.requests = []
+
+    def get(self, url):
+        from urllib.parse import parse_qs, urlsplit
+
+        params = {key: values[0] for key, values in parse_qs(urlsplit(url).query).items()}
+        self.requests.append(params)
+        matches = [
+            feature for feature in self.features
+            if feature["properties"]["startDate"] >= params["startDate"]
+            # as Dataspace does, a date-only completionDate includes products acquired at any time that day
+            and feature["properties"]["completionDate"][:10] <= params["completionDate"]
+        ]
+        max_records = int(params["maxRecords"])
+        page = int(params.get("page", 1))
+        body = {
+            "features": matches[(page - 1) * max_records: page * max_records],
+            "properties": {"totalResults": len(matches)},
+        }
+
+        class Response:
+            status_code = 200
+
+            def json(self):
+                return body
+
+        return Response()
+
+
+def test_query_dataspace_by_polygon_cache(tmp_path):
+    import datetime
+    import logging
+
+    features = [
+        {
+            "id": f"product-{day}",
+            "properties": {
+                "title": f"S2A_MSIL1C_202301{day:02d}T074151_N0509_R092_T36NXG.SAFE",
+                "startDate": f"2023-01-{day:02d}T07:41:51Z",
+                "completionDate": f"2023-01-{day:02d}T07:42:00Z",
+            },
+        }
+        for day in range(1, 29)
+    ]
+    session = _RecordedDataspaceSession(features[:20])
+    cache_path = str(tmp_path / "query_cache.sqlite")
+
+    def query(start_date, end_date):
+        return pyeo_1.queries_and_downloads.query_dataspace_by_polygon(
+            max_cloud_cover=25, start_date=start_date, end_date=end_date, area_of_interest="POINT (33 0)",
+            max_records=3, log=logging.getLogger(__name__), cache_path=cache_path, resync_days=0, session=session
+        )
+
+    products = query("2023-01-01", "2023-01-21")
+    assert products["title"].tolist() == [feature["properties"]["title"] for feature in features[:20]]
+    assert len(session.requests) == 7
+
+    # answered from the cache alone, including the product acquired on the end date itself
+    session.requests = []
+    products = query("2023-01-05", "2023-01-12")
+    assert products["title"].tolist() == [feature["properties"]["title"] for feature in features[4:12]]
+    assert session.requests == []
+
+    # a later run only asks for the dates after the last search
+    session.features = features
+    session.requests = []
+    products = query("2023-01-01", (datetime.date.today() + datetime.timedelta(days=1)).isoformat())
+    assert len(products) == 28
+    assert all(request["startDate"] == "2023-01-21" for request in session.requests)
@@ -1,6 +1,8 @@
 import glob
 import os
 import shutil
+import sys
+import warnings
 
 import numpy as np
 
@@ -388,4 +390,524 @@ def test_create_new_image_from_polygon():
     pyeo_1.raster_manipulation.create_new_image_from_polygon(polygon, out_path, x_res, y_res, bands,
                                   projection, format="GTiff", datatype=gdal.GDT_Int32, nodata=-4)
     out = gdal.Open(out_path)
-    assert np.all(out.ReadAsArray() == -4)
\ No newline at end of file
+    assert np.all(out.ReadAsArray() == -4)
+
+def test_get_block_windows():
+    driver = gdal.GetDriverByName("MEM")
+    dataset = driver.Create("", 1000, 700, 4, gdal.GDT_UInt16)
+    windows = pyeo_1.raster_manipulation.get_block_windows(dataset, mem_limit=1000 * 100 * 8)
+    assert len(windows) == 7
+    coverage = np.zeros((700, 1000), dtype=np.uint8)
+    for xoff, yoff, xsize, ysize in windows:
+        coverage[yoff:yoff + ysize, xoff:xoff + xsize] += 1
+    assert np.all(coverage == 1)
+
+
+def test_get_change_report_increment(tmp_path):
+    report_path = str(tmp_path / "report_20220101T000000_T36NXG_20230105T074151.tif")
+    open(report_path, "w").close()
+    settings = {"baseline": "composite_T36NXG_20220101T000000_class.tif", "change_from": [1, 2], "change_to": [3]}
+    old_images = ["S2A_MSIL2A_20230101T074151_N0509_R092_T36NXG_20230101T094052_class.tif",
+                  "S2B_MSIL2A_20230105T074151_N0509_R092_T36NXG_20230105T094052_class.tif"]
+    new_image = "S2A_MSIL2A_20230110T074151_N0509_R092_T36NXG_20230110T094052_class.tif"
+    late_image = "S2B_MSIL2A_20230103T074151_N0509_R092_T36NXG_20230103T094052_class.tif"
+    increment = pyeo_1.raster_manipulation.get_change_report_increment
+    assert increment(report_path, old_images, settings) is None
+    pyeo_1.raster_manipulation.save_change_report_manifest(report_path, settings, old_images)
+    assert increment(report_path, old_images, settings) == []
+    assert increment(report_path, old_images + [new_image], settings) == [new_image]
+    assert increment(report_path, old_images + [late_image], settings) is None
+    assert increment(report_path, old_images + [new_image], dict(settings, change_to=[4])) is None
+
+
+def _reference_report_update(out_report_array, change_array, dNDVI_array, new_class_array, change_from, change_to,
+                             dNDVI_threshold, dNDVI_scale_factor=100):
+    # The whole-image report layer expressions used before the report was built block by block
+    dNDVI_limit = int(dNDVI_threshold * dNDVI_scale_factor)
+    locs = out_report_array[0, :, :] >= 0
+    out_report_array[0, locs] = out_report_array[0, locs] + 1
+    locs = change_array == -1
+    out_report_array[1, locs] = out_report_array[1, locs] + 1
+    locs = change_array > 0
+    out_report_array[2, locs] = out_report_array[2, locs] + 1
+    locs = (out_report_array[3, :, :] == 0) & (change_array > 0) & (dNDVI_array < dNDVI_limit)
+    out_report_array[3, locs] = change_array[locs]
+    locs = (out_report_array[3, :, :] > 0) & (change_array > 0) & (dNDVI_array < dNDVI_limit)
+    out_report_array[3, locs] = np.minimum(out_report_array[3, locs], change_array[locs])
+    locs = (change_array > 0) & (dNDVI_array < dNDVI_limit) & (out_report_array[3, :, :] > 0)
+    out_report_array[4, locs] = out_report_array[4, locs] + 1
+    locs = (change_array == 0) & (out_report_array[3, :, :] > 0)
+    out_report_array[5, locs] = out_report_array[5, locs] + 1
+    locs = (change_array == -1) & (out_report_array[3, :, :] > 0)
+    out_report_array[6, locs] = out_report_array[6, locs] + 1
+    locs = out_report_array[3, :, :] > 0
+    out_report_array[7, locs] = out_report_array[4, locs] + out_report_array[5, locs]
+    out_report_array[8, locs] = (100 * out_report_array[4, locs]) / out_report_array[7, locs]
+    out_report_array[9, :, :] = 0
+    out_report_array[9, (out_report_array[8, :, :] >= 50) & (out_report_array[4, :, :] >= 5)] = 1
+    out_report_array[10, :, :] = out_report_array[3, :, :] * out_report_array[9, :, :]
+    locs = (change_array >= 0) & (dNDVI_array < dNDVI_limit)
+    out_report_array[11, locs] = out_report_array[11, locs] + 1
+    out_report_array[12, :, :] = 0
+    out_report_array[12, out_report_array[11, :, :] >= 5] = 1
+    out_report_array[13, :, :] = 0
+    out_report_array[13, out_report_array[2, :, :] >= 5] = 1
+    out_report_array[14, :, :] = 0
+    out_report_array[14, (out_report_array[12, :, :] > 0) & (out_report_array[13, :, :] > 0)] = 1
+    locs = np.isin(new_class_array, change_from)
+    out_report_array[15, locs] = out_report_array[15, locs] + 1
+    locs = np.isin(new_class_array, change_to)
+    out_report_array[16, locs] = out_report_array[16, locs] + 1
+    out_report_array[17, :, :] = 0
+    out_report_array[17, (out_report_array[15, :, :] >= 2) & (out_report_array[16, :, :] >= 2)] = 1
+
+
+def test_update_change_report_layers():
+    rng = np.random.default_rng(42)
+    shape = (50, 60)
+    expected = np.zeros((18,) + shape, dtype=np.int16)
+    report = np.zeros((18,) + shape, dtype=np.int16)
+    for date in range(8000, 8240, 12):
+        change_array = rng.choice([-1, 0, date], size=shape, p=[0.2, 0.4, 0.4]).astype(np.int32)
+        dNDVI_array = rng.integers(-60, 40, size=shape).astype(np.int32)
+        new_class_array = rng.integers(0, 12, size=shape).astype(np.uint8)
+        _reference_report_update(expected, change_array, dNDVI_array, new_class_array, [1, 2], [3, 4], -0.2)
+        # update the report in two windows to check that the kernel is independent of the window layout
+        for window in (np.s_[:, :20], np.s_[:, 20:]):
+            block = report[(slice(None),) + window].copy()
+            pyeo_1.raster_manipulation.update_change_report_layers(
+                block, change_array[window], dNDVI_array[window], new_class_array[window], [1, 2], [3, 4], -0.2)
+            report[(slice(None),) + window] = block
+        assert np.array_equal(report, expected)
+    assert np.any(report[17]) and np.any(report[10])
+
+
+def _write_test_band(path, array, resolution, datatype):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    raster = gdal.GetDriverByName("GTiff").Create(
+        path, array.shape[1], array.shape[0], 1, datatype)
+    raster.SetGeoTransform([500000, resolution, 0, 9000000, 0, -resolution])
+    raster.SetProjection(srs.ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(array)
+    raster = None
+
+
+def _write_test_l2a_product(directory):
+    # a minimal L2A product; GDAL opens the GeoTIFF bands regardless of their .jp2 extension
+    product = "S2A_MSIL2A_20230105T074151_N0509_R092_T36NXG_20230105T100000"
+    granule = directory / (product + ".SAFE") / "GRANULE" / "L2A_T36NXG_A000000_20230105T074151" / "IMG_DATA"
+    os.makedirs(granule / "R10m")
+    os.makedirs(granule / "R20m")
+    rng = np.random.default_rng(0)
+    bands = rng.integers(0, 12000, (2, 300, 300)).astype(np.uint16)
+    for band_index, band in enumerate(["B02", "B08"]):
+        _write_test_band(str(granule / "R10m" / f"T36NXG_20230105T074151_{band}_10m.jp2"), bands[band_index], 10,
+                         gdal.GDT_UInt16)
+    scl = rng.choice(np.array([4, 5, 9], dtype=np.uint8), size=(150, 150), p=[0.5, 0.49, 0.01])
+    _write_test_band(str(granule / "R20m" / "T36NXG_20230105T074151_SCL_20m.jp2"), scl, 20, gdal.GDT_Byte)
+    return product, bands, scl
+
+
+def test_preprocess_l2a_safe_file(tmp_path):
+    product, bands, scl = _write_test_l2a_product(tmp_path)
+
+    out_path = pyeo_1.raster_manipulation.preprocess_l2a_safe_file(
+        str(tmp_path / (product + ".SAFE")), str(tmp_path / (product + ".tif")), [9], buffer_size=2,
+        bands=["B02", "B08"], apply_offset=True, mem_limit_mb=0.5)
+
+    assert os.path.basename(out_path) == product.replace("N0509", "NA509") + ".tif"
+    mask = pyeo_1.raster_manipulation.buffer_mask_array(
+        np.logical_not(np.isin(scl.repeat(2, axis=0).repeat(2, axis=1), [9])), 2)
+    expected = np.clip(np.where(mask, bands, 0), 1000, 10000) - 1000
+    out_raster = gdal.Open(out_path)
+    assert out_raster.GetRasterBand(2).GetDescription() == "B08"
+    assert np.array_equal(out_raster.ReadAsArray(), expected)
+
+
+def test_apply_scl_cloud_mask_skips_offset_outputs(tmp_path, monkeypatch):
+    l2_dir = tmp_path / "L2A"
+    out_dir = tmp_path / "cloud_masked"
+    os.makedirs(l2_dir)
+    os.makedirs(out_dir)
+    product, _, _ = _write_test_l2a_product(l2_dir)
+    written = []
+    preprocess = pyeo_1.raster_manipulation.preprocess_l2a_safe_file
+
+    def counting_preprocess(*args, **kwargs):
+        written.append(preprocess(*args, **kwargs))
+        return written[-1]
+
+    monkeypatch.setattr(pyeo_1.raster_manipulation, "preprocess_l2a_safe_file", counting_preprocess)
+
+    def mask(**kwargs):
+        pyeo_1.raster_manipulation.apply_scl_cloud_mask(
+            str(l2_dir), str(out_dir), [9], bands=["B02", "B08"], apply_offset=True, mem_limit_mb=0.5, **kwargs)
+
+    # the offset output is written as NA509, not under the N0509 name of the product
+    mask(skip_existing=True)
+    mask(skip_existing=True)
+    assert written == [str(out_dir / (product.replace("N0509", "NA509") + ".tif"))]
+
+    try:
+        pyeo_1.filesystem_utilities.use_processing_manifest(str(tmp_path / "manifest.sqlite"))
+        mask()
+        mask()
+        assert len(written) == 2
+        # changed parameters make the recorded output stale
+        mask(buffer_size=2)
+        assert len(written) == 3
+    finally:
+        pyeo_1.filesystem_utilities.use_processing_manifest(None)
+
+
+def test_get_creation_options():
+    options = pyeo_1.raster_manipulation.get_creation_options(gdal.GDT_UInt16, profile="archive")
+    assert {"TILED=YES", "COMPRESS=DEFLATE", "PREDICTOR=2"} <= set(options)
+    assert "PREDICTOR=3" in pyeo_1.raster_manipulation.get_creation_options(gdal.GDT_Float32, profile="cog")
+    scratch_options = pyeo_1.raster_manipulation.get_creation_options(gdal.GDT_Byte, profile="scratch")
+    assert "TILED=YES" in scratch_options
+    assert not any(option.startswith(("COMPRESS", "PREDICTOR")) for option in scratch_options)
+    assert pyeo_1.raster_manipulation.get_creation_options(gdal.GDT_Byte, format="PNG") == []
+    with pytest.raises(ValueError):
+        pyeo_1.raster_manipulation.use_output_profile("fastest")
+
+
+def test_stack_images(tmp_path):
+    first = np.arange(300 * 520, dtype=np.uint16).reshape(300, 520)
+    second = np.arange(260 * 300, dtype=np.uint16).reshape(260, 300) + 1
+    _write_test_band(str(tmp_path / "first.tif"), first, 10, gdal.GDT_UInt16)
+    _write_test_band(str(tmp_path / "second.tif"), second, 10, gdal.GDT_UInt16)
+    out_path = str(tmp_path / "stack.tif")
+    # a small memory limit splits the bands into several windows
+    pyeo_1.raster_manipulation.stack_images([str(tmp_path / "first.tif"), str(tmp_path / "second.tif")], out_path,
+                                            geometry_mode="union", profile="archive", mem_limit_mb=0.2)
+    stack = gdal.Open(out_path)
+    # uint16 reflectances are stacked as uint16
+    assert stack.GetRasterBand(1).DataType == gdal.GDT_UInt16
+    assert stack.GetMetadata("IMAGE_STRUCTURE").get("COMPRESSION") == "DEFLATE"
+    expected_second = np.zeros((300, 520), dtype=np.uint16)
+    expected_second[:260, :300] = second
+    assert np.array_equal(stack.ReadAsArray(), np.stack([first, expected_second]))
+    # a nodata value the inputs' datatype cannot hold widens the stack
+    pyeo_1.raster_manipulation.stack_images([str(tmp_path / "first.tif"), str(tmp_path / "second.tif")], out_path,
+                                            geometry_mode="union", nodata_value=-1)
+    stack = gdal.Open(out_path)
+    assert stack.GetRasterBand(1).DataType == gdal.GDT_Int32
+    assert np.all(stack.GetRasterBand(2).ReadAsArray()[260:, :] == -1)
+
+
+def test_combine_masks(tmp_path):
+    rng = np.random.default_rng(0)
+    first = rng.integers(0, 2, (300, 520)).astype(np.uint8)
+    second = rng.integers(0, 2, (300, 520)).astype(np.uint8)
+    _write_test_band(str(tmp_path / "first.msk"), first, 10, gdal.GDT_Byte)
+    _write_test_band(str(tmp_path / "second.msk"), second, 10, gdal.GDT_Byte)
+    mask_paths = [str(tmp_path / "first.msk"), str(tmp_path / "second.msk")]
+    # masks are written block by block straight into the compressed default profile
+    pyeo_1.raster_manipulation.combine_masks(
+        mask_paths, str(tmp_path / "or.msk"), combination_func="or", mem_limit_mb=0.1)
+    pyeo_1.raster_manipulation.add_masks(mask_paths, str(tmp_path / "added.msk"), mem_limit_mb=0.1)
+    combined = gdal.Open(str(tmp_path / "or.msk"))
+    assert combined.GetMetadata("IMAGE_STRUCTURE").get("COMPRESSION") == "DEFLATE"
+    assert np.array_equal(combined.ReadAsArray(), first | second)
+    assert np.array_equal(gdal.Open(str(tmp_path / "added.msk")).ReadAsArray(), first + second)
+
+
+def test_update_composite_with_images(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+
+    def write_raster(path, array, x_min, y_max):
+        raster = gdal.GetDriverByName("GTiff").Create(
+            str(path), array.shape[2], array.shape[1], array.shape[0], gdal.GDT_UInt16)
+        raster.SetGeoTransform([x_min, 10, 0, y_max, 0, -10])
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index, band in enumerate(array):
+            raster.GetRasterBand(band_index + 1).WriteArray(band)
+        raster = None
+        return str(path)
+
+    rng = np.random.default_rng(0)
+    composite = rng.integers(1, 100, (2, 50, 60)).astype(np.uint16)
+    composite_path = write_raster(tmp_path / "composite.tif", composite, 500000, 9000500)
+    image = rng.integers(1, 100, (2, 40, 45)).astype(np.uint16)
+    image[:, :5, :] = 0
+    image_path = write_raster(
+        tmp_path / "S2A_MSIL2A_20230105T074151_N0509_R092_T36NXG_20230105T100000.tif", image, 500200, 9000300)
+    out_path = str(tmp_path / "updated.tif")
+
+    pyeo_1.raster_manipulation.update_composite_with_images(
+        composite_path, [image_path], out_path, mem_limit_mb=0.01)
+
+    # the image sits 20 rows down and 20 columns across, and runs 5 columns past the composite
+    expected = np.zeros((2, 60, 65), dtype=np.uint16)
+    expected[:, :50, :60] = composite
+    np.copyto(expected[:, 20:, 20:], image, where=image != 0)
+    out = gdal.Open(out_path)
+    assert out.GetRasterBand(1).DataType == gdal.GDT_UInt16
+    assert np.array_equal(out.ReadAsArray(), expected)
+    dates = gdal.Open(str(tmp_path / "updated.dates")).ReadAsArray()
+    assert np.all(dates[25:, 20:] == 20230105)
+    assert np.all(dates[20:25, 20:] == 0)
+
+
+def test_apply_raster_expression(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+
+    def write_raster(path, array, nodata=None):
+        raster = gdal.GetDriverByName("GTiff").Create(
+            str(path), array.shape[2], array.shape[1], array.shape[0], gdal.GDT_UInt16)
+        raster.SetGeoTransform([500000, 10, 0, 9000500, 0, -10])
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index, band in enumerate(array):
+            raster.GetRasterBand(band_index + 1).WriteArray(band)
+            if nodata is not None:
+                raster.GetRasterBand(band_index + 1).SetNoDataValue(nodata)
+        raster = None
+        return str(path)
+
+    rng = np.random.default_rng(0)
+    image = rng.integers(0, 3000, (4, 70, 30)).astype(np.uint16)
+    image[3, :10, :] = image[2, :10, :]
+    image[2, 40:, 5] = 0
+    image_path = write_raster(tmp_path / "image.tif", image, nodata=0)
+    out_path = str(tmp_path / "ndvi.tif")
+
+    pyeo_1.raster_manipulation.apply_raster_expression(
+        "(nir - red) / (nir + red)", {"red": (image_path, 3), "nir": (image_path, 4)}, out_path,
+        out_datatype=gdal.GDT_Float32, out_nodata=-9999, mem_limit_mb=0.01, n_workers=3)
+
+    # uint16 differences must not wrap around
+    red = image[2].astype(np.float64)
+    nir = image[3].astype(np.float64)
+    expected = ((nir - red) / (nir + red)).astype(np.float32)
+    expected[(image[2] == 0) | (image[3] == 0)] = -9999
+    out = gdal.Open(out_path)
+    assert out.GetRasterBand(1).GetNoDataValue() == -9999
+    assert np.allclose(out.ReadAsArray(), expected)
+
+    # calc_ndvi computes (red - nir) / (red + nir); where nir equals red its NDVI of 0 must not become nodata
+    ndvi_path = str(tmp_path / "calc_ndvi.tif")
+    pyeo_1.raster_manipulation.calc_ndvi(image_path, ndvi_path)
+    ndvi = gdal.Open(ndvi_path)
+    assert ndvi.GetRasterBand(1).GetNoDataValue() == -9999
+    assert np.allclose(ndvi.ReadAsArray(), np.where(expected == -9999, -9999, -expected))
+    assert np.all(ndvi.ReadAsArray()[:10][image[2, :10] != 0] == 0)
+
+    maps = [write_raster(tmp_path / "map_{}.tif".format(i), image[i:i + 1]) for i in range(4)]
+    sum_path = str(tmp_path / "sum.tif")
+    pyeo_1.raster_manipulation.raster_sum(maps, sum_path)
+    assert gdal.Open(sum_path).GetRasterBand(1).DataType == gdal.GDT_Int32
+    assert np.array_equal(gdal.Open(sum_path).ReadAsArray(), image.sum(axis=0))
+
+
+def test_apply_raster_expression_output_types(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+
+    def write_raster(path, array, datatype):
+        raster = gdal.GetDriverByName("GTiff").Create(str(path), array.shape[1], array.shape[0], 1, datatype)
+        raster.SetGeoTransform([500000, 10, 0, 9000500, 0, -10])
+        raster.SetProjection(srs.ExportToWkt())
+        raster.GetRasterBand(1).WriteArray(array)
+        raster = None
+        return str(path)
+
+    # 300 change maps of ones sum to 300, which wraps around to 44 in the Byte datatype of the maps
+    maps = [write_raster(tmp_path / "map_{}.tif".format(i), np.ones((4, 5), dtype=np.uint8), gdal.GDT_Byte)
+            for i in range(300)]
+    sum_path = str(tmp_path / "sum.tif")
+    pyeo_1.raster_manipulation.raster_sum(maps, sum_path)
+    assert gdal.Open(sum_path).GetRasterBand(1).DataType == gdal.GDT_Int32
+    assert np.all(gdal.Open(sum_path).ReadAsArray() == 300)
+
+    # floats written to integers are rounded, not truncated towards zero
+    floats_path = write_raster(tmp_path / "floats.tif", np.array([[0.6, -0.6, 1.4, 2.6]]), gdal.GDT_Float32)
+    rounded_path = str(tmp_path / "rounded.tif")
+    pyeo_1.raster_manipulation.apply_raster_expression(
+        "x * 1", {"x": floats_path}, rounded_path, out_datatype=gdal.GDT_Int16)
+    assert gdal.Open(rounded_path).ReadAsArray().tolist() == [[1, -1, 1, 3]]
+
+    # a nodata value the output datatype cannot hold is refused rather than wrapped around
+    with pytest.raises(ValueError):
+        pyeo_1.raster_manipulation.apply_raster_expression(
+            "x * 1", {"x": floats_path}, str(tmp_path / "byte.tif"), out_datatype=gdal.GDT_Byte, out_nodata=-9999)
+
+
+def test_render_class_map(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    classes = np.tile(np.array([0, 1, 2, 3, 4], dtype=np.uint8), (40, 8))
+    class_path = str(tmp_path / "classes.tif")
+    raster = gdal.GetDriverByName("GTiff").Create(class_path, 40, 40, 1, gdal.GDT_Byte)
+    raster.SetGeoTransform([500000, 10, 0, 9000500, 0, -10])
+    raster.SetProjection(srs.ExportToWkt())
+    raster.GetRasterBand(1).WriteArray(classes)
+    raster = None
+    class_key = [["1", "10", "20", "30", "255", "Forest"], ["3", "1", "2", "3", "128", "Water"]]
+
+    rgba_path = str(tmp_path / "rgba.tif")
+    pyeo_1.raster_manipulation.render_class_map(class_path, rgba_path, class_key, mem_limit_mb=0.001)
+    rgba = gdal.Open(rgba_path).ReadAsArray()
+    # classes 0, 2 and 4 are not in the key, so are transparent
+    expected = np.zeros((4, 40, 40), dtype=np.uint8)
+    expected[:, classes == 1] = np.array([[10], [20], [30], [255]])
+    expected[:, classes == 3] = np.array([[1], [2], [3], [128]])
+    assert np.array_equal(rgba, expected)
+    assert gdal.Open(rgba_path).GetRasterBand(1).GetOverviewCount() > 0
+
+    palette_path = str(tmp_path / "palette.tif")
+    pyeo_1.raster_manipulation.render_class_map(class_path, palette_path, class_key, mode="palette")
+    palette_band = gdal.Open(palette_path).GetRasterBand(1)
+    assert np.array_equal(palette_band.ReadAsArray(), classes)
+    assert palette_band.GetColorTable().GetColorEntry(3) == (1, 2, 3, 128)
+
+
+def test_apply_mask_to_dir(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+
+    def write_raster(path, array, pixel_size, datatype):
+        raster = gdal.GetDriverByName("GTiff").Create(
+            str(path), array.shape[2], array.shape[1], array.shape[0], datatype)
+        raster.SetGeoTransform([500000, pixel_size, 0, 9000500, 0, -pixel_size])
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index, band in enumerate(array):
+            raster.GetRasterBand(band_index + 1).WriteArray(band)
+        raster = None
+        return str(path)
+
+    # a 20 m mask over 10 m images, masking the western half
+    mask = np.ones((1, 30, 30), dtype=np.uint8)
+    mask[:, :, :15] = 0
+    mask_path = write_raster(tmp_path / "mask.msk", mask, 20, gdal.GDT_Byte)
+    image_dir = tmp_path / "images"
+    image_dir.mkdir()
+    masked_dir = tmp_path / "masked"
+    masked_dir.mkdir()
+    rng = np.random.default_rng(0)
+    images = {}
+    for name in ("first", "second"):
+        images[name] = rng.integers(1, 3000, (4, 60, 60)).astype(np.uint16)
+        write_raster(image_dir / (name + ".tif"), images[name], 10, gdal.GDT_UInt16)
+
+    pyeo_1.raster_manipulation.apply_mask_to_dir(mask_path, str(image_dir), str(masked_dir), mem_limit_mb=0.01)
+
+    for name, image in images.items():
+        masked = gdal.Open(str(masked_dir / (name + "_masked.tif")))
+        assert masked.GetRasterBand(1).DataType == gdal.GDT_UInt16
+        masked_array = masked.ReadAsArray()
+        assert np.all(masked_array[:, :, :28] == 0)
+        assert np.array_equal(masked_array[:, :, 32:], image[:, :, 32:])
+
+
+def test_median_composite_of_raster_list(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    rng = np.random.default_rng(0)
+    images = rng.integers(1, 3000, (4, 3, 40, 50)).astype(np.uint16)
+    images[rng.random(images.shape) < 0.3] = 0
+    images[:, :, :5, :5] = 0
+    paths = []
+    for index, image in enumerate(images):
+        path = str(tmp_path / "image_{}.tif".format(index))
+        raster = gdal.GetDriverByName("GTiff").Create(path, 50, 40, 3, gdal.GDT_UInt16)
+        raster.SetGeoTransform([500000, 10, 0, 9000400, 0, -10])
+        raster.SetProjection(srs.ExportToWkt())
+        for band_index, band in enumerate(image):
+            raster.GetRasterBand(band_index + 1).WriteArray(band)
+        raster = None
+        paths.append(path)
+    out_path = str(tmp_path / "composite.tif")
+
+    pyeo_1.raster_manipulation.median_composite_of_raster_list(paths, out_path, mem_limit_mb=0.01)
+
+    # the median of each band of a stack of all the rasters, with medians between two values rounded
+    expected = np.empty((3, 40, 50), dtype=np.uint16)
+    for band in range(3):
+        stacked = np.dstack([image[band] for image in images]).astype(np.float64)
+        stacked[stacked == 0] = np.nan
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            median = np.nanmedian(stacked, axis=-1)
+        median[np.isnan(stacked).all(axis=-1)] = 0
+        expected[band] = np.rint(median)
+    out = gdal.Open(out_path)
+    assert out.GetRasterBand(1).DataType == gdal.GDT_UInt16
+    assert np.array_equal(out.ReadAsArray(), expected)
+    assert np.all(out.ReadAsArray()[:, :5, :5] == 0)
+
+    with pytest.raises(ValueError):
+        pyeo_1.raster_manipulation.median_composite_of_raster_list([], out_path)
+
+
+_FAKE_SEN2COR = """#!{python}
+# stands in for L2A_Process; marker files in the L1C product choose how each run fails
+import os, signal, sys, time
+if sys.argv[1] == "--help":
+    print("Sen2Cor. Version: 2.11.00, created: 2022.09.22")
+    sys.exit(0)
+image_path, out_path = sys.argv[1], sys.argv[3]
+with open(os.path.join(image_path, "runs.txt"), "a") as runs:
+    runs.write(os.environ.get("SEN2COR_HOME", "") + "\\n")
+with open(os.path.join(image_path, "runs.txt")) as runs:
+    first_run = len(runs.readlines()) == 1
+if os.path.exists(os.path.join(image_path, "critical")) and (first_run or os.path.exists(os.path.join(image_path, "always"))):
+    print("CRITICAL: fake sen2cor failure", flush=True)
+    time.sleep(60)
+if os.path.exists(os.path.join(image_path, "killed")) and first_run:
+    os.kill(os.getpid(), signal.SIGKILL)
+band_dir = os.path.join(out_path, "GRANULE", "L2A_T36NXG", "IMG_DATA", "R10m")
+os.makedirs(band_dir)
+for band in ("B02", "B03", "B04", "B08"):
+    open(os.path.join(band_dir, "T36NXG_20230101T074151_" + band + "_10m.jp2"), "w").close()
+print("Application terminated successfully.")
+"""
+
+
+def test_sen2cor_pool(tmp_path, monkeypatch):
+    # sen2cor writes to the home directory before its output is moved to the L2A directory
+    monkeypatch.setenv("HOME", str(tmp_path))
+    sen2cor_path = tmp_path / "L2A_Process"
+    sen2cor_path.write_text(_FAKE_SEN2COR.format(python=sys.executable))
+    os.chmod(sen2cor_path, 0o755)
+    sen2cor_home = tmp_path / "sen2cor"
+    (sen2cor_home / "cfg").mkdir(parents=True)
+    (sen2cor_home / "cfg" / "L2A_GIPP.xml").write_text("<gipp/>")
+    l1_dir = tmp_path / "L1C"
+    l2_dir = tmp_path / "L2A"
+    l2_dir.mkdir()
+    failures = {"T36NXG": [], "T36NYG": ["critical"], "T36NZG": ["killed"], "T37NAG": ["critical", "always"]}
+    image_paths = {}
+    for tile, markers in failures.items():
+        image_path = l1_dir / f"S2A_MSIL1C_20230101T074151_N0509_R092_{tile}_20230101T094052.SAFE"
+        image_path.mkdir(parents=True)
+        for marker in markers:
+            (image_path / marker).touch()
+        image_paths[tile] = str(image_path)
+
+    with pyeo_1.raster_manipulation.Sen2CorPool(str(l2_dir), str(sen2cor_path), n_workers=2, max_retries=1,
+                                                sen2cor_home=str(sen2cor_home)) as pool:
+        for image_path in image_paths.values():
+            pool.submit(image_path)
+            # the same product again, as a downloader and a directory listing might both report it
+            pool.submit(image_path[:-len(".SAFE")])
+            pool.submit(image_path + os.sep)
+
+    assert sorted(pool.results) == sorted(image_paths.values())
+    runs = {tile: (l1_dir / os.path.basename(path) / "runs.txt").read_text().split()
+            for tile, path in image_paths.items()}
+    # each product is corrected once, a run that reported CRITICAL or was killed is retried once
+    assert {tile: len(homes) for tile, homes in runs.items()} == {"T36NXG": 1, "T36NYG": 2, "T36NZG": 2, "T37NAG": 2}
+    assert pool.results[image_paths["T37NAG"]] is None
+    for tile in ("T36NXG", "T36NYG", "T36NZG"):
+        l2_path = pool.results[image_paths[tile]]
+        assert os.path.dirname(l2_path) == str(l2_dir)
+        assert pyeo_1.filesystem_utilities.check_for_invalid_l2_data(l2_path) == 1
+    # every run had a worker's own SEN2COR_HOME, set up from the shared configuration
+    worker_homes = {str(sen2cor_home / "worker_0"), str(sen2cor_home / "worker_1")}
+    assert set(home for homes in runs.values() for home in homes) <= worker_homes
+    for worker_home in worker_homes:
+        assert os.path.exists(os.path.join(worker_home, "cfg", "L2A_GIPP.xml"))
@@ -49,11 +49,23 @@ def test_calculate_latlon_array():
     raster = gdal.Open(raster_path)
     array = raster.GetVirtualMemArray()
     transformer, gt = terrain_correction._generate_latlon_transformer(raster)
-    lon, lat = terrain_correction._generate_latlon_arrays(array, transformer, gt)
+    lat, lon = terrain_correction._generate_latlon_arrays(array, transformer, gt)
     test_lat = joblib.load("test_data/lat_array_indo")
     test_lon = joblib.load("test_data/lon_array_indo")
-    assert np.all(lat == test_lat)
-    assert np.all(lon == test_lon)
+    # interpolated from a coarse grid, so only close to the per-pixel transform
+    np.testing.assert_allclose(lat, test_lat, atol=1e-5)
+    np.testing.assert_allclose(lon, test_lon, atol=1e-5)
+
+
+def test_interpolate_grid():
+    grid_rows = np.array([0, 4, 6])
+    grid_cols = np.array([0, 5, 9])
+    row_mesh, col_mesh = np.meshgrid(grid_rows, grid_cols, indexing="ij")
+    grid_values = 2 * row_mesh + 3 * col_mesh
+    out = terrain_correction._interpolate_grid(grid_values, grid_rows, grid_cols, 2, 1, 6, 5)
+    rows, cols = np.mgrid[1:6, 2:8]
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, 2 * rows + 3 * cols)
 
 
 @pytest.mark.skip
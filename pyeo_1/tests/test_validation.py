@@ -185,3 +185,26 @@ def test_maths():
     # Values from Olafsson table 7
     np.testing.assert_allclose(foo_accuracy, 0.046, atol=1e-3)
     np.testing.assert_allclose(baz_accuracy, 0.025, atol=1e-3)
+
+
+def test_stratified_random_sample_by_window(tmp_path):
+    map_path = str(tmp_path / "class_map.tif")
+    class_array = np.random.default_rng(0).choice([0, 1, 2, 5], size=(97, 83), p=[0.3, 0.6, 0.09, 0.01])
+    class_map = gdal.GetDriverByName("GTiff").Create(
+        map_path, 83, 97, 1, gdal.GDT_Byte, options=["TILED=YES", "BLOCKXSIZE=16", "BLOCKYSIZE=16"])
+    class_map.GetRasterBand(1).WriteArray(class_array)
+    class_map = None
+
+    # a tiny memory limit splits the map into many block windows
+    counts = validation.count_pixel_classes(map_path, no_data=0, mem_limit_mb=0.001)
+    assert counts == {c: np.count_nonzero(class_array == c) for c in (1, 2, 5)}
+    class_sample_count = {1: 50, 2: 20, 5: counts[5]}
+    points = validation.stratified_random_sample(map_path, class_sample_count, no_data="0", seed=1,
+                                                 mem_limit_mb=0.001)
+    for map_class, sample_count in class_sample_count.items():
+        assert len(set(points[map_class])) == sample_count
+        assert all(class_array[y, x] == map_class for y, x in points[map_class])
+    assert points == validation.stratified_random_sample(map_path, class_sample_count, no_data=0, seed=1,
+                                                         mem_limit_mb=0.001)
+    with pytest.raises(ValueError):
+        validation.stratified_random_sample(map_path, {5: counts[5] + 1}, mem_limit_mb=0.001)
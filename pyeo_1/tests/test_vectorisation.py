@@ -0,0 +1,89 @@
+import logging
+
+from osgeo import gdal, ogr, osr
+import numpy as np
+import pandas as pd
+
+import pyeo_1.vectorisation
+
+
+def test_zonal_statistics_multiband(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    raster_path = str(tmp_path / "report.tif")
+    raster = gdal.GetDriverByName("GTiff").Create(raster_path, 20, 10, 2, gdal.GDT_Int16)
+    raster.SetGeoTransform([500000, 10, 0, 9000100, 0, -10])
+    raster.SetProjection(srs.ExportToWkt())
+    band_values = np.arange(400, dtype=np.int16).reshape(2, 10, 20)
+    band_values[0, 2, 3] = -1
+    for band_index in range(2):
+        raster.GetRasterBand(band_index + 1).WriteArray(band_values[band_index])
+        raster.GetRasterBand(band_index + 1).SetNoDataValue(-1)
+    raster = None
+
+    shapefile_path = str(tmp_path / "zones.shp")
+    zones = ogr.GetDriverByName("ESRI Shapefile").CreateDataSource(shapefile_path)
+    layer = zones.CreateLayer("zones", srs=srs, geom_type=ogr.wkbPolygon)
+    # pixel windows as (col1, col2, row1, row2)
+    windows = [(1, 5, 1, 4), (10, 13, 6, 10)]
+    for col1, col2, row1, row2 in windows:
+        x1, x2 = 500000 + col1 * 10, 500000 + col2 * 10
+        y1, y2 = 9000100 - row1 * 10, 9000100 - row2 * 10
+        polygon = ogr.CreateGeometryFromWkt(
+            f"POLYGON(({x1} {y1},{x2} {y1},{x2} {y2},{x1} {y2},{x1} {y1}))")
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(polygon)
+        layer.CreateFeature(feature)
+    zones = None
+
+    zstats = pyeo_1.vectorisation.zonal_statistics_multiband(
+        raster_path, shapefile_path, [1, 2], logging.getLogger(__name__))
+
+    for report_band in (1, 2):
+        df = zstats[report_band]
+        assert list(df["id"]) == [0, 1]
+        for row, (col1, col2, row1, row2) in enumerate(windows):
+            values = band_values[report_band - 1, row1:row2, col1:col2]
+            values = values[values != -1]
+            assert df[f"rb{report_band}_count"][row] == values.size
+            assert df[f"rb{report_band}_sum"][row] == values.sum()
+            assert df[f"rb{report_band}_min"][row] == values.min()
+            assert df[f"rb{report_band}_max"][row] == values.max()
+            assert np.isclose(df[f"rb{report_band}_mean"][row], values.mean())
+            assert np.isclose(df[f"rb{report_band}_median"][row], np.median(values))
+            assert np.isclose(df[f"rb{report_band}_sd"][row], values.std())
+        csv = pd.read_csv(str(tmp_path / f"report_zstats_over_band{report_band}.csv"))
+        assert list(csv.columns) == list(df.columns)
+
+
+def test_vectorise_with_zonal_statistics(tmp_path):
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(32736)
+    raster_path = str(tmp_path / "report.tif")
+    raster = gdal.GetDriverByName("GTiff").Create(raster_path, 30, 20, 2, gdal.GDT_Int16)
+    raster.SetGeoTransform([500000, 10, 0, 9000200, 0, -10])
+    raster.SetProjection(srs.ExportToWkt())
+    binary = np.zeros((20, 30), dtype=np.int16)
+    binary[2:15, 3:6] = 1  # a tall strip crossing many windows
+    binary[14, 3:20] = 1  # with a foot, making a single L-shaped polygon
+    binary[5:8, 20:25] = 2  # a block of another value
+    binary[5:8, 25:28] = 1  # touching a block of value 1, which stays separate
+    binary[18, 29] = 32767  # nodata is not vectorised
+    raster.GetRasterBand(1).WriteArray(binary)
+    raster.GetRasterBand(2).WriteArray(np.arange(600, dtype=np.int16).reshape(20, 30))
+    raster = None
+
+    # a tiny memory limit splits the raster into one window per row
+    out_path, zstats = pyeo_1.vectorisation.vectorise_with_zonal_statistics(
+        raster_path, band=1, report_bands=[2], log=logging.getLogger(__name__), mem_limit_mb=0.001, n_workers=3)
+
+    polygons = ogr.Open(out_path)
+    layer = polygons.GetLayer()
+    features = sorted(
+        (feature.GetField("band1"), round(feature.GetGeometryRef().GetArea() / 100), feature.GetField("id"))
+        for feature in layer
+    )
+    assert [(value, n_pixels) for value, n_pixels, _ in features] == [(1, 9), (1, 53), (2, 15)]
+    counts = zstats[2].set_index("id")["rb2_count"]
+    for _, n_pixels, polygon_id in features:
+        assert counts[polygon_id] == n_pixels
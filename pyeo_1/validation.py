@@ -45,7 +45,6 @@ Function reference
 
 import numpy as np
 from osgeo import gdal
-import random
 
 # I.R. ogr, osr now incorporated in osgeo
 # import ogr, osr
@@ -54,8 +53,8 @@ from osgeo import osr, ogr
 import pyeo_1.coordinate_manipulation
 import pyeo_1.exceptions
 import pyeo_1.filesystem_utilities
+import pyeo_1.raster_manipulation
 import logging
-import datetime
 import json
 import csv
 import itertools
@@ -129,32 +128,66 @@ def create_validation_scenario(
     #                        user_accuracies)
 
 
-def count_pixel_classes(map_path, no_data=None):
+def count_pixel_classes(map_path, no_data=None, mem_limit_mb=1024):
     """
     :meta private:
-    Counts pixels in a map. Returns a dictionary of pixels.
+    Counts pixels in a map, reading it block by block. Returns a dictionary of pixels.
     Parameters
     ----------
     map_path: Path to the map to count
     no_data: A value to ignore
+    mem_limit_mb: The maximum amount of memory, in MB, to use for each block of the map. Defaults to 1024.
 
     Returns
     -------
     A dictionary of class:count
     """
-    map = gdal.Open(map_path)
-    map_array = map.GetVirtualMemArray().squeeze()
-    unique, counts = np.unique(map_array, return_counts=True)
-    out = dict(zip([int(val) for val in unique], counts))
+    windows, window_counts = count_pixel_classes_by_window(map_path, mem_limit_mb)
+    out = {}
+    for counts in window_counts:
+        for map_class, count in counts.items():
+            out[map_class] = out.get(map_class, 0) + count
+    out = dict(sorted(out.items()))
     if no_data is not None:
         out.pop(
-            no_data, "_"
+            int(no_data), "_"
         )  # pop the no data value, but don't worry if there's nothing there.
-    map_array = None
-    map = None
     return out
 
 
+def count_pixel_classes_by_window(map_path, mem_limit_mb=1024):
+    """
+    :meta private:
+    Counts the pixels of each class in every block window of a map.
+    Parameters
+    ----------
+    map_path: Path to the map to count
+    mem_limit_mb: The maximum amount of memory, in MB, to use for each block of the map. Defaults to 1024.
+
+    Returns
+    -------
+    A list of the (xoff, yoff, xsize, ysize) block windows of the map, and a list of a dictionary of class:count for
+    each window
+    """
+    map = gdal.Open(map_path)
+    band = map.GetRasterBand(1)
+    # a block, its sorted copy in np.unique and a comparison mask
+    windows = pyeo_1.raster_manipulation.get_block_windows(
+        map, mem_limit=int(mem_limit_mb * 1024 * 1024), bytes_per_pixel=16
+    )
+    window_counts = []
+    for xoff, yoff, xsize, ysize in windows:
+        unique, counts = np.unique(
+            band.ReadAsArray(xoff, yoff, xsize, ysize), return_counts=True
+        )
+        window_counts.append(
+            dict(zip([int(val) for val in unique], [int(count) for count in counts]))
+        )
+    band = None
+    map = None
+    return windows, window_counts
+
+
 def produce_stratified_validation_points(
     map_path, out_path, class_sample_counts, no_data=None, seed=None, produce_csv=False
 ):
@@ -259,33 +292,75 @@ def save_point_list_to_shapefile(
         log.info("CSV out at: {}".format(csv_out_path))
 
 
-def stratified_random_sample(map_path, class_sample_count, no_data=None, seed=None):
+def stratified_random_sample(
+    map_path, class_sample_count, no_data=None, seed=None, mem_limit_mb=1024
+):
     """
     :meta private:
+    Draws a simple random sample of pixels from each class of a map without holding the map or any per-pixel lists
+    in memory. A first pass counts the pixels of each class in every block window; the rank of each sample among the
+    pixels of its class is then drawn at random, and a second pass reads only the windows that contain sampled ranks
+    to turn them into pixel coordinates.
     Parameters
     ----------
-    map_path
-    class_sample_count
-    no_data
-    seed
+    map_path: Path to the map to sample
+    class_sample_count: A dictionary of class:number of samples
+    no_data: A value that is never sampled
+    seed: A seed for the random number generator, for reproducible samples
+    mem_limit_mb: The maximum amount of memory, in MB, to use for each block of the map. Defaults to 1024.
 
     Returns
     -------
-
+    A dictionary of class:list of (y, x) pixel coordinates, in the order the pixels appear in the map
     """
     log = logging.getLogger(__name__)
-    if not seed:
-        seed = datetime.datetime.now().timestamp()
-    map = gdal.Open(map_path)
-    map_array = map.GetVirtualMemArray().squeeze()
-    class_dict = build_class_dict(map_array, no_data)
-    map_array = None
-    out_coord_dict = {}
+    if no_data is not None:
+        no_data = int(no_data)
+    rng = np.random.default_rng(seed)
+    windows, window_counts = count_pixel_classes_by_window(map_path, mem_limit_mb)
+    class_ranks = {}
     for map_class, sample_count in class_sample_count.items():
-        map_class_samples = random.sample(
-            class_dict[int(map_class)], class_sample_count[map_class]
+        if int(map_class) == no_data:
+            raise KeyError("Cannot sample the no data class {}".format(map_class))
+        total = sum(counts.get(int(map_class), 0) for counts in window_counts)
+        if sample_count > total:
+            raise ValueError(
+                "Cannot draw {} samples of class {} from {} pixels".format(
+                    sample_count, map_class, total
+                )
+            )
+        class_ranks[map_class] = np.sort(
+            rng.choice(total, size=sample_count, replace=False)
         )
-        out_coord_dict.update({map_class: map_class_samples})
+        log.info(
+            "Sampling {} of {} pixels of class {}".format(sample_count, total, map_class)
+        )
+
+    out_coord_dict = {map_class: [] for map_class in class_sample_count}
+    pixels_before = {map_class: 0 for map_class in class_sample_count}
+    map = gdal.Open(map_path)
+    band = map.GetRasterBand(1)
+    for (xoff, yoff, xsize, ysize), counts in zip(windows, window_counts):
+        block = None
+        for map_class, ranks in class_ranks.items():
+            in_window = counts.get(int(map_class), 0)
+            first, last = np.searchsorted(
+                ranks,
+                [pixels_before[map_class], pixels_before[map_class] + in_window],
+            )
+            if last > first:
+                if block is None:
+                    block = band.ReadAsArray(xoff, yoff, xsize, ysize)
+                positions = np.flatnonzero(block == int(map_class))[
+                    ranks[first:last] - pixels_before[map_class]
+                ]
+                rows, cols = np.divmod(positions, xsize)
+                out_coord_dict[map_class].extend(
+                    zip((rows + yoff).tolist(), (cols + xoff).tolist())
+                )
+            pixels_before[map_class] += in_window
+    band = None
+    map = None
     return out_coord_dict
 
 
@@ -294,7 +369,7 @@ def build_class_dict(class_array, no_data=None):
     :meta private:
     Returns a dict of coordinates of the following shape:
     [class, coord].
-    WARNING: This will take up a LOT of memory!"""
+    WARNING: This will take up a LOT of memory! stratified_random_sample no longer uses it."""
     out_dict = {}
     it = np.nditer(class_array, flags=["multi_index"])
     while not it.finished:
@@ -6,7 +6,10 @@ Functions for converting raster data to vectors, notably .shp but also .kml and
 Key functions
 -------------
 
-:py:func:`vectorise_from_band` 
+:py:func:`vectorise_from_band` Vectorises the non-zero pixels of a band of a change report
+
+:py:func:`vectorise_with_zonal_statistics` Vectorises a band of a change report in windows on a pool of threads,
+calculating the zonal statistics of other bands over the polygons in the same pass
 """
 
 import logging
@@ -79,9 +82,12 @@ def band_naming(band: int, log):
 def vectorise_from_band(
     change_report_path: str,
     band: int,
-    log: logging.Logger):
+    log: logging.Logger,
+    mem_limit_mb: int = 1024,
+    n_workers: int = 1):
     """
     This function takes the path of a change report raster and using a band integer, vectorises a band layer.
+    Only pixels that are not 0 or nodata are vectorised; see :py:func:`vectorise_with_zonal_statistics`.
 
 
     Parameters:
@@ -95,79 +101,301 @@ def vectorise_from_band(
         instead of 0 as in Python.
     log : logging.Logger
         log variable
+    mem_limit_mb : int, optional
+        the approximate memory ceiling in MB for each window of the raster. Defaults to 1024.
+    n_workers : int, optional
+        the number of windows to vectorise at once. Defaults to 1.
 
     Returns
     ----------------
     out_filename : str
         the output path of the vectorised band
 
+    """
+    out_filename, _ = vectorise_with_zonal_statistics(
+        change_report_path=change_report_path,
+        band=band,
+        report_bands=[],
+        log=log,
+        mem_limit_mb=mem_limit_mb,
+        n_workers=n_workers,
+    )
+    return out_filename
+
+
+def vectorise_with_zonal_statistics(
+    change_report_path: str,
+    band: int,
+    report_bands: list[int],
+    log: logging.Logger,
+    mem_limit_mb: int = 1024,
+    n_workers: int = 1,
+    skip_values: tuple = (0, 32767),
+) -> tuple[str, dict[int, pd.DataFrame]]:
+    """
+    This function vectorises a band of a change report and calculates the zonal statistics of other report bands
+    over the polygons in the same pass.
+
+    Only pixels that are not in skip_values or the nodata value of the band are vectorised, through a mask band, so
+    that no background polygons are created and have to be removed afterwards. The raster is split into windows that
+    are vectorised on a pool of threads. Each window's polygons are burned back into a window of polygon labels;
+    polygons on either side of a window seam are merged wherever a pixel on one side touches a pixel of the same value
+    on the other, so the output is the same as vectorising the whole band at once. The statistics of the
+    report_bands are collected from the same windows of labels.
+
+    Parameters
+    ----------
+    change_report_path : str
+        path to a change report raster
+    band : int
+        the band to vectorise, counting from 1
+    report_bands : list[int]
+        the bands to calculate zonal statistics of, counting from 1. May be empty.
+    log : logging.Logger
+        The logger object
+    mem_limit_mb : int, optional
+        the approximate memory ceiling in MB for each window of the raster. Defaults to 1024.
+    n_workers : int, optional
+        the number of windows to vectorise at once. Defaults to 1.
+    skip_values : tuple, optional
+        the pixel values not to vectorise. Defaults to 0 and 32767.
+
+    Returns
+    -------
+    out_filename : str
+        the path of the shapefile of polygons, with the pixel value in a field named after the band and an "id" field
+        counting from 0
+    zstats_dfs : dict[int, pd.DataFrame]
+        A DataFrame of zonal statistics for each band in report_bands, with the same columns as those of
+        :py:func:`zonal_statistics` and the "id" of each polygon. Each is also written to a csv next to the raster.
+
     """
     import os
-    from tempfile import TemporaryDirectory
+    import numpy as np
+    from multiprocessing.dummy import Pool
     from osgeo import gdal, ogr, osr
+    from pyeo_1.raster_manipulation import get_block_windows
 
     log.info(f"what is change_report_path  :  {change_report_path}")
     # let GDAL use Python to raise Exceptions, instead of printing to sys.stdout
     gdal.UseExceptions()
 
-    with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-        # get Raster datasource
-        src_ds = gdal.Open(change_report_path)
-        log.info(f"Opening {change_report_path}")
-
-        if src_ds is None:
-            log.error(f"Unable to open {change_report_path}")
+    src_ds = gdal.Open(change_report_path)
+    log.info(f"Successfully opened {change_report_path}")
+    proj = osr.SpatialReference(src_ds.GetProjection())
+    nodata = src_ds.GetRasterBand(band).GetNoDataValue()
+    report_nodata = src_ds.GetRasterBand(1).GetNoDataValue()
+    windows = get_block_windows(
+        src_ds,
+        mem_limit=int(mem_limit_mb * 1024 * 1024),
+        bytes_per_pixel=13 + 8 * len(report_bands),
+    )
+    src_ds = None
+    skip_values = list(skip_values) + ([nodata] if nodata is not None else [])
+
+    log.info(f"Now vectorising band {band} in {len(windows)} windows with {n_workers} workers")
+
+    def vectorise_window(window):
+        return _vectorise_window(change_report_path, band, report_bands, skip_values, window)
+
+    thread_pool = Pool(max(n_workers, 1))
+    results = thread_pool.map(vectorise_window, windows)
+    thread_pool.close()
+    thread_pool.join()
+
+    # give the polygons of all windows one numbering, then join those that meet across a seam
+    offsets = np.cumsum([0] + [len(result["values"]) for result in results])
+    parents = np.arange(offsets[-1])
+    for pair in _window_seams(windows):
+        _join_across_seam(results, offsets, parents, *pair)
+    roots = np.array([_find_root(parents, i) for i in range(len(parents))], dtype=np.int64)
+    unique_roots, polygon_ids = np.unique(roots, return_inverse=True)
+    log.info(f"Vectorised {len(unique_roots)} polygons ({len(parents)} before joining across window seams)")
+
+    # write the polygons
+    dst_layername = band_naming(band, log=log)
+    out_filename = f"{change_report_path[:-4]}_{dst_layername}.shp"
+    drv = ogr.GetDriverByName("ESRI Shapefile")
+    if os.path.exists(out_filename):
+        drv.DeleteDataSource(out_filename)
+    dst_ds = drv.CreateDataSource(out_filename)
+    dst_layer = dst_ds.CreateLayer(dst_layername, srs=proj, geom_type=ogr.wkbPolygon)
+    dst_layer.CreateField(ogr.FieldDefn(dst_layername, ogr.OFTInteger))
+    dst_layer.CreateField(ogr.FieldDefn("id", ogr.OFTInteger))
+    geometries = [geometry for result in results for geometry in result["geometries"]]
+    values = np.concatenate([result["values"] for result in results]) if results else np.zeros(0)
+    parts = [[] for _ in unique_roots]
+    for polygon_index, polygon_id in enumerate(polygon_ids):
+        parts[polygon_id].append(polygon_index)
+    dst_layer.StartTransaction()
+    for polygon_id, part_indices in enumerate(parts):
+        if len(part_indices) == 1:
+            geometry = ogr.CreateGeometryFromWkb(geometries[part_indices[0]])
+        else:
+            multipolygon = ogr.Geometry(ogr.wkbMultiPolygon)
+            for part_index in part_indices:
+                multipolygon.AddGeometry(ogr.CreateGeometryFromWkb(geometries[part_index]))
+            geometry = multipolygon.UnionCascaded()
+        feature = ogr.Feature(dst_layer.GetLayerDefn())
+        feature.SetGeometry(geometry)
+        feature.SetField(dst_layername, int(values[part_indices[0]]))
+        feature.SetField("id", polygon_id)
+        dst_layer.CreateFeature(feature)
+    dst_layer.CommitTransaction()
+    dst_ds = None
+    log.info(f"Band {band} was written to {out_filename}")
+
+    # zonal statistics of the joined polygons, from the pixels collected in each window
+    zstats_dfs = {}
+    if report_bands:
+        zones = np.concatenate(
+            [polygon_ids[offsets[i] + result["zones"] - 1] + 1 for i, result in enumerate(results)]
+        )
+        for report_band in report_bands:
+            zstats_df = _zone_statistics(
+                zones,
+                np.concatenate([result["report_values"][report_band] for result in results]),
+                report_nodata,
+                list(range(len(unique_roots))),
+                report_band,
+            )
+            fn_csv = f"{os.path.splitext(change_report_path)[0]}_zstats_over_{band_naming(report_band, log=log)}.csv"
+            zstats_df.to_csv(fn_csv, index=False)
+            zstats_dfs[report_band] = zstats_df
 
-        log.info(f"Successfully opened {change_report_path}")
+    return out_filename, zstats_dfs
 
-        try:
-            src_band = src_ds.GetRasterBand(band)
 
-            # get projection of report.tif, assign to the vector
-            proj = osr.SpatialReference(src_ds.GetProjection())
-        except RuntimeError as error:
-            log.error(
-                f"Could not open band {band}. encountered the following error \n {error}"
-            )
+def _vectorise_window(
+    raster_path: str,
+    band: int,
+    report_bands: list[int],
+    skip_values: list,
+    window: tuple,
+) -> dict:
+    """
+    Vectorises one window of a band through a mask of the pixels not in skip_values, then burns the polygons back
+    into a window of labels 1..n to find the pixels of each polygon.
 
-        # create output datasource
-        dst_layername = band_naming(band, log=log)
+    Returns a dict with the polygons as WKB ("geometries"), their pixel values ("values"), the labels and values of
+    the window's edge pixels ("edges"), and the label ("zones") and value in each report band ("report_values") of
+    every pixel inside a polygon.
+    """
+    import numpy as np
+    from osgeo import gdal, ogr
 
-        drv = ogr.GetDriverByName("ESRI Shapefile")
-        out_filename = f"{change_report_path[:-4]}_{dst_layername}.shp"
-        dst_ds = drv.CreateDataSource(out_filename)
-        dst_layer = dst_ds.CreateLayer(dst_layername, srs=proj)
+    xoff, yoff, xsize, ysize = window
+    # each thread opens its own dataset, as gdal datasets must not be shared between threads
+    src_ds = gdal.Open(raster_path)
+    values = src_ds.GetRasterBand(band).ReadAsArray(xoff, yoff, xsize, ysize).astype(np.int32)
+    mask = ~np.isin(values, skip_values)
+    geotransform = src_ds.GetGeoTransform()
+    window_geotransform = geotFromOffsets(yoff, xoff, geotransform)
+
+    mem_driver = gdal.GetDriverByName("MEM")
+    window_ds = mem_driver.Create("", xsize, ysize, 2, gdal.GDT_Int32)
+    window_ds.SetGeoTransform(window_geotransform)
+    window_ds.SetProjection(src_ds.GetProjection())
+    window_ds.GetRasterBand(1).WriteArray(values)
+    window_ds.GetRasterBand(2).WriteArray(mask.astype(np.int32))
+
+    polygons_ds = ogr.GetDriverByName("Memory").CreateDataSource("polygons")
+    polygons_lyr = polygons_ds.CreateLayer("polygons", srs=None, geom_type=ogr.wkbPolygon)
+    polygons_lyr.CreateField(ogr.FieldDefn("value", ogr.OFTInteger))
+    polygons_lyr.CreateField(ogr.FieldDefn("label", ogr.OFTInteger))
+    gdal.Polygonize(window_ds.GetRasterBand(1), window_ds.GetRasterBand(2), polygons_lyr, 0, [])
+
+    geometries = []
+    polygon_values = []
+    for feature in polygons_lyr:
+        geometries.append(feature.GetGeometryRef().ExportToWkb())
+        polygon_values.append(feature.GetField("value"))
+        feature.SetField("label", len(geometries))
+        polygons_lyr.SetFeature(feature)
+
+    labels_ds = mem_driver.Create("", xsize, ysize, 1, gdal.GDT_Int32)
+    labels_ds.SetGeoTransform(window_geotransform)
+    gdal.RasterizeLayer(labels_ds, [1], polygons_lyr, options=["ATTRIBUTE=label"])
+    labels = labels_ds.GetRasterBand(1).ReadAsArray()
+    inside = labels > 0
+
+    report_values = {
+        report_band: src_ds.GetRasterBand(report_band).ReadAsArray(xoff, yoff, xsize, ysize)[inside]
+        for report_band in report_bands
+    }
+    edges = {
+        "top": (labels[0, :], values[0, :]),
+        "bottom": (labels[-1, :], values[-1, :]),
+        "left": (labels[:, 0], values[:, 0]),
+        "right": (labels[:, -1], values[:, -1]),
+    }
+    src_ds = None
+    return {
+        "window": window,
+        "geometries": geometries,
+        "values": np.array(polygon_values, dtype=np.int32),
+        "edges": edges,
+        "zones": labels[inside],
+        "report_values": report_values,
+    }
 
-        # make number of Detections column from pixel values
-        field = ogr.FieldDefn(dst_layername, ogr.OFTInteger)
-        dst_layer.CreateField(field)
-        dst_field = dst_layer.GetLayerDefn().GetFieldIndex(dst_layername)
 
-        # polygonise the raster band
-        log.info("Now vectorising the raster band")
-        try:
-            gdal.Polygonize(
-                src_band,
-                # src_band.GetMaskBand(),  # use .msk to only polygonise values > 0 # can't get gdal.Polygonize to respect .msk
-                None,  # no mask
-                dst_layer,
-                dst_field,  # -1 for no field column
-                [],
-            )
+def _window_seams(windows: list) -> list:
+    """
+    Returns (first, second, side, overlap) for every pair of adjoining windows: the index of the window above or to
+    the left, the index of the window below or to the right, "vertical" or "horizontal" for the direction to cross
+    the seam, and the (start, end) of the pixel range they share along it, relative to the raster.
+    """
+    seams = []
+    for first, (x1, y1, xs1, ys1) in enumerate(windows):
+        for second, (x2, y2, xs2, ys2) in enumerate(windows):
+            if y1 + ys1 == y2 and x1 < x2 + xs2 and x2 < x1 + xs1:
+                seams.append((first, second, "vertical", (max(x1, x2), min(x1 + xs1, x2 + xs2))))
+            elif x1 + xs1 == x2 and y1 < y2 + ys2 and y2 < y1 + ys1:
+                seams.append((first, second, "horizontal", (max(y1, y2), min(y1 + ys1, y2 + ys2))))
+    return seams
 
-        except RuntimeError as error:
-            log.error(f"GDAL Polygonize failed: \n {error}")
-        except Exception as error:
-            log.error(f"GDAL Polygonize failed, error received : \n {error}")
 
-        # close dst_ds and src_band
-        dst_ds = None
-        src_band = None
-        if dst_ds is None:
-            log.info(f"Band {band} of {change_report_path} was successfully vectorised")
-            log.info(f"Band {band} was written to {out_filename}")
+def _join_across_seam(results, offsets, parents, first, second, direction, overlap):
+    """
+    Joins the polygons of two adjoining windows where a pixel on one side of their seam touches a pixel of the same
+    value on the other.
+    """
+    import numpy as np
 
-    return out_filename
+    first_window, second_window = results[first]["window"], results[second]["window"]
+    if direction == "vertical":
+        first_labels, first_values = results[first]["edges"]["bottom"]
+        second_labels, second_values = results[second]["edges"]["top"]
+        first_start, second_start = first_window[0], second_window[0]
+    else:
+        first_labels, first_values = results[first]["edges"]["right"]
+        second_labels, second_values = results[second]["edges"]["left"]
+        first_start, second_start = first_window[1], second_window[1]
+    start, end = overlap
+    first_labels = first_labels[start - first_start: end - first_start]
+    first_values = first_values[start - first_start: end - first_start]
+    second_labels = second_labels[start - second_start: end - second_start]
+    second_values = second_values[start - second_start: end - second_start]
+    touching = (first_labels > 0) & (second_labels > 0) & (first_values == second_values)
+    pairs = np.unique(np.stack([first_labels[touching], second_labels[touching]], axis=1), axis=0)
+    for first_label, second_label in pairs:
+        first_root = _find_root(parents, offsets[first] + first_label - 1)
+        second_root = _find_root(parents, offsets[second] + second_label - 1)
+        if first_root != second_root:
+            parents[max(first_root, second_root)] = min(first_root, second_root)
+
+
+def _find_root(parents, index):
+    """
+    Returns the representative polygon of the group that polygon index belongs to, shortening the path on the way.
+    """
+    root = index
+    while parents[root] != root:
+        root = parents[root]
+    while parents[index] != root:
+        parents[index], index = root, parents[index]
+    return root
 
 
 def clean_zero_nodata_vectorised_band(
@@ -360,7 +588,8 @@ def zonal_statistics(
 
     Notes
     -----
-    The raster at raster_path needs to be an even shape, e.g. 10980, 10980, not 10979, 10979.
+    This is a single-band wrapper around :py:func:`zonal_statistics_multiband`; use that function directly to compute
+    several bands with a single pass over the raster.
 
     The original implementation of this function was written by Konrad Hafen and can be found at: https://opensourceoptions.com/blog/zonal-statistics-algorithm-with-python-in-4-steps/
 
@@ -368,156 +597,223 @@ def zonal_statistics(
 
     """
 
+    return zonal_statistics_multiband(
+        raster_path=raster_path,
+        shapefile_path=shapefile_path,
+        report_bands=[report_band],
+        log=log,
+    )[report_band]
+
+
+def zonal_statistics_multiband(
+    raster_path: str,
+    shapefile_path: str,
+    report_bands: list[int],
+    log: logging.Logger,
+    mem_limit_mb: int = 1024,
+) -> dict[int, pd.DataFrame]:
+    """
+    This function calculates zonal statistics on several bands of a raster at once.
+
+    All polygons are burned into a single raster of zone labels with one call to gdal.RasterizeLayer, and the raster
+    is then read once, block by block, keeping only the pixels that fall inside a zone. The statistics of every zone
+    are computed from these pixels by sorting them by zone and grouping with np.bincount, instead of rasterising
+    and reading each polygon separately.
+
+    Parameters
+    ----------
+    raster_path : str
+        the path to the raster to obtain the values from.
+    shapefile_path : str
+        the path to the shapefile which we will use as the "zones". Polygons are assumed not to overlap, as is the
+        case for the output of :py:func:`vectorise_from_band`.
+    report_bands : list[int]
+        the bands to run zonal statistics on.
+    log : logging.Logger
+        The logger object
+    mem_limit_mb : int, optional
+        the approximate memory ceiling in MB for each block of the raster that is read. Defaults to 1024.
+
+    Returns
+    -------
+    zstats_dfs : dict[int, pd.DataFrame]
+        A DataFrame of zonal statistics for each band in report_bands, with the same columns as those of
+        :py:func:`zonal_statistics`. Each is also written to a csv next to the raster. Zones without any valid pixels
+        have a count of 0 and NaN statistics.
+
+    """
+
     from osgeo import gdal, ogr
     import numpy as np
-    import pandas as pd
     import os
-    import csv
     from tempfile import TemporaryDirectory
+    from pyeo_1.raster_manipulation import get_block_windows
 
     # enable gdal to raise exceptions
     gdal.UseExceptions()
 
     with TemporaryDirectory(dir=os.path.expanduser('~')) as td:
-        mem_driver = ogr.GetDriverByName("Memory")
-        mem_driver_gdal = gdal.GetDriverByName("MEM")
-        shp_name = "temp"
+        r_ds = gdal.Open(raster_path)
+        p_ds = ogr.Open(shapefile_path)
+        lyr = p_ds.GetLayer()
+        nodata = r_ds.GetRasterBand(1).GetNoDataValue()
+
+        # copy the polygons into a memory layer, labelling them 1..n in the order they are read
+        zones_ds = ogr.GetDriverByName("Memory").CreateDataSource("zones")
+        zones_lyr = zones_ds.CreateLayer("zones", srs=lyr.GetSpatialRef(), geom_type=ogr.wkbUnknown)
+        zones_lyr.CreateField(ogr.FieldDefn("zone", ogr.OFTInteger))
+        fids = []
+        for p_feat in lyr:
+            if p_feat.GetGeometryRef() is None:
+                continue
+            zone_feat = ogr.Feature(zones_lyr.GetLayerDefn())
+            zone_feat.SetGeometry(p_feat.GetGeometryRef())
+            zone_feat.SetField("zone", len(fids) + 1)
+            zones_lyr.CreateFeature(zone_feat)
+            fids.append(p_feat.GetFID())
+        log.info(f"Calculating zonal statistics of {len(fids)} polygons over bands {report_bands}")
+
+        # burn all zones in one go; the label raster is mostly zeros so it compresses well on disk
+        label_ds = gdal.GetDriverByName("GTiff").Create(
+            os.path.join(td, "zones.tif"),
+            r_ds.RasterXSize,
+            r_ds.RasterYSize,
+            1,
+            gdal.GDT_Int32,
+            options=["COMPRESS=DEFLATE"],
+        )
+        label_ds.SetGeoTransform(r_ds.GetGeoTransform())
+        label_ds.SetProjection(r_ds.GetProjection())
+        gdal.RasterizeLayer(label_ds, [1], zones_lyr, options=["ATTRIBUTE=zone"])
+        label_band = label_ds.GetRasterBand(1)
+
+        # read the zone labels and band values of all pixels inside a zone, block by block
+        zone_chunks = []
+        value_chunks = {report_band: [] for report_band in report_bands}
+        windows = get_block_windows(
+            r_ds,
+            mem_limit=int(mem_limit_mb * 1024 * 1024),
+            bytes_per_pixel=5 + 8 * len(report_bands),
+        )
+        for xoff, yoff, xsize, ysize in windows:
+            labels = label_band.ReadAsArray(xoff, yoff, xsize, ysize)
+            inside = labels > 0
+            if not inside.any():
+                continue
+            zone_chunks.append(labels[inside])
+            for report_band in report_bands:
+                r_array = r_ds.GetRasterBand(report_band).ReadAsArray(xoff, yoff, xsize, ysize)
+                value_chunks[report_band].append(r_array[inside])
+        label_band = None
+        label_ds = None
+        zones_ds = None
+
+        all_zones = np.concatenate(zone_chunks) if zone_chunks else np.zeros(0, dtype=np.int32)
+        zstats_dfs = {}
+        for report_band in report_bands:
+            if value_chunks[report_band]:
+                values = np.concatenate(value_chunks[report_band])
+            else:
+                values = np.zeros(0)
+            zstats_df = _zone_statistics(all_zones, values, nodata, fids, report_band)
+
+            fn_csv = f"{os.path.splitext(raster_path)[0]}_zstats_over_{band_naming(report_band, log=log)}.csv"
+            zstats_df.to_csv(fn_csv, index=False)
+            zstats_dfs[report_band] = zstats_df
+
+    return zstats_dfs
+
+
+def _zone_statistics(
+    all_zones,
+    values,
+    nodata,
+    fids: list,
+    report_band: int,
+) -> pd.DataFrame:
+    """
+    Calculates the statistics of setFeatureStats for every zone from the zone label (1..n) and value of each pixel
+    inside a zone, by sorting the pixels by zone and grouping with np.bincount.
 
-        fn_raster = raster_path
-        fn_zones = shapefile_path
+    Parameters
+    ----------
+    all_zones : np.ndarray
+        the zone label of each pixel, from 1 to len(fids)
+    values : np.ndarray
+        the value of each pixel
+    nodata : number or None
+        pixels with this value are left out
+    fids : list
+        the id of each zone, in label order
+    report_band : int
+        the band the values come from, used to name the columns
 
-        r_ds = gdal.Open(fn_raster)
-        p_ds = ogr.Open(fn_zones)
+    Returns
+    -------
+    zstats_df : pd.DataFrame
+        one row of statistics per zone
 
-        # lyr = shapefile layer
-        lyr = p_ds.GetLayer()
-        # get projection to apply to temporary files
-        proj = lyr.GetSpatialRef()
-        geot = r_ds.GetGeoTransform()
-        nodata = r_ds.GetRasterBand(1).GetNoDataValue()
+    """
+    import numpy as np
 
-        zstats = []
-
-        # p_feat = polygon feature
-        p_feat = lyr.GetNextFeature()
-        niter = 0
-
-        # while lyr.GetNextFeature() returns a polygon feature, do the following:
-        while p_feat:
-            try:
-                # if a geometry is returned from p_feat, do the following:
-                if p_feat.GetGeometryRef() is not None:
-                    if os.path.exists(shp_name):
-                        mem_driver.DeleteDataSource(shp_name)
-
-                    # tp_ds = temporary datasource
-                    tp_ds = mem_driver.CreateDataSource(shp_name)
-                    tp_lyr = tp_ds.CreateLayer(
-                        "polygons", srs=proj, geom_type=ogr.wkbPolygon
-                    )
-                    tp_lyr.CreateFeature(p_feat.Clone())
-                    offsets = boundingBoxToOffsets(
-                        p_feat.GetGeometryRef().GetEnvelope(), geot
-                    )
-                    new_geot = geotFromOffsets(offsets[0], offsets[2], geot)
-
-                    # tr_ds = target datasource
-                    tr_ds = mem_driver_gdal.Create(
-                        "",
-                        offsets[3] - offsets[2],
-                        offsets[1] - offsets[0],
-                        1,
-                        gdal.GDT_Byte,
-                    )
-
-                    tr_ds.SetGeoTransform(new_geot)
-                    gdal.RasterizeLayer(tr_ds, [1], tp_lyr, burn_values=[1])
-                    tr_array = tr_ds.ReadAsArray()
-
-                    r_array = r_ds.GetRasterBand(report_band).ReadAsArray(
-                        offsets[2],
-                        offsets[0],
-                        offsets[3] - offsets[2],
-                        offsets[1] - offsets[0],
-                    )
-
-                    # get identifier for
-                    id = p_feat.GetFID()
-
-                    # if raster array was successfully read, do the following:
-                    if r_array is not None:
-                        maskarray = np.ma.MaskedArray(
-                            r_array,
-                            mask=np.logical_or(
-                                r_array == nodata, np.logical_not(tr_array)
-                            ),
-                        )
-
-                        if maskarray is not None:
-                            zstats.append(
-                                setFeatureStats(
-                                    id,
-                                    maskarray.min(),
-                                    maskarray.max(),
-                                    maskarray.mean(),
-                                    np.ma.median(maskarray),
-                                    maskarray.std(),
-                                    maskarray.sum(),
-                                    maskarray.count(),
-                                    report_band=report_band,
-                                )
-                            )
-                        else:
-                            zstats.append(
-                                setFeatureStats(
-                                    id,
-                                    nodata,
-                                    nodata,
-                                    nodata,
-                                    nodata,
-                                    nodata,
-                                    nodata,
-                                    nodata,
-                                    report_band=report_band,
-                                )
-                            )
-                    else:
-                        zstats.append(
-                            setFeatureStats(
-                                id,
-                                nodata,
-                                nodata,
-                                nodata,
-                                nodata,
-                                nodata,
-                                nodata,
-                                nodata,
-                                report_band=report_band,
-                            )
-                        )
-
-                    # close temporary variables, resetting them for the next iteration
-                    tp_ds = None
-                    tp_lyr = None
-                    tr_ds = None
-
-                    # once there are no more features to retrieve, p_feat will return as None, exiting the loop
-                    p_feat = lyr.GetNextFeature()
-
-            except RuntimeError as error:
-                print(error)
-
-        fn_csv = f"{os.path.splitext(raster_path)[0]}_zstats_over_{band_naming(report_band, log=log)}.csv"
-        col_names = zstats[0].keys()
-
-        zstats_df = pd.DataFrame(data=zstats, columns=col_names)
-
-        with open(fn_csv, "w", newline="") as csvfile:
-            writer = csv.DictWriter(csvfile, col_names)
-            writer.writeheader()
-            writer.writerows(zstats)
-
-    return zstats_df
+    n_zones = len(fids)
+    valid = values != nodata if nodata is not None else np.ones(values.shape, dtype=bool)
+    zones = all_zones[valid]
+    values = values[valid]
+
+    # sort by zone, then by value, so that each zone is a contiguous, ordered run of values
+    order = np.lexsort((values, zones))
+    zones = zones[order]
+    values = values[order]
+    float_values = values.astype(np.float64)
+
+    count = np.bincount(zones, minlength=n_zones + 1)[1:]
+    has_pixels = count > 0
+    ends = np.cumsum(count)
+    starts = ends - count
+    last = max(values.size - 1, 0)
+
+    sums = np.bincount(zones, weights=float_values, minlength=n_zones + 1)[1:]
+    mean = np.full(n_zones, np.nan)
+    np.divide(sums, count, out=mean, where=has_pixels)
+    deviations = float_values - mean[zones - 1]
+    variance = np.full(n_zones, np.nan)
+    np.divide(
+        np.bincount(zones, weights=deviations * deviations, minlength=n_zones + 1)[1:],
+        count,
+        out=variance,
+        where=has_pixels,
+    )
+    sd = np.sqrt(variance)
+    if np.issubdtype(values.dtype, np.integer):
+        sums = sums.astype(np.int64)
+
+    median = np.full(n_zones, np.nan)
+    if values.size > 0:
+        lower = np.minimum(starts + (count - 1) // 2, last)
+        upper = np.minimum(starts + count // 2, last)
+        median[has_pixels] = ((float_values[lower] + float_values[upper]) / 2)[has_pixels]
+
+    # min and max keep the data type of the raster, as with the masked array statistics they replace
+    zstats = [
+        setFeatureStats(
+            fids[i],
+            values[starts[i]] if has_pixels[i] else np.nan,
+            values[ends[i] - 1] if has_pixels[i] else np.nan,
+            mean[i],
+            median[i],
+            sd[i],
+            sums[i],
+            count[i],
+            report_band=report_band,
+        )
+        for i in range(n_zones)
+    ]
+    # keep the columns of setFeatureStats even when there are no zones
+    col_names = setFeatureStats(
+        None, None, None, None, None, None, None, None, report_band=report_band
+    ).keys()
+    return pd.DataFrame(data=zstats, columns=col_names)
 
 
 def merge_and_calculate_spatial(